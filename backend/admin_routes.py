@@ -1,17 +1,18 @@
 """
 Admin routes per gestionar continguts del backoffice
 """
-from fastapi import APIRouter, HTTPException, Header, UploadFile, File, Form
+from fastapi import APIRouter, HTTPException, Header, UploadFile, File, Form, Request
 from fastapi.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime
+from datetime import datetime, timedelta
 from typing import Optional, List
 from pydantic import BaseModel, Field
 from bson import ObjectId
 import os
+import re
+import asyncio
 import pandas as pd
 import tempfile
-import base64
 import io
 from openpyxl import Workbook
 from dotenv import load_dotenv
@@ -21,9 +22,27 @@ from participation_tracker import (
     get_users_by_tag,
     get_participation_stats
 )
-from push_notifications import send_push_notification
 from email_service import send_welcome_email
-from web_push_service import send_web_push_to_many
+from broadcast_jobs import enqueue_broadcast, get_job, list_jobs
+from auth_cache import resolve_user, invalidate_user, get_auth_cache_stats
+from db_indexes import ensure_indexes, explain_hot_queries
+from geo import with_location, sync_location
+from search_index import get_search_stats
+from blob_store import put_blob, blob_url, get_blob_stats
+from static_assets import get_static_stats
+from scheduler import get_scheduler_status, run_job_now
+from audience_segments import audience_segments, get_segment_stats, PUSH_QUERY
+from live_events import get_live_stats
+from stats_rollups import (
+    get_dashboard_rollup, get_daily_rollups, reconcile_rollups, month_key, record_signups, record_news
+)
+from pagination import paginated_response
+from data_loader import DataLoaders
+from response_cache import (
+    invalidate_catalogue,
+    get_catalogue_cache_stats,
+    ESTABLISHMENTS, OFFERS, EVENTS, NEWS, CLUB
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -48,6 +67,7 @@ class NotificationResponse(BaseModel):
     sent_count: int
     failed_count: int
     message: str
+    job_id: Optional[str] = None
 
 # Models de Rols
 class RoleBase(BaseModel):
@@ -216,30 +236,13 @@ async def verify_admin(authorization: str = Header(None)):
     if not authorization:
         raise HTTPException(status_code=401, detail="No autoritzat")
     
-    # Suportar diferents formats de token
-    token = authorization.replace("Bearer ", "").replace("token_", "")
+    user = await resolve_user(db, authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Token invàlid")
     
-    try:
-        # Primer intentar buscar per token directament
-        user = await db.users.find_one({"token": token})
-        if user:
-            if user.get('role') != 'admin':
-                raise HTTPException(status_code=403, detail="Accés denegat - només administradors")
-            return user
-        
-        # Si no es troba, intentar buscar per _id
-        try:
-            user = await db.users.find_one({"_id": ObjectId(token)})
-            if user:
-                if user.get('role') != 'admin':
-                    raise HTTPException(status_code=403, detail="Accés denegat - només administradors")
-                return user
-        except:
-            pass
-    except Exception:
-        pass
-    
-    raise HTTPException(status_code=401, detail="Token invàlid")
+    if user.get('role') != 'admin':
+        raise HTTPException(status_code=403, detail="Accés denegat - només administradors")
+    return user
 
 # ============================================================================
 # ESTABLIMENTS - Admin CRUD
@@ -256,8 +259,10 @@ async def create_establishment(
     establishment_dict = establishment.dict()
     establishment_dict['created_at'] = datetime.utcnow()
     establishment_dict['updated_at'] = datetime.utcnow()
+    with_location(establishment_dict)
     
     result = await db.establishments.insert_one(establishment_dict)
+    invalidate_catalogue(ESTABLISHMENTS)
     establishment_dict['_id'] = str(result.inserted_id)
     
     return establishment_dict
@@ -285,6 +290,7 @@ async def assign_owner_to_establishment(
             "updated_at": datetime.utcnow()
         }}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Establiment no trobat")
@@ -295,6 +301,7 @@ async def assign_owner_to_establishment(
             {"_id": user['_id']},
             {"$set": {"role": "local_associat"}}
         )
+        invalidate_user(user['_id'])
     
     updated = await db.establishments.find_one({"_id": ObjectId(establishment_id)})
     updated['_id'] = str(updated['_id'])
@@ -325,10 +332,14 @@ async def update_establishment(
         {"_id": ObjectId(establishment_id)},
         {"$set": update_data}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Establiment no trobat")
     
+    if "latitude" in update_data or "longitude" in update_data:
+        await sync_location(db, ObjectId(establishment_id))
+    
     updated = await db.establishments.find_one({"_id": ObjectId(establishment_id)})
     updated['_id'] = str(updated['_id'])
     
@@ -340,23 +351,35 @@ async def update_establishment(
     
     return updated
 
+# Camps que mostra i edita el backoffice d'establiments
+ADMIN_ESTABLISHMENT_PROJECTION = {field: 1 for field in [
+    "name", "commercial_name", "description", "category", "subcategory",
+    "address", "postal_code", "phone", "whatsapp", "website", "email", "nif",
+    "image_url", "latitude", "longitude", "external_id", "partner_id",
+    "google_maps_url", "video_url", "video_url_2", "social_media",
+    "establishment_type", "collaboration_type", "status", "visible_in_public_list",
+    "owner_id", "establishment_code", "created_at", "updated_at",
+]}
+
 @admin_router.get("/establishments")
 async def get_all_establishments_admin(
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    format: Optional[str] = None
 ):
-    """Obtenir TOTS els establiments (incloent tancats) per a administradors"""
+    """
+    Obtenir TOTS els establiments (incloent tancats) per a administradors.
+    Amb limit/cursor retorna una pàgina; amb format=ndjson fa streaming.
+    """
     await verify_admin(authorization)
     
     # Retornar tots els establiments sense filtrar per visible_in_public_list
-    establishments = await db.establishments.find({}).to_list(1000)
-    
-    for est in establishments:
-        est['_id'] = str(est['_id'])
-        est['id'] = est['_id']
-        if est.get('owner_id'):
-            est['owner_id'] = str(est['owner_id'])
-    
-    return establishments
+    return await paginated_response(
+        db.establishments, {},
+        limit=limit, cursor=cursor, format=format,
+        projection=ADMIN_ESTABLISHMENT_PROJECTION
+    )
 
 @admin_router.get("/establishments/{establishment_id}/owner")
 async def get_establishment_owner(
@@ -397,6 +420,7 @@ async def delete_establishment(
     await verify_admin(authorization)
     
     result = await db.establishments.delete_one({"_id": ObjectId(establishment_id)})
+    invalidate_catalogue(ESTABLISHMENTS)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Establiment no trobat")
@@ -445,6 +469,7 @@ async def create_offer(
                 offer_dict['valid_until'] = parser.parse(offer_dict['valid_until'])
     
     result = await db.offers.insert_one(offer_dict)
+    invalidate_catalogue(OFFERS)
     offer_dict['_id'] = str(result.inserted_id)
     
     return offer_dict
@@ -486,6 +511,7 @@ async def update_offer(
         {"_id": ObjectId(offer_id)},
         {"$set": update_data}
     )
+    invalidate_catalogue(OFFERS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Oferta no trobada")
@@ -504,6 +530,7 @@ async def delete_offer(
     await verify_admin(authorization)
     
     result = await db.offers.delete_one({"_id": ObjectId(offer_id)})
+    invalidate_catalogue(OFFERS)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Oferta no trobada")
@@ -516,25 +543,24 @@ async def delete_offer(
 
 @admin_router.get("/events")
 async def get_all_events(
-    authorization: str = Header(None)
+    authorization: str = Header(None),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    format: Optional[str] = None
 ):
     """Obtenir tots els esdeveniments (admin)"""
     await verify_admin(authorization)
     
     # Només retornar esdeveniments amb l'estructura nova (valid_from i valid_until)
-    events_cursor = db.events.find({
-        "valid_from": {"$exists": True},
-        "valid_until": {"$exists": True}
-    }).sort("valid_from", -1)
-    events = await events_cursor.to_list(length=None)
-    
-    for event in events:
-        event['_id'] = str(event['_id'])
-        event['id'] = str(event['_id'])
-        if event.get('establishment_id'):
-            event['establishment_id'] = str(event['establishment_id'])
-    
-    return events
+    return await paginated_response(
+        db.events,
+        {
+            "valid_from": {"$exists": True},
+            "valid_until": {"$exists": True}
+        },
+        limit=limit, cursor=cursor, format=format,
+        sort_field="valid_from"
+    )
 
 @admin_router.post("/events")
 async def create_event(
@@ -574,6 +600,7 @@ async def create_event(
                 event_dict['valid_until'] = parser.parse(event_dict['valid_until'])
     
     result = await db.events.insert_one(event_dict)
+    invalidate_catalogue(EVENTS, CLUB)
     event_id = str(result.inserted_id)
     event_dict['_id'] = event_id
     
@@ -637,6 +664,7 @@ async def update_event(
         {"_id": ObjectId(event_id)},
         {"$set": update_data}
     )
+    invalidate_catalogue(EVENTS, CLUB)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Esdeveniment no trobat")
@@ -655,6 +683,7 @@ async def delete_event(
     await verify_admin(authorization)
     
     result = await db.events.delete_one({"_id": ObjectId(event_id)})
+    invalidate_catalogue(EVENTS, CLUB)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Esdeveniment no trobat")
@@ -693,6 +722,8 @@ async def create_news(
     news_dict['updated_at'] = datetime.utcnow()
     
     result = await db.news.insert_one(news_dict)
+    invalidate_catalogue(NEWS)
+    await record_news()
     news_dict['_id'] = str(result.inserted_id)
     
     return news_dict
@@ -713,6 +744,7 @@ async def update_news(
         {"_id": ObjectId(news_id)},
         {"$set": update_data}
     )
+    invalidate_catalogue(NEWS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Notícia no trobada")
@@ -731,6 +763,7 @@ async def delete_news(
     await verify_admin(authorization)
     
     result = await db.news.delete_one({"_id": ObjectId(news_id)})
+    invalidate_catalogue(NEWS)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Notícia no trobada")
@@ -741,23 +774,29 @@ async def delete_news(
 # ESTABLIMENTS - Admin gestió
 # ============================================================================
 
-@admin_router.get("/establishments")
-async def get_all_establishments_admin(authorization: str = Header(None)):
-    """Obtenir tots els establiments per a l'admin"""
-    await verify_admin(authorization)
-    
-    establishments = await db.establishments.find().to_list(1000)
-    for est in establishments:
-        est['_id'] = str(est['_id'])
-        est['id'] = str(est['_id'])
+def _local_associat_row(user: dict) -> dict:
+    # Determinar el rol principal a mostrar
+    role = user.get('role', 'user')
+    roles = user.get('roles', [])
+    if 'local_associat' in roles:
+        role = 'local_associat'
     
-    return establishments
+    return {
+        'id': str(user['_id']),
+        '_id': str(user['_id']),
+        'name': user.get('name', ''),
+        'email': user.get('email', ''),
+        'role': role
+    }
 
 
 @admin_router.get("/users/local-associats")
 async def get_local_associats(
     authorization: str = Header(None),
-    email: str = None
+    email: str = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    format: Optional[str] = None
 ):
     """Obtenir usuaris amb rol local_associat"""
     await verify_admin(authorization)
@@ -770,26 +809,14 @@ async def get_local_associats(
     }
     
     if email:
-        query["email"] = {"$regex": email, "$options": "i"}
+        query["email"] = {"$regex": re.escape(email), "$options": "i"}
     
-    users = await db.users.find(query).to_list(1000)
-    result = []
-    for user in users:
-        # Determinar el rol principal a mostrar
-        role = user.get('role', 'user')
-        roles = user.get('roles', [])
-        if 'local_associat' in roles:
-            role = 'local_associat'
-        
-        result.append({
-            'id': str(user['_id']),
-            '_id': str(user['_id']),
-            'name': user.get('name', ''),
-            'email': user.get('email', ''),
-            'role': role
-        })
-    
-    return result
+    return await paginated_response(
+        db.users, query,
+        limit=limit, cursor=cursor, format=format,
+        projection={"name": 1, "email": 1, "role": 1, "roles": 1},
+        transform=_local_associat_row
+    )
 
 
 class AssignOwnerRequest(BaseModel):
@@ -813,6 +840,7 @@ async def assign_establishment_owner(
             {"_id": ObjectId(establishment_id)},
             {"$unset": {"owner_id": ""}}
         )
+        invalidate_catalogue(ESTABLISHMENTS)
         return {"success": True, "message": "Propietari desassignat"}
     
     # Verificar que l'usuari existeix
@@ -825,12 +853,14 @@ async def assign_establishment_owner(
         {"_id": ObjectId(establishment_id)},
         {"$set": {"owner_id": ObjectId(owner_id)}}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     # Assignar establiment a l'usuari
     await db.users.update_one(
         {"_id": ObjectId(owner_id)},
         {"$set": {"establishment_id": establishment_id}}
     )
+    invalidate_user(owner_id)
     
     return {"success": True, "message": f"Propietari assignat correctament a {user.get('name')}"}
 
@@ -862,10 +892,12 @@ async def get_all_users(
     
     # Filtre per cerca
     if search:
+        # Text literal: sense escapar, "." o "(" canviaven la consulta o la feien fallar
+        search_pattern = re.escape(search.strip())
         search_query = {
             "$or": [
-                {"email": {"$regex": search, "$options": "i"}},
-                {"name": {"$regex": search, "$options": "i"}}
+                {"email": {"$regex": search_pattern, "$options": "i"}},
+                {"name": {"$regex": search_pattern, "$options": "i"}}
             ]
         }
         if query:
@@ -876,19 +908,19 @@ async def get_all_users(
     # Obtenir total
     total = await db.users.count_documents(query)
     
-    # Obtenir usuaris paginats
-    users = await db.users.find(query).skip(skip).limit(limit).to_list(limit)
+    # Obtenir usuaris paginats (sense password)
+    users = await db.users.find(query, {"password": 0}).skip(skip).limit(limit).to_list(limit)
+    
+    # Establiments dels usuaris de la pàgina (una sola consulta)
+    loaders = DataLoaders(db)
+    establishments_by_owner = await loaders.establishments_by_owner.load_many(u['_id'] for u in users)
     
     # Enriquir usuaris amb nom d'establiment (si són propietaris)
     for user in users:
         user['id'] = str(user['_id'])
-        user_oid = user['_id']
         user['_id'] = str(user['_id'])
-        # No retornar password
-        user.pop('password', None)
         
-        # Buscar si l'usuari és propietari d'algun establiment
-        establishment = await db.establishments.find_one({"owner_id": user_oid})
+        establishment = establishments_by_owner.get(user['_id'])
         if establishment:
             user['establishment_name'] = establishment.get('name', '')
             user['establishment_id'] = str(establishment.get('_id', ''))
@@ -969,6 +1001,7 @@ async def create_user_with_establishment(
     
     result = await db.users.insert_one(new_user)
     user_id = result.inserted_id
+    await record_signups()
     
     # Si s'ha especificat un establiment, assignar-lo
     if establishment_id and role == "local_associat":
@@ -979,6 +1012,7 @@ async def create_user_with_establishment(
                 "updated_at": datetime.utcnow()
             }}
         )
+        invalidate_catalogue(ESTABLISHMENTS)
     
     return {
         "success": True,
@@ -1047,6 +1081,7 @@ async def update_user(
         {"_id": ObjectId(user_id)},
         {"$set": update_data}
     )
+    invalidate_user(user_id)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Usuari no trobat")
@@ -1070,6 +1105,7 @@ async def delete_user(
         raise HTTPException(status_code=400, detail="No pots eliminar el teu propi compte")
     
     result = await db.users.delete_one({"_id": ObjectId(user_id)})
+    invalidate_user(user_id)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Usuari no trobat")
@@ -1202,44 +1238,47 @@ async def get_all_gift_cards(
 # PUJADA D'IMATGES
 # ============================================================================
 
-@admin_router.post("/upload-image", response_model=ImageUploadResponse)
-async def upload_image(
-    file: UploadFile = File(...),
-    authorization: str = Header(None)
-):
-    """Pujar una imatge (com a base64 per simplicitat)"""
-    await verify_admin(authorization)
-    
-    # Llegir fitxer
+async def _store_uploaded_image(request: Request, file: UploadFile, uploaded_by: Optional[str] = None) -> ImageUploadResponse:
+    """Desar la imatge al magatzem de fitxers i registrar-la a db.images"""
     contents = await file.read()
-    
-    # Convertir a base64
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    
-    # Determinar el mime type
     content_type = file.content_type or 'image/jpeg'
-    
-    # Crear data URL
-    data_url = f"data:{content_type};base64,{base64_image}"
-    
-    # Guardar a MongoDB per referència futura
+    if not content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="El fitxer ha de ser una imatge")
+
+    # Una sola còpia per contingut: tornar a pujar la mateixa imatge no ocupa més espai
+    blob = await put_blob(contents, content_type, filename=file.filename, uploaded_by=uploaded_by)
+    url = blob_url(blob["id"], str(request.base_url))
+
+    # Guardar a MongoDB per referència futura (només la referència, no el contingut)
     image_doc = {
         "filename": file.filename,
         "content_type": content_type,
-        "data_url": data_url,
+        "blob_id": blob["id"],
+        "url": url,
+        "size": blob["size"],
         "uploaded_at": datetime.utcnow()
     }
-    
-    result = await db.images.insert_one(image_doc)
-    
-    return ImageUploadResponse(
-        url=data_url,
-        filename=file.filename
-    )
+    if uploaded_by:
+        image_doc["uploaded_by"] = uploaded_by
+    await db.images.insert_one(image_doc)
+
+    return ImageUploadResponse(url=url, filename=file.filename)
+
+
+@admin_router.post("/upload-image", response_model=ImageUploadResponse)
+async def upload_image(
+    request: Request,
+    file: UploadFile = File(...),
+    authorization: str = Header(None)
+):
+    """Pujar una imatge; retorna la URL del fitxer (/api/blobs/{sha256})"""
+    await verify_admin(authorization)
+    return await _store_uploaded_image(request, file)
 
 
 @admin_router.post("/local-associat/upload-image", response_model=ImageUploadResponse)
 async def upload_image_local(
+    request: Request,
     file: UploadFile = File(...),
     authorization: str = Header(None)
 ):
@@ -1247,8 +1286,7 @@ async def upload_image_local(
     if not authorization:
         raise HTTPException(status_code=401, detail="Token no proporcionat")
     
-    token = authorization.replace('Bearer ', '')
-    user = await db.users.find_one({"token": token})
+    user = await resolve_user(db, authorization)
     
     if not user:
         raise HTTPException(status_code=401, detail="Usuari no trobat")
@@ -1256,33 +1294,7 @@ async def upload_image_local(
     if user.get('role') not in ['local_associat', 'admin']:
         raise HTTPException(status_code=403, detail="Accés denegat")
     
-    # Llegir fitxer
-    contents = await file.read()
-    
-    # Convertir a base64
-    base64_image = base64.b64encode(contents).decode('utf-8')
-    
-    # Determinar el mime type
-    content_type = file.content_type or 'image/jpeg'
-    
-    # Crear data URL
-    data_url = f"data:{content_type};base64,{base64_image}"
-    
-    # Guardar a MongoDB per referència futura
-    image_doc = {
-        "filename": file.filename,
-        "content_type": content_type,
-        "data_url": data_url,
-        "uploaded_at": datetime.utcnow(),
-        "uploaded_by": str(user['_id'])
-    }
-    
-    result = await db.images.insert_one(image_doc)
-    
-    return ImageUploadResponse(
-        url=data_url,
-        filename=file.filename
-    )
+    return await _store_uploaded_image(request, file, uploaded_by=str(user['_id']))
 
 
 # ============================================================================
@@ -1398,7 +1410,7 @@ async def import_establishments_excel(
                 establishment = {k: v for k, v in establishment.items() if v and str(v) != 'nan'}
                 
                 # Insertar
-                await db.establishments.insert_one(establishment)
+                await db.establishments.insert_one(with_location(establishment))
                 imported += 1
                 
             except Exception as e:
@@ -1408,6 +1420,9 @@ async def import_establishments_excel(
         # Eliminar fitxer temporal
         os.unlink(tmp_path)
         
+        if imported:
+            invalidate_catalogue(ESTABLISHMENTS)
+        
         return {
             "success": True,
             "imported": imported,
@@ -1433,10 +1448,103 @@ async def get_stats(authorization: str = Header(None)):
         "active_gift_cards": await db.gift_cards.count_documents({"status": "active"}),
         "ticket_scans": await db.ticket_scans.count_documents({})
     }
-    
+
     return stats
 
 
+@admin_router.get("/system/auth-cache")
+async def get_auth_cache_status(authorization: str = Header(None)):
+    """Obtenir els comptadors de la cache d'autenticació (hits/misses)"""
+    await verify_admin(authorization)
+    return get_auth_cache_stats()
+
+
+@admin_router.get("/system/catalogue-cache")
+async def get_catalogue_cache_status(authorization: str = Header(None)):
+    """Obtenir l'estat de la cache de respostes del catàleg públic"""
+    await verify_admin(authorization)
+    return get_catalogue_cache_stats()
+
+
+@admin_router.get("/system/search-index")
+async def get_search_index_stats(authorization: str = Header(None)):
+    """Mida i estat dels índexs del cercador"""
+    await verify_admin(authorization)
+    return get_search_stats()
+
+
+@admin_router.get("/system/blobs")
+async def get_blob_store_stats(authorization: str = Header(None)):
+    """Nombre i mida dels fitxers del magatzem (públics i privats)"""
+    await verify_admin(authorization)
+    return await get_blob_stats()
+
+
+@admin_router.get("/system/static-assets")
+async def get_static_assets_stats(authorization: str = Header(None)):
+    """Fitxers estàtics preparats i variants comprimides en memòria"""
+    await verify_admin(authorization)
+    return get_static_stats()
+
+
+@admin_router.get("/system/segments")
+async def get_segments_stats(authorization: str = Header(None)):
+    """Segments d'audiència en memòria (usuaris, segments per tipus, antiguitat)"""
+    await verify_admin(authorization)
+    return get_segment_stats()
+
+
+@admin_router.get("/system/live")
+async def get_live_events_stats(authorization: str = Header(None)):
+    """Canal en directe d'aquest worker (connexions, latència de distribució, descartats)"""
+    await verify_admin(authorization)
+    return get_live_stats()
+
+
+@admin_router.get("/system/news-sources")
+async def get_news_sources(authorization: str = Header(None)):
+    """Estat de l'última consulta de cada font de notícies (latència, notícies, 304)"""
+    await verify_admin(authorization)
+    sources = await db.news_sources.find({}).sort("_id", 1).to_list(100)
+    for source in sources:
+        source['id'] = source['_id']
+    return sources
+
+
+@admin_router.get("/system/scheduler")
+async def get_scheduler(limit: int = 50, authorization: str = Header(None)):
+    """Líder actual, tasques programades i últimes execucions amb la durada"""
+    await verify_admin(authorization)
+    return await get_scheduler_status(min(max(limit, 1), 500))
+
+
+@admin_router.post("/system/scheduler/{job_id}/run")
+async def run_scheduled_job(job_id: str, authorization: str = Header(None)):
+    """Executar una tasca programada ara (la fa el worker líder al pròxim cicle)"""
+    await verify_admin(authorization)
+    if not await run_job_now(job_id):
+        raise HTTPException(status_code=404, detail="Tasca no trobada")
+    return {"success": True, "message": "La tasca s'executarà en uns segons"}
+
+
+@admin_router.post("/system/indexes")
+async def sync_indexes(authorization: str = Header(None)):
+    """Crear els índexs declarats que falten i retornar les diferències"""
+    await verify_admin(authorization)
+    return await ensure_indexes(db)
+
+
+@admin_router.get("/system/query-plans")
+async def get_query_plans(authorization: str = Header(None)):
+    """Executar explain() de les consultes freqüents i marcar els COLLSCAN"""
+    await verify_admin(authorization)
+    plans = await explain_hot_queries(db)
+    return {
+        "collscans": [p["name"] for p in plans if p.get("collscan")],
+        "plans": plans
+    }
+
+
 # ============================================
 # ENDPOINTS PER GESTIÓ DE MARCADORS (TAGS)
 # ============================================
@@ -1543,22 +1651,22 @@ async def export_establishments_emails(authorization: str = Header(None)):
     """
     await verify_admin(authorization)
     
-    # Obtenir tots els establiments amb email
-    establishments = await db.establishments.find(
-        {"email": {"$exists": True, "$ne": None, "$ne": ""}}
-    ).to_list(length=None)
+    # Obtenir tots els establiments amb email (només els camps necessaris)
+    establishments = db.establishments.find(
+        {"email": {"$exists": True, "$nin": [None, ""]}},
+        {"name": 1, "email": 1}
+    ).batch_size(500)
     
-    # Crear Excel amb openpyxl
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Correus Establiments"
+    # Crear Excel amb openpyxl (mode write_only: les files no es queden en memòria)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Correus Establiments")
     
     # Headers
     headers = ["Nom", "Correu Electrònic"]
     ws.append(headers)
     
     # Dades
-    for establishment in establishments:
+    async for establishment in establishments:
         row = [
             establishment.get("name", ""),
             establishment.get("email", "")
@@ -1612,6 +1720,9 @@ async def fix_hosteleria_spelling(authorization: str = Header(None)):
                 "new": new_category
             })
     
+    if corrected_count:
+        invalidate_catalogue(ESTABLISHMENTS)
+    
     return {
         "success": True,
         "corrected_count": corrected_count,
@@ -1642,9 +1753,11 @@ async def delete_user_by_email(email: str, authorization: str = Header(None)):
         {"owner_id": user_id},
         {"$set": {"owner_id": None, "updated_at": datetime.utcnow()}}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     # Esborrar l'usuari
     result = await db.users.delete_one({"_id": user_id})
+    invalidate_user(user_id)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=500, detail="No s'ha pogut esborrar l'usuari")
@@ -1683,6 +1796,9 @@ async def cleanup_descriptions():
                 )
                 updated_count += 1
     
+    if updated_count:
+        invalidate_catalogue(ESTABLISHMENTS)
+    
     return {
         "success": True,
         "message": f"S'han netejat {updated_count} descripcions d'establiments",
@@ -1698,149 +1814,98 @@ async def get_statistics(authorization: str = Header(None)):
     """Obtenir estadístiques generals de l'aplicació"""
     await verify_admin(authorization)
     
-    from datetime import datetime, timedelta
     from dateutil.relativedelta import relativedelta
     
     now = datetime.utcnow()
-    start_of_month = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-    start_of_quarter = now.replace(month=((now.month - 1) // 3) * 3 + 1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    start_of_year = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-    last_month = start_of_month - timedelta(days=1)
-    start_of_last_month = last_month.replace(day=1)
+    this_month = month_key(now)
+    last_month = month_key(now - relativedelta(months=1))
+    quarter_months = [month_key(now - relativedelta(months=i)) for i in range((now.month - 1) % 3 + 1)]
+    year_months = [month_key(now - relativedelta(months=i)) for i in range(now.month)]
+    
+    # Comptadors materialitzats (un sol document); el primer cop es calculen ara
+    rollup = await get_dashboard_rollup()
+    if rollup is None:
+        await reconcile_rollups()
+        rollup = await get_dashboard_rollup()
+    months = rollup["months"]
+    
+    def monthly(key: str, month_list) -> int:
+        return sum(months.get(month, {}).get(key, 0) for month in month_list)
+    
+    # Recomptes en viu (amb gestió d'errors si la col·lecció no existeix), tots alhora
+    live_counts = await asyncio.gather(
+        db.users.count_documents({}),
+        db.establishments.count_documents({}),
+        db.establishments.count_documents({"is_active": True}),
+        db.events.count_documents({}),
+        db.events.count_documents({"valid_until": {"$gte": now}}),
+        db.events.count_documents({"valid_from": {"$gte": now}}),
+        db.raffles.count_documents({}),
+        db.raffles.count_documents({"end_date": {"$gte": now}, "status": "active"}),
+        db.news.count_documents({}),
+        return_exceptions=True,
+    )
+    (total_users, total_establishments, active_establishments, total_events, active_events,
+     upcoming_events, total_raffles, active_raffles, total_news) = [
+        0 if isinstance(count, Exception) else count for count in live_counts
+    ]
     
     # Estadístiques d'usuaris
-    total_users = await db.users.count_documents({})
-    users_this_month = await db.users.count_documents({"created_at": {"$gte": start_of_month}})
-    users_last_month = await db.users.count_documents({
-        "created_at": {"$gte": start_of_last_month, "$lt": start_of_month}
-    })
-    users_this_quarter = await db.users.count_documents({"created_at": {"$gte": start_of_quarter}})
-    users_this_year = await db.users.count_documents({"created_at": {"$gte": start_of_year}})
+    users_this_month = monthly("signups", [this_month])
+    users_last_month = monthly("signups", [last_month])
+    users_this_quarter = monthly("signups", quarter_months)
+    users_this_year = monthly("signups", year_months)
     
     # Calcular creixement mensual
     monthly_growth = 0
     if users_last_month > 0:
         monthly_growth = round(((users_this_month - users_last_month) / users_last_month) * 100, 1)
     
-    # Estadístiques d'establiments
-    total_establishments = await db.establishments.count_documents({})
-    active_establishments = await db.establishments.count_documents({"is_active": True})
-    
-    # Estadístiques d'esdeveniments
-    total_events = await db.events.count_documents({})
-    active_events = 0
-    upcoming_events = 0
-    try:
-        active_events = await db.events.count_documents({"valid_until": {"$gte": now}})
-        upcoming_events = await db.events.count_documents({"valid_from": {"$gte": now}})
-    except Exception:
-        pass
-    
-    # Estadístiques de promocions (amb gestió d'errors si la col·lecció no existeix)
-    total_promotions = 0
-    approved_promotions = 0
-    pending_promotions = 0
-    try:
-        total_promotions = await db.promotions.count_documents({})
-        approved_promotions = await db.promotions.count_documents({"status": "approved"})
-        pending_promotions = await db.promotions.count_documents({"status": "pending"})
-    except Exception:
-        pass
-    
-    # Estadístiques de participació (amb gestió d'errors si la col·lecció no existeix)
-    total_participations = 0
-    participations_this_month = 0
-    active_users = 0
+    # Estadístiques de promocions
+    promotions_by_status = rollup["promotions_by_status"]
+    total_promotions = sum(promotions_by_status.values())
+    approved_promotions = promotions_by_status.get("approved", 0)
+    pending_promotions = promotions_by_status.get("pending", 0)
+    
+    # Estadístiques de participació
+    total_participations = rollup.get("participations", 0)
+    participations_this_month = monthly("participations", [this_month])
+    active_users = rollup.get("active_users", 0)
+    participation_by_type = dict(sorted(
+        rollup["participations_by_type"].items(), key=lambda item: item[1], reverse=True
+    ))
+    
+    # Top 5 esdeveniments per participació (una sola consulta per als títols)
+    top_events_data = sorted(rollup["participations_by_event"].items(), key=lambda item: item[1], reverse=True)[:5]
+    events_by_id = await DataLoaders(db).events.load_many(event_id for event_id, _ in top_events_data)
     top_events = []
-    top_tags = []
-    participation_by_type = {}
+    for event_id, count in top_events_data:
+        event = events_by_id.get(event_id)
+        if event:
+            top_events.append({
+                "name": event.get("title", "Desconegut"),
+                "participations": count
+            })
     
-    try:
-        total_participations = await db.participations.count_documents({})
-        participations_this_month = await db.participations.count_documents({
-            "created_at": {"$gte": start_of_month}
-        })
-        
-        # Usuaris actius (amb almenys una participació)
-        active_users_pipeline = [
-            {"$group": {"_id": "$user_id"}},
-            {"$count": "total"}
-        ]
-        active_users_result = await db.participations.aggregate(active_users_pipeline).to_list(length=1)
-        active_users = active_users_result[0]["total"] if active_users_result else 0
-        
-        # Top 5 esdeveniments per participació
-        top_events_pipeline = [
-            {"$match": {"activity_type": "event"}},
-            {"$group": {"_id": "$activity_id", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
-        top_events_data = await db.participations.aggregate(top_events_pipeline).to_list(length=5)
-        
-        for item in top_events_data:
-            if item.get("_id"):
-                try:
-                    event = await db.events.find_one({"_id": ObjectId(item["_id"])})
-                    if event:
-                        top_events.append({
-                            "name": event.get("title", "Desconegut"),
-                            "participations": item["count"]
-                        })
-                except Exception:
-                    pass
-        
-        # Marcadors més populars
-        top_tags_pipeline = [
-            {"$match": {"tag": {"$exists": True, "$ne": None}}},
-            {"$group": {"_id": "$tag", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}},
-            {"$limit": 5}
-        ]
-        top_tags_data = await db.participations.aggregate(top_tags_pipeline).to_list(length=5)
-        top_tags = [{"tag": item["_id"], "count": item["count"]} for item in top_tags_data if item.get("_id")]
-        
-        # Participacions per tipus d'activitat
-        activity_types_pipeline = [
-            {"$match": {"activity_type": {"$exists": True, "$ne": None}}},
-            {"$group": {"_id": "$activity_type", "count": {"$sum": 1}}},
-            {"$sort": {"count": -1}}
-        ]
-        activity_types_data = await db.participations.aggregate(activity_types_pipeline).to_list(length=10)
-        participation_by_type = {item["_id"]: item["count"] for item in activity_types_data if item.get("_id")}
-    except Exception:
-        pass
+    # Marcadors més populars
+    top_tags = [
+        {"tag": tag, "count": count}
+        for tag, count in sorted(rollup["participations_by_tag"].items(), key=lambda item: item[1], reverse=True)[:5]
+    ]
     
     # Percentatge de participació
     participation_rate = round((active_users / total_users * 100), 1) if total_users > 0 else 0
     
-    # Estadístiques de sortejos (amb gestió d'errors si la col·lecció no existeix)
-    total_raffles = 0
-    active_raffles = 0
-    try:
-        total_raffles = await db.raffles.count_documents({})
-        active_raffles = await db.raffles.count_documents({
-            "end_date": {"$gte": now},
-            "status": "active"
-        })
-    except Exception:
-        pass
-    
     # Estadístiques de notícies
-    total_news = await db.news.count_documents({})
-    news_this_month = await db.news.count_documents({"created_at": {"$gte": start_of_month}})
+    news_this_month = monthly("news", [this_month])
     
     # Altes mensuals dels últims 6 mesos
     monthly_signups = []
     for i in range(5, -1, -1):
         month_start = (now - relativedelta(months=i)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        month_end = (month_start + relativedelta(months=1))
-        count = await db.users.count_documents({
-            "created_at": {"$gte": month_start, "$lt": month_end}
-        })
         monthly_signups.append({
             "month": month_start.strftime("%b %Y"),
-            "count": count
+            "count": monthly("signups", [month_key(month_start)])
         })
     
     return {
@@ -1889,6 +1954,15 @@ async def get_statistics(authorization: str = Header(None)):
     }
 
 
+@admin_router.get("/statistics/daily")
+async def get_daily_statistics(days: int = 30, authorization: str = Header(None)):
+    """Altes, participacions (per tipus i marcador) i notícies per dia"""
+    await verify_admin(authorization)
+    now = datetime.utcnow()
+    days = min(max(days, 1), 366)
+    return await get_daily_rollups(now - timedelta(days=days - 1), now)
+
+
 # ============================================================================
 # IMPORTACIÓ MASSIVA D'USUARIS
 # ============================================================================
@@ -2105,6 +2179,7 @@ async def import_users_bulk(
             
             try:
                 await db.users.insert_one(new_user)
+                await record_signups()
                 result.created += 1
                 
                 # Enviar email de benvinguda
@@ -2170,177 +2245,87 @@ async def download_import_template(authorization: str = Header(None)):
 # NOTIFICACIONS PUSH
 # ============================================================================
 
-@admin_router.post("/notifications/send", response_model=NotificationResponse)
-async def send_notification_to_users(
-    notification: NotificationRequest,
-    authorization: str = Header(None)
-):
+async def build_target_query(target: str) -> dict:
     """
-    Enviar notificació push a usuaris
-    
+    Consulta d'usuaris segons el target d'una notificació
+
     Targets disponibles:
-    - "all": Tots els usuaris amb push token
+    - "all": Tots els usuaris
     - "admins": Només administradors
     - "users": Només usuaris normals
     - "role:local_associat": Usuaris amb un rol específic
     - "tag:nadal2024": Usuaris amb un marcador específic
     - "campaign:ID": Participants d'una campanya de sorteig
     """
-    await verify_admin(authorization)
-    
+    query = {}
+
+    if target == "admins":
+        query["role"] = "admin"
+    elif target == "users":
+        # "users" = tots els usuaris que NO són admin ni local_associat
+        query["role"] = {"$nin": ["admin", "local_associat"]}
+    elif target == "local_associat":
+        query["role"] = "local_associat"
+    elif target.startswith("role:"):
+        role = target.split(":", 1)[1]
+        query["role"] = role
+    elif target.startswith("tag:"):
+        tag = target.split(":", 1)[1]
+        query["tags"] = tag
+    elif target.startswith("campaign:"):
+        # Obtenir participants d'una campanya de sorteig
+        user_ids_filter = await db.draw_participations.distinct(
+            "user_id", {"participations": {"$gt": 0}}
+        )
+        user_ids_filter = [uid for uid in user_ids_filter if uid]
+        query["_id"] = {"$in": [ObjectId(uid) if isinstance(uid, str) else uid for uid in user_ids_filter]}
+    # "all" no afegeix cap filtre addicional
+
+    return query
+
+
+@admin_router.post("/notifications/send", response_model=NotificationResponse)
+async def send_notification_to_users(
+    notification: NotificationRequest,
+    authorization: str = Header(None)
+):
+    """
+    Enviar notificació push a usuaris (veure build_target_query per als targets)
+
+    L'enviament es fa en segon pla: retorna l'ID del treball, i el progrés
+    es consulta a /notifications/jobs/{job_id}
+    """
+    admin = await verify_admin(authorization)
+
     try:
-        # Construir la consulta base segons el target (sense filtrar per push_token)
-        query = {}
-        user_ids_filter = None
-        
-        if notification.target == "admins":
-            query["role"] = "admin"
-        elif notification.target == "users":
-            # "users" = tots els usuaris que NO són admin ni local_associat
-            query["role"] = {"$nin": ["admin", "local_associat"]}
-        elif notification.target == "local_associat":
-            query["role"] = "local_associat"
-        elif notification.target.startswith("role:"):
-            role = notification.target.split(":", 1)[1]
-            query["role"] = role
-        elif notification.target.startswith("tag:"):
-            tag = notification.target.split(":", 1)[1]
-            query["tags"] = tag
-        elif notification.target.startswith("campaign:"):
-            # Obtenir participants d'una campanya de sorteig
-            campaign_id = notification.target.split(":", 1)[1]
-            participations = await db.draw_participations.find(
-                {"participations": {"$gt": 0}}
-            ).to_list(10000)
-            user_ids_filter = [p.get("user_id") for p in participations if p.get("user_id")]
-            if user_ids_filter:
-                query["_id"] = {"$in": [ObjectId(uid) if isinstance(uid, str) else uid for uid in user_ids_filter]}
-        # "all" no afegeix cap filtre addicional
-        
-        # Obtenir TOTS els usuaris que compleixen el filtre
-        users = await db.users.find(query).to_list(10000)
-        
-        if not users:
-            return NotificationResponse(
-                success=True,
-                sent_count=0,
-                failed_count=0,
-                message="No hi ha usuaris per aquest filtre"
-            )
-        
-        # ==============================
-        # 1. EXPO PUSH NOTIFICATIONS
-        # ==============================
-        expo_tokens = [
-            user.get("push_token") 
-            for user in users 
-            if user.get("push_token") and user.get("push_token").startswith("ExponentPushToken")
-        ]
-        
-        expo_sent = 0
-        expo_failed = 0
-        
-        if expo_tokens:
-            result = send_push_notification(
-                push_tokens=expo_tokens,
-                title=notification.title,
-                body=notification.body,
-                data=notification.data
-            )
-            
-            if isinstance(result, dict):
-                if "data" in result:
-                    for item in result.get("data", []):
-                        if item.get("status") == "ok":
-                            expo_sent += 1
-                        else:
-                            expo_failed += 1
-                elif "error" in result:
-                    expo_failed = len(expo_tokens)
-            else:
-                expo_sent = len(expo_tokens)  # Assumim que s'han enviat
-        
-        # ==============================
-        # 2. WEB PUSH NOTIFICATIONS
-        # ==============================
-        web_subscriptions = [
-            user.get("web_push_subscription") 
-            for user in users 
-            if user.get("web_push_subscription") and isinstance(user.get("web_push_subscription"), dict)
-        ]
-        
-        web_sent = 0
-        web_failed = 0
-        
-        if web_subscriptions:
-            web_result = send_web_push_to_many(
-                subscriptions=web_subscriptions,
-                title=notification.title,
-                body=notification.body,
-                data=notification.data
-            )
-            web_sent = web_result.get("sent_count", 0)
-            web_failed = web_result.get("failed_count", 0)
-        
-        # ==============================
-        # 3. GUARDAR NOTIFICACIONS PER CADA USUARI
-        # ==============================
-        now = datetime.utcnow()
-        user_notifications = []
-        for user in users:
-            user_notifications.append({
-                "user_id": user["_id"],
-                "title": notification.title,
-                "body": notification.body,
-                "data": notification.data or {},
-                "read": False,
-                "created_at": now
-            })
-        
-        # Inserció massiva per eficiència
-        if user_notifications:
-            await db.notifications.insert_many(user_notifications)
-        
-        # ==============================
-        # GUARDAR HISTORIAL ADMIN
-        # ==============================
-        notification_log = {
-            "title": notification.title,
-            "body": notification.body,
-            "target": notification.target,
-            "data": notification.data,
-            "expo_tokens_count": len(expo_tokens),
-            "web_subscriptions_count": len(web_subscriptions),
-            "expo_sent": expo_sent,
-            "expo_failed": expo_failed,
-            "web_sent": web_sent,
-            "web_failed": web_failed,
-            "users_notified": len(user_notifications),
-            "sent_at": now,
-            "sent_by": authorization
-        }
-        await db.notification_history.insert_one(notification_log)
-        
-        # Totals
-        total_sent = expo_sent + web_sent
-        total_failed = expo_failed + web_failed
-        total_devices = len(expo_tokens) + len(web_subscriptions)
-        
-        if total_devices == 0:
+        query = await build_target_query(notification.target)
+
+        job = await enqueue_broadcast(
+            query,
+            title=notification.title,
+            body=notification.body,
+            data=notification.data,
+            target=notification.target,
+            sent_by=str(admin["_id"]),
+        )
+
+        if job["total_users"] == 0:
             return NotificationResponse(
                 success=True,
                 sent_count=0,
                 failed_count=0,
-                message=f"No hi ha dispositius subscrits per aquest filtre (ni Expo ni Web Push). {len(user_notifications)} usuaris notificats."
+                message="No hi ha usuaris per aquest filtre",
+                job_id=job["id"]
             )
-        
+
         return NotificationResponse(
             success=True,
-            sent_count=total_sent,
-            failed_count=total_failed,
-            message=f"Notificació enviada: {expo_sent} Expo, {web_sent} Web Push. {len(user_notifications)} usuaris notificats."
+            sent_count=0,
+            failed_count=0,
+            message=f"Notificació en cua per a {job['total_users']} usuaris.",
+            job_id=job["id"]
         )
-        
+
     except Exception as e:
         return NotificationResponse(
             success=False,
@@ -2350,6 +2335,30 @@ async def send_notification_to_users(
         )
 
 
+@admin_router.get("/notifications/jobs")
+async def get_notification_jobs(
+    authorization: str = Header(None),
+    limit: int = 20
+):
+    """Llistar els últims treballs de notificació massiva"""
+    await verify_admin(authorization)
+    return await list_jobs(min(limit, 100))
+
+
+@admin_router.get("/notifications/jobs/{job_id}")
+async def get_notification_job(
+    job_id: str,
+    authorization: str = Header(None)
+):
+    """Estat i progrés d'un treball de notificació massiva"""
+    await verify_admin(authorization)
+
+    job = await get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Treball no trobat")
+    return job
+
+
 @admin_router.get("/notifications/history")
 async def get_notification_history(
     authorization: str = Header(None),
@@ -2434,26 +2443,14 @@ class BroadcastRequest(BaseModel):
     data: Optional[dict] = None
 
 async def build_segmentation_query(filters: SegmentationFilters) -> dict:
-    """Construir la consulta MongoDB a partir dels filtres de segmentació"""
+    """
+    Construir la consulta MongoDB dels filtres d'usuari (gènere, edat, ciutat, codi postal)
+    Els filtres de participació (marcadors, campanyes, esdeveniments) es resolen
+    amb audience_segments.resolve
+    """
     query = {}
     conditions = []
     
-    # Filtre per tags/marcadors
-    if filters.tags and len(filters.tags) > 0:
-        # Buscar usuaris que tenen almenys un dels marcadors seleccionats
-        participations = await db.participations.find({
-            "tag": {"$in": filters.tags}
-        }).to_list(100000)
-        user_ids_from_tags = list(set([str(p.get("user_id")) for p in participations if p.get("user_id")]))
-        
-        if user_ids_from_tags:
-            conditions.append({
-                "_id": {"$in": [ObjectId(uid) for uid in user_ids_from_tags]}
-            })
-        else:
-            # Si no hi ha usuaris amb aquests tags, retornar consulta buida
-            return {"_id": {"$exists": False}}
-    
     # Filtre per gènere
     if filters.gender:
         conditions.append({"gender": filters.gender})
@@ -2484,43 +2481,9 @@ async def build_segmentation_query(filters: SegmentationFilters) -> dict:
         if age_condition:
             conditions.append({"birth_date": age_condition})
     
-    # Filtre per campanyes de sorteig
-    if filters.campaigns and len(filters.campaigns) > 0:
-        campaign_participations = await db.draw_participations.find({
-            "campaign_id": {"$in": [ObjectId(cid) for cid in filters.campaigns]},
-            "participations": {"$gt": 0}
-        }).to_list(100000)
-        user_ids_from_campaigns = list(set([
-            str(p.get("user_id")) for p in campaign_participations if p.get("user_id")
-        ]))
-        
-        if user_ids_from_campaigns:
-            conditions.append({
-                "_id": {"$in": [ObjectId(uid) for uid in user_ids_from_campaigns]}
-            })
-        else:
-            return {"_id": {"$exists": False}}
-    
-    # Filtre per events (participació)
-    if filters.events and len(filters.events) > 0:
-        event_participations = await db.participations.find({
-            "activity_type": "event",
-            "activity_id": {"$in": filters.events}
-        }).to_list(100000)
-        user_ids_from_events = list(set([
-            str(p.get("user_id")) for p in event_participations if p.get("user_id")
-        ]))
-        
-        if user_ids_from_events:
-            conditions.append({
-                "_id": {"$in": [ObjectId(uid) for uid in user_ids_from_events]}
-            })
-        else:
-            return {"_id": {"$exists": False}}
-    
     # Filtre per ciutat
     if filters.city and filters.city.strip():
-        city_pattern = filters.city.strip()
+        city_pattern = re.escape(filters.city.strip())
         # Cerca insensible a majúscules/minúscules
         conditions.append({
             "city": {"$regex": city_pattern, "$options": "i"}
@@ -2533,7 +2496,7 @@ async def build_segmentation_query(filters: SegmentationFilters) -> dict:
         conditions.append({
             "$or": [
                 {"postal_code": postal_code},
-                {"postal_code": {"$regex": f"^{postal_code}"}}
+                {"postal_code": {"$regex": f"^{re.escape(postal_code)}"}}
             ]
         })
     
@@ -2563,30 +2526,18 @@ async def estimate_notification_recipients(
         
         # Construir la consulta de segmentació
         query = await build_segmentation_query(filters)
-        
+        segment = await audience_segments.resolve(filters.tags, filters.campaigns, filters.events)
+
         # Comptar usuaris que compleixen els filtres I tenen dispositiu de notificacions
         # (Expo push token O Web push subscription)
-        if query:
-            full_query = {
-                "$and": [
-                    query,
-                    {
-                        "$or": [
-                            {"push_token": {"$exists": True, "$ne": None, "$ne": ""}},
-                            {"web_push_subscription": {"$exists": True, "$ne": None}}
-                        ]
-                    }
-                ]
-            }
+        full_query = {"$and": [query, PUSH_QUERY]} if query else PUSH_QUERY
+        if segment is None:
+            count = await db.users.count_documents(full_query)
+        elif not query:
+            # Només filtres de participació: es resol tot en memòria
+            count = await audience_segments.count_reachable(segment)
         else:
-            full_query = {
-                "$or": [
-                    {"push_token": {"$exists": True, "$ne": None, "$ne": ""}},
-                    {"web_push_subscription": {"$exists": True, "$ne": None}}
-                ]
-            }
-        
-        count = await db.users.count_documents(full_query)
+            count = await audience_segments.count_users(segment, full_query)
         
         return {
             "success": True,
@@ -2615,125 +2566,27 @@ async def send_broadcast_notification(
 ):
     """
     Enviar notificació broadcast amb filtres de segmentació opcionals.
+    Es processa en segon pla: retorna l'ID del treball de seguida.
     """
-    await verify_admin(authorization)
-    
+    admin = await verify_admin(authorization)
+
     try:
         # Construir la consulta base
         base_query = {}
-        
-        # Si el target és "segmented" o hi ha filtres, aplicar segmentació
-        if request.target == "segmented" and request.filters:
+        audience = total_users = None
+
+        # Si el target és "segmented" (el frontend hi afegeix ":{filtres}") aplicar segmentació
+        if request.target.startswith("segmented") and request.filters:
             base_query = await build_segmentation_query(request.filters)
-        elif request.target == "admins":
-            base_query = {"role": "admin"}
-        elif request.target == "users":
-            # "users" = tots els usuaris que NO són admin ni local_associat
-            base_query = {"role": {"$nin": ["admin", "local_associat"]}}
-        elif request.target == "local_associat":
-            base_query = {"role": "local_associat"}
-        elif request.target.startswith("role:"):
-            role = request.target.split(":", 1)[1]
-            base_query = {"role": role}
-        # "all" no afegeix filtre addicional
-        
-        # 1. Obtenir TOTS els usuaris que compleixen el filtre (per guardar notificacions)
-        all_users_query = base_query if base_query else {}
-        all_users = await db.users.find(all_users_query).to_list(50000)
-        
-        if not all_users:
-            return {
-                "success": True,
-                "expo_sent": 0,
-                "web_sent": 0,
-                "users_notified": 0,
-                "message": "No hi ha usuaris per aquest filtre"
-            }
-        
-        # 2. Filtrar només els que tenen dispositius per enviar push
-        users_with_push = [
-            user for user in all_users
-            if (user.get("push_token") and user.get("push_token").startswith("ExponentPushToken")) or
-               (user.get("web_push_subscription") and isinstance(user.get("web_push_subscription"), dict))
-        ]
-        
-        # ==============================
-        # 3. EXPO PUSH NOTIFICATIONS
-        # ==============================
-        expo_tokens = [
-            user.get("push_token") 
-            for user in users_with_push 
-            if user.get("push_token") and user.get("push_token").startswith("ExponentPushToken")
-        ]
-        
-        expo_sent = 0
-        expo_failed = 0
-        
-        if expo_tokens:
-            result = send_push_notification(
-                push_tokens=expo_tokens,
-                title=request.title,
-                body=request.body,
-                data=request.data
-            )
-            
-            if isinstance(result, dict):
-                if "data" in result:
-                    for item in result.get("data", []):
-                        if item.get("status") == "ok":
-                            expo_sent += 1
-                        else:
-                            expo_failed += 1
-                elif "error" in result:
-                    expo_failed = len(expo_tokens)
-            else:
-                expo_sent = len(expo_tokens)
-        
-        # ==============================
-        # 4. WEB PUSH NOTIFICATIONS
-        # ==============================
-        web_subscriptions = [
-            user.get("web_push_subscription") 
-            for user in users_with_push 
-            if user.get("web_push_subscription") and isinstance(user.get("web_push_subscription"), dict)
-        ]
-        
-        web_sent = 0
-        web_failed = 0
-        
-        if web_subscriptions:
-            web_result = send_web_push_to_many(
-                subscriptions=web_subscriptions,
-                title=request.title,
-                body=request.body,
-                data=request.data
+            segment = await audience_segments.resolve(
+                request.filters.tags, request.filters.campaigns, request.filters.events
             )
-            web_sent = web_result.get("sent_count", 0)
-            web_failed = web_result.get("failed_count", 0)
-        
-        # ==============================
-        # 5. GUARDAR NOTIFICACIONS PER A TOTS ELS USUARIS FILTRATS
-        # ==============================
-        # Guardar la notificació per a TOTS els usuaris (no només els amb push)
-        now = datetime.utcnow()
-        user_notifications = []
-        for user in all_users:
-            user_notifications.append({
-                "user_id": user["_id"],
-                "title": request.title,
-                "body": request.body,
-                "data": request.data or {},
-                "read": False,
-                "created_at": now
-            })
-        
-        # Inserció massiva per eficiència
-        if user_notifications:
-            await db.notifications.insert_many(user_notifications)
-        
-        # ==============================
-        # GUARDAR HISTORIAL ADMIN
-        # ==============================
+            if segment is not None:
+                audience = audience_segments.object_ids(segment)
+                total_users = await audience_segments.count_users(segment, base_query)
+        else:
+            base_query = await build_target_query(request.target)
+
         filters_summary = None
         if request.filters:
             filters_summary = {
@@ -2743,36 +2596,39 @@ async def send_broadcast_notification(
                 "campaigns": request.filters.campaigns,
                 "events": request.filters.events
             }
-        
-        notification_log = {
-            "title": request.title,
-            "body": request.body,
-            "target": request.target,
-            "filters": filters_summary,
-            "data": request.data,
-            "expo_tokens_count": len(expo_tokens),
-            "web_subscriptions_count": len(web_subscriptions),
-            "expo_sent": expo_sent,
-            "expo_failed": expo_failed,
-            "web_sent": web_sent,
-            "web_failed": web_failed,
-            "users_notified": len(user_notifications),
-            "sent_at": now,
-            "sent_by": authorization
-        }
-        await db.notification_history.insert_one(notification_log)
-        
-        total_sent = expo_sent + web_sent
-        
+
+        job = await enqueue_broadcast(
+            base_query,
+            title=request.title,
+            body=request.body,
+            data=request.data,
+            target=request.target,
+            filters=filters_summary,
+            sent_by=str(admin["_id"]),
+            audience=audience,
+            total_users=total_users,
+        )
+
+        if job["total_users"] == 0:
+            return {
+                "success": True,
+                "job_id": job["id"],
+                "status": job["status"],
+                "expo_sent": 0,
+                "web_sent": 0,
+                "users_notified": 0,
+                "message": "No hi ha usuaris per aquest filtre"
+            }
+
         return {
             "success": True,
-            "expo_sent": expo_sent,
-            "web_sent": web_sent,
-            "total_sent": total_sent,
-            "users_notified": len(user_notifications),
-            "message": f"Notificació enviada: {expo_sent} Expo, {web_sent} Web Push. {len(user_notifications)} usuaris notificats."
+            "job_id": job["id"],
+            "status": job["status"],
+            "total_users": job["total_users"],
+            "message": f"Notificació en cua per a {job['total_users']} usuaris. "
+                       f"Progrés a /admin/notifications/jobs/{job['id']}"
         }
-        
+
     except Exception as e:
         return {
             "success": False,
@@ -0,0 +1,278 @@
+"""
+Segments d'audiència per a les notificacions segmentades
+Per a cada marcador (tag), campanya de tiquets i esdeveniment es manté en
+memòria el conjunt d'usuaris que hi han participat com a mapa de bits: cada
+usuari té un índex dens (0, 1, 2...) i el segment és un enter de Python amb
+el bit corresponent activat. Les unions i interseccions de filtres són
+operacions | i & sobre enters (en C), i no cal portar participacions a Python
+ni enviar llistes $in enormes a MongoDB.
+
+Fonts:
+- user_participations (track_participation) i participations: tag i, si
+  activity_type == "event", l'esdeveniment
+- tickets.campaign_id: campanya de tiquets on s'ha escanejat
+- draw_participations amb campaign_id i participacions > 0 (dades antigues)
+
+track_participation i el processament de tiquets hi afegeixen l'usuari al
+moment. Els altres workers ho veuen en la sincronització incremental (per
+_id, cada SEGMENTS_SYNC_INTERVAL) i tot es reconstrueix cada SEGMENTS_REBUILD_INTERVAL.
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+TAG, CAMPAIGN, EVENT = "tag", "campaign", "event"
+
+SEGMENTS_SYNC_INTERVAL = int(os.getenv('SEGMENTS_SYNC_INTERVAL', '30'))
+SEGMENTS_REBUILD_INTERVAL = int(os.getenv('SEGMENTS_REBUILD_INTERVAL', '3600'))
+# Usuaris amb dispositiu de notificacions (es refresca menys sovint que una estimació)
+REACHABLE_TTL = int(os.getenv('SEGMENTS_REACHABLE_TTL', '60'))
+# Per sota d'aquesta mida es compta amb un $in; per sobre, s'intersecta en memòria
+IN_QUERY_LIMIT = 5000
+# Marge de la sincronització per _id: insercions de processos diferents poden
+# arribar amb ObjectIds lleugerament desordenats
+SYNC_OVERLAP = timedelta(seconds=10)
+
+PARTICIPATION_PROJECTION = {"user_id": 1, "tag": 1, "activity_type": 1, "activity_id": 1}
+PUSH_QUERY = {
+    "$or": [
+        {"push_token": {"$exists": True, "$nin": [None, ""]}},
+        {"web_push_subscription": {"$exists": True, "$ne": None}}
+    ]
+}
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def _from_slots(slots: Iterable[int]) -> int:
+    """Mapa de bits amb aquests índexs activats (construït d'un cop, no bit a bit)"""
+    slots = list(slots)
+    if not slots:
+        return 0
+    buffer = bytearray(max(slots) // 8 + 1)
+    for slot in slots:
+        buffer[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def _participation_keys(doc: dict) -> List[Tuple[str, str]]:
+    keys = []
+    if doc.get("tag"):
+        keys.append((TAG, str(doc["tag"])))
+    if doc.get("activity_type") == "event" and doc.get("activity_id"):
+        keys.append((EVENT, str(doc["activity_id"])))
+    return keys
+
+
+def _ticket_keys(doc: dict) -> List[Tuple[str, str]]:
+    return [(CAMPAIGN, str(doc["campaign_id"]))] if doc.get("campaign_id") else []
+
+
+# Col·leccions que només creixen: (col·lecció, projecció, claus del document)
+APPEND_SOURCES = [
+    ("user_participations", PARTICIPATION_PROJECTION, _participation_keys),
+    ("participations", PARTICIPATION_PROJECTION, _participation_keys),
+    ("tickets", {"user_id": 1, "campaign_id": 1}, _ticket_keys),
+]
+
+
+class SegmentIndex:
+    """Mapes de bits d'usuaris per marcador, campanya i esdeveniment"""
+
+    def __init__(self):
+        self._slots: Dict[str, int] = {}  # user_id -> índex dens
+        self._user_ids: List[str] = []  # índex dens -> user_id
+        self._bitmaps: Dict[Tuple[str, str], int] = {}
+        self._watermarks: Dict[str, ObjectId] = {}
+        self._reachable = 0
+        self._reachable_at = 0.0
+        self._lock = asyncio.Lock()
+        self.built_at = 0.0
+        self.synced_at = 0.0
+
+    # --- Manteniment ---
+
+    def _slot(self, user_id) -> int:
+        user_id = str(user_id)
+        slot = self._slots.get(user_id)
+        if slot is None:
+            slot = self._slots[user_id] = len(self._user_ids)
+            self._user_ids.append(user_id)
+        return slot
+
+    def add(self, kind: str, key, user_id):
+        """Afegir un usuari a un segment (idempotent)"""
+        if not key or not user_id:
+            return
+        segment = (kind, str(key))
+        self._bitmaps[segment] = self._bitmaps.get(segment, 0) | (1 << self._slot(user_id))
+
+    def _apply_docs(self, docs: Iterable[dict], keys_of) -> ObjectId:
+        # Els índexs s'acumulen per segment i s'apliquen d'un cop (un OR per segment)
+        pending: Dict[Tuple[str, str], List[int]] = {}
+        last_id = None
+        for doc in docs:
+            last_id = doc["_id"]
+            if not doc.get("user_id"):
+                continue
+            slot = self._slot(doc["user_id"])
+            for segment in keys_of(doc):
+                pending.setdefault(segment, []).append(slot)
+        for segment, slots in pending.items():
+            self._bitmaps[segment] = self._bitmaps.get(segment, 0) | _from_slots(slots)
+        return last_id
+
+    async def _read_source(self, collection: str, projection: dict, keys_of, since: Optional[ObjectId]):
+        query = {}
+        if since is not None:
+            overlap_start = ObjectId.from_datetime(since.generation_time - SYNC_OVERLAP)
+            query = {"_id": {"$gt": overlap_start}}
+        docs = await db[collection].find(query, projection).sort("_id", 1).to_list(None)
+        last_id = self._apply_docs(docs, keys_of)
+        if last_id is not None and (since is None or last_id > since):
+            self._watermarks[collection] = last_id
+        return len(docs)
+
+    async def _rebuild(self):
+        start = time.perf_counter()
+        self._slots, self._user_ids, self._bitmaps, self._watermarks = {}, [], {}, {}
+        self._reachable_at = 0.0
+        total = 0
+        for collection, projection, keys_of in APPEND_SOURCES:
+            total += await self._read_source(collection, projection, keys_of, None)
+        # Dades antigues: participacions al sorteig per campanya (es posen a 0 en cada sorteig)
+        draws = await db.draw_participations.find(
+            {"campaign_id": {"$exists": True}, "participations": {"$gt": 0}},
+            {"user_id": 1, "campaign_id": 1},
+        ).to_list(None)
+        self._apply_docs(draws, _ticket_keys)
+        total += len(draws)
+        self.built_at = self.synced_at = time.monotonic()
+        logger.info(f"[SEGMENTS] {len(self._bitmaps)} segments, {len(self._user_ids)} usuaris "
+                    f"({total} documents) en {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    async def _sync(self):
+        for collection, projection, keys_of in APPEND_SOURCES:
+            await self._read_source(collection, projection, keys_of, self._watermarks.get(collection))
+        self.synced_at = time.monotonic()
+
+    async def rebuild(self):
+        """Reconstruir tots els segments des de zero"""
+        async with self._lock:
+            await self._rebuild()
+
+    async def ensure_fresh(self):
+        """Sincronitzar les insercions noves (o reconstruir si toca) abans d'una consulta"""
+        async with self._lock:
+            now = time.monotonic()
+            if not self.built_at or now - self.built_at > SEGMENTS_REBUILD_INTERVAL:
+                await self._rebuild()
+            elif now - self.synced_at > SEGMENTS_SYNC_INTERVAL:
+                await self._sync()
+
+    async def _reachable_bitmap(self) -> int:
+        """Usuaris amb push_token o subscripció Web Push"""
+        if time.monotonic() - self._reachable_at > REACHABLE_TTL:
+            users = await db.users.find(PUSH_QUERY, {"_id": 1}).to_list(None)
+            self._reachable = _from_slots(self._slot(user["_id"]) for user in users)
+            self._reachable_at = time.monotonic()
+        return self._reachable
+
+    # --- Consultes ---
+
+    def union(self, kind: str, keys: Iterable[str]) -> int:
+        bitmap = 0
+        for key in keys:
+            bitmap |= self._bitmaps.get((kind, str(key)), 0)
+        return bitmap
+
+    async def resolve(
+        self,
+        tags: Optional[List[str]] = None,
+        campaigns: Optional[List[str]] = None,
+        events: Optional[List[str]] = None,
+    ) -> Optional[int]:
+        """
+        Usuaris que compleixen els filtres de participació: qualsevol dels
+        marcadors I qualsevol de les campanyes I qualsevol dels esdeveniments.
+        None si no hi ha cap filtre de participació.
+        """
+        groups = [(kind, keys) for kind, keys in ((TAG, tags), (CAMPAIGN, campaigns), (EVENT, events)) if keys]
+        if not groups:
+            return None
+        await self.ensure_fresh()
+        result = None
+        for kind, keys in groups:
+            bitmap = self.union(kind, keys)
+            result = bitmap if result is None else result & bitmap
+            if not result:
+                return 0
+        return result
+
+    def members(self, bitmap: int) -> List[str]:
+        """IDs dels usuaris d'un mapa de bits"""
+        bits = bin(bitmap)[:1:-1]  # bit 0 primer
+        members = []
+        position = bits.find("1")
+        while position != -1:
+            members.append(self._user_ids[position])
+            position = bits.find("1", position + 1)
+        return members
+
+    def object_ids(self, bitmap: int) -> List[ObjectId]:
+        """ObjectIds ordenats (per recórrer-los per lots i reprendre per _id)"""
+        return sorted(ObjectId(uid) for uid in self.members(bitmap) if ObjectId.is_valid(uid))
+
+    async def count_reachable(self, bitmap: int) -> int:
+        """Usuaris del segment amb dispositiu de notificacions (en memòria)"""
+        return bin(bitmap & await self._reachable_bitmap()).count("1")
+
+    async def count_users(self, bitmap: int, query: dict) -> int:
+        """Usuaris del segment que compleixen també una consulta d'usuaris (edat, ciutat...)"""
+        ids = self.object_ids(bitmap)
+        if not ids:
+            return 0
+        if not query:
+            return len(ids)
+        if len(ids) <= IN_QUERY_LIMIT:
+            return await db.users.count_documents({"$and": [query, {"_id": {"$in": ids}}]})
+        # Segment gran: es recorren els usuaris que compleixen la consulta i s'intersecten aquí
+        members = set(ids)
+        count = 0
+        async for user in db.users.find(query, {"_id": 1}):
+            if user["_id"] in members:
+                count += 1
+        return count
+
+    def stats(self) -> dict:
+        by_kind: Dict[str, int] = {}
+        for kind, _ in self._bitmaps:
+            by_kind[kind] = by_kind.get(kind, 0) + 1
+        return {
+            "users": len(self._user_ids),
+            "segments": by_kind,
+            "bitmap_bytes": sum((bitmap.bit_length() + 7) // 8 for bitmap in self._bitmaps.values()),
+            "built_seconds_ago": round(time.monotonic() - self.built_at) if self.built_at else None,
+            "synced_seconds_ago": round(time.monotonic() - self.synced_at) if self.synced_at else None,
+            "watermarks": {name: str(oid) for name, oid in self._watermarks.items()},
+        }
+
+
+audience_segments = SegmentIndex()
+
+
+def get_segment_stats() -> dict:
+    return audience_segments.stats()
@@ -0,0 +1,147 @@
+"""
+Cache en memòria per resoldre tokens d'autorització a usuaris
+Evita una consulta a MongoDB (o dues) a cada petició autenticada
+"""
+import os
+import copy
+import time
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+# Configuració
+AUTH_CACHE_MAX_SIZE = int(os.getenv('AUTH_CACHE_MAX_SIZE', '10000'))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '60'))
+AUTH_CACHE_NEGATIVE_TTL = float(os.getenv('AUTH_CACHE_NEGATIVE_TTL', '10'))
+
+
+def normalize_token(authorization: Optional[str]) -> Optional[str]:
+    """Treure els prefixos 'Bearer ' i 'token_' del header d'autorització"""
+    if not authorization:
+        return None
+    token = authorization.replace("Bearer ", "").replace("token_", "").strip()
+    return token or None
+
+
+class TokenUserCache:
+    """
+    Cache LRU amb TTL de token -> usuari.
+    També guarda els tokens invàlids (cache negativa) durant menys temps.
+    """
+
+    def __init__(self, max_size: int = AUTH_CACHE_MAX_SIZE, ttl: float = AUTH_CACHE_TTL,
+                 negative_ttl: float = AUTH_CACHE_NEGATIVE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()  # token -> (expires_at, user | None)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, token: str):
+        """Retorna (trobat, usuari). L'usuari és una còpia per evitar mutacions"""
+        entry = self._entries.get(token)
+        if entry is None:
+            self.misses += 1
+            return False, None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[token]
+            self.misses += 1
+            return False, None
+        self._entries.move_to_end(token)
+        if user is None:
+            self.negative_hits += 1
+            return True, None
+        self.hits += 1
+        return True, copy.deepcopy(user)
+
+    def set(self, token: str, user: Optional[dict]):
+        ttl = self.ttl if user is not None else self.negative_ttl
+        self._entries[token] = (time.monotonic() + ttl, copy.deepcopy(user))
+        self._entries.move_to_end(token)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate_token(self, token: Optional[str]):
+        token = normalize_token(token)
+        if token and self._entries.pop(token, None) is not None:
+            self.invalidations += 1
+
+    def invalidate_user(self, user_id):
+        """Eliminar totes les entrades d'un usuari (per _id)"""
+        user_id = str(user_id)
+        stale = [
+            token for token, (_, user) in self._entries.items()
+            if user is not None and str(user.get('_id')) == user_id
+        ]
+        for token in stale:
+            del self._entries[token]
+        self.invalidations += len(stale)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "ttl_seconds": self.ttl,
+            "negative_ttl_seconds": self.negative_ttl,
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+        }
+
+
+token_cache = TokenUserCache()
+
+
+async def resolve_user(db, authorization: Optional[str]) -> Optional[dict]:
+    """
+    Obtenir l'usuari a partir del header d'autorització.
+    Primer busca pel camp 'token' i, si no, per _id (sistema antic amb token_).
+    """
+    token = normalize_token(authorization)
+    if not token:
+        return None
+
+    found, user = token_cache.get(token)
+    if found:
+        return user
+
+    try:
+        user = await db.users.find_one({"token": token})
+        if not user and ObjectId.is_valid(token):
+            user = await db.users.find_one({"_id": ObjectId(token)})
+    except Exception as e:
+        # No guardar a la cache els errors de connexió
+        logger.error(f"[AUTH] Error resolent el token: {e}")
+        return None
+
+    token_cache.set(token, user)
+    return user
+
+
+def invalidate_user(user_id):
+    """Invalidar la cache quan canvien les dades d'un usuari"""
+    if user_id is not None:
+        token_cache.invalidate_user(user_id)
+
+
+def invalidate_token(token: Optional[str]):
+    """Invalidar un token concret (login, registre, etc.)"""
+    token_cache.invalidate_token(token)
+
+
+def get_auth_cache_stats() -> dict:
+    return token_cache.stats()
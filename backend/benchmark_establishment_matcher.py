@@ -0,0 +1,104 @@
+"""
+Benchmark de la identificació d'establiments dels tiquets
+Genera establiments sintètics i consultes amb soroll d'OCR (NIF amb guions,
+noms sense accents, lletres retallades o canviades) i mesura la latència i
+l'encert del matcher en memòria.
+
+Ús:
+    python benchmark_establishment_matcher.py [--establishments 8000] [--queries 5000]
+"""
+import argparse
+import random
+import string
+import time
+
+from establishment_matcher import EstablishmentMatcher
+
+NAMES = ["Saitama", "Cafè", "Forn", "Pastisseria", "Sabateria", "Joieria", "Llibreria", "Ferreteria",
+         "Perruqueria", "Òptica", "Floristeria", "Bar", "Restaurant", "Vermuteria", "Gelateria",
+         "Carnisseria", "Peixateria", "Farmàcia", "Papereria", "Botiga", "Moda", "Esports"]
+SURNAMES = ["Cano", "Martí", "Ferré", "Puig", "Solé", "Vidal", "Roig", "Casals", "Güell", "Peña",
+            "Gaudí", "Fortuny", "Sagarra", "Llorens", "Domènech", "Boada", "Jové", "Sardà"]
+LEGAL = ["", "", ", S.L.", " SL", ", S.A.", " SCP"]
+OCR_CONFUSIONS = {"o": "0", "i": "1", "l": "1", "e": "c", "a": "o", "s": "5"}
+
+
+def _nif():
+    return random.choice("ABCEFGHJ") + "".join(random.choices(string.digits, k=8))
+
+
+def generate(count: int) -> list:
+    docs = []
+    for i in range(count):
+        docs.append({
+            "_id": f"est{i}",
+            "name": f"{random.choice(NAMES)} {random.choice(SURNAMES)} {i}{random.choice(LEGAL)}",
+            "nif": _nif(),
+        })
+    return docs
+
+
+def noisy_name(name: str) -> str:
+    name = name.upper()
+    roll = random.random()
+    if roll < 0.3:
+        return name[:-random.randint(1, 3)]
+    if roll < 0.6:
+        chars = list(name.lower())
+        positions = [i for i, c in enumerate(chars) if c in OCR_CONFUSIONS]
+        if positions:
+            i = random.choice(positions)
+            chars[i] = OCR_CONFUSIONS[chars[i]]
+        return "".join(chars).upper()
+    return name
+
+
+def noisy_nif(nif: str) -> str:
+    return random.choice([nif, f"{nif[0]}-{nif[1:]}", f"ES{nif}", f"{nif[0]} {nif[1:3]}.{nif[3:6]}.{nif[6:]}"])
+
+
+def run(establishments: int, queries: int):
+    docs = generate(establishments)
+    matcher = EstablishmentMatcher()
+
+    start = time.perf_counter()
+    matcher.apply(docs)
+    print(f"🏗️  Índex: {establishments} establiments en {(time.perf_counter() - start) * 1000:.0f}ms "
+          f"({matcher.stats()['trigrams']} trigrames)")
+
+    # Refresc incremental: un 1% de canvis
+    for doc in random.sample(docs, max(1, establishments // 100)):
+        doc["name"] += " Nou"
+    start = time.perf_counter()
+    changes = matcher.apply(docs)
+    print(f"🔄 Refresc: {changes} canvis en {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    for label, with_nif in (("NIF", True), ("Nom", False)):
+        latencies, hits, misses, wrong = [], 0, 0, 0
+        for _ in range(queries):
+            doc = random.choice(docs)
+            nif = noisy_nif(doc["nif"]) if with_nif else None
+            name = noisy_name(doc["name"])
+            start = time.perf_counter()
+            match = matcher.match(nif, name)
+            latencies.append((time.perf_counter() - start) * 1_000_000)
+            if match is None:
+                misses += 1
+            elif match["establishment_id"] == doc["_id"]:
+                hits += 1
+            else:
+                wrong += 1
+        latencies.sort()
+        print(f"🔎 {label}: p50 {latencies[len(latencies) // 2]:.0f}µs, "
+              f"p95 {latencies[int(len(latencies) * 0.95)]:.0f}µs — "
+              f"encerts {hits}, sense coincidència {misses}, errors {wrong}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--establishments", type=int, default=8000)
+    parser.add_argument("--queries", type=int, default=5000)
+    args = parser.parse_args()
+
+    random.seed(42)
+    run(args.establishments, args.queries)
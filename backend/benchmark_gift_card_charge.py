@@ -0,0 +1,109 @@
+"""
+Benchmark de concurrència dels cobraments de Targetes Regal
+Llança molts cobraments en paral·lel contra un mateix client i comprova
+que el saldo mai queda en negatiu i que quadra amb les targetes.
+
+Ús:
+    python benchmark_gift_card_charge.py [--charges 200] [--amount 5] [--cards 10] [--card-amount 50]
+
+Fa servir una base de dades temporal (<DB_NAME>_bench) que s'esborra al final.
+"""
+import argparse
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import gift_card_engine
+
+load_dotenv()
+
+MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost:27017')
+DB_NAME = os.getenv('DB_NAME', 'tomb_reus_db') + '_bench'
+
+
+async def run(charges: int, amount: float, cards: int, card_amount: float):
+    client = AsyncIOMotorClient(MONGO_URL, maxPoolSize=100)
+    db = client[DB_NAME]
+    await client.drop_database(DB_NAME)
+
+    customer_id = str(ObjectId())
+    shop = {"_id": ObjectId(), "name": "Botiga Benchmark", "gift_card_balance": 0}
+    await db.establishments.insert_one(shop)
+
+    now = datetime.utcnow()
+    await db.gift_cards.insert_many([
+        {
+            "user_id": customer_id,
+            "code": f"BENCH{i:06d}",
+            "amount": card_amount,
+            "balance": card_amount,
+            "status": "active",
+            "created_at": now + timedelta(seconds=i),
+        }
+        for i in range(cards)
+    ])
+    initial = await gift_card_engine.rebuild_user_balance(db, customer_id)
+
+    latencies = []
+
+    async def one_charge():
+        start = time.perf_counter()
+        try:
+            await gift_card_engine.charge(db, customer_id, shop, amount)
+            return True
+        except gift_card_engine.InsufficientBalance:
+            return False
+        finally:
+            latencies.append(time.perf_counter() - start)
+
+    print(f"🏁 {charges} cobraments de {amount:.2f}€ en paral·lel (saldo inicial {initial:.2f}€)")
+    start = time.perf_counter()
+    results = await asyncio.gather(*[one_charge() for _ in range(charges)])
+    elapsed = time.perf_counter() - start
+
+    succeeded = sum(results)
+    expected_balance = round(initial - succeeded * amount, 2)
+    denormalized = await gift_card_engine.get_user_balance(db, customer_id)
+    cards_total = round(sum(
+        gc["balance"] async for gc in db.gift_cards.find({"user_id": customer_id, "status": "active"})
+    ), 2)
+    negative_cards = await db.gift_cards.count_documents({"user_id": customer_id, "balance": {"$lt": 0}})
+    shop_doc = await db.establishments.find_one({"_id": shop["_id"]})
+    transactions = await db.gift_card_transactions.count_documents({"customer_id": customer_id})
+
+    latencies.sort()
+    print(f"✅ Acceptats: {succeeded}, rebutjats: {charges - succeeded}")
+    print(f"⏱️  Total: {elapsed:.2f}s ({charges / elapsed:.0f} cobraments/s)")
+    print(f"   p50: {latencies[len(latencies) // 2] * 1000:.1f}ms, "
+          f"p95: {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f}ms")
+    print(f"💰 Saldo esperat {expected_balance:.2f}€ | desnormalitzat {denormalized:.2f}€ | targetes {cards_total:.2f}€")
+    print(f"🏪 Saldo botiga {shop_doc.get('gift_card_balance', 0):.2f}€ | transaccions {transactions}")
+
+    ok = (
+        denormalized == expected_balance == cards_total
+        and negative_cards == 0
+        and transactions == succeeded
+        and round(shop_doc.get('gift_card_balance', 0), 2) == round(succeeded * amount, 2)
+    )
+    print("✅ Consistent" if ok else "❌ INCONSISTENT")
+
+    await client.drop_database(DB_NAME)
+    client.close()
+    return ok
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--charges", type=int, default=200)
+    parser.add_argument("--amount", type=float, default=5)
+    parser.add_argument("--cards", type=int, default=10)
+    parser.add_argument("--card-amount", type=float, default=50)
+    args = parser.parse_args()
+
+    ok = asyncio.run(run(args.charges, args.amount, args.cards, args.card_amount))
+    raise SystemExit(0 if ok else 1)
@@ -0,0 +1,128 @@
+"""
+Benchmark del cercador del catàleg
+Construeix els índexs amb un catàleg 10 vegades més gran que l'actual i mesura
+la latència de consultes amb accents, prefixos i errors tipogràfics.
+
+Ús:
+    python benchmark_search.py [--scale 10] [--queries 2000] [--from-db]
+
+Sense --from-db es genera un catàleg sintètic amb la mida aproximada actual
+(800 establiments, 200 ofertes, 50 esdeveniments, 50 promocions) multiplicada
+per --scale. Amb --from-db es repliquen els documents reals de MONGO_URL.
+"""
+import argparse
+import asyncio
+import os
+import random
+import time
+from datetime import datetime, timedelta
+
+from bson import ObjectId
+
+from search_index import SearchIndex, TypeIndex, LOADERS, SEARCH_TYPES
+
+BASE_SIZES = {"establishment": 800, "offer": 200, "event": 50, "promotion": 50}
+
+NAMES = ["Saitama", "Cafè", "Forn", "Pastisseria", "Sabateria", "Joieria", "Llibreria", "Ferreteria",
+         "Perruqueria", "Òptica", "Floristeria", "Bar", "Restaurant", "Vermuteria", "Gelateria",
+         "Carnisseria", "Peixateria", "Farmàcia", "Papereria", "Botiga", "Moda", "Esports", "Reus", "Prim"]
+SURNAMES = ["Cano", "Martí", "Ferré", "Puig", "Solé", "Vidal", "Roig", "Casals", "Güell", "Peña",
+            "Gaudí", "Fortuny", "Sagarra", "Llorens", "Domènech", "Boada", "Jové", "Sardà"]
+CATEGORIES = ["Hostelería", "Moda", "Alimentació", "Salut i bellesa", "Serveis", "Llar", "Oci i cultura"]
+STREETS = ["Carrer de Llovera", "Carrer Monterols", "Plaça del Mercadal", "Raval de Santa Anna",
+           "Carrer de la Galera", "Passeig de Prim", "Carrer de Jesús"]
+WORDS = ["descompte", "oferta", "nadal", "rebaixes", "degustació", "concert", "vermut", "música",
+         "festa", "tallers", "infantil", "mercat", "gimcana", "sorteig", "regal", "promoció"]
+
+QUERIES = [
+    "hosteleria", "Hostelería", "saitama cafe", "SAITAMA CAFÉ", "pastis", "forn de pa", "oftica",
+    "perruqeria", "llibre", "carrer llovera", "gaudi", "domenech", "vermut musica", "descomte",
+    "nadal", "rebaix", "degustacio", "moda", "salut bellesa", "concert", "gimkana", "regal",
+]
+
+
+def _text(words, count):
+    return " ".join(random.choice(words) for _ in range(count))
+
+
+def generate_catalogue(scale: int) -> dict:
+    now = datetime.utcnow()
+    docs = {doc_type: [] for doc_type in SEARCH_TYPES}
+    for _ in range(BASE_SIZES["establishment"] * scale):
+        docs["establishment"].append({
+            "_id": ObjectId(),
+            "name": f"{random.choice(NAMES)} {random.choice(SURNAMES)}",
+            "category": random.choice(CATEGORIES),
+            "address": f"{random.choice(STREETS)}, {random.randint(1, 120)}",
+            "description": _text(NAMES + WORDS, 25),
+        })
+    for doc_type in ("offer", "event", "promotion"):
+        for _ in range(BASE_SIZES[doc_type] * scale):
+            docs[doc_type].append({
+                "_id": ObjectId(),
+                "title": f"{random.choice(WORDS).capitalize()} {random.choice(NAMES)}",
+                "description": _text(WORDS + NAMES, 30),
+                "tags" if doc_type != "promotion" else "tag": [random.choice(WORDS)],
+                "valid_until": now + timedelta(days=random.randint(1, 60)),
+            })
+    return docs
+
+
+async def load_from_db(scale: int) -> dict:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv()
+    client = AsyncIOMotorClient(os.getenv('MONGO_URL', 'mongodb://localhost:27017'))
+    db = client[os.getenv('DB_NAME', 'tomb_reus_db')]
+    docs = {}
+    for doc_type in SEARCH_TYPES:
+        original = await LOADERS[doc_type](db)
+        docs[doc_type] = [{**doc, "_id": ObjectId()} for _ in range(scale) for doc in original]
+    client.close()
+    return docs
+
+
+def _percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def run(scale: int, queries: int, from_db: bool):
+    docs = await load_from_db(scale) if from_db else generate_catalogue(scale)
+    print(f"📚 Catàleg x{scale}: " + ", ".join(f"{len(v)} {k}" for k, v in docs.items()))
+
+    index = SearchIndex()
+    for doc_type, items in docs.items():
+        start = time.perf_counter()
+        index._indexes[doc_type] = TypeIndex(doc_type, items)
+        built = index._indexes[doc_type]
+        print(f"🏗️  Índex {doc_type}: {len(built.results)} documents, {len(built.vocabulary)} termes "
+              f"en {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    latencies = []
+    for i in range(queries):
+        query = QUERIES[i % len(QUERIES)]
+        start = time.perf_counter()
+        await index.search(query, limit=20)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    print(f"🔎 {queries} consultes: p50 {_percentile(latencies, 0.5):.2f}ms, "
+          f"p95 {_percentile(latencies, 0.95):.2f}ms, p99 {_percentile(latencies, 0.99):.2f}ms, "
+          f"màx {max(latencies):.2f}ms")
+
+    for query in ("Hostelería", "hosteleria", "perruqeria", "saitama caf"):
+        result = await index.search(query, limit=3)
+        top = [r.get("name") or r.get("title") for r in result["results"]]
+        print(f"   '{query}' -> {result['total']} resultats, top: {top}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scale", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--from-db", action="store_true")
+    args = parser.parse_args()
+
+    random.seed(42)
+    asyncio.run(run(args.scale, args.queries, args.from_db))
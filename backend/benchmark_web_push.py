@@ -0,0 +1,123 @@
+"""
+Benchmark del fan-out de Web Push
+Aixeca un servei push fals en local (aiohttp) i compara l'enviament
+seqüencial amb el pool de fils de web_push_service.
+
+El servei fals respon 201, o 410 per als endpoints que contenen "expired".
+Les subscripcions es generen amb claus reals perquè el xifrat sigui el mateix
+que en producció.
+
+Ús:
+    python benchmark_web_push.py [--subscriptions 2000] [--expired 5] [--latency 0.05] [--workers 32]
+"""
+import argparse
+import asyncio
+import base64
+import os
+import secrets
+import time
+
+from aiohttp import web
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+
+PORT = 8091
+
+
+def _b64(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def _public_key(private_key) -> bytes:
+    return private_key.public_key().public_bytes(
+        serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+    )
+
+
+def generate_vapid_keys():
+    private_key = ec.generate_private_key(ec.SECP256R1())
+    raw = private_key.private_numbers().private_value.to_bytes(32, "big")
+    return _b64(raw), _b64(_public_key(private_key))
+
+
+def generate_subscriptions(count: int, expired_percent: float) -> list:
+    subscriptions = []
+    expired_every = int(100 / expired_percent) if expired_percent else 0
+    for i in range(count):
+        kind = "expired" if expired_every and i % expired_every == 0 else "ok"
+        subscriptions.append({
+            "endpoint": f"http://127.0.0.1:{PORT}/push/{kind}/{i}",
+            "keys": {
+                "p256dh": _b64(_public_key(ec.generate_private_key(ec.SECP256R1()))),
+                "auth": _b64(secrets.token_bytes(16)),
+            },
+        })
+    return subscriptions
+
+
+async def start_fake_push_service(latency: float):
+    async def receive(request: web.Request):
+        await request.read()
+        await asyncio.sleep(latency)
+        status = 410 if request.match_info["kind"] == "expired" else 201
+        return web.Response(status=status)
+
+    app = web.Application()
+    app.router.add_post("/push/{kind}/{id}", receive)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT).start()
+    return runner
+
+
+async def run(count: int, expired_percent: float, latency: float, serial_sample: int):
+    # S'importa després de configurar les claus VAPID a l'entorn
+    import web_push_service
+
+    runner = await start_fake_push_service(latency)
+    subscriptions = generate_subscriptions(count, expired_percent)
+    payload = web_push_service._build_payload("Benchmark", "Prova de rendiment")
+    loop = asyncio.get_running_loop()
+
+    # Seqüencial (com l'antic send_web_push_to_many) sobre una mostra
+    sample = subscriptions[:serial_sample]
+    start = time.perf_counter()
+    for sub in sample:
+        await loop.run_in_executor(None, web_push_service._send_one, sub, payload)
+    serial_rate = len(sample) / (time.perf_counter() - start)
+    print(f"🐢 Seqüencial: {serial_rate:.0f} enviaments/s (mostra de {len(sample)}, "
+          f"{count / serial_rate:.1f}s estimats per {count})")
+
+    start = time.perf_counter()
+    result = await web_push_service.send_web_push_to_many(subscriptions, "Benchmark", "Prova de rendiment")
+    elapsed = time.perf_counter() - start
+    print(f"🚀 Pool de {web_push_service.WEB_PUSH_MAX_WORKERS} fils: {count / elapsed:.0f} enviaments/s "
+          f"({elapsed:.2f}s per {count})")
+    print(f"✅ Enviats: {result['sent_count']}, ❌ fallits: {result['failed_count']}, "
+          f"⌛ expirats: {len(result['expired_endpoints'])}")
+
+    errors = [r for r in result["results"] if r["status"] == "failed"]
+    if errors:
+        print(f"⚠️  Primer error: {errors[0]['error']}")
+
+    web_push_service.close_web_push()
+    await runner.cleanup()
+    return not errors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscriptions", type=int, default=2000)
+    parser.add_argument("--expired", type=float, default=5, help="Percentatge de subscripcions expirades")
+    parser.add_argument("--latency", type=float, default=0.05, help="Latència simulada del servei push (s)")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--serial-sample", type=int, default=100)
+    args = parser.parse_args()
+
+    private_key, public_key = generate_vapid_keys()
+    os.environ["VAPID_PRIVATE_KEY"] = private_key
+    os.environ["VAPID_PUBLIC_KEY"] = public_key
+    os.environ["WEB_PUSH_MAX_WORKERS"] = str(args.workers)
+
+    ok = asyncio.run(run(args.subscriptions, args.expired, args.latency, args.serial_sample))
+    raise SystemExit(0 if ok else 1)
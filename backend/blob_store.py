@@ -0,0 +1,300 @@
+"""
+Magatzem de fitxers per contingut (imatges, PDFs, fotos de tiquets)
+Cada fitxer es desa una sola vegada amb el seu hash SHA-256 com a identificador
+i els documents només en guarden la referència (/api/blobs/{sha256}), en lloc
+d'un data URL base64 que viatja amb cada consulta.
+
+Backends (BLOB_STORE_BACKEND):
+- "gridfs": GridFS de la mateixa base de dades (per defecte; Railway no té
+  disc persistent i el directori de l'app s'esborra a cada desplegament)
+- "local": disc, a BLOB_STORE_DIR/ab/cd/abcd... Cal indicar BLOB_STORE_DIR
+  explícitament, apuntant a un volum persistent
+
+Les metadades (mida, tipus, privat) són a la col·lecció "blobs". Els fitxers
+privats (tiquets, documents del consell) no es serveixen per la ruta pública.
+"""
+import os
+import re
+import base64
+import asyncio
+import hashlib
+import binascii
+import logging
+import unicodedata
+from pathlib import Path
+from urllib.parse import quote
+from datetime import datetime
+from typing import AsyncIterator, Optional, Tuple
+
+from fastapi import HTTPException, Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+logger = logging.getLogger(__name__)
+
+BLOB_STORE_BACKEND = os.getenv('BLOB_STORE_BACKEND', 'gridfs')
+BLOB_STORE_DIR = os.getenv('BLOB_STORE_DIR')
+# Base pública per a les URLs (les apps natives no resolen URLs relatives)
+PUBLIC_BASE_URL = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+BLOB_URL_PREFIX = "/api/blobs/"
+CHUNK_SIZE = 256 * 1024
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+BLOB_URL_RE = re.compile(r"/api/blobs/([0-9a-f]{64})")
+_DATA_URL_RE = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?(?:;[^,]*)?;base64,", re.IGNORECASE)
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Database reference (will be set from server.py)
+db = None
+_backend = None
+
+
+def set_database(database):
+    global db, _backend
+    db = database
+    if BLOB_STORE_BACKEND == "local":
+        if not BLOB_STORE_DIR:
+            # Un directori dins de l'app es perdria al següent desplegament
+            raise RuntimeError("BLOB_STORE_BACKEND=local necessita BLOB_STORE_DIR (un volum persistent)")
+        _backend = LocalBlobBackend(Path(BLOB_STORE_DIR))
+    else:
+        _backend = GridFSBlobBackend(database)
+
+
+class LocalBlobBackend:
+    """Fitxers al disc, repartits en subdirectoris pels primers caràcters del hash"""
+
+    name = "local"
+
+    def __init__(self, root: Path):
+        self.root = root
+
+    def path(self, sha: str) -> Path:
+        return self.root / sha[:2] / sha[2:4] / sha
+
+    async def exists(self, sha: str) -> bool:
+        return await asyncio.to_thread(self.path(sha).exists)
+
+    def _write(self, sha: str, data: bytes):
+        path = self.path(sha)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Escriptura atòmica: un lector mai veu un fitxer a mitges
+        tmp = path.with_name(f"{sha}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+
+    async def write(self, sha: str, data: bytes):
+        await asyncio.to_thread(self._write, sha, data)
+
+    async def read(self, sha: str) -> bytes:
+        return await asyncio.to_thread(self.path(sha).read_bytes)
+
+    async def stream(self, sha: str, start: int, end: int) -> AsyncIterator[bytes]:
+        f = await asyncio.to_thread(open, self.path(sha), "rb")
+        try:
+            await asyncio.to_thread(f.seek, start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = await asyncio.to_thread(f.read, min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            await asyncio.to_thread(f.close)
+
+
+class GridFSBlobBackend:
+    """Fitxers a GridFS (bucket "blobs") amb el hash com a _id"""
+
+    name = "gridfs"
+
+    def __init__(self, database):
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+        self.database = database
+        self.bucket = AsyncIOMotorGridFSBucket(database, bucket_name="blobs")
+
+    async def exists(self, sha: str) -> bool:
+        return await self.database["blobs.files"].find_one({"_id": sha}, {"_id": 1}) is not None
+
+    async def write(self, sha: str, data: bytes):
+        from pymongo.errors import DuplicateKeyError
+        try:
+            await self.bucket.upload_from_stream_with_id(sha, sha, data)
+        except DuplicateKeyError:
+            pass  # Pujada simultània del mateix contingut
+
+    async def read(self, sha: str) -> bytes:
+        stream = await self.bucket.open_download_stream(sha)
+        return await stream.read()
+
+    async def stream(self, sha: str, start: int, end: int) -> AsyncIterator[bytes]:
+        grid_out = await self.bucket.open_download_stream(sha)
+        grid_out.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await grid_out.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def blob_url(sha: str, base_url: Optional[str] = None) -> str:
+    base = PUBLIC_BASE_URL or (base_url or "").rstrip("/")
+    return f"{base}{BLOB_URL_PREFIX}{sha}"
+
+
+def blob_id_from_url(url) -> Optional[str]:
+    """Hash d'una URL /api/blobs/{sha256} (relativa o absoluta), o None"""
+    if not isinstance(url, str):
+        return None
+    match = BLOB_URL_RE.search(url)
+    return match.group(1) if match else None
+
+
+def is_data_url(value) -> bool:
+    return isinstance(value, str) and bool(_DATA_URL_RE.match(value))
+
+
+def decode_data_url(value: str) -> Tuple[str, bytes]:
+    """(content_type, bytes) d'un data URL base64, o base64 sense prefix"""
+    match = _DATA_URL_RE.match(value)
+    content_type = (match.group(1) if match else None) or "application/octet-stream"
+    payload = value[match.end():] if match else value
+    try:
+        return content_type, base64.b64decode(payload)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Fitxer codificat incorrectament")
+
+
+async def put_blob(
+    data: bytes,
+    content_type: str,
+    filename: Optional[str] = None,
+    private: bool = False,
+    uploaded_by: Optional[str] = None,
+) -> dict:
+    """Desar un fitxer (una sola còpia per contingut) i retornar-ne les metadades"""
+    if not data:
+        raise HTTPException(status_code=400, detail="El fitxer és buit")
+    sha = hashlib.sha256(data).hexdigest()
+
+    meta = await db.blobs.find_one({"_id": sha})
+    if meta is None or not await _backend.exists(sha):
+        await _backend.write(sha, data)
+
+    update = {
+        "$setOnInsert": {
+            "size": len(data),
+            "content_type": content_type,
+            "filename": filename,
+            "backend": _backend.name,
+            "uploaded_by": uploaded_by,
+            "created_at": datetime.utcnow(),
+        },
+    }
+    # El mateix contingut pujat com a públic deixa de ser privat (ja és públic igualment)
+    if private:
+        update["$setOnInsert"]["private"] = True
+    else:
+        update["$set"] = {"private": False}
+    await db.blobs.update_one({"_id": sha}, update, upsert=True)
+
+    return {
+        "id": sha,
+        "size": len(data),
+        "content_type": (meta or {}).get("content_type", content_type),
+        "deduplicated": meta is not None,
+    }
+
+
+async def put_data_url(value: str, private: bool = False, filename: Optional[str] = None, base_url: Optional[str] = None) -> dict:
+    content_type, data = decode_data_url(value)
+    blob = await put_blob(data, content_type, filename=filename, private=private)
+    blob["url"] = blob_url(blob["id"], base_url)
+    return blob
+
+
+async def read_blob(sha: str) -> bytes:
+    return await _backend.read(sha)
+
+
+def _parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Rang únic "bytes=a-b", "bytes=a-" o "bytes=-n"; None si no n'hi ha"""
+    if not header:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match or (not match.group(1) and not match.group(2)):
+        raise HTTPException(status_code=416, detail="Rang no vàlid", headers={"Content-Range": f"bytes */{size}"})
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start = max(size - int(last), 0)
+        end = size - 1
+    if start > end or start >= size:
+        raise HTTPException(status_code=416, detail="Rang no vàlid", headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def _content_disposition(name: str) -> str:
+    """
+    Capçalera de descàrrega per a un nom de fitxer qualsevol
+    filename= en ASCII (navegadors antics) i filename*= amb el nom original en UTF-8 (RFC 6266)
+    """
+    ascii_name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode("ascii")
+    ascii_name = re.sub(r'[\x00-\x1f\x7f"\\]', "_", ascii_name).strip() or "fitxer"
+    return f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(name, safe='')}"
+
+
+async def blob_response(
+    request: Request,
+    sha: str,
+    download_name: Optional[str] = None,
+    allow_private: bool = False,
+) -> Response:
+    """Servir un fitxer amb ETag, memòria cau i suport de Range (vídeo, PDFs grans)"""
+    if not _SHA256_RE.match(sha or ""):
+        raise HTTPException(status_code=404, detail="Fitxer no trobat")
+    meta = await db.blobs.find_one({"_id": sha})
+    if not meta or (meta.get("private") and not allow_private):
+        raise HTTPException(status_code=404, detail="Fitxer no trobat")
+
+    size = meta["size"]
+    media_type = meta.get("content_type") or "application/octet-stream"
+    headers = {
+        "ETag": f'"{sha}"',
+        "Accept-Ranges": "bytes",
+        # El contingut d'un hash no canvia mai
+        "Cache-Control": "private, max-age=3600" if meta.get("private") else "public, max-age=31536000, immutable",
+    }
+    if download_name:
+        headers["Content-Disposition"] = _content_disposition(download_name)
+
+    if request.headers.get("if-none-match") in (f'"{sha}"', f'W/"{sha}"'):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = _parse_range(request.headers.get("range"), size)
+    if byte_range is None:
+        if isinstance(_backend, LocalBlobBackend):
+            return FileResponse(_backend.path(sha), media_type=media_type, headers=headers)
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(_backend.stream(sha, 0, size - 1), media_type=media_type, headers=headers)
+
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(_backend.stream(sha, start, end), status_code=206, media_type=media_type, headers=headers)
+
+
+async def get_blob_stats() -> dict:
+    result = await db.blobs.aggregate([
+        {"$group": {"_id": "$private", "count": {"$sum": 1}, "bytes": {"$sum": "$size"}}}
+    ]).to_list(None)
+    return {
+        "backend": BLOB_STORE_BACKEND,
+        "public": next(({"count": r["count"], "bytes": r["bytes"]} for r in result if not r["_id"]), {"count": 0, "bytes": 0}),
+        "private": next(({"count": r["count"], "bytes": r["bytes"]} for r in result if r["_id"]), {"count": 0, "bytes": 0}),
+    }
@@ -0,0 +1,446 @@
+"""
+Cua de treballs per a les notificacions massives
+L'administrador crea el treball i rep l'ID de seguida; un treballador en segon
+pla recorre els usuaris per lots (cursor per _id, només els camps de push),
+envia Expo i Web Push, desa les notificacions i guarda el progrés després de
+cada lot. Si el procés cau, un altre treballador reprèn el treball des de
+l'últim _id processat quan el batec (heartbeat) queda antic. Si el treball
+falla per un error transitori (xarxa, MongoDB) torna a la cua i es reintenta
+més tard (espera exponencial); només queda "failed" després de
+BROADCAST_MAX_ATTEMPTS intents o amb un error que no es pot reintentar.
+
+Lliurament "com a mínim una vegada": el lot que s'estava enviant quan va caure
+el procés es torna a enviar. Les notificacions desades no es dupliquen gràcies
+a l'índex únic (broadcast_job_id, user_id).
+
+El text de la notificació es desa una sola vegada (notification_inbox). Si el
+target es pot expressar amb claus d'audiència (tots, rol, marcador) no es desa
+res per usuari; si no, només una referència per destinatari.
+
+Si la segmentació ja s'ha resolt amb audience_segments, els IDs dels
+destinataris es desen ordenats a broadcast_audiences en lots i el treballador
+els recorre en lloc de la consulta sencera.
+"""
+import os
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import List, Optional
+
+from bson import ObjectId, json_util
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from push_notifications import send_push_notification
+from notification_inbox import create_broadcast, target_audience_keys, count_new_notifications
+from web_push_service import send_web_push_to_many
+from live_events import publish, user_topic
+
+logger = logging.getLogger(__name__)
+
+BROADCAST_CHUNK_SIZE = int(os.getenv('BROADCAST_CHUNK_SIZE', '500'))
+BROADCAST_POLL_INTERVAL = float(os.getenv('BROADCAST_POLL_INTERVAL', '10'))
+# Un treball "running" sense batec durant aquest temps es considera abandonat
+BROADCAST_STALE_AFTER = timedelta(seconds=int(os.getenv('BROADCAST_STALE_AFTER', '120')))
+# Reintents després d'un error: espera BROADCAST_RETRY_DELAY * 2^(intent - 1), fins a BROADCAST_MAX_RETRY_DELAY
+BROADCAST_MAX_ATTEMPTS = int(os.getenv('BROADCAST_MAX_ATTEMPTS', '5'))
+BROADCAST_RETRY_DELAY = timedelta(seconds=int(os.getenv('BROADCAST_RETRY_DELAY', '30')))
+BROADCAST_MAX_RETRY_DELAY = timedelta(minutes=15)
+
+USER_PUSH_PROJECTION = {"push_token": 1, "web_push_subscription": 1}
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_worker_task: Optional[asyncio.Task] = None
+_wakeup: Optional[asyncio.Event] = None
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def _serialize_job(job: dict) -> dict:
+    total = job.get("total_users", 0)
+    processed = job.get("users_processed", 0)
+    job = {k: v for k, v in job.items() if k != "query"}
+    job["_id"] = str(job["_id"])
+    job["id"] = job["_id"]
+    if job.get("last_user_id") is not None:
+        job["last_user_id"] = str(job["last_user_id"])
+    job["progress"] = round(processed * 100 / total, 1) if total else (100.0 if job.get("status") == "completed" else 0.0)
+    return job
+
+
+async def _store_audience(job_id: ObjectId, audience: List[ObjectId]):
+    """Desar els destinataris d'un segment (ordenats) en lots de BROADCAST_CHUNK_SIZE"""
+    now = datetime.utcnow()
+    chunks = [audience[i:i + BROADCAST_CHUNK_SIZE] for i in range(0, len(audience), BROADCAST_CHUNK_SIZE)]
+    if chunks:
+        await db.broadcast_audiences.insert_many([
+            {"job_id": job_id, "seq": seq, "last": chunk[-1], "user_ids": chunk, "created_at": now}
+            for seq, chunk in enumerate(chunks)
+        ])
+
+
+async def enqueue_broadcast(
+    query: dict,
+    title: str,
+    body: str,
+    data: Optional[dict] = None,
+    target: str = "all",
+    filters: Optional[dict] = None,
+    sent_by: Optional[str] = None,
+    audience: Optional[List[ObjectId]] = None,
+    total_users: Optional[int] = None,
+) -> dict:
+    """
+    Crear un treball de notificació massiva i despertar el treballador
+    audience: IDs ordenats d'un segment (audience_segments); es combina amb la consulta
+    """
+    now = datetime.utcnow()
+    job_id = ObjectId()
+    if audience is not None:
+        # Abans del treball: el treballador el pot reclamar tan bon punt existeix
+        await _store_audience(job_id, audience)
+    if total_users is None:
+        total_users = await db.users.count_documents(query or {})
+    # Audiència per claus: la safata de cada usuari la calcula en llegir
+    audience_keys = target_audience_keys(target) if audience is None else None
+    await create_broadcast(job_id, title, body, data, audience_keys, now)
+    if audience_keys is not None:
+        # Ja és a la safata de tothom: els connectats la reben de seguida
+        await publish(audience_keys, "notification", {
+            "broadcast_job_id": str(job_id), "title": title, "body": body, "data": data or {},
+        })
+    job = {
+        "_id": job_id,
+        "title": title,
+        "body": body,
+        "data": data or {},
+        "target": target,
+        "filters": filters,
+        # La consulta pot contenir ObjectId i operadors: es desa serialitzada
+        "query": json_util.dumps(query or {}),
+        "status": "queued",
+        "total_users": total_users,
+        "audience_size": len(audience) if audience is not None else None,
+        "shared_inbox": audience_keys is not None,
+        "users_processed": 0,
+        "expo_tokens_count": 0,
+        "web_subscriptions_count": 0,
+        "expo_sent": 0,
+        "expo_failed": 0,
+        "web_sent": 0,
+        "web_failed": 0,
+        "last_user_id": None,
+        "error": None,
+        "attempts": 0,
+        "retry_at": None,
+        "sent_by": sent_by,
+        "created_at": now,
+        "updated_at": now,
+        "started_at": None,
+        "finished_at": None,
+        "heartbeat_at": None,
+        "worker_id": None,
+    }
+    await db.broadcast_jobs.insert_one(job)
+
+    if _wakeup is not None:
+        _wakeup.set()
+    return _serialize_job(job)
+
+
+async def get_job(job_id: str) -> Optional[dict]:
+    if not ObjectId.is_valid(job_id):
+        return None
+    job = await db.broadcast_jobs.find_one({"_id": ObjectId(job_id)})
+    return _serialize_job(job) if job else None
+
+
+async def list_jobs(limit: int = 20) -> list:
+    jobs = await db.broadcast_jobs.find({}, {"query": 0}).sort("created_at", -1).limit(limit).to_list(limit)
+    return [_serialize_job(job) for job in jobs]
+
+
+async def _claim_job() -> Optional[dict]:
+    """Agafar el treball pendent més antic, o un d'abandonat per un altre procés"""
+    now = datetime.utcnow()
+    return await db.broadcast_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued", "retry_at": None},
+            {"status": "queued", "retry_at": {"$lte": now}},
+            {"status": "running", "heartbeat_at": {"$lt": now - BROADCAST_STALE_AFTER}},
+        ]},
+        [{"$set": {
+            "status": "running",
+            "worker_id": WORKER_ID,
+            "heartbeat_at": now,
+            "updated_at": now,
+            "started_at": {"$ifNull": ["$started_at", now]},
+        }}],
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _send_chunk(job: dict, users: list) -> dict:
+    """Enviar un lot d'usuaris i desar-ne les notificacions"""
+    expo_tokens = [
+        u["push_token"] for u in users
+        if isinstance(u.get("push_token"), str) and u["push_token"].startswith("ExponentPushToken")
+    ]
+    web_subscriptions = [
+        u["web_push_subscription"] for u in users
+        if isinstance(u.get("web_push_subscription"), dict)
+    ]
+
+    counters = {
+        "users_processed": len(users),
+        "expo_tokens_count": len(expo_tokens),
+        "web_subscriptions_count": len(web_subscriptions),
+        "expo_sent": 0,
+        "expo_failed": 0,
+        "web_sent": 0,
+        "web_failed": 0,
+    }
+
+    if expo_tokens:
+        result = await send_push_notification(expo_tokens, job["title"], job["body"], job.get("data"))
+        if "data" in result:
+            for item in result["data"]:
+                if item.get("status") == "ok":
+                    counters["expo_sent"] += 1
+                else:
+                    counters["expo_failed"] += 1
+        else:
+            counters["expo_failed"] = len(expo_tokens)
+
+    if web_subscriptions:
+        web_result = await send_web_push_to_many(web_subscriptions, job["title"], job["body"], job.get("data"))
+        counters["web_sent"] = web_result.get("sent_count", 0)
+        counters["web_failed"] = web_result.get("failed_count", 0)
+
+    if job.get("shared_inbox"):
+        return counters
+
+    # Audiència calculada: només una referència per usuari (el text és a notification_broadcasts)
+    now = datetime.utcnow()
+    notifications = [{
+        "user_id": user["_id"],
+        "read": False,
+        "broadcast_job_id": job["_id"],
+        "created_at": now,
+        "updated_at": now,
+    } for user in users]
+    duplicates = set()
+    try:
+        await db.notifications.insert_many(notifications, ordered=False)
+    except BulkWriteError as e:
+        # Lot reprès després d'una caiguda: les ja desades es descarten
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+        duplicates = {err["index"] for err in e.details.get("writeErrors", [])}
+
+    # Comptador de no llegides: només les que s'han desat ara
+    inserted = [
+        notification["user_id"] for index, notification in enumerate(notifications) if index not in duplicates
+    ]
+    await count_new_notifications(inserted)
+    if inserted:
+        await publish([user_topic(user_id) for user_id in inserted], "notification", {
+            "broadcast_job_id": str(job["_id"]), "title": job["title"], "body": job["body"], "data": job.get("data") or {},
+        })
+    return counters
+
+
+async def _finish_job(job: dict):
+    """Marcar el treball com a completat i desar-lo a l'historial"""
+    now = datetime.utcnow()
+    job = await db.broadcast_jobs.find_one_and_update(
+        {"_id": job["_id"], "worker_id": WORKER_ID},
+        {"$set": {"status": "completed", "finished_at": now, "updated_at": now}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not job:
+        return
+    if job.get("audience_size") is not None:
+        await db.broadcast_audiences.delete_many({"job_id": job["_id"]})
+
+    await db.notification_history.insert_one({
+        "title": job["title"],
+        "body": job["body"],
+        "target": job["target"],
+        "filters": job.get("filters"),
+        "data": job.get("data"),
+        "broadcast_job_id": str(job["_id"]),
+        "expo_tokens_count": job["expo_tokens_count"],
+        "web_subscriptions_count": job["web_subscriptions_count"],
+        "expo_sent": job["expo_sent"],
+        "expo_failed": job["expo_failed"],
+        "web_sent": job["web_sent"],
+        "web_failed": job["web_failed"],
+        "users_notified": job["users_processed"],
+        "sent_at": now,
+        "sent_by": job.get("sent_by"),
+    })
+    logger.info(f"[BROADCAST] Treball {job['_id']} completat: {job['users_processed']} usuaris, "
+                f"{job['expo_sent']} Expo, {job['web_sent']} Web Push")
+
+
+async def _checkpoint(job: dict, counters: dict, last_id) -> bool:
+    """Desar el progrés; False si un altre procés ha reclamat el treball (batec massa antic)"""
+    now = datetime.utcnow()
+    update = {"$set": {"last_user_id": last_id, "heartbeat_at": now, "updated_at": now}}
+    if counters:
+        update["$inc"] = counters
+    checkpoint = await db.broadcast_jobs.update_one({"_id": job["_id"], "worker_id": WORKER_ID}, update)
+    if checkpoint.matched_count == 0:
+        logger.warning(f"[BROADCAST] Treball {job['_id']} reclamat per un altre procés")
+        return False
+    return True
+
+
+async def _heartbeat(job: dict):
+    """Mantenir el treball viu mentre s'envia un lot (Expo i Web Push poden trigar més que BROADCAST_STALE_AFTER)"""
+    while True:
+        await asyncio.sleep(BROADCAST_STALE_AFTER.total_seconds() / 3)
+        await db.broadcast_jobs.update_one(
+            {"_id": job["_id"], "worker_id": WORKER_ID},
+            {"$set": {"heartbeat_at": datetime.utcnow()}},
+        )
+
+
+async def _audience_chunks(job: dict, query: dict, last_id):
+    """Lots d'usuaris d'un segment desat, a partir de l'últim _id processat"""
+    while True:
+        chunk_filter = {"job_id": job["_id"]}
+        if last_id:
+            chunk_filter["last"] = {"$gt": last_id}
+        chunk = await db.broadcast_audiences.find_one(chunk_filter, sort=[("seq", 1)])
+        if chunk is None:
+            return
+        ids = [user_id for user_id in chunk["user_ids"] if not last_id or user_id > last_id]
+        users_query = {"_id": {"$in": ids}}
+        users = await db.users.find({"$and": [query, users_query]} if query else users_query,
+                                    USER_PUSH_PROJECTION).sort("_id", 1).to_list(None)
+        last_id = ids[-1]
+        yield users, last_id
+
+
+async def _query_chunks(query: dict, last_id):
+    """Lots d'usuaris de la consulta ordenats per _id"""
+    while True:
+        chunk_query = {"$and": [query, {"_id": {"$gt": last_id}}]} if last_id else query
+        users = await db.users.find(chunk_query, USER_PUSH_PROJECTION) \
+            .sort("_id", 1).limit(BROADCAST_CHUNK_SIZE).to_list(BROADCAST_CHUNK_SIZE)
+        if not users:
+            return
+        last_id = users[-1]["_id"]
+        yield users, last_id
+        if len(users) < BROADCAST_CHUNK_SIZE:
+            return
+
+
+async def process_job(job: dict):
+    """Processar un treball per lots des de l'últim usuari desat"""
+    query = json_util.loads(job["query"])
+    last_id = job.get("last_user_id")
+    logger.info(f"[BROADCAST] Processant treball {job['_id']}"
+                + (f" (reprès des de {last_id})" if last_id else ""))
+
+    if job.get("audience_size") is not None:
+        chunks = _audience_chunks(job, query, last_id)
+    else:
+        chunks = _query_chunks(query, last_id)
+
+    heartbeat = asyncio.create_task(_heartbeat(job))
+    try:
+        async for users, last_id in chunks:
+            # Un lot del segment pot quedar buit si cap usuari compleix la resta de filtres
+            counters = await _send_chunk(job, users) if users else {}
+            if not await _checkpoint(job, counters, last_id):
+                return
+    finally:
+        heartbeat.cancel()
+
+    await _finish_job(job)
+
+
+def _is_retryable(error: Exception) -> bool:
+    """Errors transitoris (xarxa, MongoDB no disponible); les dades incorrectes fallen de seguida"""
+    if isinstance(error, OperationFailure):
+        return error.has_error_label("RetryableWriteError") or error.has_error_label("TransientTransactionError")
+    return not isinstance(error, (ValueError, TypeError, KeyError))
+
+
+async def _job_failed(job: dict, error: Exception):
+    """Tornar el treball a la cua amb espera exponencial, o marcar-lo "failed" si no es pot reintentar"""
+    now = datetime.utcnow()
+    attempts = job.get("attempts", 0) + 1
+    update = {"error": str(error), "attempts": attempts, "updated_at": now}
+    if _is_retryable(error) and attempts < BROADCAST_MAX_ATTEMPTS:
+        delay = min(BROADCAST_RETRY_DELAY * 2 ** (attempts - 1), BROADCAST_MAX_RETRY_DELAY)
+        update.update({"status": "queued", "retry_at": now + delay, "worker_id": None, "heartbeat_at": None})
+        logger.warning(f"[BROADCAST] Error al treball {job['_id']} (intent {attempts}/{BROADCAST_MAX_ATTEMPTS}), "
+                       f"es reintenta en {int(delay.total_seconds())} s: {error}")
+    else:
+        update.update({"status": "failed", "retry_at": None, "finished_at": now})
+        logger.error(f"[BROADCAST] Treball {job['_id']} fallit (intent {attempts}): {error}")
+    await db.broadcast_jobs.update_one({"_id": job["_id"], "worker_id": WORKER_ID}, {"$set": update})
+
+
+async def _worker_loop():
+    while True:
+        try:
+            job = await _claim_job()
+            if job is None:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=BROADCAST_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            try:
+                await process_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await _job_failed(job, e)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[BROADCAST] Error al treballador: {e}")
+            await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+
+def start_broadcast_worker():
+    """Iniciar el treballador (reprèn els treballs pendents o abandonats)"""
+    global _worker_task, _wakeup
+    if _worker_task is not None and not _worker_task.done():
+        return
+    _wakeup = asyncio.Event()
+    _worker_task = asyncio.create_task(_worker_loop())
+    logger.info(f"[BROADCAST] Treballador iniciat ({WORKER_ID})")
+
+
+async def stop_broadcast_worker():
+    """
+    Aturar el treballador. El treball en curs queda "running" i es reprèn
+    quan el batec caduca.
+    """
+    global _worker_task
+    if _worker_task is None:
+        return
+    _worker_task.cancel()
+    try:
+        await _worker_task
+    except asyncio.CancelledError:
+        pass
+    _worker_task = None
@@ -1,7 +1,7 @@
 """
 Routes per gestionar el contingut del Consell
 """
-from fastapi import APIRouter, HTTPException, Header, UploadFile, File
+from fastapi import APIRouter, HTTPException, Header, UploadFile, File, Request
 from motor.motor_asyncio import AsyncIOMotorClient
 from bson import ObjectId
 from datetime import datetime
@@ -9,6 +9,9 @@ from typing import Optional, List
 from pydantic import BaseModel
 import os
 import base64
+import mimetypes
+from auth_cache import resolve_user
+from blob_store import decode_data_url, put_blob, read_blob, blob_response
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
@@ -27,7 +30,7 @@ async def verify_consell_member(authorization: str):
     if not authorization:
         raise HTTPException(status_code=401, detail="No autoritzat")
     
-    user = await db.users.find_one({"token": authorization})
+    user = await resolve_user(db, authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Token invàlid")
     
@@ -332,6 +335,42 @@ async def delete_future_campaign(campaign_id: str, authorization: str = Header(N
     
     return {"success": True}
 
+# ============================================================================
+# FITXERS ADJUNTS (magatzem de fitxers privat)
+# ============================================================================
+
+def _list_pipeline(sort: dict) -> list:
+    """Llistat sense el contingut dels fitxers, indicant si en tenen"""
+    return [
+        {"$sort": sort},
+        {"$limit": 100},
+        {"$addFields": {"has_file": {"$or": [
+            {"$ifNull": ["$file_blob_id", False]},
+            {"$ifNull": ["$file_data", False]},
+        ]}}},
+        {"$project": {"file_data": 0}},
+    ]
+
+async def _store_attachment(data: dict) -> dict:
+    """Desar el fitxer base64 al magatzem i guardar-ne només la referència"""
+    file_data = data.pop("file_data", None)
+    if file_data:
+        content_type, contents = decode_data_url(file_data)
+        if content_type == "application/octet-stream" and data.get("file_name"):
+            content_type = mimetypes.guess_type(data["file_name"])[0] or content_type
+        blob = await put_blob(contents, content_type, filename=data.get("file_name"), private=True)
+        data["file_blob_id"] = blob["id"]
+        data["file_size"] = blob["size"]
+    return data
+
+async def _attachment_base64(doc: dict) -> str:
+    """Contingut en base64 (format que espera l'app), del magatzem o del document antic"""
+    if doc.get("file_blob_id"):
+        return base64.b64encode(await read_blob(doc["file_blob_id"])).decode("utf-8")
+    if doc.get("file_data"):
+        return doc["file_data"]
+    raise HTTPException(status_code=404, detail="No hi ha fitxer adjunt")
+
 # ============================================================================
 # ESTAT DE COMPTES ENDPOINTS
 # ============================================================================
@@ -341,14 +380,10 @@ async def get_accounts(authorization: str = Header(None)):
     """Obtenir tots els documents comptables"""
     await verify_consell_member(authorization)
     
-    accounts = await db.consell_comptes.find().sort("created_at", -1).to_list(100)
+    accounts = await db.consell_comptes.aggregate(_list_pipeline({"created_at": -1})).to_list(100)
     
     for account in accounts:
         account["_id"] = str(account["_id"])
-        # No retornar les dades del fitxer complet per eficiència
-        if "file_data" in account:
-            account["has_file"] = True
-            del account["file_data"]
     
     return accounts
 
@@ -361,22 +396,33 @@ async def get_account_file(account_id: str, authorization: str = Header(None)):
     if not account:
         raise HTTPException(status_code=404, detail="Document no trobat")
     
-    if not account.get("file_data"):
-        raise HTTPException(status_code=404, detail="No hi ha fitxer adjunt")
-    
     return {
-        "file_data": account["file_data"],
+        "file_data": await _attachment_base64(account),
         "file_name": account.get("file_name", "document"),
         "file_type": account.get("file_type", "pdf")
     }
 
+@consell_router.get("/comptes/{account_id}/download")
+async def download_account_file(account_id: str, request: Request, authorization: str = Header(None)):
+    """Descarregar el fitxer d'un document comptable (amb suport de Range)"""
+    await verify_consell_member(authorization)
+    
+    account = await db.consell_comptes.find_one({"_id": ObjectId(account_id)}, {"file_data": 0})
+    if not account:
+        raise HTTPException(status_code=404, detail="Document no trobat")
+    if not account.get("file_blob_id"):
+        raise HTTPException(status_code=404, detail="No hi ha fitxer adjunt")
+    
+    return await blob_response(request, account["file_blob_id"],
+                               download_name=account.get("file_name") or "document", allow_private=True)
+
 @consell_router.post("/comptes")
 async def create_account(account: EstatComptesCreate, authorization: str = Header(None)):
     """Crear un nou document comptable"""
     user = await verify_consell_member(authorization)
     
     account_data = {
-        **account.dict(),
+        **await _store_attachment(account.dict()),
         "created_by": str(user["_id"]),
         "created_by_name": user.get("name", user.get("email", "")),
         "created_at": datetime.utcnow()
@@ -465,14 +511,10 @@ async def get_meeting_minutes(authorization: str = Header(None)):
     """Obtenir totes les actes del consell"""
     await verify_consell_member(authorization)
     
-    minutes = await db.consell_actes.find().sort("meeting_date", -1).to_list(100)
+    minutes = await db.consell_actes.aggregate(_list_pipeline({"meeting_date": -1})).to_list(100)
     
     for minute in minutes:
         minute["_id"] = str(minute["_id"])
-        # No retornar les dades del fitxer complet per eficiència
-        if "file_data" in minute:
-            minute["has_file"] = True
-            del minute["file_data"]
     
     return minutes
 
@@ -485,21 +527,32 @@ async def get_acta_file(acta_id: str, authorization: str = Header(None)):
     if not acta:
         raise HTTPException(status_code=404, detail="Acta no trobada")
     
-    if not acta.get("file_data"):
-        raise HTTPException(status_code=404, detail="No hi ha fitxer adjunt")
-    
     return {
-        "file_data": acta["file_data"],
+        "file_data": await _attachment_base64(acta),
         "file_name": acta.get("file_name", "acta.pdf"),
     }
 
+@consell_router.get("/actes/{acta_id}/download")
+async def download_acta_file(acta_id: str, request: Request, authorization: str = Header(None)):
+    """Descarregar el PDF d'una acta (amb suport de Range)"""
+    await verify_consell_member(authorization)
+    
+    acta = await db.consell_actes.find_one({"_id": ObjectId(acta_id)}, {"file_data": 0})
+    if not acta:
+        raise HTTPException(status_code=404, detail="Acta no trobada")
+    if not acta.get("file_blob_id"):
+        raise HTTPException(status_code=404, detail="No hi ha fitxer adjunt")
+    
+    return await blob_response(request, acta["file_blob_id"],
+                               download_name=acta.get("file_name") or "acta.pdf", allow_private=True)
+
 @consell_router.post("/actes")
 async def create_meeting_minutes(acta: ActaConsellCreate, authorization: str = Header(None)):
     """Crear una nova acta"""
     user = await verify_consell_member(authorization)
     
     acta_data = {
-        **acta.dict(),
+        **await _store_attachment(acta.dict()),
         "created_by": str(user["_id"]),
         "created_by_name": user.get("name", user.get("email", "")),
         "created_at": datetime.utcnow()
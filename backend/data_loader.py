@@ -0,0 +1,63 @@
+"""
+Càrrega agrupada de documents (dataloader) per evitar consultes N+1
+Recull els IDs, fa una sola consulta amb $in i uneix els resultats en memòria.
+Cada instància és per petició: un mateix document no es busca dues vegades.
+"""
+from typing import Dict, Iterable, Optional
+
+from bson import ObjectId
+
+
+def _id_variants(key: str) -> list:
+    """Un ID pot estar desat com a ObjectId o com a string"""
+    variants = [key]
+    if ObjectId.is_valid(key):
+        variants.append(ObjectId(key))
+    return variants
+
+
+class BatchLoader:
+    """Carregador d'una col·lecció indexat per un camp (per defecte _id)"""
+
+    def __init__(self, collection, field: str = "_id", projection: Optional[dict] = None):
+        self.collection = collection
+        self.field = field
+        self.projection = projection
+        self._cache: Dict[str, Optional[dict]] = {}
+
+    async def load_many(self, keys: Iterable) -> Dict[str, dict]:
+        """Retorna {clau (str): document} amb una sola consulta per les claus noves"""
+        keys = [str(k) for k in keys if k is not None]
+        missing = list(dict.fromkeys(k for k in keys if k not in self._cache))
+
+        if missing:
+            values = [v for key in missing for v in _id_variants(key)]
+            cursor = self.collection.find({self.field: {"$in": values}}, self.projection)
+            async for doc in cursor:
+                # Si n'hi ha més d'un (p.ex. owner_id), com find_one: el primer
+                self._cache.setdefault(str(doc.get(self.field)), doc)
+            for key in missing:
+                self._cache.setdefault(key, None)
+
+        return {k: self._cache[k] for k in keys if self._cache.get(k) is not None}
+
+    async def load(self, key) -> Optional[dict]:
+        if key is None:
+            return None
+        return (await self.load_many([key])).get(str(key))
+
+    def prime(self, doc: dict):
+        """Afegir a la cache un document ja obtingut"""
+        self._cache[str(doc.get(self.field))] = doc
+
+
+class DataLoaders:
+    """Carregadors d'una petició"""
+
+    def __init__(self, db):
+        self.db = db
+        self.users = BatchLoader(db.users, projection={"password": 0})
+        self.establishments = BatchLoader(db.establishments)
+        self.establishments_by_owner = BatchLoader(db.establishments, field="owner_id",
+                                                   projection={"name": 1, "owner_id": 1})
+        self.events = BatchLoader(db.events)
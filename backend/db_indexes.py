@@ -0,0 +1,286 @@
+"""
+Gestió dels índexs de MongoDB
+Declara els índexs de cada col·lecció, els crea a l'arrencada (idempotent)
+i permet auditar els plans d'execució de les consultes més freqüents
+"""
+import logging
+from typing import Dict, List
+
+from pymongo import ASCENDING, DESCENDING, GEOSPHERE, IndexModel
+from pymongo.errors import OperationFailure, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+def _non_empty_string(field: str) -> dict:
+    """
+    Filtre parcial: només documents amb el camp com a string no buit.
+    Una igualtat ({camp: "valor"}) implica aquest filtre i pot usar l'índex.
+    """
+    return {field: {"$gt": ""}}
+
+
+# Índexs declarats per col·lecció. El nom és explícit per poder detectar canvis.
+INDEX_SPECS: Dict[str, List[IndexModel]] = {
+    "users": [
+        IndexModel([("token", ASCENDING)], name="token_1", sparse=True),
+        IndexModel([("email", ASCENDING)], name="email_unique", unique=True,
+                   partialFilterExpression=_non_empty_string("email")),
+        IndexModel([("role", ASCENDING)], name="role_1"),
+        IndexModel([("push_token", ASCENDING)], name="push_token_1", sparse=True),
+        IndexModel([("web_push_subscription.endpoint", ASCENDING)], name="web_push_endpoint_1", sparse=True),
+    ],
+    "establishments": [
+        IndexModel([("nif", ASCENDING)], name="nif_1"),
+        IndexModel([("owner_id", ASCENDING)], name="owner_id_1"),
+        IndexModel([("status", ASCENDING), ("visible_in_public_list", ASCENDING)], name="status_1_visible_1"),
+        IndexModel([("location", GEOSPHERE)], name="location_2dsphere"),
+    ],
+    "offers": [
+        IndexModel([("valid_until", ASCENDING), ("created_at", DESCENDING)], name="valid_until_1_created_at_-1"),
+        IndexModel([("establishment_id", ASCENDING)], name="establishment_id_1"),
+    ],
+    "events": [
+        IndexModel([("valid_until", ASCENDING), ("valid_from", ASCENDING)], name="valid_until_1_valid_from_1"),
+        IndexModel([("valid_from", DESCENDING), ("_id", DESCENDING)], name="valid_from_-1__id_-1"),
+    ],
+    "promotions": [
+        IndexModel([("status", ASCENDING), ("created_at", DESCENDING)], name="status_1_created_at_-1"),
+        IndexModel([("created_by", ASCENDING), ("created_at", DESCENDING)], name="created_by_1_created_at_-1"),
+    ],
+    "news": [
+        IndexModel([("created_at", DESCENDING)], name="created_at_-1"),
+        # Deduplicació de les notícies automàtiques (bulk upsert per URL).
+        # Amb dades antigues: python news_scheduler.py --dedupe i eliminar url_1
+        IndexModel([("url", ASCENDING)], name="url_unique", unique=True,
+                   partialFilterExpression=_non_empty_string("url")),
+    ],
+    "tickets": [
+        IndexModel([("ticket_number", ASCENDING)], name="ticket_number_unique", unique=True,
+                   partialFilterExpression=_non_empty_string("ticket_number")),
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_1_created_at_-1"),
+        IndexModel([("image_hash", ASCENDING)], name="image_hash_1", sparse=True),
+        IndexModel([("ticket_job_id", ASCENDING)], name="ticket_job_id_1", sparse=True),
+    ],
+    "ticket_jobs": [
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_1_created_at_1"),
+        IndexModel([("user_id", ASCENDING), ("image_hash", ASCENDING), ("status", ASCENDING)],
+                   name="user_id_1_image_hash_1_status_1"),
+        # Els treballs acabats només serveixen per consultar-ne l'estat uns dies
+        IndexModel([("finished_at", ASCENDING)], name="finished_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    "ticket_ocr_cache": [
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=90 * 24 * 3600),
+    ],
+    "draw_participations": [
+        IndexModel([("user_id", ASCENDING)], name="user_id_1"),
+    ],
+    "gift_cards": [
+        IndexModel([("user_id", ASCENDING), ("status", ASCENDING), ("created_at", ASCENDING)],
+                   name="user_id_1_status_1_created_at_1"),
+        IndexModel([("code", ASCENDING)], name="code_1"),
+    ],
+    "gift_card_transactions": [
+        IndexModel([("customer_id", ASCENDING), ("created_at", DESCENDING)], name="customer_id_1_created_at_-1"),
+        IndexModel([("shop_id", ASCENDING), ("created_at", DESCENDING)], name="shop_id_1_created_at_-1"),
+    ],
+    "notifications": [
+        IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], name="user_id_1_created_at_-1"),
+        # Sincronització de la safata amb cursor (?since=)
+        IndexModel([("user_id", ASCENDING), ("updated_at", ASCENDING)], name="user_id_1_updated_at_1"),
+        # Evita duplicats quan es reprèn un treball de notificació massiva
+        IndexModel([("broadcast_job_id", ASCENDING), ("user_id", ASCENDING)], name="broadcast_job_id_1_user_id_unique",
+                   unique=True, partialFilterExpression={"broadcast_job_id": {"$exists": True}}),
+    ],
+    "notification_broadcasts": [
+        # Safata: notificacions massives per clau d'audiència ("all", "role:admin", "tag:...")
+        IndexModel([("audience_keys", ASCENDING), ("created_at", DESCENDING)], name="audience_keys_1_created_at_-1"),
+    ],
+    "broadcast_jobs": [
+        IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_1_created_at_1"),
+        IndexModel([("created_at", DESCENDING)], name="created_at_-1"),
+    ],
+    "broadcast_audiences": [
+        IndexModel([("job_id", ASCENDING), ("last", ASCENDING)], name="job_id_1_last_1"),
+        # Destinataris de treballs que no s'han arribat a completar (7 dies)
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=7 * 24 * 3600),
+    ],
+    "live_events": [
+        # Esdeveniments del canal en directe amb LIVE_BROKER=mongo (només cal el change stream)
+        IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=3600),
+    ],
+    "scheduled_job_runs": [
+        # Historial de les tasques programades (30 dies)
+        IndexModel([("started_at", DESCENDING)], name="started_at_ttl", expireAfterSeconds=30 * 24 * 3600),
+    ],
+    "user_participations": [
+        IndexModel([("tag", ASCENDING), ("participated_at", DESCENDING)], name="tag_1_participated_at_-1"),
+        IndexModel([("user_id", ASCENDING)], name="user_id_1"),
+    ],
+    "gimcana_qr_codes": [
+        IndexModel([("campaign_id", ASCENDING), ("code", ASCENDING)], name="campaign_id_1_code_unique", unique=True),
+        IndexModel([("code", ASCENDING)], name="code_1"),
+    ],
+    "gimcana_progress": [
+        IndexModel([("campaign_id", ASCENDING), ("user_id", ASCENDING)], name="campaign_id_1_user_id_1"),
+        # Llistat paginat de participants (ordenat per QR escanejats)
+        IndexModel([("campaign_id", ASCENDING), ("scanned_count", DESCENDING), ("_id", DESCENDING)],
+                   name="campaign_id_1_scanned_count_-1__id_-1"),
+    ],
+}
+
+# Opcions que es comparen per detectar diferències amb l'índex existent
+_COMPARED_OPTIONS = ("unique", "sparse", "partialFilterExpression", "expireAfterSeconds")
+
+
+def _normalize_key(key) -> list:
+    """Clau com a llista de (camp, direcció), tant si ve d'IndexModel com de MongoDB"""
+    pairs = key.items() if hasattr(key, "items") else key
+    return [
+        (field, int(direction) if isinstance(direction, (int, float)) else direction)
+        for field, direction in pairs
+    ]
+
+
+def _spec_options(document: dict) -> dict:
+    return {opt: document[opt] for opt in _COMPARED_OPTIONS if opt in document}
+
+
+def _existing_options(info: dict) -> dict:
+    return {opt: info[opt] for opt in _COMPARED_OPTIONS if opt in info}
+
+
+async def ensure_indexes(db) -> dict:
+    """
+    Crear els índexs declarats que faltin i registrar les diferències.
+    Mai elimina índexs: els canvis d'opcions s'han de fer manualment.
+    """
+    report = {"created": [], "existing": [], "drift": [], "undeclared": [], "errors": []}
+
+    for collection_name, models in INDEX_SPECS.items():
+        collection = db[collection_name]
+        try:
+            existing = await collection.index_information()
+        except OperationFailure as e:
+            report["errors"].append(f"{collection_name}: {e}")
+            continue
+
+        existing_by_key = {tuple(_normalize_key(info["key"])): name for name, info in existing.items()}
+        declared_names = set()
+
+        for model in models:
+            document = model.document
+            name = document["name"]
+            key = tuple(_normalize_key(document["key"]))
+            declared_names.add(name)
+            label = f"{collection_name}.{name}"
+
+            current_name = name if name in existing else existing_by_key.get(key)
+            if current_name:
+                declared_names.add(current_name)
+                info = existing[current_name]
+                if tuple(_normalize_key(info["key"])) != key or _existing_options(info) != _spec_options(document):
+                    report["drift"].append(label)
+                    logger.warning(
+                        f"[INDEXES] Diferència a {label}: existent={info} declarat={document}"
+                    )
+                else:
+                    report["existing"].append(label)
+                continue
+
+            try:
+                await collection.create_indexes([model])
+                report["created"].append(label)
+                logger.info(f"[INDEXES] Creat {label}")
+            except (DuplicateKeyError, OperationFailure) as e:
+                # Normalment dades duplicades que impedeixen un índex únic
+                report["errors"].append(f"{label}: {e}")
+                logger.error(f"[INDEXES] No s'ha pogut crear {label}: {e}")
+
+        for name in existing:
+            if name != "_id_" and name not in declared_names:
+                report["undeclared"].append(f"{collection_name}.{name}")
+                logger.info(f"[INDEXES] Índex no declarat: {collection_name}.{name}")
+
+    logger.info(
+        f"[INDEXES] Creats: {len(report['created'])}, existents: {len(report['existing'])}, "
+        f"diferències: {len(report['drift'])}, errors: {len(report['errors'])}"
+    )
+    return report
+
+
+# Consultes més freqüents per auditar amb explain()
+HOT_QUERIES = [
+    {"name": "auth_token", "collection": "users", "filter": {"token": "__token__"}},
+    {"name": "login_email", "collection": "users", "filter": {"email": "user@example.com"}},
+    {"name": "establishment_by_owner", "collection": "establishments", "filter": {"owner_id": "__owner__"}},
+    {"name": "establishment_by_nif", "collection": "establishments", "filter": {"nif": "B00000000"}},
+    {"name": "public_establishments", "collection": "establishments",
+     "filter": {"status": "A Soci", "$or": [{"visible_in_public_list": True},
+                                           {"visible_in_public_list": {"$exists": False}}]}},
+    {"name": "active_offers", "collection": "offers", "filter": {"valid_until": {"$gte": "__now__"}},
+     "sort": {"created_at": -1}},
+    {"name": "ticket_duplicate", "collection": "tickets", "filter": {"ticket_number": "0000"}},
+    {"name": "user_tickets", "collection": "tickets", "filter": {"user_id": "__user__"},
+     "sort": {"created_at": -1}},
+    {"name": "draw_participation", "collection": "draw_participations", "filter": {"user_id": "__user__"}},
+    {"name": "active_gift_cards", "collection": "gift_cards",
+     "filter": {"user_id": "__user__", "status": "active", "balance": {"$gt": 0}}, "sort": {"created_at": 1}},
+    {"name": "user_notifications", "collection": "notifications", "filter": {"user_id": "__user__"},
+     "sort": {"created_at": -1}},
+    {"name": "shared_notifications", "collection": "notification_broadcasts", "filter": {"audience_keys": "all"},
+     "sort": {"created_at": -1}},
+    {"name": "users_by_tag", "collection": "user_participations", "filter": {"tag": "__tag__"}},
+    {"name": "gimcana_scan", "collection": "gimcana_qr_codes",
+     "filter": {"campaign_id": "__campaign__", "code": "GIMCANA-0000"}},
+    {"name": "gimcana_progress", "collection": "gimcana_progress",
+     "filter": {"campaign_id": "__campaign__", "user_id": "__user__"}},
+]
+
+
+def _plan_stages(plan: dict) -> List[str]:
+    """Recollir totes les etapes d'un pla d'execució (recursiu)"""
+    stages = []
+    if not isinstance(plan, dict):
+        return stages
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    for child_key in ("inputStage", "queryPlan"):
+        if child_key in plan:
+            stages.extend(_plan_stages(plan[child_key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(_plan_stages(child))
+    return stages
+
+
+async def explain_hot_queries(db) -> List[dict]:
+    """Executar explain() de les consultes freqüents i marcar els COLLSCAN"""
+    from datetime import datetime
+
+    results = []
+    for query in HOT_QUERIES:
+        query_filter = {
+            k: ({"$gte": datetime.utcnow()} if v == {"$gte": "__now__"} else v)
+            for k, v in query["filter"].items()
+        }
+        command = {"find": query["collection"], "filter": query_filter}
+        if query.get("sort"):
+            command["sort"] = query["sort"]
+        try:
+            explanation = await db.command({"explain": command, "verbosity": "queryPlanner"})
+            winning_plan = explanation.get("queryPlanner", {}).get("winningPlan", {})
+            stages = _plan_stages(winning_plan)
+            results.append({
+                "name": query["name"],
+                "collection": query["collection"],
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages,
+                "in_memory_sort": "SORT" in stages,
+            })
+        except OperationFailure as e:
+            results.append({
+                "name": query["name"],
+                "collection": query["collection"],
+                "error": str(e),
+            })
+    return results
@@ -0,0 +1,94 @@
+"""
+Motor de sortejos ponderats
+Selecciona guanyadors sense reemplaçament llegint els participants d'un cursor,
+sense expandir un "bombo" de bitllets en memòria.
+
+Algorisme A-ES (Efraimidis i Spirakis): cada participant rep la clau
+log(u) / pes amb u uniforme a (0, 1]; els k participants amb la clau més alta
+són els guanyadors, en ordre. És equivalent a treure bitllets d'un en un
+sense reemplaçament, amb memòria O(k).
+
+Amb la mateixa llavor i el mateix ordre de lectura (per _id) el resultat
+es pot reproduir per auditar-lo.
+"""
+import heapq
+import math
+import random
+import secrets
+from dataclasses import dataclass, field
+from typing import Callable, List, Optional
+
+ALGORITHM = "a-es"
+
+
+@dataclass
+class DrawResult:
+    winners: List[dict] = field(default_factory=list)
+    seed: int = 0
+    total_participants: int = 0
+    total_weight: float = 0
+    algorithm: str = ALGORITHM
+
+    def audit(self) -> dict:
+        """Dades per desar al registre del sorteig"""
+        return {
+            "seed": str(self.seed),
+            "algorithm": self.algorithm,
+            "order": "_id asc",
+        }
+
+
+def new_seed() -> int:
+    return secrets.randbits(63)
+
+
+class WeightedSampler:
+    """Mostreig ponderat sense reemplaçament d'un flux de documents"""
+
+    def __init__(self, num_winners: int, seed: Optional[int] = None,
+                 weight: Callable[[dict], float] = lambda doc: 1):
+        self.num_winners = max(0, num_winners)
+        self.seed = new_seed() if seed is None else int(seed)
+        self.weight = weight
+        self._rng = random.Random(self.seed)
+        self._heap = []  # (clau, ordre, document) - mínim a dalt
+        self._count = 0
+        self.total_participants = 0
+        self.total_weight = 0
+
+    def add(self, doc: dict):
+        weight = self.weight(doc) or 0
+        if weight <= 0:
+            return
+        self.total_participants += 1
+        self.total_weight += weight
+        self._count += 1
+
+        # 1 - random() és a (0, 1]: evita log(0)
+        key = math.log(1.0 - self._rng.random()) / weight
+        item = (key, self._count, doc)
+        if len(self._heap) < self.num_winners:
+            heapq.heappush(self._heap, item)
+        elif self._heap and key > self._heap[0][0]:
+            heapq.heapreplace(self._heap, item)
+
+    def result(self) -> DrawResult:
+        winners = [doc for _, _, doc in sorted(self._heap, key=lambda item: (-item[0], item[1]))]
+        return DrawResult(
+            winners=winners,
+            seed=self.seed,
+            total_participants=self.total_participants,
+            total_weight=self.total_weight,
+        )
+
+
+async def weighted_draw(cursor, num_winners: int, seed: Optional[int] = None,
+                        weight: Callable[[dict], float] = lambda doc: 1) -> DrawResult:
+    """
+    Sorteig sobre un cursor de Motor. El cursor ha d'estar ordenat de forma
+    estable (per _id) perquè el resultat sigui reproduïble amb la llavor.
+    """
+    sampler = WeightedSampler(num_winners, seed=seed, weight=weight)
+    async for doc in cursor:
+        sampler.add(doc)
+    return sampler.result()
@@ -0,0 +1,321 @@
+"""
+Identificació de l'establiment d'un tiquet escanejat (OCR)
+Índex en memòria de tots els establiments amb:
+- NIF/CIF normalitzat (sense guions, espais ni prefix "ES"), perquè
+  "B-43688217", "b 43688217" i "ESB43688217" siguin la mateixa clau
+- trigrames dels noms normalitzats (sense accents ni forma jurídica) per
+  trobar candidats, ordenats amb Jaro-Winkler
+
+L'índex es refresca quan s'invalida l'espai d'establiments del catàleg: es
+llegeixen només els camps necessaris i es reindexen els establiments que han
+canviat. Una consulta no toca MongoDB.
+"""
+import os
+import re
+import time
+import asyncio
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+from search_index import normalize
+from response_cache import add_invalidation_listener, ESTABLISHMENTS
+
+logger = logging.getLogger(__name__)
+
+# Confiança mínima per acceptar una coincidència per nom
+NAME_MATCH_THRESHOLD = float(os.getenv('TICKET_NAME_MATCH_THRESHOLD', '0.85'))
+# Diferència mínima amb el segon candidat: si dos noms s'assemblen igual, no se'n tria cap
+AMBIGUITY_MARGIN = 0.03
+MAX_CANDIDATES = 10
+# Trigrames presents en més establiments que això ("bar", " ca") no serveixen
+# per triar candidats i només allarguen la consulta
+COMMON_TRIGRAM_LIMIT = 200
+REFRESH_DELAY = 1.0  # segons: agrupa invalidacions seguides (p.ex. un import)
+# Els scripts d'importació escriuen des d'un altre procés sense invalidar:
+# l'índex es refresca igualment passat aquest temps
+MAX_AGE = 900
+
+MATCHER_PROJECTION = {"name": 1, "commercial_name": 1, "nif": 1, "vat_number": 1}
+
+_NIF_RE = re.compile(r"[^A-Z0-9]")
+_NAME_RE = re.compile(r"[a-z0-9]+")
+# Formes jurídiques i paraules que no identifiquen el comerç
+LEGAL_FORMS = {"sl", "slu", "sll", "sa", "scp", "cb", "sc", "scoop", "coop", "slne"}
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def normalize_nif(value) -> str:
+    """'B-43.688.217' -> 'B43688217'; descarta el prefix de país del NIF-IVA"""
+    if not value:
+        return ""
+    nif = _NIF_RE.sub("", str(value).upper())
+    if len(nif) == 11 and nif.startswith("ES"):
+        nif = nif[2:]
+    return nif
+
+
+def normalize_name(value) -> str:
+    """'SAITAMA CAFÉ, S.L.' -> 'saitama cafe'"""
+    tokens = _NAME_RE.findall(normalize(value))
+    # "S.L." queda com "s" "l": es tornen a ajuntar les lletres soltes del final
+    stripped = True
+    while stripped and len(tokens) > 1:
+        stripped = False
+        for size in (3, 2, 1):
+            suffix = tokens[-size:]
+            if len(tokens) > size and "".join(suffix) in LEGAL_FORMS and (size == 1 or all(len(t) == 1 for t in suffix)):
+                del tokens[-size:]
+                stripped = True
+                break
+    return " ".join(tokens)
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def jaro_winkler(a: str, b: str) -> float:
+    """Similitud Jaro-Winkler (0-1), bona per a errors d'OCR a l'inici curt"""
+    if a == b:
+        return 1.0
+    len_a, len_b = len(a), len(b)
+    if not len_a or not len_b:
+        return 0.0
+
+    window = max(max(len_a, len_b) // 2 - 1, 0)
+    matched_a = [False] * len_a
+    matched_b = [False] * len_b
+    matches = 0
+    for i, char in enumerate(a):
+        for j in range(max(0, i - window), min(i + window + 1, len_b)):
+            if not matched_b[j] and b[j] == char:
+                matched_a[i] = matched_b[j] = True
+                matches += 1
+                break
+    if not matches:
+        return 0.0
+
+    transpositions = 0
+    j = 0
+    for i in range(len_a):
+        if matched_a[i]:
+            while not matched_b[j]:
+                j += 1
+            if a[i] != b[j]:
+                transpositions += 1
+            j += 1
+
+    jaro = (matches / len_a + matches / len_b + (matches - transpositions / 2) / matches) / 3
+    prefix = 0
+    for char_a, char_b in zip(a[:4], b[:4]):
+        if char_a != char_b:
+            break
+        prefix += 1
+    return jaro + prefix * 0.1 * (1 - jaro)
+
+
+class EstablishmentMatcher:
+    """Índex de NIF i noms, actualitzat per diferències"""
+
+    def __init__(self):
+        self._entries: Dict[str, Tuple] = {}  # id -> (nif, noms normalitzats)
+        self._by_nif: Dict[str, Set[str]] = {}
+        self._by_name: Dict[str, Set[str]] = {}
+        self._trigrams: Dict[str, Set[str]] = {}
+        self._names: Dict[str, List[Tuple[str, Set[str]]]] = {}
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+        self.loaded = False
+        self.refreshed_at = 0.0
+        self.refreshes = 0
+        self.lookups = 0
+
+    # --- Manteniment de l'índex ---
+
+    @staticmethod
+    def _entry(doc: dict) -> Tuple:
+        nif = normalize_nif(doc.get("nif")) or normalize_nif(doc.get("vat_number"))
+        names = []
+        for field in ("name", "commercial_name"):
+            name = normalize_name(doc.get(field))
+            if name and name not in names:
+                names.append(name)
+        return nif, tuple(names)
+
+    def _remove(self, est_id: str):
+        nif, names = self._entries.pop(est_id)
+        if nif:
+            ids = self._by_nif.get(nif)
+            if ids is not None:
+                ids.discard(est_id)
+                if not ids:
+                    del self._by_nif[nif]
+        for name in names:
+            ids = self._by_name.get(name)
+            if ids is not None:
+                ids.discard(est_id)
+                if not ids:
+                    del self._by_name[name]
+            for gram in trigrams(name):
+                ids = self._trigrams.get(gram)
+                if ids is not None:
+                    ids.discard(est_id)
+                    if not ids:
+                        del self._trigrams[gram]
+        self._names.pop(est_id, None)
+
+    def _add(self, est_id: str, entry: Tuple):
+        nif, names = entry
+        self._entries[est_id] = entry
+        if nif:
+            self._by_nif.setdefault(nif, set()).add(est_id)
+        for name in names:
+            self._by_name.setdefault(name, set()).add(est_id)
+            for gram in trigrams(name):
+                self._trigrams.setdefault(gram, set()).add(est_id)
+        self._names[est_id] = [(name, trigrams(name)) for name in names]
+
+    def apply(self, docs: List[dict]) -> int:
+        """Sincronitzar l'índex amb la llista completa; retorna els canvis"""
+        current = {}
+        for doc in docs:
+            current[str(doc["_id"])] = self._entry(doc)
+
+        changes = 0
+        for est_id in [i for i in self._entries if i not in current]:
+            self._remove(est_id)
+            changes += 1
+        for est_id, entry in current.items():
+            previous = self._entries.get(est_id)
+            if previous == entry:
+                continue
+            if previous is not None:
+                self._remove(est_id)
+            self._add(est_id, entry)
+            changes += 1
+        return changes
+
+    async def refresh(self):
+        async with self._lock:
+            start = time.perf_counter()
+            docs = await db.establishments.find({}, MATCHER_PROJECTION).to_list(None)
+            changes = self.apply(docs)
+            self.loaded = True
+            self.refreshed_at = time.monotonic()
+            self.refreshes += 1
+            if changes:
+                logger.info(f"[MATCHER] {changes} establiments reindexats ({len(self._entries)} en total) "
+                            f"en {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    def schedule_refresh(self):
+        """Refrescar en segon pla després d'un canvi als establiments"""
+        if db is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._refresh_task and not self._refresh_task.done():
+            return
+
+        async def refresh():
+            await asyncio.sleep(REFRESH_DELAY)
+            try:
+                await self.refresh()
+            except Exception as e:
+                logger.error(f"[MATCHER] Error refrescant l'índex d'establiments: {e}")
+
+        self._refresh_task = loop.create_task(refresh())
+
+    # --- Consultes ---
+
+    def _name_score(self, query: str, query_grams: Set[str], est_id: str) -> float:
+        best = 0.0
+        for name, grams in self._names.get(est_id, []):
+            dice = 2 * len(query_grams & grams) / (len(query_grams) + len(grams))
+            # L'OCR sovint retalla o afegeix text: es compara també amb l'inici del nom
+            similarity = jaro_winkler(query, name)
+            if len(name) > len(query):
+                similarity = max(similarity, jaro_winkler(query, name[:len(query)]) * 0.95)
+            best = max(best, 0.6 * similarity + 0.4 * dice)
+        return best
+
+    def candidates(self, name: str, limit: int = 5) -> List[dict]:
+        """Establiments amb nom semblant, ordenats per confiança"""
+        query = normalize_name(name)
+        if not query:
+            return []
+        query_grams = trigrams(query)
+        postings = sorted((self._trigrams[g] for g in query_grams if g in self._trigrams), key=len)
+        selective = [ids for ids in postings if len(ids) <= COMMON_TRIGRAM_LIMIT] or postings[:2]
+        shared: Dict[str, int] = {}
+        for ids in selective:
+            for est_id in ids:
+                shared[est_id] = shared.get(est_id, 0) + 1
+        top = sorted(shared, key=shared.get, reverse=True)[:MAX_CANDIDATES]
+        scored = sorted(((self._name_score(query, query_grams, i), i) for i in top), reverse=True)[:limit]
+        return [{"establishment_id": i, "score": round(score, 3), "method": "name"} for score, i in scored]
+
+    def match(self, nif: Optional[str] = None, name: Optional[str] = None) -> Optional[dict]:
+        """
+        Millor establiment per al NIF i el nom llegits del tiquet.
+        Retorna {establishment_id, score, method} o None si no n'hi ha cap
+        amb prou confiança.
+        """
+        self.lookups += 1
+        key = normalize_nif(nif)
+        ids = self._by_nif.get(key) if key else None
+        if ids:
+            if len(ids) == 1:
+                return {"establishment_id": next(iter(ids)), "score": 1.0, "method": "nif"}
+            # NIF repetit (p.ex. una empresa amb diverses botigues): decideix el nom
+            query = normalize_name(name)
+            query_grams = trigrams(query)
+            best = max(ids, key=lambda i: self._name_score(query, query_grams, i) if query else 0)
+            return {"establishment_id": best, "score": 1.0, "method": "nif"}
+
+        # Nom idèntic un cop normalitzat ("SAITAMA CAFE" = "Saitama Café, S.L.")
+        exact = self._by_name.get(normalize_name(name)) if name else None
+        if exact and len(exact) == 1:
+            return {"establishment_id": next(iter(exact)), "score": 1.0, "method": "name"}
+
+        candidates = self.candidates(name, limit=2) if name else []
+        if not candidates or candidates[0]["score"] < NAME_MATCH_THRESHOLD:
+            return None
+        if len(candidates) > 1 and candidates[0]["score"] - candidates[1]["score"] < AMBIGUITY_MARGIN:
+            return None
+        return candidates[0]
+
+    def stats(self) -> dict:
+        return {
+            "establishments": len(self._entries),
+            "nifs": len(self._by_nif),
+            "trigrams": len(self._trigrams),
+            "refreshes": self.refreshes,
+            "lookups": self.lookups,
+        }
+
+
+establishment_matcher = EstablishmentMatcher()
+add_invalidation_listener(ESTABLISHMENTS, establishment_matcher.schedule_refresh)
+
+
+async def match_ticket_establishment(nif: Optional[str], name: Optional[str]) -> Optional[dict]:
+    """Coincidència per al tiquet; carrega l'índex la primera vegada"""
+    if not establishment_matcher.loaded:
+        await establishment_matcher.refresh()
+    elif time.monotonic() - establishment_matcher.refreshed_at > MAX_AGE:
+        establishment_matcher.schedule_refresh()
+    return establishment_matcher.match(nif, name)
+
+
+def get_matcher_stats() -> dict:
+    return establishment_matcher.stats()
@@ -0,0 +1,91 @@
+"""
+Servidor local que imita l'API push d'Expo per a proves
+Respon /--/api/v2/push/send i /--/api/v2/push/getReceipts amb el mateix format
+que Expo. Els tokens que contenen "INVALID" retornen DeviceNotRegistered
+(al tiquet si contenen "INVALID_TICKET", al rebut en cas contrari).
+
+Ús:
+    python expo_push_stub.py [--port 8090] [--latency 0.05]
+
+    EXPO_PUSH_URL=http://localhost:8090/--/api/v2/push/send \\
+    EXPO_RECEIPTS_URL=http://localhost:8090/--/api/v2/push/getReceipts \\
+    EXPO_RECEIPT_DELAY=5 uvicorn server:app
+"""
+import argparse
+import asyncio
+import uuid
+
+from aiohttp import web
+
+MAX_MESSAGES = 100
+
+receipts = {}
+stats = {"requests": 0, "messages": 0, "max_batch": 0, "receipt_requests": 0}
+
+
+def _unregistered(token: str) -> dict:
+    return {
+        "status": "error",
+        "message": f"\"{token}\" is not a registered push notification recipient",
+        "details": {"error": "DeviceNotRegistered"},
+    }
+
+
+async def send(request: web.Request):
+    messages = await request.json()
+    if isinstance(messages, dict):
+        messages = [messages]
+
+    stats["requests"] += 1
+    stats["messages"] += len(messages)
+    stats["max_batch"] = max(stats["max_batch"], len(messages))
+
+    if len(messages) > MAX_MESSAGES:
+        return web.json_response({"errors": [{
+            "code": "PUSH_TOO_MANY_NOTIFICATIONS",
+            "message": f"You are trying to send more than {MAX_MESSAGES} push notifications in one request",
+        }]}, status=400)
+
+    await asyncio.sleep(request.app["latency"])
+
+    tickets = []
+    for message in messages:
+        token = message.get("to", "")
+        if "INVALID_TICKET" in token:
+            tickets.append(_unregistered(token))
+            continue
+        receipt_id = str(uuid.uuid4())
+        receipts[receipt_id] = _unregistered(token) if "INVALID" in token else {"status": "ok"}
+        tickets.append({"status": "ok", "id": receipt_id})
+
+    return web.json_response({"data": tickets})
+
+
+async def get_receipts(request: web.Request):
+    payload = await request.json()
+    stats["receipt_requests"] += 1
+    data = {rid: receipts.pop(rid) for rid in payload.get("ids", []) if rid in receipts}
+    return web.json_response({"data": data})
+
+
+async def get_stats(request: web.Request):
+    return web.json_response({**stats, "pending_receipts": len(receipts)})
+
+
+def create_app(latency: float = 0.05) -> web.Application:
+    app = web.Application(client_max_size=10 * 1024 * 1024)
+    app["latency"] = latency
+    app.router.add_post("/--/api/v2/push/send", send)
+    app.router.add_post("/--/api/v2/push/getReceipts", get_receipts)
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", type=float, default=0.05, help="Latència simulada per petició (s)")
+    args = parser.parse_args()
+
+    print(f"📡 Stub d'Expo escoltant a http://localhost:{args.port}")
+    web.run_app(create_app(args.latency), port=args.port, print=None)
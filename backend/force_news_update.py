@@ -3,11 +3,17 @@
 Script per forçar l'actualització de notícies
 """
 import asyncio
-from news_scheduler import scheduled_news_update
+from motor.motor_asyncio import AsyncIOMotorClient
+from news_scheduler import scheduled_news_update, set_database, MONGO_URL, DB_NAME
+from news_scraper import close_news_client
 
 async def main():
     print("🚀 Forçant actualització de notícies...")
+    client = AsyncIOMotorClient(MONGO_URL)
+    set_database(client[DB_NAME])
     await scheduled_news_update()
+    await close_news_client()
+    client.close()
     print("✅ Actualització completada!")
 
 if __name__ == "__main__":
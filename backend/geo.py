@@ -0,0 +1,171 @@
+"""
+Consultes geoespacials dels establiments
+Camp GeoJSON "location" (Point [lon, lat]) derivat de latitude/longitude,
+amb índex 2dsphere, per buscar establiments propers i els del mapa visible
+"""
+import logging
+from typing import List, Optional
+
+from fastapi import HTTPException
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+NEARBY_MAX_RADIUS = 20000  # metres
+NEARBY_MAX_LIMIT = 100
+BBOX_MAX_RESULTS = 2000
+
+# Camps retornats per les consultes del mapa (sense descripcions ni galeries)
+NEARBY_PROJECTION = {
+    "name": 1, "commercial_name": 1, "category": 1, "subcategory": 1, "address": 1,
+    "phone": 1, "image_url": 1, "logo_url": 1, "latitude": 1, "longitude": 1,
+}
+MARKER_PROJECTION = {"name": 1, "category": 1, "address": 1, "latitude": 1, "longitude": 1}
+
+# Establiments públics: socis actius i visibles
+PUBLIC_ESTABLISHMENTS_QUERY = {
+    "$and": [
+        # Només socis actius
+        {"status": "A Soci"},
+        # I visibles públicament
+        {
+            "$or": [
+                {"visible_in_public_list": True},
+                {"visible_in_public_list": {"$exists": False}}  # Per compatibilitat amb establiments antics
+            ]
+        }
+    ]
+}
+
+
+def _coordinate(value) -> Optional[float]:
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value == value else None  # NaN
+
+
+def geo_point(latitude, longitude) -> Optional[dict]:
+    """Punt GeoJSON a partir de latitud/longitud, o None si no són vàlides"""
+    lat, lon = _coordinate(latitude), _coordinate(longitude)
+    if lat is None or lon is None:
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    # 0,0 és el valor per defecte d'alguns imports, no una ubicació real
+    if lat == 0 and lon == 0:
+        return None
+    return {"type": "Point", "coordinates": [lon, lat]}
+
+
+def with_location(doc: dict, existing: Optional[dict] = None) -> dict:
+    """
+    Afegir "location" a un document nou o a un $set que canvia les coordenades.
+    En una actualització parcial, la coordenada que no canvia es pren d'existing.
+    """
+    if "latitude" not in doc and "longitude" not in doc:
+        return doc
+    existing = existing or {}
+    doc["location"] = geo_point(
+        doc.get("latitude", existing.get("latitude")),
+        doc.get("longitude", existing.get("longitude")),
+    )
+    return doc
+
+
+async def sync_location(db, establishment_id) -> Optional[dict]:
+    """Recalcular "location" d'un establiment a partir de les coordenades desades"""
+    est = await db.establishments.find_one({"_id": establishment_id}, {"latitude": 1, "longitude": 1})
+    if not est:
+        return None
+    location = geo_point(est.get("latitude"), est.get("longitude"))
+    await db.establishments.update_one({"_id": establishment_id}, {"$set": {"location": location}})
+    return location
+
+
+async def backfill_locations(db) -> int:
+    """Omplir "location" dels establiments que encara no el tenen (idempotent)"""
+    operations = []
+    async for est in db.establishments.find({"location": {"$exists": False}}, {"latitude": 1, "longitude": 1}):
+        operations.append(UpdateOne(
+            {"_id": est["_id"]},
+            {"$set": {"location": geo_point(est.get("latitude"), est.get("longitude"))}}
+        ))
+    if not operations:
+        return 0
+    await db.establishments.bulk_write(operations, ordered=False)
+    logger.info(f"[GEO] Camp location omplert per {len(operations)} establiments")
+    return len(operations)
+
+
+def _serialize(doc: dict) -> dict:
+    doc['_id'] = str(doc['_id'])
+    doc['id'] = doc['_id']
+    if "distance" in doc:
+        doc["distance"] = round(doc["distance"])
+    return doc
+
+
+def parse_bbox(bbox: str) -> List[float]:
+    """bbox=oest,sud,est,nord (lon, lat, lon, lat) com Leaflet toBBoxString()"""
+    try:
+        west, south, east, north = [float(v) for v in bbox.split(",")]
+    except (AttributeError, ValueError):
+        raise HTTPException(status_code=400, detail="bbox ha de ser oest,sud,est,nord")
+    if not (-180 <= west <= 180 and -180 <= east <= 180 and -90 <= south < north <= 90):
+        raise HTTPException(status_code=400, detail="bbox fora de rang")
+    return [west, south, east, north]
+
+
+def bbox_polygon(west: float, south: float, east: float, north: float) -> dict:
+    return {
+        "type": "Polygon",
+        "coordinates": [[[west, south], [east, south], [east, north], [west, north], [west, south]]],
+    }
+
+
+async def nearby_establishments(
+    db,
+    lat: float,
+    lon: float,
+    radius: float,
+    base_query: dict,
+    limit: int = 20,
+    offset: int = 0,
+) -> dict:
+    """Establiments dins del radi (metres) ordenats per distància, paginats"""
+    point = geo_point(lat, lon)
+    if point is None:
+        raise HTTPException(status_code=400, detail="Coordenades invàlides")
+    radius = max(1, min(radius, NEARBY_MAX_RADIUS))
+    limit = max(1, min(limit, NEARBY_MAX_LIMIT))
+    offset = max(0, offset)
+
+    docs = await db.establishments.aggregate([
+        {"$geoNear": {
+            "near": point,
+            "distanceField": "distance",
+            "maxDistance": radius,
+            "query": base_query,
+            "spherical": True,
+            "key": "location",
+        }},
+        {"$skip": offset},
+        {"$limit": limit + 1},
+        {"$project": {**NEARBY_PROJECTION, "distance": 1}},
+    ]).to_list(limit + 1)
+
+    has_more = len(docs) > limit
+    return {
+        "items": [_serialize(doc) for doc in docs[:limit]],
+        "next_offset": offset + limit if has_more else None,
+        "has_more": has_more,
+    }
+
+
+async def establishments_in_bbox(db, bbox: List[float], base_query: dict) -> List[dict]:
+    """Marcadors dels establiments dins del rectangle visible del mapa"""
+    query = {"$and": [base_query, {"location": {"$geoWithin": {"$geometry": bbox_polygon(*bbox)}}}]}
+    docs = await db.establishments.find(query, MARKER_PROJECTION).limit(BBOX_MAX_RESULTS).to_list(BBOX_MAX_RESULTS)
+    return [_serialize(doc) for doc in docs]
@@ -0,0 +1,203 @@
+"""
+Motor de cobraments de Targetes Regal
+Operacions atòmiques amb guardes condicionals ($inc només si hi ha saldo)
+i un document de saldo desnormalitzat per usuari (gift_card_balances).
+
+Ordre d'un cobrament:
+1. Reserva atòmica al saldo de l'usuari (balance >= import). És la guarda
+   que impedeix que dos cobraments simultanis deixin el saldo en negatiu.
+2. Descompte FIFO de les targetes amb find_one_and_update (una per targeta).
+3. Alliberament de la reserva, $inc del saldo del botiguer i registre de la
+   transacció.
+
+Mentre un cobrament té una reserva pendent (camp pending) el saldo i les
+targetes no quadren, i per això el saldo només es recalcula sense reserves
+pendents i amb una guarda de versió (cada $inc del document la incrementa).
+"""
+import asyncio
+import logging
+from datetime import datetime
+from typing import Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+
+class InsufficientBalance(Exception):
+    def __init__(self, available: float):
+        self.available = available
+        super().__init__(f"Saldo insuficient: {available:.2f}€")
+
+
+# Reintents del recàlcul del saldo mentre hi ha cobraments en curs
+REBUILD_ATTEMPTS = 5
+REBUILD_RETRY_DELAY = 0.05
+
+
+def _money(value) -> float:
+    return round(float(value or 0), 2)
+
+
+async def _cards_balance(db, user_id: str) -> float:
+    result = await db.gift_cards.aggregate([
+        {"$match": {"user_id": user_id, "status": "active"}},
+        {"$group": {"_id": None, "balance": {"$sum": "$balance"}}}
+    ]).to_list(1)
+    return _money(result[0]["balance"]) if result else 0.0
+
+
+async def rebuild_user_balance(db, user_id: str) -> float:
+    """
+    Recalcular el saldo desnormalitzat a partir de les targetes actives
+    Si hi ha cobraments en curs s'espera que acabin; si el document canvia
+    entre la lectura i l'escriptura es torna a calcular.
+    """
+    for attempt in range(REBUILD_ATTEMPTS):
+        doc = await db.gift_card_balances.find_one({"_id": user_id})
+        if doc is not None and _money(doc.get("pending")) > 0:
+            await asyncio.sleep(REBUILD_RETRY_DELAY * (attempt + 1))
+            continue
+
+        balance = await _cards_balance(db, user_id)
+        now = datetime.utcnow()
+        if doc is None:
+            try:
+                await db.gift_card_balances.insert_one(
+                    {"_id": user_id, "balance": balance, "pending": 0.0, "version": 0, "updated_at": now}
+                )
+                return balance
+            except DuplicateKeyError:
+                # Creat alhora per una altra petició: es recalcula sobre el seu document
+                continue
+
+        result = await db.gift_card_balances.update_one(
+            {"_id": user_id, "version": doc.get("version")},
+            {"$set": {"balance": balance, "pending": 0.0, "updated_at": now}, "$inc": {"version": 1}}
+        )
+        if result.matched_count:
+            return balance
+
+    logger.warning(f"[GIFT CARDS] No s'ha pogut recalcular el saldo de {user_id} (cobraments en curs)")
+    return await get_user_balance(db, user_id)
+
+
+async def get_user_balance(db, user_id: str) -> float:
+    """Saldo de l'usuari (O(1) amb el document desnormalitzat)"""
+    doc = await db.gift_card_balances.find_one({"_id": user_id})
+    if doc is None:
+        return await rebuild_user_balance(db, user_id)
+    return _money(doc.get("balance"))
+
+
+async def credit_user_balance(db, user_id: str, amount: float):
+    """Sumar saldo (nova targeta). Si no hi ha document, es reconstrueix"""
+    result = await db.gift_card_balances.update_one(
+        {"_id": user_id},
+        {"$inc": {"balance": _money(amount), "version": 1}, "$set": {"updated_at": datetime.utcnow()}}
+    )
+    if result.matched_count == 0:
+        await rebuild_user_balance(db, user_id)
+
+
+async def _reserve(db, user_id: str, amount: float) -> Optional[dict]:
+    return await db.gift_card_balances.find_one_and_update(
+        {"_id": user_id, "balance": {"$gte": amount}},
+        {"$inc": {"balance": -amount, "pending": amount, "version": 1}, "$set": {"updated_at": datetime.utcnow()}},
+        return_document=ReturnDocument.AFTER
+    )
+
+
+async def _release(db, user_id: str, amount: float, refund: bool = False):
+    """Tancar la reserva d'un cobrament (refund: tornar-ne l'import al saldo)"""
+    inc = {"pending": -amount, "version": 1}
+    if refund:
+        inc["balance"] = amount
+    await db.gift_card_balances.update_one(
+        {"_id": user_id}, {"$inc": inc, "$set": {"updated_at": datetime.utcnow()}}
+    )
+
+
+async def _take_from_oldest_card(db, user_id: str, remaining: float) -> Optional[tuple]:
+    """Descomptar de la targeta activa més antiga. Retorna (targeta, import descomptat)"""
+    before = await db.gift_cards.find_one_and_update(
+        {"user_id": user_id, "status": "active", "balance": {"$gt": 0}},
+        [
+            {"$set": {"balance": {"$round": [
+                {"$subtract": ["$balance", {"$min": ["$balance", remaining]}]}, 2
+            ]}}},
+            {"$set": {"status": {"$cond": [{"$lte": ["$balance", 0]}, "used", "$status"]}}},
+        ],
+        sort=[("created_at", 1)],
+        projection={"balance": 1},
+        return_document=ReturnDocument.BEFORE
+    )
+    if before is None:
+        return None
+    return before["_id"], _money(min(before.get("balance", 0), remaining))
+
+
+async def charge(db, customer_id: str, establishment: dict, amount: float) -> dict:
+    """
+    Cobrar un import de les targetes d'un client i abonar-lo al botiguer.
+    Llença InsufficientBalance si el client no té prou saldo.
+    """
+    amount = _money(amount)
+
+    # 1. Reserva atòmica
+    reserved = await _reserve(db, customer_id, amount)
+    if reserved is None:
+        # Pot ser que el document de saldo encara no existeixi: reconstruir i reintentar
+        if await db.gift_card_balances.find_one({"_id": customer_id}, {"_id": 1}) is None:
+            await rebuild_user_balance(db, customer_id)
+            reserved = await _reserve(db, customer_id, amount)
+        if reserved is None:
+            raise InsufficientBalance(await get_user_balance(db, customer_id))
+
+    # 2. Descompte FIFO de les targetes
+    remaining = amount
+    taken = []
+    while remaining > 0.001:
+        step = await _take_from_oldest_card(db, customer_id, remaining)
+        if step is None:
+            break
+        taken.append(step)
+        remaining = _money(remaining - step[1])
+
+    if remaining > 0.001:
+        # El saldo desnormalitzat no quadrava amb les targetes: desfer i recalcular
+        logger.error(f"[GIFT CARDS] Saldo desquadrat per {customer_id}, falten {remaining:.2f}€")
+        for card_id, value in taken:
+            await db.gift_cards.update_one(
+                {"_id": card_id},
+                {"$inc": {"balance": value}, "$set": {"status": "active"}}
+            )
+        await _release(db, customer_id, amount, refund=True)
+        available = await rebuild_user_balance(db, customer_id)
+        raise InsufficientBalance(available)
+
+    # 3. Alliberar la reserva, abonar al botiguer i registrar la transacció
+    await _release(db, customer_id, amount)
+    shop = await db.establishments.find_one_and_update(
+        {"_id": establishment["_id"]},
+        {"$inc": {"gift_card_balance": amount}},
+        projection={"gift_card_balance": 1},
+        return_document=ReturnDocument.AFTER
+    )
+
+    await db.gift_card_transactions.insert_one({
+        "type": "gift_card_charge",
+        "customer_id": customer_id,
+        "shop_id": str(establishment["_id"]),
+        "shop_name": establishment.get("name", ""),
+        "amount": amount,
+        "cards": [{"card_id": str(card_id), "amount": value} for card_id, value in taken],
+        "created_at": datetime.utcnow(),
+    })
+
+    return {
+        "amount": amount,
+        "new_balance": _money(reserved.get("balance")),
+        "shop_balance": _money(shop.get("gift_card_balance")) if shop else amount,
+    }
@@ -16,8 +16,11 @@ from datetime import datetime
 from bson import ObjectId
 import secrets
 import logging
-import random
 import io
+from auth_cache import resolve_user, invalidate_user
+from pagination import paginated_response
+from draw_engine import weighted_draw
+from live_events import publish, publish_to_user, user_topic
 
 logger = logging.getLogger(__name__)
 
@@ -83,18 +86,14 @@ class ScanQRRequest(BaseModel):
 class RaffleExecuteRequest(BaseModel):
     """Sol·licitud per executar un sorteig"""
     num_winners: int = Field(1, ge=1, le=10, description="Nombre de guanyadors")
+    seed: Optional[int] = Field(None, description="Llavor per reproduir el sorteig (opcional)")
 
 
 # ============== HELPER FUNCTIONS ==============
 
 async def get_user_from_token(authorization: str):
     """Obtenir usuari des del token"""
-    if not authorization:
-        return None
-    
-    token = authorization.replace("Bearer ", "")
-    user = await db.users.find_one({"token": token})
-    return user
+    return await resolve_user(db, authorization)
 
 
 def generate_qr_code():
@@ -658,6 +657,16 @@ async def scan_qr_code(request: ScanQRRequest, authorization: str = Header(None)
     )
     
     logger.info(f"Usuari {user.get('email')} ha escanejat QR {qr_code} de la campanya {campaign['name']}")
+
+    # Altres dispositius de l'usuari (p. ex. la cartilla oberta a la web)
+    await publish_to_user(user_id, "gimcana_progress", {
+        "campaign_id": campaign_id,
+        "qr_code": qr_code,
+        "scanned_count": progress['scanned_count'],
+        "total": campaign['total_qr_codes'],
+        "completed": progress['completed'],
+        "just_completed": completed_now
+    })
     
     return {
         "success": True,
@@ -707,6 +716,12 @@ async def enter_raffle(campaign_id: str, authorization: str = Header(None)):
             "entered_raffle_at": datetime.utcnow()
         }}
     )
+    await publish_to_user(user_id, "gimcana_progress", {
+        "campaign_id": campaign_id,
+        "scanned_count": progress.get('scanned_count', 0),
+        "completed": True,
+        "entered_raffle": True
+    })
     
     return {
         "success": True,
@@ -717,20 +732,23 @@ async def enter_raffle(campaign_id: str, authorization: str = Header(None)):
 # ============== ADMIN STATISTICS ==============
 
 @gimcana_router.get("/campaigns/{campaign_id}/participants")
-async def get_participants(campaign_id: str, authorization: str = Header(None)):
+async def get_participants(
+    campaign_id: str,
+    authorization: str = Header(None),
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    format: Optional[str] = None
+):
     """Obtenir llista de participants d'una campanya (només admin)"""
     user = await get_user_from_token(authorization)
     if not user or user.get('role') != 'admin':
         raise HTTPException(status_code=403, detail="Només els administradors poden veure els participants")
     
-    participants = await db.gimcana_progress.find({"campaign_id": campaign_id}).sort("scanned_count", -1).to_list(1000)
-    
     campaign = await db.gimcana_campaigns.find_one({"_id": ObjectId(campaign_id)})
     total_qr = campaign['total_qr_codes'] if campaign else 0
     
-    result = []
-    for p in participants:
-        result.append({
+    def participant_row(p):
+        return {
             "_id": str(p['_id']),
             "user_name": p.get('user_name', 'Usuari'),
             "user_email": p.get('user_email', ''),
@@ -740,9 +758,16 @@ async def get_participants(campaign_id: str, authorization: str = Header(None)):
             "completed_at": p.get('completed_at'),
             "entered_raffle": p.get('entered_raffle', False),
             "created_at": p.get('created_at')
-        })
+        }
     
-    return result
+    # No cal carregar el diccionari scanned_codes
+    return await paginated_response(
+        db.gimcana_progress, {"campaign_id": campaign_id},
+        limit=limit, cursor=cursor, format=format,
+        projection={"scanned_codes": 0},
+        sort_field="scanned_count",
+        transform=participant_row
+    )
 
 
 @gimcana_router.get("/campaigns/{campaign_id}/raffle-participants")
@@ -796,20 +821,25 @@ async def execute_raffle(campaign_id: str, request: RaffleExecuteRequest, author
     if campaign.get('raffle_executed'):
         raise HTTPException(status_code=400, detail="El sorteig ja s'ha executat per aquesta campanya")
     
-    # Obtenir participants elegibles (els que han completat i entrat al sorteig)
-    participants = await db.gimcana_progress.find({
+    # Participants elegibles (els que han completat i entrat al sorteig)
+    eligible_query = {
         "campaign_id": campaign_id,
         "completed": True,
         "entered_raffle": True
-    }).to_list(10000)
+    }
     
-    if len(participants) == 0:
-        raise HTTPException(status_code=400, detail="No hi ha participants elegibles per al sorteig")
+    # Seleccionar guanyadors aleatoris (tots amb el mateix pes)
+    draw = await weighted_draw(
+        db.gimcana_progress.find(eligible_query, {"scanned_codes": 0}).sort("_id", 1),
+        request.num_winners,
+        seed=request.seed
+    )
     
-    num_winners = min(request.num_winners, len(participants))
+    if draw.total_participants == 0:
+        raise HTTPException(status_code=400, detail="No hi ha participants elegibles per al sorteig")
     
-    # Seleccionar guanyadors aleatoris
-    winners = random.sample(participants, num_winners)
+    winners = draw.winners
+    num_winners = len(winners)
     
     # Preparar dades dels guanyadors
     winners_data = []
@@ -833,6 +863,7 @@ async def execute_raffle(campaign_id: str, request: RaffleExecuteRequest, author
                 }
             }
         )
+        invalidate_user(winner['user_id'])
         
         # Marcar el participant com a guanyador
         await db.gimcana_progress.update_one(
@@ -845,24 +876,27 @@ async def execute_raffle(campaign_id: str, request: RaffleExecuteRequest, author
         )
     
     # Marcar a tots els participants (guanyadors i no guanyadors)
-    for p in participants:
-        await db.users.update_one(
-            {"_id": ObjectId(p['user_id'])},
-            {
-                "$addToSet": {
-                    "tags": f"gimcana_participant_{campaign_id}"
-                }
+    participant_ids = await db.gimcana_progress.distinct("user_id", eligible_query)
+    await db.users.update_many(
+        {"_id": {"$in": [ObjectId(uid) for uid in participant_ids if ObjectId.is_valid(uid)]}},
+        {
+            "$addToSet": {
+                "tags": f"gimcana_participant_{campaign_id}"
             }
-        )
+        }
+    )
+    for uid in participant_ids:
+        invalidate_user(uid)
     
     # Actualitzar campanya amb el resultat del sorteig
     raffle_result = {
         "executed_at": datetime.utcnow(),
         "executed_by": str(user['_id']),
         "executed_by_name": user.get('name', 'Admin'),
-        "total_participants": len(participants),
+        "total_participants": draw.total_participants,
         "num_winners": num_winners,
-        "winners": winners_data
+        "winners": winners_data,
+        "draw_audit": draw.audit()
     }
     
     await db.gimcana_campaigns.update_one(
@@ -884,13 +918,32 @@ async def execute_raffle(campaign_id: str, request: RaffleExecuteRequest, author
     }
     await db.gimcana_raffles.insert_one(raffle_record)
     
-    logger.info(f"Sorteig executat per campanya {campaign.get('name')}: {num_winners} guanyadors de {len(participants)} participants")
+    # Avisar els participants connectats del resultat
+    for winner in winners_data:
+        await publish_to_user(winner['user_id'], "raffle_result", {
+            "source": "gimcana",
+            "campaign_id": campaign_id,
+            "campaign_name": campaign.get('name'),
+            "won": True,
+            "position": winner['position'],
+            "prize_description": campaign.get('prize_description', '')
+        })
+    winner_ids = {winner['user_id'] for winner in winners_data}
+    await publish([user_topic(uid) for uid in participant_ids if uid not in winner_ids], "raffle_result", {
+        "source": "gimcana",
+        "campaign_id": campaign_id,
+        "campaign_name": campaign.get('name'),
+        "won": False
+    })
+    
+    logger.info(f"Sorteig executat per campanya {campaign.get('name')}: {num_winners} guanyadors de {draw.total_participants} participants (llavor {draw.seed})")
     
     return {
         "success": True,
         "message": f"Sorteig executat correctament! {num_winners} guanyador(s) seleccionat(s)",
-        "total_participants": len(participants),
-        "winners": winners_data
+        "total_participants": draw.total_participants,
+        "winners": winners_data,
+        "seed": str(draw.seed)
     }
 
 
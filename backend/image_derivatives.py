@@ -0,0 +1,187 @@
+"""
+Derivats de les imatges pujades (miniatura, mitjana i gran, en WebP i JPEG)
+Les fotos arriben a resolució de càmera; després de la pujada es generen en
+un pool de processos (fora del bucle d'esdeveniments) versions reduïdes sense
+EXIF (ni GPS ni orientació: la rotació s'aplica als píxels).
+
+/api/uploads/{nom}?w=300 serveix el derivat més petit que cobreix l'amplada
+demanada, en WebP si el client l'accepta. Si encara no s'ha generat (o és una
+imatge antiga) es serveix l'original.
+
+Ús per generar els derivats de les imatges ja pujades:
+    python image_derivatives.py --backfill
+"""
+import os
+import asyncio
+import logging
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+from urllib.parse import urlsplit
+
+from PIL import Image, ImageOps
+
+logger = logging.getLogger(__name__)
+
+UPLOAD_DIR = Path(__file__).parent / "uploads"
+DERIVATIVES_DIR = UPLOAD_DIR / "derivatives"
+UPLOAD_URL_PREFIX = "/api/uploads/"
+
+# Costat llarg màxim de cada derivat, de menor a major
+SIZES = {"thumb": 240, "medium": 720, "large": 1440}
+THUMBNAIL_WIDTH = SIZES["thumb"]
+WEBP_QUALITY = 80
+JPEG_QUALITY = 82
+# Formats que es processen (els GIF poden ser animats i es deixen tal qual)
+PROCESSED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', str(min(2, os.cpu_count() or 1))))
+
+_pool: Optional[ProcessPoolExecutor] = None
+_tasks = set()
+
+
+def _derivative_path(stem: str, size: str, ext: str) -> Path:
+    return DERIVATIVES_DIR / stem / f"{size}.{ext}"
+
+
+def _save(image: Image.Image, path: Path, **options):
+    """Escriptura atòmica: una petició mai serveix un fitxer a mitges"""
+    tmp = path.with_name(f".{path.name}.tmp")
+    image.save(tmp, **options)
+    os.replace(tmp, path)
+
+
+def build_derivatives(source: str) -> dict:
+    """
+    Generar els derivats d'una imatge (s'executa en un procés del pool).
+    També reescriu l'original sense EXIF.
+    """
+    path = Path(source)
+    with Image.open(path) as original:
+        original.load()
+        image_format = original.format
+        # Aplicar l'orientació EXIF als píxels abans de descartar-la
+        image = ImageOps.exif_transpose(original)
+
+    has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+    image = image.convert("RGBA" if has_alpha else "RGB")
+
+    # Original sense metadades (les fotos de mòbil porten la ubicació GPS)
+    save_format = image_format if image_format in ("JPEG", "PNG", "WEBP") else "PNG"
+    save_image = image if save_format != "JPEG" else image.convert("RGB")
+    _save(save_image, path, format=save_format, quality=92, optimize=True)
+
+    out_dir = DERIVATIVES_DIR / path.stem
+    out_dir.mkdir(parents=True, exist_ok=True)
+    variants = {}
+    for size, max_side in SIZES.items():
+        derivative = image.copy()
+        derivative.thumbnail((max_side, max_side), Image.LANCZOS)
+        _save(derivative, out_dir / f"{size}.webp", format="WEBP", quality=WEBP_QUALITY, method=4)
+        # JPEG no té transparència: fons blanc
+        if derivative.mode == "RGBA":
+            background = Image.new("RGB", derivative.size, (255, 255, 255))
+            background.paste(derivative, mask=derivative.split()[3])
+            derivative = background
+        _save(derivative, out_dir / f"{size}.jpg", format="JPEG", quality=JPEG_QUALITY,
+              optimize=True, progressive=True)
+        variants[size] = {"width": derivative.width, "height": derivative.height}
+        if max(image.size) <= max_side:
+            break  # No s'amplien imatges petites: aquest derivat ja és a mida real
+
+    return {"width": image.width, "height": image.height, "variants": variants}
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _pool
+
+
+async def generate_derivatives(path: Path) -> Optional[dict]:
+    """Generar els derivats al pool de processos; None si el format no es processa"""
+    if path.suffix.lower() not in PROCESSED_EXTENSIONS:
+        return None
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(_get_pool(), build_derivatives, str(path))
+    except Exception as e:
+        logger.error(f"[IMAGES] Error generant derivats de {path.name}: {e}")
+        return None
+    logger.info(f"[IMAGES] Derivats de {path.name}: {', '.join(result['variants'])}")
+    return result
+
+
+def schedule_derivatives(path: Path):
+    """Generar els derivats en segon pla, sense esperar-los"""
+    task = asyncio.get_running_loop().create_task(generate_derivatives(path))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def shutdown_image_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def pick_derivative(filename: str, width: Optional[int], accept: Optional[str]) -> Optional[Path]:
+    """Derivat més petit que cobreix l'amplada demanada (o None per servir l'original)"""
+    if not width:
+        return None
+    stem = Path(filename).stem
+    ext = "webp" if accept and "image/webp" in accept else "jpg"
+    for size, max_side in SIZES.items():
+        if max_side >= width:
+            path = _derivative_path(stem, size, ext)
+            if path.exists():
+                return path
+    # Més ample que el derivat gran: el gran si existeix (l'original pot ser enorme)
+    path = _derivative_path(stem, "large", ext)
+    return path if path.exists() and width <= SIZES["large"] * 2 else None
+
+
+def thumbnail_url(url) -> Optional[str]:
+    """URL de la miniatura per a una imatge pujada a /api/uploads/, o None"""
+    if not isinstance(url, str) or UPLOAD_URL_PREFIX not in urlsplit(url).path:
+        return None
+    if Path(urlsplit(url).path).suffix.lower() not in PROCESSED_EXTENSIONS:
+        return None
+    return f"{url}{'&' if '?' in url else '?'}w={THUMBNAIL_WIDTH}"
+
+
+def with_thumbnail(doc: dict, fields=("logo_url", "image_url", "imatge1_url")) -> dict:
+    """Afegir thumbnail_url a un element d'un llistat a partir de la primera imatge pujada"""
+    for field in fields:
+        url = thumbnail_url(doc.get(field))
+        if url:
+            doc["thumbnail_url"] = url
+            break
+    return doc
+
+
+async def backfill():
+    """Generar els derivats de les imatges pujades que encara no en tenen"""
+    pending = [
+        path for path in sorted(UPLOAD_DIR.iterdir())
+        if path.is_file() and path.suffix.lower() in PROCESSED_EXTENSIONS
+        and not _derivative_path(path.stem, "thumb", "jpg").exists()
+    ]
+    print(f"🖼️ {len(pending)} imatges sense derivats")
+    results = await asyncio.gather(*(generate_derivatives(path) for path in pending))
+    print(f"✅ Derivats generats per {sum(1 for r in results if r)} imatges")
+    shutdown_image_pool()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backfill", action="store_true", help="Generar els derivats de les imatges existents")
+    args = parser.parse_args()
+    if args.backfill:
+        asyncio.run(backfill())
+    else:
+        parser.print_help()
@@ -0,0 +1,323 @@
+"""
+Canal en directe per als usuaris (Server-Sent Events, amb WebSocket com a alternativa)
+En lloc de consultar periòdicament /notifications, /gimcana/my-progress i
+/tickets/my-participations, l'app obre una connexió i rep els esdeveniments:
+
+- notification: notificació nova (massiva o directa)
+- ticket_processed: resultat del processament d'un tiquet
+- participations: participacions del sorteig de tiquets actualitzades
+- gimcana_progress: QR escanejat o inscripció al sorteig de la gimcana
+- raffle_result: resultat d'un sorteig (gimcana o tiquets)
+- resync: s'han perdut esdeveniments (cua plena); cal tornar a consultar
+  (p. ex. /notifications?since=<cursor>)
+
+Cada connexió se subscriu als temes "user:<id>" i a les claus d'audiència de
+l'usuari ("all", "role:...", "tag:..."), les mateixes que les notificacions
+compartides. La distribució (LiveHub) és en memòria; el "broker" decideix com
+arriben els esdeveniments a cada worker:
+- local (per defecte): directament al hub d'aquest procés
+- mongo (LIVE_BROKER=mongo): s'insereixen a live_events i cada worker els
+  llegeix amb un change stream (necessita un replica set, com Atlas)
+
+Publicar mai fa fallar l'operació original: els errors només es registren.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Dict, Iterable, Optional, Set
+
+from fastapi import Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import StreamingResponse
+
+from notification_inbox import user_audience_keys, make_cursor
+
+logger = logging.getLogger(__name__)
+
+LIVE_BROKER = os.getenv('LIVE_BROKER', 'local')
+# Esdeveniments pendents per connexió; si s'omple es descarten els més antics
+LIVE_QUEUE_SIZE = int(os.getenv('LIVE_QUEUE_SIZE', '100'))
+# Batec per mantenir la connexió oberta a través de proxies
+LIVE_PING_INTERVAL = float(os.getenv('LIVE_PING_INTERVAL', '15'))
+LATENCY_SAMPLES = 1000
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def user_topic(user_id) -> str:
+    return f"user:{user_id}"
+
+
+def _encode(data) -> str:
+    return json.dumps(data, default=str, ensure_ascii=False)
+
+
+class Subscription:
+    """Una connexió oberta (SSE o WebSocket) amb la seva cua"""
+
+    def __init__(self, user_id: str, topics: Iterable[str], transport: str):
+        self.user_id = user_id
+        self.topics = list(dict.fromkeys(topics))
+        self.transport = transport
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=LIVE_QUEUE_SIZE)
+        self.lagged = False
+        self.closed = False
+
+    async def next(self, timeout: float) -> Optional[dict]:
+        """Següent esdeveniment; None si passa el temps (toca batec)"""
+        if self.lagged:
+            self.lagged = False
+            return {"type": "resync", "data": {"cursor": make_cursor(datetime.utcnow())}}
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+
+class LiveHub:
+    """Subscripcions per tema i mètriques de distribució d'aquest worker"""
+
+    def __init__(self):
+        self._topics: Dict[str, Set[Subscription]] = {}
+        self._subscriptions: Set[Subscription] = set()
+        self._latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.published = 0
+        self.dispatched = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.connections_total = 0
+
+    def subscribe(self, user: dict, transport: str) -> Subscription:
+        topics = [user_topic(user["_id"])] + user_audience_keys(user)
+        subscription = Subscription(str(user["_id"]), topics, transport)
+        for topic in subscription.topics:
+            self._topics.setdefault(topic, set()).add(subscription)
+        self._subscriptions.add(subscription)
+        self.connections_total += 1
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        subscription.closed = True
+        self._subscriptions.discard(subscription)
+        for topic in subscription.topics:
+            subscribers = self._topics.get(topic)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._topics[topic]
+
+    def dispatch(self, event: dict):
+        """Posar l'esdeveniment a la cua de cada connexió subscrita (una sola vegada per connexió)"""
+        self.dispatched += 1
+        targets = set()
+        for topic in event["topics"]:
+            targets |= self._topics.get(topic, set())
+        for subscription in targets:
+            queue = subscription.queue
+            if queue.full():
+                # Client massa lent: es descarta el més antic i se li demana que es resincronitzi
+                queue.get_nowait()
+                subscription.lagged = True
+                self.dropped += 1
+            queue.put_nowait(event)
+
+    def record_delivery(self, event: dict):
+        self.delivered += 1
+        if event.get("published_at"):
+            self._latencies.append((time.time() - event["published_at"]) * 1000)
+
+    def close_all(self):
+        """Tancar totes les connexions (aturada del servidor)"""
+        for subscription in list(self._subscriptions):
+            subscription.closed = True
+            if subscription.queue.full():
+                subscription.queue.get_nowait()
+            subscription.queue.put_nowait(None)
+
+    def stats(self) -> dict:
+        by_transport: Dict[str, int] = {}
+        for subscription in self._subscriptions:
+            by_transport[subscription.transport] = by_transport.get(subscription.transport, 0) + 1
+        latencies = sorted(self._latencies)
+
+        def percentile(p: float):
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))], 1) if latencies else None
+
+        return {
+            "connections": len(self._subscriptions),
+            "connections_by_transport": by_transport,
+            "connections_total": self.connections_total,
+            "users": len({subscription.user_id for subscription in self._subscriptions}),
+            "topics": len(self._topics),
+            "published": self.published,
+            "dispatched": self.dispatched,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "latency_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(latencies[-1], 1) if latencies else None,
+            },
+        }
+
+
+hub = LiveHub()
+
+
+class LocalBroker:
+    """Un sol worker: els esdeveniments van directament al hub"""
+    name = "local"
+
+    async def publish(self, event: dict):
+        hub.dispatch(event)
+
+    def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+
+class MongoChangeStreamBroker:
+    """Diversos workers: cada esdeveniment es desa a live_events i tots el reben pel change stream"""
+    name = "mongo"
+
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+
+    async def publish(self, event: dict):
+        await db.live_events.insert_one({**event, "created_at": datetime.utcnow()})
+
+    async def _watch(self):
+        resume_token = None
+        while True:
+            try:
+                async with db.live_events.watch([{"$match": {"operationType": "insert"}}],
+                                                resume_after=resume_token) as stream:
+                    async for change in stream:
+                        resume_token = change["_id"]
+                        event = change["fullDocument"]
+                        event.pop("_id", None)
+                        event.pop("created_at", None)
+                        hub.dispatch(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"[LIVE] Error al change stream de live_events: {e}")
+                await asyncio.sleep(5)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+broker = MongoChangeStreamBroker() if LIVE_BROKER == "mongo" else LocalBroker()
+
+
+async def publish(topics: Iterable[str], event_type: str, data: dict):
+    """Publicar un esdeveniment als temes indicats"""
+    topics = list(topics)
+    if not topics:
+        return
+    hub.published += 1
+    try:
+        await broker.publish({"type": event_type, "data": data, "topics": topics, "published_at": time.time()})
+    except Exception as e:
+        logger.warning(f"[LIVE] No s'ha pogut publicar {event_type}: {e}")
+
+
+async def publish_to_user(user_id, event_type: str, data: dict):
+    await publish([user_topic(user_id)], event_type, data)
+
+
+def start_live_events():
+    broker.start()
+    logger.info(f"[LIVE] Canal en directe iniciat (broker {broker.name})")
+
+
+async def stop_live_events():
+    hub.close_all()
+    await broker.stop()
+
+
+def get_live_stats() -> dict:
+    return {"broker": broker.name, **hub.stats()}
+
+
+# --- Transports ---
+
+def _ready_event(subscription: Subscription) -> dict:
+    return {"type": "ready", "data": {"cursor": make_cursor(datetime.utcnow()), "topics": subscription.topics}}
+
+
+def sse_response(request: Request, user: dict) -> StreamingResponse:
+    """Flux text/event-stream de l'usuari fins que el client es desconnecta"""
+    subscription = hub.subscribe(user, "sse")
+
+    async def stream():
+        try:
+            ready = _ready_event(subscription)
+            yield f"event: {ready['type']}\ndata: {_encode(ready['data'])}\n\n"
+            while not subscription.closed:
+                event = await subscription.next(LIVE_PING_INTERVAL)
+                if event is None:
+                    if subscription.closed or await request.is_disconnected():
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield f"event: {event['type']}\ndata: {_encode(event['data'])}\n\n"
+                hub.record_delivery(event)
+        finally:
+            hub.unsubscribe(subscription)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Sense buffer als proxies (nginx)
+        "X-Accel-Buffering": "no",
+    })
+
+
+async def _wait_disconnect(websocket: WebSocket):
+    """Llegir (i ignorar) els missatges del client fins que tanca"""
+    try:
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+
+
+async def websocket_session(websocket: WebSocket, user: dict):
+    """Enviar els esdeveniments de l'usuari com a missatges JSON {type, data}"""
+    await websocket.accept()
+    subscription = hub.subscribe(user, "websocket")
+    receiver = asyncio.create_task(_wait_disconnect(websocket))
+    try:
+        await websocket.send_text(_encode(_ready_event(subscription)))
+        while not receiver.done() and not subscription.closed:
+            event = await subscription.next(LIVE_PING_INTERVAL)
+            if event is None:
+                if not receiver.done() and not subscription.closed:
+                    await websocket.send_text(_encode({"type": "ping"}))
+                continue
+            await websocket.send_text(_encode({"type": event["type"], "data": event["data"]}))
+            hub.record_delivery(event)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        hub.unsubscribe(subscription)
@@ -0,0 +1,290 @@
+"""
+Clústers de marcadors per als mapes (establiments i esdeveniments)
+Agrupa els punts en una graella sobre les tessel·les Web Mercator de cada
+nivell de zoom. L'índex es precalcula quan canvien els establiments i es
+guarda en memòria: una tessel·la es respon sense consultar MongoDB, i el
+pes de la resposta no creix amb el nombre de botigues.
+
+Cada element és un punt {id, lat, lon, category} o un clúster
+{cluster: true, lat, lon, count}.
+"""
+import math
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from bson import ObjectId
+from fastapi import HTTPException, Request, Response
+
+from geo import PUBLIC_ESTABLISHMENTS_QUERY
+from response_cache import (
+    encode_json,
+    etag_matches,
+    catalogue_cache,
+    add_invalidation_listener,
+    ESTABLISHMENTS, EVENTS
+)
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 256
+CELL_SIZE = 64  # píxels: 4x4 cel·les per tessel·la
+MIN_ZOOM = 0
+# Últim zoom agrupat; per sobre es retornen els punts sense agrupar
+CLUSTER_MAX_ZOOM = 16
+POINTS_ZOOM = CLUSTER_MAX_ZOOM + 1
+MAX_ZOOM = 19
+MAX_EVENT_LAYERS = 50
+REBUILD_DELAY = 1.0  # segons: agrupa invalidacions seguides (p.ex. un import)
+
+ESTABLISHMENTS_LAYER = "establishments"
+POINT_PROJECTION = {"category": 1, "location": 1}
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def _project(lat: float, lon: float, zoom: int) -> Tuple[float, float]:
+    """Coordenades en píxels Web Mercator al zoom indicat"""
+    scale = TILE_SIZE * (2 ** zoom)
+    x = (lon + 180.0) / 360.0 * scale
+    sin_lat = min(max(math.sin(math.radians(lat)), -0.9999), 0.9999)
+    y = (0.5 - math.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)) * scale
+    return x, y
+
+
+class ClusterIndex:
+    """Índex precalculat {zoom: {(x, y) tessel·la: [elements]}}"""
+
+    def __init__(self, points: List[dict], version):
+        self.version = version
+        self.count = len(points)
+        self.tiles: Dict[int, Dict[Tuple[int, int], List[dict]]] = {}
+        self.bounds = self._bounds(points)
+        # Signatura del contingut per als ETag
+        self.signature = hashlib.sha1(encode_json(points)).hexdigest()[:16]
+
+        for zoom in range(MIN_ZOOM, CLUSTER_MAX_ZOOM + 1):
+            self.tiles[zoom] = self._cluster(points, zoom)
+
+        # Punts individuals per tessel·la del primer zoom sense agrupar
+        self.points: Dict[Tuple[int, int], List[dict]] = {}
+        for point in points:
+            x, y = _project(point["lat"], point["lon"], POINTS_ZOOM)
+            self.points.setdefault((int(x // TILE_SIZE), int(y // TILE_SIZE)), []).append(point)
+
+    @staticmethod
+    def _bounds(points: List[dict]) -> Optional[List[float]]:
+        if not points:
+            return None
+        lats = [p["lat"] for p in points]
+        lons = [p["lon"] for p in points]
+        return [min(lons), min(lats), max(lons), max(lats)]
+
+    @staticmethod
+    def _cluster(points: List[dict], zoom: int) -> Dict[Tuple[int, int], List[dict]]:
+        cells = {}
+        for point in points:
+            x, y = _project(point["lat"], point["lon"], zoom)
+            cells.setdefault((int(x // CELL_SIZE), int(y // CELL_SIZE)), []).append(point)
+
+        cells_per_tile = TILE_SIZE // CELL_SIZE
+        tiles = {}
+        for (cx, cy), members in cells.items():
+            if len(members) == 1:
+                item = members[0]
+            else:
+                item = {
+                    "cluster": True,
+                    "lat": round(sum(p["lat"] for p in members) / len(members), 6),
+                    "lon": round(sum(p["lon"] for p in members) / len(members), 6),
+                    "count": len(members),
+                }
+            tiles.setdefault((cx // cells_per_tile, cy // cells_per_tile), []).append(item)
+        return tiles
+
+    def tile(self, zoom: int, x: int, y: int) -> List[dict]:
+        if zoom <= CLUSTER_MAX_ZOOM:
+            return self.tiles[zoom].get((x, y), [])
+
+        # Zoom alt: punts de la tessel·la pare al primer zoom sense agrupar
+        shift = zoom - POINTS_ZOOM
+        parent = self.points.get((x >> shift, y >> shift), [])
+        if shift == 0:
+            return parent
+        items = []
+        for point in parent:
+            px, py = _project(point["lat"], point["lon"], zoom)
+            if int(px // TILE_SIZE) == x and int(py // TILE_SIZE) == y:
+                items.append(point)
+        return items
+
+    def summary(self) -> dict:
+        return {"count": self.count, "bounds": self.bounds, "signature": self.signature}
+
+
+def _point(doc: dict) -> Optional[dict]:
+    location = doc.get("location") or {}
+    coordinates = location.get("coordinates") or []
+    if len(coordinates) != 2:
+        return None
+    return {
+        "id": str(doc["_id"]),
+        "lat": round(coordinates[1], 6),
+        "lon": round(coordinates[0], 6),
+        "category": doc.get("category"),
+    }
+
+
+async def _load_points(query: dict) -> List[dict]:
+    query = {"$and": [query, {"location.type": "Point"}]}
+    points = []
+    async for doc in db.establishments.find(query, POINT_PROJECTION).sort("_id", 1):
+        point = _point(doc)
+        if point:
+            points.append(point)
+    return points
+
+
+async def _event_query(event_id: str) -> dict:
+    if not ObjectId.is_valid(event_id):
+        raise HTTPException(status_code=404, detail="Esdeveniment no trobat")
+    event = await db.events.find_one(
+        {"_id": ObjectId(event_id)},
+        {"participating_establishment_ids": 1, "participating_establishments": 1}
+    )
+    if not event:
+        raise HTTPException(status_code=404, detail="Esdeveniment no trobat")
+
+    ids = set(str(i) for i in (event.get("participating_establishment_ids") or []))
+    ids |= set(str(i) for i in (event.get("participating_establishments") or []))
+    values = [ObjectId(i) for i in ids if ObjectId.is_valid(i)] + list(ids)
+    return {"$and": [PUBLIC_ESTABLISHMENTS_QUERY, {"_id": {"$in": values}}]}
+
+
+class ClusterStore:
+    """Índexs per capa, reconstruïts quan canvia la versió del catàleg"""
+
+    def __init__(self):
+        self._layers: "OrderedDict[str, ClusterIndex]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self.builds = 0
+
+    @staticmethod
+    def _version(layer: str):
+        if layer == ESTABLISHMENTS_LAYER:
+            return catalogue_cache.version(ESTABLISHMENTS)
+        return catalogue_cache.version(ESTABLISHMENTS), catalogue_cache.version(EVENTS)
+
+    async def get(self, layer: str) -> ClusterIndex:
+        version = self._version(layer)
+        index = self._layers.get(layer)
+        if index and index.version == version:
+            self._layers.move_to_end(layer)
+            return index
+
+        lock = self._locks.setdefault(layer, asyncio.Lock())
+        if index and lock.locked():
+            # Ja s'està reconstruint: mentrestant es serveix l'índex anterior
+            return index
+
+        async with lock:
+            index = self._layers.get(layer)
+            if index and index.version == self._version(layer):
+                return index
+            try:
+                return await self._build(layer)
+            except HTTPException:
+                self._locks.pop(layer, None)
+                raise
+
+    async def _build(self, layer: str) -> ClusterIndex:
+        version = self._version(layer)
+        if layer == ESTABLISHMENTS_LAYER:
+            query = PUBLIC_ESTABLISHMENTS_QUERY
+        elif layer.startswith("event:"):
+            query = await _event_query(layer.split(":", 1)[1])
+        else:
+            raise HTTPException(status_code=400, detail="Capa de mapa desconeguda")
+
+        points = await _load_points(query)
+        # La construcció és CPU: fora del bucle d'esdeveniments
+        index = await asyncio.to_thread(ClusterIndex, points, version)
+        self.builds += 1
+
+        self._layers[layer] = index
+        self._layers.move_to_end(layer)
+        while len(self._layers) > MAX_EVENT_LAYERS + 1:
+            oldest = next(k for k in self._layers if k != ESTABLISHMENTS_LAYER)
+            self._layers.pop(oldest)
+            self._locks.pop(oldest, None)
+        logger.info(f"[MAP] Índex de clústers '{layer}' reconstruït ({len(points)} punts)")
+        return index
+
+    def schedule_rebuild(self):
+        """Recalcular la capa d'establiments en segon pla després d'un canvi"""
+        if db is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._rebuild_task and not self._rebuild_task.done():
+            return
+
+        async def rebuild():
+            await asyncio.sleep(REBUILD_DELAY)
+            try:
+                await self.get(ESTABLISHMENTS_LAYER)
+            except Exception as e:
+                logger.error(f"[MAP] Error reconstruint els clústers: {e}")
+
+        self._rebuild_task = loop.create_task(rebuild())
+
+    def stats(self) -> dict:
+        return {
+            "layers": {name: index.summary() for name, index in self._layers.items()},
+            "builds": self.builds,
+        }
+
+
+cluster_store = ClusterStore()
+add_invalidation_listener(ESTABLISHMENTS, cluster_store.schedule_rebuild)
+
+
+async def warm_clusters():
+    """Precalcular la capa d'establiments a l'arrencada"""
+    await cluster_store.get(ESTABLISHMENTS_LAYER)
+
+
+async def cluster_tile_response(request: Request, layer: str, zoom: int, x: int, y: int) -> Response:
+    """Elements d'una tessel·la (z/x/y) amb ETag"""
+    if not MIN_ZOOM <= zoom <= MAX_ZOOM or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+        raise HTTPException(status_code=400, detail="Tessel·la fora de rang")
+
+    index = await cluster_store.get(layer)
+    etag = f'"{index.signature}-{zoom}-{x}-{y}"'
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=60"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    body = encode_json({"zoom": zoom, "x": x, "y": y, "items": index.tile(zoom, x, y)})
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def layer_summary(layer: str) -> dict:
+    """Nombre de punts i límits de la capa (per centrar el mapa)"""
+    index = await cluster_store.get(layer)
+    return {"layer": layer, **index.summary()}
+
+
+def get_cluster_stats() -> dict:
+    return cluster_store.stats()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Script per moure els fitxers base64 dels documents al magatzem de fitxers
+- Data URLs (data:image/...;base64,...) dels camps d'imatge -> URL /api/blobs/{sha256}
+- db.images.data_url -> blob_id + url
+- tickets.image -> image_blob_id (privat)
+- consell_comptes / consell_actes file_data -> file_blob_id (privat)
+
+És idempotent: es pot tornar a executar i només tracta el que queda en base64.
+
+Ús:
+    python migrate_blobs.py [--dry-run] [--base-url https://www.reusapp.com]
+"""
+import os
+import asyncio
+import argparse
+import mimetypes
+
+from dotenv import load_dotenv
+from motor.motor_asyncio import AsyncIOMotorClient
+
+import blob_store
+from blob_store import is_data_url, decode_data_url, put_blob, blob_url
+
+load_dotenv()
+
+# Col·leccions amb URLs d'imatge que poden ser data URLs (a qualsevol camp)
+IMAGE_COLLECTIONS = [
+    "establishments", "offers", "events", "promotions", "news", "info_content",
+    "ticket_campaigns", "gimcana_campaigns", "users",
+]
+
+
+class Stats:
+    def __init__(self):
+        self.documents = 0
+        self.fields = 0
+        self.bytes = 0
+        self.deduplicated = 0
+
+    def add(self, blob: dict):
+        self.fields += 1
+        self.bytes += blob["size"]
+        if blob["deduplicated"]:
+            self.deduplicated += 1
+
+
+async def _store(value: str, dry_run: bool, stats: Stats, private: bool = False, filename=None,
+                 default_type: str = "application/octet-stream") -> dict:
+    content_type, data = decode_data_url(value)
+    if content_type == "application/octet-stream":
+        content_type = (mimetypes.guess_type(filename)[0] if filename else None) or default_type
+    if dry_run:
+        blob = {"id": "", "size": len(data), "deduplicated": False}
+    else:
+        blob = await put_blob(data, content_type, filename=filename, private=private)
+    stats.add(blob)
+    return blob
+
+
+async def _rewrite(value, base_url: str, dry_run: bool, stats: Stats):
+    """Substituir data URLs dins d'un valor (string, llista o subdocument)"""
+    if is_data_url(value):
+        return blob_url((await _store(value, dry_run, stats))["id"], base_url), True
+    if isinstance(value, list):
+        changed = False
+        items = []
+        for item in value:
+            new_item, item_changed = await _rewrite(item, base_url, dry_run, stats)
+            items.append(new_item)
+            changed = changed or item_changed
+        return items, changed
+    if isinstance(value, dict):
+        changed = False
+        result = {}
+        for key, item in value.items():
+            result[key], item_changed = await _rewrite(item, base_url, dry_run, stats)
+            changed = changed or item_changed
+        return result, changed
+    return value, False
+
+
+async def migrate_image_fields(db, collection: str, base_url: str, dry_run: bool) -> Stats:
+    stats = Stats()
+    async for doc in db[collection].find({}):
+        update = {}
+        for field, value in doc.items():
+            if field == "_id":
+                continue
+            new_value, changed = await _rewrite(value, base_url, dry_run, stats)
+            if changed:
+                update[field] = new_value
+        if update:
+            stats.documents += 1
+            if not dry_run:
+                await db[collection].update_one({"_id": doc["_id"]}, {"$set": update})
+    return stats
+
+
+async def migrate_images(db, base_url: str, dry_run: bool) -> Stats:
+    stats = Stats()
+    async for doc in db.images.find({"data_url": {"$exists": True}}):
+        blob = await _store(doc["data_url"], dry_run, stats, filename=doc.get("filename"))
+        stats.documents += 1
+        if not dry_run:
+            await db.images.update_one(
+                {"_id": doc["_id"]},
+                {"$set": {"blob_id": blob["id"], "url": blob_url(blob["id"], base_url), "size": blob["size"]},
+                 "$unset": {"data_url": ""}}
+            )
+    return stats
+
+
+async def migrate_private_field(db, collection: str, field: str, target: str, dry_run: bool) -> Stats:
+    stats = Stats()
+    async for doc in db[collection].find({field: {"$type": "string", "$ne": ""}}):
+        is_ticket = collection == "tickets"
+        blob = await _store(doc[field], dry_run, stats, private=True, filename=doc.get("file_name"),
+                            default_type="image/jpeg" if is_ticket else "application/pdf")
+        stats.documents += 1
+        if not dry_run:
+            extra = {"image_hash": blob["id"]} if is_ticket else {"file_size": blob["size"]}
+            await db[collection].update_one(
+                {"_id": doc["_id"]},
+                {"$set": {target: blob["id"], **extra}, "$unset": {field: ""}}
+            )
+    return stats
+
+
+def _report(label: str, stats: Stats):
+    print(f"   {label:<28} {stats.documents:>6} documents, {stats.fields:>6} fitxers, "
+          f"{stats.bytes / 1024 / 1024:>8.1f} MB ({stats.deduplicated} duplicats)")
+
+
+async def main(dry_run: bool, base_url: str):
+    client = AsyncIOMotorClient(os.getenv('MONGO_URL', 'mongodb://localhost:27017/'))
+    db = client[os.getenv('DB_NAME', 'tomb_reus_db')]
+    blob_store.set_database(db)
+
+    print("=" * 80)
+    print("MIGRACIÓ DE FITXERS BASE64 AL MAGATZEM DE FITXERS" + (" (simulació)" if dry_run else ""))
+    print(f"Backend: {blob_store.BLOB_STORE_BACKEND}, URL base: {base_url or '(relativa)'}")
+    print("=" * 80)
+    if not base_url:
+        print("⚠️ Sense --base-url ni PUBLIC_BASE_URL les URLs seran relatives (/api/blobs/...)")
+
+    _report("images", await migrate_images(db, base_url, dry_run))
+    for collection in IMAGE_COLLECTIONS:
+        _report(collection, await migrate_image_fields(db, collection, base_url, dry_run))
+    _report("tickets.image", await migrate_private_field(db, "tickets", "image", "image_blob_id", dry_run))
+    _report("consell_comptes.file_data",
+            await migrate_private_field(db, "consell_comptes", "file_data", "file_blob_id", dry_run))
+    _report("consell_actes.file_data",
+            await migrate_private_field(db, "consell_actes", "file_data", "file_blob_id", dry_run))
+
+    print("✅ Migració completada" if not dry_run else "ℹ️ Simulació completada, no s'ha modificat res")
+    client.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dry-run", action="store_true", help="Comptar sense modificar res")
+    parser.add_argument("--base-url", default=blob_store.PUBLIC_BASE_URL,
+                        help="Base de les URLs públiques (per defecte PUBLIC_BASE_URL)")
+    args = parser.parse_args()
+
+    asyncio.run(main(args.dry_run, args.base_url.rstrip("/")))
@@ -1,141 +1,258 @@
 """
 Sistema de tasques programades per actualització automàtica de notícies
-Execució: 8:00, 14:00 i 20:00 cada dia
+Execució: 8:00, 14:00 i 20:00 cada dia, en un sol worker (vegeu scheduler.py)
+
+Cada execució:
+1. Consulta totes les fonts alhora, amb els validadors (ETag / Last-Modified)
+   de l'execució anterior: els feeds sense canvis responen 304 i no es processen
+2. Descarta amb una sola consulta les URLs que ja són a la base de dades
+3. Desa les seleccionades amb un únic bulk upsert (l'índex únic per URL
+   evita duplicats encara que s'executin dues actualitzacions alhora)
+4. Registra a news_sources l'estat, la latència i les notícies de cada font
+
+Ús manual:
+    python news_scheduler.py            # Executar una actualització
+    python news_scheduler.py --dedupe   # Eliminar URLs duplicades abans de crear l'índex únic
 """
 import asyncio
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+import argparse
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime
+from typing import Dict, List, Tuple
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 import os
 from dotenv import load_dotenv
+from response_cache import invalidate_catalogue, NEWS
+from scheduler import register_job
+from stats_rollups import record_news
 
 load_dotenv()
 
-# Connexió a MongoDB
+# Connexió a MongoDB (només per a l'execució manual)
 MONGO_URL = os.getenv('MONGO_URL', 'mongodb://localhost:27017')
 DB_NAME = os.getenv('DB_NAME', 'tomb_reus_db')
 
+MAX_NEWS_PER_RUN = 6
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
 async def clean_expired_news():
     """Eliminar notícies caducades"""
     try:
-        client = AsyncIOMotorClient(MONGO_URL)
-        db = client[DB_NAME]
-        
         # Eliminar notícies amb expiry_date passat
         result = await db.news.delete_many({
             "expiry_date": {"$exists": True, "$ne": None, "$lt": datetime.utcnow()}
         })
-        
+
         if result.deleted_count > 0:
+            invalidate_catalogue(NEWS)
             print(f"   🗑️  Eliminades {result.deleted_count} notícies caducades")
-        
-        client.close()
     except Exception as e:
         print(f"   ❌ Error eliminant notícies caducades: {str(e)}")
 
+
+async def load_source_state() -> Dict[str, Dict]:
+    """Validadors HTTP de l'última resposta de cada font"""
+    state = {}
+    async for doc in db.news_sources.find({}, {"etag": 1, "last_modified": 1}):
+        state[doc["_id"]] = {"etag": doc.get("etag"), "last_modified": doc.get("last_modified")}
+    return state
+
+
+async def record_sources(results: List[Dict], save_validators: bool = True):
+    """
+    Desar l'estat, la latència i el nombre de notícies de cada font
+    save_validators: desar ETag/Last-Modified (només quan les notícies ja s'han desat;
+    si no, la consulta següent rebria un 304 i es perdrien)
+    """
+    now = datetime.utcnow()
+    operations = []
+    for result in results:
+        update = {
+            "name": result["name"],
+            "url": result["url"],
+            "last_status": result["status"],
+            "last_error": result["error"],
+            "latency_ms": result["latency_ms"],
+            "items": len(result["items"]),
+            "fetched_at": now,
+        }
+        if result["status"] == "ok" and save_validators:
+            update["etag"] = result["etag"]
+            update["last_modified"] = result["last_modified"]
+        operations.append(UpdateOne(
+            {"_id": result["key"]},
+            {"$set": update, "$inc": {f"runs.{result['status']}": 1, "total_items": len(result["items"])}},
+            upsert=True,
+        ))
+    if operations:
+        await db.news_sources.bulk_write(operations, ordered=False)
+
+
+async def store_news_items(news_items: List[Dict]) -> Tuple[int, int]:
+    """
+    Desar notícies noves amb un sol bulk upsert per URL
+    Retorna (noves, duplicades)
+    """
+    unique = list({item['url']: item for item in news_items}.values())
+    if not unique:
+        return 0, len(news_items)
+
+    now = datetime.utcnow()
+    operations = [
+        UpdateOne(
+            {"url": item['url']},
+            {"$setOnInsert": {
+                "title": item['title'],
+                "url": item['url'],
+                "source": item['source'],
+                "created_at": now,
+                "publish_date": now,
+                "is_automatic": True,
+                "category": "general"
+            }},
+            upsert=True,
+        )
+        for item in unique
+    ]
+    try:
+        result = await db.news.bulk_write(operations, ordered=False)
+        upserted = result.upserted_ids
+    except BulkWriteError as e:
+        # Una altra execució ha inserit la mateixa URL alhora: l'índex únic la rebutja
+        if any(error.get("code") != 11000 for error in e.details.get("writeErrors", [])):
+            raise
+        upserted = {entry["index"]: entry["_id"] for entry in e.details.get("upserted", [])}
+
+    for index in sorted(upserted):
+        item = unique[index]
+        print(f"   ✅ {item['title'][:60]}... ({item['source']})")
+
+    inserted_count = len(upserted)
+    if inserted_count:
+        invalidate_catalogue(NEWS)
+        await record_news(inserted_count)
+    return inserted_count, len(news_items) - inserted_count
+
+
+async def run_news_ingestion(max_news: int = MAX_NEWS_PER_RUN) -> Dict:
+    """Obtenir, seleccionar i desar les notícies noves de totes les fonts"""
+    from news_scraper import fetch_all_sources, select_news
+
+    results = await fetch_all_sources(await load_source_state())
+
+    all_news = [item for result in results for item in result['items']]
+    # Invertir l'ordre per tenir les més recents primer
+    all_news = list(reversed(all_news))
+
+    # Només es trien entre les que encara no tenim
+    known = set(await db.news.distinct("url", {"url": {"$in": [item['url'] for item in all_news]}})) if all_news else set()
+    candidates = [item for item in all_news if item['url'] not in known]
+
+    try:
+        selected = await select_news(candidates, max_news) if candidates else []
+        inserted_count, skipped_count = await store_news_items(selected)
+    except Exception:
+        # Sense validadors: la propera execució torna a descarregar les fonts
+        await record_sources(results, save_validators=False)
+        raise
+    await record_sources(results)
+
+    return {
+        "fetched": len(all_news),
+        "known": len(all_news) - len(candidates),
+        "selected": len(selected),
+        "inserted": inserted_count,
+        "skipped": skipped_count + len(all_news) - len(candidates),
+        "sources": [
+            {
+                "source": result['key'],
+                "status": result['status'],
+                "items": len(result['items']),
+                "latency_ms": result['latency_ms'],
+            }
+            for result in results
+        ],
+    }
+
+
 async def scheduled_news_update():
     """Tasca programada per actualitzar notícies"""
     try:
         print(f"\n📰 Actualització automàtica de notícies - {datetime.now().strftime('%d/%m/%Y %H:%M')}")
-        
+
         # Primer, netejar notícies caducades
         await clean_expired_news()
-        
-        from news_scraper import fetch_daily_news
-        
-        # Obtenir notícies
-        news_items = await fetch_daily_news(max_news=6)
-        
-        if not news_items:
-            print("   ⚠️  No s'han trobat notícies")
+
+        summary = await run_news_ingestion()
+
+        if not summary["fetched"]:
+            print("   ⚠️  No s'han trobat notícies noves")
             return
-        
-        # Connectar a la base de dades
-        client = AsyncIOMotorClient(MONGO_URL)
-        db = client[DB_NAME]
-        
-        # Guardar notícies
-        inserted_count = 0
-        skipped_count = 0
-        
-        for item in news_items:
-            # Evitar duplicats
-            existing = await db.news.find_one({"url": item['url']})
-            if not existing:
-                await db.news.insert_one({
-                    "title": item['title'],
-                    "url": item['url'],
-                    "source": item['source'],
-                    "created_at": datetime.utcnow(),
-                    "publish_date": datetime.utcnow(),
-                    "is_automatic": True,
-                    "category": "general"
-                })
-                inserted_count += 1
-                print(f"   ✅ {item['title'][:60]}... ({item['source']})")
-            else:
-                skipped_count += 1
-        
-        print(f"   📊 Resum: {inserted_count} noves, {skipped_count} duplicades\n")
-        
-        client.close()
-        
+
+        print(f"   📊 Resum: {summary['inserted']} noves, {summary['skipped']} duplicades\n")
+
     except Exception as e:
         print(f"   ❌ Error en l'actualització automàtica: {str(e)}\n")
+        raise  # El planificador registra l'execució com a fallida
 
-def start_news_scheduler():
-    """Iniciar el scheduler de notícies"""
-    import logging
-    logger = logging.getLogger(__name__)
-    
-    scheduler = AsyncIOScheduler()
-    
-    # Programar tasques a les 8:00, 14:00 i 20:00
-    scheduler.add_job(
-        scheduled_news_update,
-        CronTrigger(hour=8, minute=0),
-        id='news_morning',
-        name='Notícies matí (8:00)',
-        replace_existing=True
-    )
-    
-    scheduler.add_job(
-        scheduled_news_update,
-        CronTrigger(hour=14, minute=0),
-        id='news_afternoon',
-        name='Notícies migdia (14:00)',
-        replace_existing=True
-    )
-    
-    scheduler.add_job(
+
+async def dedupe_news_urls() -> int:
+    """
+    Eliminar notícies amb URL repetida (es conserva la més antiga)
+    Necessari abans que ensure_indexes pugui crear l'índex únic per URL
+    """
+    removed = 0
+    duplicates = db.news.aggregate([
+        {"$match": {"url": {"$gt": ""}}},
+        {"$sort": {"created_at": 1, "_id": 1}},
+        {"$group": {"_id": "$url", "ids": {"$push": "$_id"}, "count": {"$sum": 1}}},
+        {"$match": {"count": {"$gt": 1}}},
+    ])
+    async for group in duplicates:
+        result = await db.news.delete_many({"_id": {"$in": group["ids"][1:]}})
+        removed += result.deleted_count
+    return removed
+
+
+def register_news_jobs():
+    """
+    Registrar l'actualització de notícies al planificador (8:00, 14:00 i 20:00)
+    Només l'executa el worker líder; la primera vegada, 30 segons després d'arrencar
+    """
+    register_job(
+        "news_update",
+        "Actualització de notícies (8:00, 14:00, 20:00)",
         scheduled_news_update,
-        CronTrigger(hour=20, minute=0),
-        id='news_evening',
-        name='Notícies vespre (20:00)',
-        replace_existing=True
+        CronTrigger(hour="8,14,20", minute=0),
+        first_run_delay=30,
     )
-    
-    scheduler.start()
-    logger.info("Scheduler de notícies iniciat correctament")
-    logger.info("Actualitzacions programades: 8:00, 14:00, 20:00")
-    
-    # Executar una actualització inicial en segon pla (després de 30 segons)
-    import threading
-    def delayed_initial_update():
-        import time
-        time.sleep(30)  # Esperar 30 segons perquè el servidor arrenqui
-        asyncio.run(scheduled_news_update())
-    
-    thread = threading.Thread(target=delayed_initial_update, daemon=True)
-    thread.start()
-    logger.info("Actualització inicial de notícies programada per dins de 30 segons")
-    
-    return scheduler
+
 
 # Per executar manualment
 if __name__ == "__main__":
-    async def test():
-        await scheduled_news_update()
-    
-    asyncio.run(test())
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dedupe", action="store_true", help="Eliminar notícies amb URL duplicada")
+    args = parser.parse_args()
+
+    async def main():
+        from news_scraper import close_news_client
+        client = AsyncIOMotorClient(MONGO_URL)
+        set_database(client[DB_NAME])
+        if args.dedupe:
+            print(f"🗑️  Eliminades {await dedupe_news_urls()} notícies duplicades")
+        else:
+            await scheduled_news_update()
+        await close_news_client()
+        client.close()
+
+    asyncio.run(main())
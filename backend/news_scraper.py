@@ -1,12 +1,16 @@
 """
 Sistema de scraping i processament de notícies locals de Reus
 Utilitza RSS feeds i scraping millorat per màxima fiabilitat
+Totes les fonts es consulten alhora amb un client HTTP compartit; els feeds
+es demanen amb If-None-Match / If-Modified-Since i un 304 no es torna a processar.
 """
 import asyncio
-import requests
+import time
+import httpx
 from bs4 import BeautifulSoup
 from datetime import datetime
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from urllib.parse import urljoin
 import os
 from dotenv import load_dotenv
 # from emergentintegrations.llm.chat import LlmChat, UserMessage
@@ -39,136 +43,241 @@ RSS_FEEDS = {
     }
 }
 
+NEWS_TIMEOUT = float(os.getenv('NEWS_TIMEOUT', '10'))
+MAX_ITEMS_PER_SOURCE = 10
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+_client: Optional[httpx.AsyncClient] = None
+
 # URL Agenda Municipal
 AGENDA_MUNICIPAL_URL = "https://www.reus.cat/ajuntament/lajuntament-informa/agenda"
 
 
-async def fetch_from_rss(feed_url: str, source_name: str) -> List[Dict]:
-    """
-    Obtenir notícies des d'un RSS feed
-    """
-    try:
-        print(f"   📡 RSS {source_name}...")
-        feed = feedparser.parse(feed_url)
+def get_client() -> httpx.AsyncClient:
+    """Client HTTP compartit entre fonts i execucions (reutilitza connexions)"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=NEWS_TIMEOUT,
+            follow_redirects=True,
+            headers={"User-Agent": USER_AGENT, "Accept-Encoding": "gzip, deflate"},
+        )
+    return _client
+
+
+async def close_news_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _parse_feed(content: bytes, source_name: str) -> List[Dict]:
+    feed = feedparser.parse(content)
+    
+    news_items = []
+    for entry in feed.entries[:MAX_ITEMS_PER_SOURCE]:
+        title = entry.get('title', '').strip()
+        link = entry.get('link', '').strip()
         
-        news_items = []
-        for entry in feed.entries[:10]:  # Màxim 10 per font
-            title = entry.get('title', '').strip()
-            link = entry.get('link', '').strip()
-            
-            # Canal Reus sempre és de Reus, no cal filtrar pel títol
-            if source_name == "Canal Reus":
-                if title and link:
-                    news_items.append({
-                        'title': title,
-                        'url': link,
-                        'source': source_name
-                    })
-            # Per altres fonts, filtrar per "reus" al títol
-            elif title and link and 'reus' in title.lower():
+        # Canal Reus sempre és de Reus, no cal filtrar pel títol
+        if source_name == "Canal Reus":
+            if title and link:
                 news_items.append({
                     'title': title,
                     'url': link,
                     'source': source_name
                 })
-        
-        print(f"      ✅ {len(news_items)} notícies trobades")
-        return news_items
+        # Per altres fonts, filtrar per "reus" al títol
+        elif title and link and 'reus' in title.lower():
+            news_items.append({
+                'title': title,
+                'url': link,
+                'source': source_name
+            })
+    return news_items
+
+
+async def fetch_from_rss(
+    client: httpx.AsyncClient,
+    feed_url: str,
+    source_name: str,
+    validators: Optional[Dict] = None,
+) -> Optional[Tuple[List[Dict], Dict]]:
+    """
+    Obtenir notícies des d'un RSS feed amb una petició condicional
+    Retorna (notícies, validadors nous) o None si el feed no ha canviat (304)
+    """
+    headers = {}
+    if validators and validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators and validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
     
-    except Exception as e:
-        print(f"      ❌ Error RSS {source_name}: {str(e)}")
-        return []
+    response = await client.get(feed_url, headers=headers)
+    if response.status_code == 304:
+        return None
+    response.raise_for_status()
+    
+    # feedparser és síncron: fora del bucle d'esdeveniments
+    news_items = await asyncio.to_thread(_parse_feed, response.content, source_name)
+    return news_items, {
+        'etag': response.headers.get('etag'),
+        'last_modified': response.headers.get('last-modified'),
+    }
 
 
-async def scrape_news_from_url(url: str, source_name: str) -> List[Dict]:
+def _parse_html(content: bytes, url: str, source_name: str) -> List[Dict]:
     """
-    Scraping millorat de notícies d'una URL específica
+    Scraping millorat de notícies d'una pàgina
     Busca en múltiples llocs i estructures HTML
     """
-    try:
-        print(f"   🔍 Scraping {source_name}...")
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-        }
-        response = requests.get(url, headers=headers, timeout=10)
-        
-        if response.status_code != 200:
-            print(f"      ❌ Error {response.status_code}")
-            return []
-        
-        soup = BeautifulSoup(response.content, 'html.parser')
-        news_items = []
-        
-        # Estratègia 1: Buscar articles amb classes comunes
-        selectors = [
-            ('article', None),
-            ('div', ['noticia', 'article', 'news-item', 'entry', 'post', 'item']),
-            ('li', ['news-list-item', 'article-item']),
-        ]
+    soup = BeautifulSoup(content, 'html.parser')
+    news_items = []
+    
+    # Estratègia 1: Buscar articles amb classes comunes
+    selectors = [
+        ('article', None),
+        ('div', ['noticia', 'article', 'news-item', 'entry', 'post', 'item']),
+        ('li', ['news-list-item', 'article-item']),
+    ]
+    
+    for tag, classes in selectors:
+        if classes:
+            for cls in classes:
+                articles = soup.find_all(tag, class_=lambda x: x and cls in x if x else False)
+                if articles:
+                    break
+        else:
+            articles = soup.find_all(tag)
         
-        for tag, classes in selectors:
-            if classes:
-                for cls in classes:
-                    articles = soup.find_all(tag, class_=lambda x: x and cls in x if x else False)
-                    if articles:
-                        break
+        if articles and len(articles) > 2:
+            break
+    
+    # Estratègia 2: Si no troba articles, buscar tots els enllaços amb títols
+    if not articles or len(articles) < 3:
+        articles = soup.find_all('a', href=True)
+    
+    for article in articles[:15]:  # Limitar a 15 per font
+        try:
+            # Buscar títol
+            title_elem = article.find(['h1', 'h2', 'h3', 'h4', 'span', 'strong'])
+            if not title_elem:
+                title_elem = article
+            
+            title = title_elem.get_text(strip=True)
+            
+            # Buscar enllaç
+            if article.name == 'a':
+                link = article.get('href', '')
             else:
-                articles = soup.find_all(tag)
+                link_elem = article.find('a', href=True)
+                link = link_elem['href'] if link_elem else ''
             
-            if articles and len(articles) > 2:
-                break
-        
-        # Estratègia 2: Si no troba articles, buscar tots els enllaços amb títols
-        if not articles or len(articles) < 3:
-            articles = soup.find_all('a', href=True)
-        
-        for article in articles[:15]:  # Limitar a 15 per font
-            try:
-                # Buscar títol
-                title_elem = article.find(['h1', 'h2', 'h3', 'h4', 'span', 'strong'])
-                if not title_elem:
-                    title_elem = article
+            # Filtrar notícies vàlides
+            if title and link and len(title) > 20 and len(title) < 200:
+                # Assegurar URL absoluta
+                if not link.startswith('http'):
+                    link = urljoin(url, link)
                 
-                title = title_elem.get_text(strip=True)
-                
-                # Buscar enllaç
-                if article.name == 'a':
-                    link = article.get('href', '')
-                else:
-                    link_elem = article.find('a', href=True)
-                    link = link_elem['href'] if link_elem else ''
-                
-                # Filtrar notícies vàlides
-                if title and link and len(title) > 20 and len(title) < 200:
-                    # Assegurar URL absoluta
-                    if not link.startswith('http'):
-                        from urllib.parse import urljoin
-                        link = urljoin(url, link)
-                    
-                    # Filtrar per "reus" al títol o URL
-                    if 'reus' in title.lower() or 'reus' in link.lower():
-                        news_items.append({
-                            'title': title,
-                            'url': link,
-                            'source': source_name
-                        })
-            except:
-                continue
-        
-        # Eliminar duplicats per URL
-        seen_urls = set()
-        unique_news = []
-        for item in news_items:
-            if item['url'] not in seen_urls:
-                seen_urls.add(item['url'])
-                unique_news.append(item)
-        
-        print(f"      ✅ {len(unique_news)} notícies trobades")
-        return unique_news[:10]  # Màxim 10
+                # Filtrar per "reus" al títol o URL
+                if 'reus' in title.lower() or 'reus' in link.lower():
+                    news_items.append({
+                        'title': title,
+                        'url': link,
+                        'source': source_name
+                    })
+        except Exception:
+            continue
+    
+    # Eliminar duplicats per URL
+    seen_urls = set()
+    unique_news = []
+    for item in news_items:
+        if item['url'] not in seen_urls:
+            seen_urls.add(item['url'])
+            unique_news.append(item)
     
+    return unique_news[:MAX_ITEMS_PER_SOURCE]
+
+
+async def scrape_news_from_url(client: httpx.AsyncClient, url: str, source_name: str) -> List[Dict]:
+    """Scraping d'una font sense RSS"""
+    response = await client.get(url)
+    response.raise_for_status()
+    return await asyncio.to_thread(_parse_html, response.content, url, source_name)
+
+
+async def fetch_source(client: httpx.AsyncClient, key: str, feed_info: Dict, validators: Optional[Dict] = None) -> Dict:
+    """
+    Obtenir una font i mesurar-ne la latència
+    status: "ok", "not_modified" (304, sense descarregar res) o "error"
+    """
+    validators = validators or {}
+    result = {
+        'key': key,
+        'name': feed_info['name'],
+        'url': feed_info['url'],
+        'status': 'ok',
+        'items': [],
+        'error': None,
+        'etag': validators.get('etag'),
+        'last_modified': validators.get('last_modified'),
+    }
+    start = time.perf_counter()
+    try:
+        if feed_info.get('rss'):
+            fetched = await fetch_from_rss(client, feed_info['url'], feed_info['name'], validators)
+            if fetched is None:
+                result['status'] = 'not_modified'
+            else:
+                result['items'], new_validators = fetched
+                result.update(new_validators)
+        else:
+            result['items'] = await scrape_news_from_url(client, feed_info['url'], feed_info['name'])
     except Exception as e:
-        print(f"      ❌ Error: {str(e)}")
-        return []
+        result['status'] = 'error'
+        result['error'] = str(e) or e.__class__.__name__
+    result['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    
+    if result['status'] == 'error':
+        print(f"      ❌ {feed_info['name']}: {result['error']} ({result['latency_ms']:.0f}ms)")
+    elif result['status'] == 'not_modified':
+        print(f"      ⏭️  {feed_info['name']}: sense canvis ({result['latency_ms']:.0f}ms)")
+    else:
+        print(f"      ✅ {feed_info['name']}: {len(result['items'])} notícies ({result['latency_ms']:.0f}ms)")
+    return result
+
+
+async def fetch_all_sources(
+    state: Optional[Dict[str, Dict]] = None,
+    client: Optional[httpx.AsyncClient] = None,
+    sources: Optional[Dict[str, Dict]] = None,
+) -> List[Dict]:
+    """
+    Obtenir totes les fonts alhora
+    state: validadors (etag, last_modified) de l'execució anterior per font
+    """
+    state = state or {}
+    client = client or get_client()
+    sources = sources if sources is not None else RSS_FEEDS
+    
+    # 1. RSS feeds primer (més fiable)
+    rss_sources = [(key, info) for key, info in sources.items() if info.get('rss')]
+    results = list(await asyncio.gather(*(
+        fetch_source(client, key, info, state.get(key)) for key, info in rss_sources
+    )))
+    
+    # 2. Si els RSS no han donat resultats (i no és perquè no hagin canviat), provar scraping
+    fresh_items = sum(len(r['items']) for r in results)
+    unchanged = any(r['status'] == 'not_modified' for r in results)
+    scrape_sources = [(key, info) for key, info in sources.items() if not info.get('rss')]
+    if fresh_items < 3 and not unchanged and scrape_sources:
+        print(f"   🔍 Provant scraping directe...")
+        results.extend(await asyncio.gather(*(
+            fetch_source(client, key, info) for key, info in scrape_sources
+        )))
+    return results
 
 
 async def process_news_with_ai(raw_news: List[Dict], max_news: int = 6) -> List[Dict]:
@@ -211,7 +320,9 @@ RESPOSTA (NOMÉS NÚMEROS):"""
 
         client = OpenAI(api_key=api_key)
         
-        completion = client.chat.completions.create(
+        # El client d'OpenAI és síncron: fora del bucle d'esdeveniments
+        completion = await asyncio.to_thread(
+            client.chat.completions.create,
             model="gpt-4o-mini",
             messages=[
                 {"role": "system", "content": "Ets un editor de notícies local expert en seleccionar contingut rellevant."},
@@ -242,30 +353,14 @@ RESPOSTA (NOMÉS NÚMEROS):"""
 
 async def fetch_daily_news(max_news: int = 6) -> List[Dict]:
     """
-    Obtenir notícies diàries de totes les fonts
-    Utilitza RSS primer, després scraping com a fallback
+    Obtenir notícies diàries de totes les fonts (sense peticions condicionals)
+    L'actualització programada (news_scheduler) fa servir fetch_all_sources amb
+    els validadors desats i només selecciona les notícies noves.
     """
     print(f"\n🔍 Cercant notícies de Reus... ({datetime.now().strftime('%H:%M')})")
     
-    all_news = []
-    
-    # 1. Intentar RSS feeds primer (més fiable)
-    print(f"   📡 Provant RSS feeds...")
-    for key, feed_info in RSS_FEEDS.items():
-        if feed_info.get('rss'):
-            news = await fetch_from_rss(feed_info['url'], feed_info['name'])
-            all_news.extend(news)
-            await asyncio.sleep(1)
-    
-    # 2. Si RSS no ha donat resultats, provar scraping
-    if len(all_news) < 3:
-        print(f"   🔍 Provant scraping directe...")
-        for key, feed_info in RSS_FEEDS.items():
-            if not feed_info.get('rss'):  # Només scraping per fonts sense RSS
-                news = await scrape_news_from_url(feed_info['url'], feed_info['name'])
-                all_news.extend(news)
-                await asyncio.sleep(1)
-    
+    results = await fetch_all_sources()
+    all_news = [item for result in results for item in result['items']]
     print(f"   ✅ Total notícies trobades: {len(all_news)}")
     
     # Invertir l'ordre per tenir les més recents primer
@@ -273,19 +368,23 @@ async def fetch_daily_news(max_news: int = 6) -> List[Dict]:
     
     # 3. Processar amb IA per seleccionar les més rellevants
     if all_news:
-        print(f"   🤖 Processant amb IA...")
-        try:
-            selected_news = await process_news_with_ai(all_news, max_news)
-            print(f"   ✅ Seleccionades: {len(selected_news)} notícies\n")
-            return selected_news
-        except Exception as e:
-            print(f"   ⚠️  IA no disponible, retornant notícies sense filtrar")
-            # Retornar les més recents quan la IA falla
-            return all_news[:max_news]
+        return await select_news(all_news, max_news)
     
     return []
 
 
+async def select_news(all_news: List[Dict], max_news: int) -> List[Dict]:
+    print(f"   🤖 Processant amb IA...")
+    try:
+        selected_news = await process_news_with_ai(all_news, max_news)
+        print(f"   ✅ Seleccionades: {len(selected_news)} notícies\n")
+        return selected_news
+    except Exception as e:
+        print(f"   ⚠️  IA no disponible, retornant notícies sense filtrar")
+        # Retornar les més recents quan la IA falla
+        return all_news[:max_news]
+
+
 # Test del scraper
 if __name__ == "__main__":
     async def test():
@@ -294,5 +393,6 @@ if __name__ == "__main__":
             print(f"{i}. {item['title']}")
             print(f"   Font: {item['source']}")
             print(f"   URL: {item['url']}\n")
+        await close_news_client()
     
     asyncio.run(test())
@@ -0,0 +1,511 @@
+"""
+Safata de notificacions dels usuaris (fan-out en llegir)
+Abans cada notificació massiva desava una còpia del títol i el text per a
+cada usuari (fins a desenes de milers de documents iguals). Ara:
+
+- notification_broadcasts: cada notificació massiva es desa UNA vegada, amb
+  la definició de l'audiència (audience_keys: "all", "role:admin", "users",
+  "tag:nadal2024"...). Si l'audiència és una llista calculada (segmentació,
+  campanya), audience_keys és buit i el treballador desa per a cada usuari
+  una referència mínima (user_id, broadcast_job_id) a notifications.
+- notifications: notificacions directes d'un usuari i referències a les
+  notificacions massives amb audiència calculada (user_id sempre ObjectId)
+- notification_states: un document per usuari amb les notificacions
+  compartides llegides i eliminades, la marca read_before ("llegit fins
+  a"), el comptador de directes no llegides i el registre de canvis recents
+- notification_deletions: compartides eliminades que ja no caben a la llista
+  de notification_states (_id "<user_id>:<notification_id>"); només es
+  consulten per als usuaris que n'han eliminat més de STATE_LIMIT
+
+La safata es llegeix amb una sola agregació: les notificacions de l'usuari
+(índex user_id, created_at) més les compartides que coincideixen amb les
+claus de l'usuari (índex audience_keys, created_at). Les compartides només
+arriben als usuaris que ja existien quan es van enviar. L'audiència per rol o
+marcador s'avalua en llegir: si canvia el rol d'un usuari, canvia també què veu.
+
+Sincronització incremental: amb un cursor (get_inbox_changes) només es
+retornen les notificacions noves o modificades (updated_at), les compartides
+noves o llegides i els IDs eliminats des del cursor. El nombre de no llegides
+és el comptador de directes més un recompte indexat de les compartides
+posteriors a read_before.
+
+Ús manual:
+    python notification_inbox.py --normalise   # user_id com a ObjectId
+    python notification_inbox.py --compact     # Treure el text de les còpies antigues
+"""
+import os
+import asyncio
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional
+
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+INBOX_LIMIT = 100
+# Notificacions compartides llegides/eliminades que es recorden per usuari
+STATE_LIMIT = 500
+# Marge del cursor: escriptures de processos diferents poden arribar lleugerament desordenades
+SYNC_OVERLAP = timedelta(seconds=5)
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def target_audience_keys(target: str) -> Optional[List[str]]:
+    """
+    Claus d'audiència d'un target de build_target_query
+    None si l'audiència s'ha de calcular (campanya, segmentació): es desa per usuari
+    """
+    if target == "all":
+        return ["all"]
+    if target == "admins":
+        return ["role:admin"]
+    if target == "users":
+        return ["users"]
+    if target == "local_associat":
+        return ["role:local_associat"]
+    if target.startswith("role:"):
+        return [target]
+    if target.startswith("tag:"):
+        return [target]
+    return None
+
+
+def user_audience_keys(user: dict) -> List[str]:
+    """Claus d'audiència d'un usuari (han de coincidir amb build_target_query)"""
+    role = user.get("role")
+    keys = ["all"]
+    if role:
+        keys.append(f"role:{role}")
+    if role not in ("admin", "local_associat"):
+        keys.append("users")
+    tags = user.get("tags")
+    if isinstance(tags, list):
+        keys.extend(f"tag:{tag}" for tag in tags if isinstance(tag, str))
+    return keys
+
+
+async def create_broadcast(job_id: ObjectId, title: str, body: str, data: Optional[dict],
+                           audience_keys: Optional[List[str]], created_at: datetime):
+    """Desar el contingut d'una notificació massiva (una sola vegada)"""
+    await db.notification_broadcasts.insert_one({
+        "_id": job_id,
+        "title": title,
+        "body": body,
+        "data": data or {},
+        "audience_keys": audience_keys or [],
+        "created_at": created_at,
+    })
+
+
+async def _get_state(user_id: ObjectId) -> dict:
+    return await db.notification_states.find_one({"_id": user_id}) or {}
+
+
+# --- Cursor de sincronització ---
+
+def make_cursor(at: datetime) -> str:
+    """Cursor opac: mil·lisegons UTC"""
+    return str(int(at.replace(tzinfo=timezone.utc).timestamp() * 1000))
+
+
+def parse_cursor(cursor: str) -> Optional[datetime]:
+    """Cursor de make_cursor o data ISO; None si no és vàlid"""
+    try:
+        if cursor.isdigit():
+            return datetime.fromtimestamp(int(cursor) / 1000, tz=timezone.utc).replace(tzinfo=None)
+        at = datetime.fromisoformat(cursor.replace("Z", "+00:00"))
+    except (ValueError, OverflowError, OSError):
+        return None
+    if at.tzinfo is not None:
+        at = at.astimezone(timezone.utc).replace(tzinfo=None)
+    return at
+
+
+# --- Comptador de no llegides ---
+
+async def _adjust_unread(user_id: ObjectId, delta: int):
+    """Ajustar el comptador (si ja s'ha inicialitzat; si no, es calcularà en demanar-lo)"""
+    if delta:
+        await db.notification_states.update_one(
+            {"_id": user_id, "unread": {"$exists": True}},
+            [{"$set": {"unread": {"$max": [0, {"$add": ["$unread", delta]}]}}}],
+        )
+
+
+async def count_new_notifications(user_ids: List[ObjectId]):
+    """Una notificació nova per a cada usuari (un sol update per lot)"""
+    if user_ids:
+        await db.notification_states.update_many(
+            {"_id": {"$in": user_ids}, "unread": {"$exists": True}},
+            {"$inc": {"unread": 1}},
+        )
+
+
+async def _direct_unread(user_id: ObjectId, state: dict) -> int:
+    if "unread" in state:
+        return state["unread"]
+    # Primera vegada: es compta i a partir d'aquí es manté amb $inc
+    unread = await db.notifications.count_documents({"user_id": user_id, "read": {"$ne": True}})
+    try:
+        await db.notification_states.update_one(
+            {"_id": user_id, "unread": {"$exists": False}},
+            {"$set": {"unread": unread}},
+            upsert=True,
+        )
+    except DuplicateKeyError:
+        # Un altre procés l'ha inicialitzat alhora
+        pass
+    return unread
+
+
+def _shared_match(user: dict, state: dict) -> dict:
+    match = {"audience_keys": {"$in": user_audience_keys(user)}, "_id": {"$nin": state.get("deleted", [])}}
+    if isinstance(user.get("created_at"), datetime):
+        match["created_at"] = {"$gte": user["created_at"]}
+    return match
+
+
+def _deletion_key(user_id: ObjectId, notification_id: ObjectId) -> str:
+    return f"{user_id}:{notification_id}"
+
+
+def _without_old_deletions(user_id: ObjectId, state: dict) -> list:
+    """Etapes que treuen les compartides eliminades de notification_deletions (si l'usuari en té)"""
+    if not state.get("deleted_overflow"):
+        return []
+    return [
+        {"$set": {"deletion_key": {"$concat": [str(user_id), ":", {"$toString": "$_id"}]}}},
+        {"$lookup": {"from": "notification_deletions", "localField": "deletion_key",
+                     "foreignField": "_id", "as": "deletion"}},
+        {"$match": {"deletion": {"$size": 0}}},
+        {"$project": {"deletion_key": 0, "deletion": 0}},
+    ]
+
+
+async def unread_count(user: dict, state: Optional[dict] = None) -> int:
+    """Notificacions no llegides: comptador de les directes + compartides posteriors a read_before"""
+    if state is None:
+        state = await _get_state(user["_id"])
+    shared_query = _shared_match(user, state)
+    shared_query["_id"]["$nin"] = state.get("deleted", []) + state.get("read", [])
+    if state.get("read_before"):
+        shared_query.setdefault("created_at", {})["$gt"] = state["read_before"]
+    direct, shared = await asyncio.gather(
+        _direct_unread(user["_id"], state),
+        _count_shared(shared_query, _without_old_deletions(user["_id"], state)),
+    )
+    return direct + shared
+
+
+async def _count_shared(query: dict, without_deleted: list) -> int:
+    if not without_deleted:
+        return await db.notification_broadcasts.count_documents(query)
+    counted = await db.notification_broadcasts.aggregate(
+        [{"$match": query}, *without_deleted, {"$count": "count"}]
+    ).to_list(1)
+    return counted[0]["count"] if counted else 0
+
+
+# --- Lectura ---
+
+def _serialize(notification: dict, state: dict) -> dict:
+    broadcast = (notification.pop("broadcast", None) or [None])[0]
+    if broadcast and "title" not in notification:
+        # Referència a una notificació massiva: el text és al document compartit
+        for field in ("title", "body", "data"):
+            notification[field] = broadcast.get(field)
+    if notification.pop("shared", False):
+        read_before = state.get("read_before")
+        notification["read"] = notification["_id"] in state.get("read", []) or bool(
+            read_before and notification["created_at"] <= read_before
+        )
+    notification['_id'] = str(notification['_id'])
+    notification['id'] = notification['_id']
+    for field in ("user_id", "broadcast_job_id"):
+        if notification.get(field):
+            notification[field] = str(notification[field])
+    notification.setdefault("read", False)
+    return notification
+
+
+def _inbox_pipeline(own_match: dict, shared_match: dict, limit: int, shared_filter: list = ()) -> list:
+    """
+    Notificacions pròpies + compartides en una sola agregació
+    shared_filter: etapes addicionals per a les compartides (abans del límit)
+    """
+    return [
+        {"$match": own_match},
+        {"$sort": {"created_at": -1}},
+        {"$limit": limit},
+        {"$unionWith": {"coll": "notification_broadcasts", "pipeline": [
+            {"$match": shared_match},
+            {"$sort": {"created_at": -1}},
+            *shared_filter,
+            {"$limit": limit},
+            {"$project": {"audience_keys": 0}},
+            {"$set": {"shared": True}},
+        ]}},
+        {"$sort": {"created_at": -1}},
+        {"$limit": limit},
+        # Només les referències sense text (les còpies antigues ja el tenen)
+        {"$lookup": {"from": "notification_broadcasts", "localField": "broadcast_job_id",
+                     "foreignField": "_id", "as": "broadcast"}},
+    ]
+
+
+async def get_inbox(user: dict, limit: int = INBOX_LIMIT) -> List[dict]:
+    """Notificacions de l'usuari, les més recents primer"""
+    state = await _get_state(user["_id"])
+    pipeline = _inbox_pipeline({"user_id": user["_id"]}, _shared_match(user, state), limit,
+                               _without_old_deletions(user["_id"], state))
+    notifications = await db.notifications.aggregate(pipeline).to_list(limit)
+    return [_serialize(notification, state) for notification in notifications]
+
+
+async def get_inbox_changes(user: dict, since: datetime, limit: int = INBOX_LIMIT) -> dict:
+    """
+    Canvis des d'un cursor: notificacions noves o modificades, IDs eliminats,
+    read_before (tot el que és anterior està llegit) i el nombre de no llegides
+    """
+    now = datetime.utcnow()
+    after = since - SYNC_OVERLAP
+    state = await _get_state(user["_id"])
+    changes = [change for change in state.get("changes", []) if change["at"] > after]
+    read_ids = [change["id"] for change in changes if change["type"] == "read"]
+
+    shared_match = _shared_match(user, state)
+    shared_match["$or"] = [{"created_at": {"$gt": after}}, {"_id": {"$in": read_ids}}]
+    pipeline = _inbox_pipeline({"user_id": user["_id"], "updated_at": {"$gt": after}}, shared_match, limit,
+                               _without_old_deletions(user["_id"], state))
+    notifications, unread = await asyncio.gather(
+        db.notifications.aggregate(pipeline).to_list(limit),
+        unread_count(user, state),
+    )
+    return {
+        "cursor": make_cursor(now),
+        "items": [_serialize(notification, state) for notification in notifications],
+        "deleted": list(dict.fromkeys(str(change["id"]) for change in changes if change["type"] == "deleted")),
+        "read_before": state.get("read_before"),
+        "unread_count": unread,
+    }
+
+
+# --- Llegides i eliminades ---
+
+async def _shared_ids_for_user(user: dict, notification_ids: List[ObjectId]) -> List[ObjectId]:
+    """Notificacions compartides que existeixen i tenen l'usuari a l'audiència"""
+    if not notification_ids:
+        return []
+    query = {"_id": {"$in": notification_ids}, "audience_keys": {"$in": user_audience_keys(user)}}
+    return [doc["_id"] async for doc in db.notification_broadcasts.find(query, {"_id": 1})]
+
+
+async def _remember(user_id: ObjectId, field: str, notification_ids: List[ObjectId], state: dict,
+                    shared: bool = True):
+    """
+    Registrar notificacions llegides o eliminades per als clients que sincronitzen amb cursor
+    shared: també s'afegeixen a la llista de compartides llegides/eliminades de l'usuari
+    """
+    if not notification_ids:
+        return
+    now = datetime.utcnow()
+    push = {"changes": {"$each": [{"id": nid, "type": field, "at": now} for nid in notification_ids],
+                        "$slice": -STATE_LIMIT}}
+    update = {"$push": push, "$set": {"updated_at": now}}
+    new_ids = [nid for nid in notification_ids if nid not in state.get(field, [])]
+    if not (shared and new_ids and field == "deleted"):
+        if shared and new_ids:
+            push[field] = {"$each": new_ids, "$slice": -STATE_LIMIT}
+        await db.notification_states.update_one({"_id": user_id}, update, upsert=True)
+        return
+
+    # Eliminades: es conserven les més recents a la llista i les que no hi caben
+    # passen a notification_deletions (si es descartessin, tornarien a la safata)
+    overflow = sorted(state.get("deleted", []) + new_ids)[:-STATE_LIMIT]
+    if overflow:
+        await _store_old_deletions(user_id, overflow, now)
+        update["$set"]["deleted_overflow"] = True
+    push[field] = {"$each": new_ids, "$sort": 1, "$slice": -STATE_LIMIT}
+    before = await db.notification_states.find_one_and_update(
+        {"_id": user_id}, update, upsert=True, projection={"deleted": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    # Eliminacions simultànies: el que s'ha retallat realment pot ser diferent de la còpia llegida
+    trimmed = sorted(set((before or {}).get("deleted", [])) | set(new_ids))[:-STATE_LIMIT]
+    missing = sorted(set(trimmed) - set(overflow))
+    if missing:
+        await _store_old_deletions(user_id, missing, now)
+        await db.notification_states.update_one({"_id": user_id}, {"$set": {"deleted_overflow": True}})
+
+
+async def _store_old_deletions(user_id: ObjectId, notification_ids: List[ObjectId], now: datetime):
+    try:
+        await db.notification_deletions.insert_many([
+            {"_id": _deletion_key(user_id, nid), "user_id": user_id, "notification_id": nid, "created_at": now}
+            for nid in notification_ids
+        ], ordered=False)
+    except BulkWriteError as e:
+        # Ja desades per una eliminació anterior
+        if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+            raise
+
+
+def _object_ids(notification_ids) -> List[ObjectId]:
+    return [ObjectId(nid) for nid in notification_ids if ObjectId.is_valid(nid)]
+
+
+async def mark_many_read(user: dict, notification_ids: Optional[List[str]] = None,
+                         up_to: Optional[datetime] = None) -> int:
+    """
+    Marcar com a llegides una llista d'IDs i/o totes les anteriors a up_to
+    Retorna quantes notificacions han passat a llegides
+    """
+    user_id = user["_id"]
+    now = datetime.utcnow()
+    read_update = {"$set": {"read": True, "read_at": now, "updated_at": now}}
+    state = await _get_state(user_id)
+    direct_marked = shared_marked = 0
+
+    if notification_ids:
+        ids = _object_ids(notification_ids)
+        direct_ids = await db.notifications.distinct("_id", {"_id": {"$in": ids}, "user_id": user_id})
+        if direct_ids:
+            result = await db.notifications.update_many(
+                {"_id": {"$in": direct_ids}, "user_id": user_id, "read": {"$ne": True}}, read_update
+            )
+            direct_marked += result.modified_count
+        shared = await _shared_ids_for_user(user, [nid for nid in ids if nid not in set(direct_ids)])
+        shared = [nid for nid in shared if nid not in state.get("read", [])]
+        await _remember(user_id, "read", shared, state)
+        shared_marked += len(shared)
+
+    if up_to is not None:
+        result = await db.notifications.update_many(
+            {"user_id": user_id, "read": {"$ne": True}, "created_at": {"$lte": up_to}}, read_update
+        )
+        direct_marked += result.modified_count
+        # Compartides: marca d'aigua (tot el que és anterior queda llegit)
+        await db.notification_states.update_one(
+            {"_id": user_id},
+            {"$max": {"read_before": up_to}, "$set": {"updated_at": now}},
+            upsert=True,
+        )
+
+    # Només les directes es descompten del comptador; les compartides es calculen
+    await _adjust_unread(user_id, -direct_marked)
+    return direct_marked + shared_marked
+
+
+async def mark_read(user: dict, notification_id: str) -> bool:
+    """Marcar com a llegida; False si no existeix o no és de l'usuari"""
+    if not ObjectId.is_valid(notification_id):
+        return False
+    notification_id = ObjectId(notification_id)
+    now = datetime.utcnow()
+    result = await db.notifications.update_one(
+        {"_id": notification_id, "user_id": user["_id"]},
+        [{"$set": {
+            "read_at": {"$cond": ["$read", "$read_at", now]},
+            "updated_at": {"$cond": ["$read", "$updated_at", now]},
+            "read": True,
+        }}],
+    )
+    if result.matched_count:
+        await _adjust_unread(user["_id"], -result.modified_count)
+        return True
+    if not await _shared_ids_for_user(user, [notification_id]):
+        return False
+    await _remember(user["_id"], "read", [notification_id], await _get_state(user["_id"]))
+    return True
+
+
+async def delete_for_user(user: dict, notification_id: str) -> bool:
+    """Eliminar de la safata de l'usuari; False si no existeix o no és de l'usuari"""
+    if not ObjectId.is_valid(notification_id):
+        return False
+    notification_id = ObjectId(notification_id)
+    state = await _get_state(user["_id"])
+    deleted = await db.notifications.find_one_and_delete(
+        {"_id": notification_id, "user_id": user["_id"]}, projection={"read": 1}
+    )
+    if deleted is not None:
+        if not deleted.get("read"):
+            await _adjust_unread(user["_id"], -1)
+    elif not await _shared_ids_for_user(user, [notification_id]):
+        return False
+    # Registre per als clients que sincronitzen amb cursor (també les directes)
+    await _remember(user["_id"], "deleted", [notification_id], state, shared=deleted is None)
+    return True
+
+
+# --- Migracions ---
+
+async def normalise_user_ids() -> int:
+    """Convertir a ObjectId els user_id desats com a string"""
+    result = await db.notifications.update_many(
+        {"user_id": {"$type": "string", "$regex": "^[0-9a-fA-F]{24}$"}},
+        [{"$set": {"user_id": {"$toObjectId": "$user_id"}}}],
+    )
+    return result.modified_count
+
+
+async def compact_broadcast_copies() -> int:
+    """
+    Còpies antigues de notificacions massives (títol i text per usuari):
+    es desa el contingut una vegada a notification_broadcasts i les còpies
+    queden com a referències
+    """
+    compacted = 0
+    job_ids = await db.notifications.distinct("broadcast_job_id", {"broadcast_job_id": {"$exists": True},
+                                                                   "title": {"$exists": True}})
+    for job_id in job_ids:
+        sample = await db.notifications.find_one({"broadcast_job_id": job_id, "title": {"$exists": True}})
+        if sample is None:
+            continue
+        await db.notification_broadcasts.update_one(
+            {"_id": job_id},
+            {"$setOnInsert": {"title": sample.get("title"), "body": sample.get("body"),
+                              "data": sample.get("data") or {}, "audience_keys": [],
+                              "created_at": sample.get("created_at")}},
+            upsert=True,
+        )
+        result = await db.notifications.update_many(
+            {"broadcast_job_id": job_id},
+            {"$unset": {"title": "", "body": "", "data": ""}},
+        )
+        compacted += result.modified_count
+    return compacted
+
+
+# Per executar manualment
+if __name__ == "__main__":
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from dotenv import load_dotenv
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--normalise", action="store_true", help="Convertir user_id a ObjectId")
+    parser.add_argument("--compact", action="store_true", help="Treure el text de les còpies antigues")
+    args = parser.parse_args()
+    load_dotenv()
+
+    async def main():
+        client = AsyncIOMotorClient(os.getenv('MONGO_URL', 'mongodb://localhost:27017'))
+        set_database(client[os.getenv('DB_NAME', 'tomb_reus_db')])
+        if args.normalise:
+            print(f"🔄 {await normalise_user_ids()} notificacions amb user_id normalitzat")
+        if args.compact:
+            print(f"🗜️  {await compact_broadcast_copies()} còpies convertides en referències")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+"""
+Paginació per cursor (keyset) i streaming NDJSON per als llistats d'administració
+Evita els límits fixos de to_list() que tallaven resultats sense avisar
+"""
+import json
+import base64
+from datetime import datetime
+from typing import Callable, List, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from pymongo import DESCENDING
+
+from response_cache import encode_json
+
+MAX_PAGE_SIZE = 500
+NDJSON_BATCH_SIZE = 200
+
+
+def _encode_value(value):
+    if isinstance(value, ObjectId):
+        return {"$oid": str(value)}
+    if isinstance(value, datetime):
+        return {"$date": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict):
+        if "$oid" in value:
+            return ObjectId(value["$oid"])
+        if "$date" in value:
+            return datetime.fromisoformat(value["$date"])
+    return value
+
+
+def encode_cursor(doc: dict, sort_field: str) -> str:
+    """Cursor opac amb el valor del camp d'ordenació i l'_id de l'últim document"""
+    payload = {"v": _encode_value(doc.get(sort_field)), "id": str(doc["_id"])}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return _decode_value(payload["v"]), ObjectId(payload["id"])
+    except Exception:
+        raise HTTPException(status_code=400, detail="Cursor de paginació invàlid")
+
+
+def keyset_query(query: dict, sort_field: str, direction: int, cursor: Optional[str]) -> dict:
+    """Afegir a la consulta la condició per començar després del cursor"""
+    if not cursor:
+        return query
+
+    value, last_id = decode_cursor(cursor)
+    op = "$lt" if direction == DESCENDING else "$gt"
+    if sort_field == "_id":
+        after = {"_id": {op: last_id}}
+    else:
+        after = {"$or": [
+            {sort_field: {op: value}},
+            {sort_field: value, "_id": {op: last_id}},
+        ]}
+    return {"$and": [query, after]} if query else after
+
+
+def stringify_ids(doc: dict, fields=("owner_id", "establishment_id")) -> dict:
+    """Convertir _id i altres referències ObjectId a string"""
+    doc['_id'] = str(doc['_id'])
+    doc['id'] = doc['_id']
+    for field in fields:
+        if isinstance(doc.get(field), ObjectId):
+            doc[field] = str(doc[field])
+    return doc
+
+
+def _find(collection, query, projection, sort_field, direction):
+    sort = [(sort_field, direction)]
+    if sort_field != "_id":
+        sort.append(("_id", direction))
+    return collection.find(query, projection).sort(sort)
+
+
+async def fetch_page(
+    collection,
+    query: dict,
+    *,
+    limit: int,
+    cursor: Optional[str] = None,
+    projection: Optional[dict] = None,
+    sort_field: str = "_id",
+    direction: int = DESCENDING,
+    transform: Callable[[dict], dict] = stringify_ids,
+) -> dict:
+    """Obtenir una pàgina i el cursor de la següent"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    docs = await _find(
+        collection, keyset_query(query, sort_field, direction, cursor), projection, sort_field, direction
+    ).limit(limit + 1).to_list(limit + 1)
+
+    has_more = len(docs) > limit
+    docs = docs[:limit]
+    next_cursor = encode_cursor(docs[-1], sort_field) if has_more else None
+
+    return {
+        "items": [transform(doc) for doc in docs],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    }
+
+
+async def fetch_all(
+    collection,
+    query: dict,
+    *,
+    projection: Optional[dict] = None,
+    sort_field: str = "_id",
+    direction: int = DESCENDING,
+    transform: Callable[[dict], dict] = stringify_ids,
+) -> List[dict]:
+    """Llistat complet (sense límit) iterant el cursor de Motor"""
+    cursor = _find(collection, query, projection, sort_field, direction).batch_size(NDJSON_BATCH_SIZE)
+    return [transform(doc) async for doc in cursor]
+
+
+def ndjson_response(
+    collection,
+    query: dict,
+    *,
+    projection: Optional[dict] = None,
+    sort_field: str = "_id",
+    direction: int = DESCENDING,
+    transform: Callable[[dict], dict] = stringify_ids,
+) -> StreamingResponse:
+    """Enviar els documents com a NDJSON a mesura que el cursor els retorna"""
+    async def generate():
+        cursor = _find(collection, query, projection, sort_field, direction).batch_size(NDJSON_BATCH_SIZE)
+        async for doc in cursor:
+            yield encode_json(transform(doc)) + b"\n"
+
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+async def paginated_response(
+    collection,
+    query: dict,
+    *,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
+    format: Optional[str] = None,
+    projection: Optional[dict] = None,
+    sort_field: str = "_id",
+    direction: int = DESCENDING,
+    transform: Callable[[dict], dict] = stringify_ids,
+):
+    """
+    Resposta comuna dels llistats:
+    - format=ndjson: streaming de tots els documents
+    - limit/cursor: pàgina {items, next_cursor, has_more}
+    - sense paràmetres: llista completa (compatibilitat amb el frontend actual)
+    """
+    options = dict(projection=projection, sort_field=sort_field, direction=direction, transform=transform)
+    if format == "ndjson":
+        return ndjson_response(collection, query, **options)
+    if limit or cursor:
+        return await fetch_page(collection, query, limit=limit or 100, cursor=cursor, **options)
+    return await fetch_all(collection, query, **options)
+
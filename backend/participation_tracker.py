@@ -9,6 +9,9 @@ from typing import Optional, List, Dict
 from pydantic import BaseModel
 import os
 from dotenv import load_dotenv
+from data_loader import BatchLoader
+from audience_segments import audience_segments, TAG, EVENT
+from stats_rollups import record_participation
 
 load_dotenv()
 
@@ -65,6 +68,12 @@ ador/etiqueta de la campanya
     
     # Inserir participació
     result = await db.user_participations.insert_one(participation)
+    
+    # Segments per a les notificacions segmentades (sense esperar la sincronització)
+    audience_segments.add(TAG, tag, user_id)
+    if activity_type == "event":
+        audience_segments.add(EVENT, activity_id, user_id)
+    await record_participation(activity_type, tag, activity_id)
     return str(result.inserted_id)
 
 
@@ -100,9 +109,13 @@ async def get_users_by_tag(tag: str) -> List[Dict]:
     
     users = await db.user_participations.aggregate(pipeline).to_list(None)
     
-    # Obtenir info addicional dels usuaris
+    # Obtenir info addicional dels usuaris (una sola consulta amb $in)
+    users_by_id = await BatchLoader(
+        db.users, projection={"name": 1, "email": 1, "phone": 1}
+    ).load_many(u["user_id"] for u in users)
+    
     for user_data in users:
-        user = await db.users.find_one({"_id": user_data["user_id"]})
+        user = users_by_id.get(str(user_data["user_id"]))
         if user:
             user_data["name"] = user.get("name", "")
             user_data["email"] = user.get("email", "")
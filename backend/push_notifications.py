@@ -1,11 +1,160 @@
-import requests
-import json
-from typing import List, Optional
+"""
+Enviament de notificacions push a través d'Expo
+Client httpx compartit (pool de connexions), lots de 100 missatges enviats
+en paral·lel amb concurrència limitada, i seguiment dels rebuts per esborrar
+els tokens que Expo indica com a DeviceNotRegistered.
+"""
+import asyncio
+import logging
+import os
+from typing import Dict, List, Optional
 
-# URL de l'API d'Expo per enviar notificacions
-EXPO_PUSH_URL = "https://exp.host/--/api/v2/push/send"
+import httpx
 
-def send_push_notification(
+logger = logging.getLogger(__name__)
+
+# URL de l'API d'Expo per enviar notificacions (es pot apuntar a expo_push_stub.py)
+EXPO_PUSH_URL = os.getenv('EXPO_PUSH_URL', "https://exp.host/--/api/v2/push/send")
+EXPO_RECEIPTS_URL = os.getenv('EXPO_RECEIPTS_URL', "https://exp.host/--/api/v2/push/getReceipts")
+
+# Límits d'Expo: 100 missatges per enviament i 1000 IDs per consulta de rebuts
+EXPO_BATCH_SIZE = 100
+EXPO_RECEIPTS_BATCH_SIZE = 1000
+EXPO_MAX_CONCURRENCY = int(os.getenv('EXPO_MAX_CONCURRENCY', '6'))
+EXPO_TIMEOUT = float(os.getenv('EXPO_TIMEOUT', '10'))
+# Expo recomana consultar els rebuts uns minuts després de l'enviament
+EXPO_RECEIPT_DELAY = float(os.getenv('EXPO_RECEIPT_DELAY', '900'))
+
+_client: Optional[httpx.AsyncClient] = None
+_pending_tasks = set()
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def get_client() -> httpx.AsyncClient:
+    """Client HTTP compartit entre peticions"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=EXPO_TIMEOUT,
+            limits=httpx.Limits(max_connections=EXPO_MAX_CONCURRENCY * 2,
+                                max_keepalive_connections=EXPO_MAX_CONCURRENCY),
+            headers={
+                "Accept": "application/json",
+                "Accept-Encoding": "gzip, deflate",
+                "Content-Type": "application/json",
+            },
+        )
+    return _client
+
+
+async def close_push_client():
+    """Tancar el client i cancel·lar les consultes de rebuts pendents"""
+    global _client
+    for task in list(_pending_tasks):
+        task.cancel()
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+def _chunks(items: list, size: int):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _is_unregistered(result: dict) -> bool:
+    return (
+        result.get("status") == "error"
+        and (result.get("details") or {}).get("error") == "DeviceNotRegistered"
+    )
+
+
+async def prune_push_tokens(tokens: List[str]) -> int:
+    """Esborrar dels usuaris els tokens que ja no són vàlids"""
+    tokens = list(set(t for t in tokens if t))
+    if not tokens or db is None:
+        return 0
+    try:
+        result = await db.users.update_many(
+            {"push_token": {"$in": tokens}},
+            {"$unset": {"push_token": ""}}
+        )
+        if result.modified_count:
+            logger.info(f"[PUSH] {result.modified_count} tokens DeviceNotRegistered esborrats")
+        return result.modified_count
+    except Exception as e:
+        logger.error(f"[PUSH] Error esborrant tokens: {e}")
+        return 0
+
+
+async def _post_batch(semaphore: asyncio.Semaphore, messages: List[dict]) -> List[dict]:
+    """Enviar un lot. Retorna un tiquet per missatge (error inclòs si falla el lot)"""
+    async with semaphore:
+        try:
+            response = await get_client().post(EXPO_PUSH_URL, json=messages)
+            payload = response.json()
+            tickets = payload.get("data")
+            if isinstance(tickets, list) and len(tickets) == len(messages):
+                return tickets
+            error = str(payload.get("errors") or f"HTTP {response.status_code}")
+        except Exception as e:
+            error = str(e)
+        logger.error(f"[PUSH] Error enviant lot de {len(messages)} missatges: {error}")
+        return [{"status": "error", "message": error} for _ in messages]
+
+
+async def check_receipts(receipt_tokens: Dict[str, str]) -> dict:
+    """
+    Consultar els rebuts d'Expo ({receipt_id: token}) i esborrar els tokens
+    DeviceNotRegistered
+    """
+    ids = list(receipt_tokens.keys())
+    semaphore = asyncio.Semaphore(EXPO_MAX_CONCURRENCY)
+
+    async def fetch(batch):
+        async with semaphore:
+            try:
+                response = await get_client().post(EXPO_RECEIPTS_URL, json={"ids": batch})
+                return response.json().get("data") or {}
+            except Exception as e:
+                logger.error(f"[PUSH] Error consultant rebuts: {e}")
+                return {}
+
+    results = await asyncio.gather(*[fetch(batch) for batch in _chunks(ids, EXPO_RECEIPTS_BATCH_SIZE)])
+
+    ok = errors = 0
+    unregistered = []
+    for receipts in results:
+        for receipt_id, receipt in receipts.items():
+            if receipt.get("status") == "ok":
+                ok += 1
+                continue
+            errors += 1
+            if _is_unregistered(receipt) and receipt_id in receipt_tokens:
+                unregistered.append(receipt_tokens[receipt_id])
+
+    pruned = await prune_push_tokens(unregistered)
+    return {"ok": ok, "errors": errors, "pruned": pruned}
+
+
+def _schedule_receipts(receipt_tokens: Dict[str, str]):
+    async def run():
+        await asyncio.sleep(EXPO_RECEIPT_DELAY)
+        await check_receipts(receipt_tokens)
+
+    task = asyncio.create_task(run())
+    _pending_tasks.add(task)
+    task.add_done_callback(_pending_tasks.discard)
+
+
+async def send_push_notification(
     push_tokens: List[str],
     title: str,
     body: str,
@@ -13,22 +162,22 @@ def send_push_notification(
 ) -> dict:
     """
     Enviar notificació push a través d'Expo
-    
+
     Args:
         push_tokens: Llista de tokens Expo push
         title: Títol de la notificació
         body: Text de la notificació
         data: Dades addicionals (opcional)
-    
+
     Returns:
-        Resposta de l'API d'Expo
+        {"data": [tiquets]} amb un tiquet per token vàlid, en el mateix ordre
     """
     messages = []
-    
-    for token in push_tokens:
+
+    for token in dict.fromkeys(push_tokens):
         if not token or not token.startswith('ExponentPushToken'):
             continue
-            
+
         message = {
             "to": token,
             "sound": "default",
@@ -37,26 +186,34 @@ def send_push_notification(
             "data": data or {},
         }
         messages.append(message)
-    
+
     if not messages:
         return {"error": "No valid push tokens"}
-    
-    try:
-        response = requests.post(
-            EXPO_PUSH_URL,
-            headers={
-                "Accept": "application/json",
-                "Content-Type": "application/json",
-            },
-            data=json.dumps(messages)
-        )
-        
-        return response.json()
-    except Exception as e:
-        return {"error": str(e)}
+
+    semaphore = asyncio.Semaphore(EXPO_MAX_CONCURRENCY)
+    batches = list(_chunks(messages, EXPO_BATCH_SIZE))
+    results = await asyncio.gather(*[_post_batch(semaphore, batch) for batch in batches])
+
+    tickets = []
+    unregistered = []
+    receipt_tokens = {}
+    for batch, batch_tickets in zip(batches, results):
+        for message, ticket in zip(batch, batch_tickets):
+            tickets.append(ticket)
+            if ticket.get("status") == "ok" and ticket.get("id"):
+                receipt_tokens[ticket["id"]] = message["to"]
+            elif _is_unregistered(ticket):
+                unregistered.append(message["to"])
+
+    if unregistered:
+        await prune_push_tokens(unregistered)
+    if receipt_tokens and db is not None:
+        _schedule_receipts(receipt_tokens)
+
+    return {"data": tickets}
 
 
-def send_notification_to_user(
+async def send_notification_to_user(
     push_token: str,
     title: str,
     body: str,
@@ -65,4 +222,4 @@ def send_notification_to_user(
     """
     Enviar notificació a un únic usuari
     """
-    return send_push_notification([push_token], title, body, data)
+    return await send_push_notification([push_token], title, body, data)
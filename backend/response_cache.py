@@ -0,0 +1,197 @@
+"""
+Cache de respostes per als endpoints públics del catàleg
+Guarda el JSON ja codificat amb un ETag i respon 304 si el client ja el té
+"""
+import os
+import json
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Awaitable, Callable, Optional
+
+from fastapi import Request, Response
+from fastapi.encoders import jsonable_encoder
+
+logger = logging.getLogger(__name__)
+
+# Temps màxim que una resposta es considera vàlida encara que no hi hagi escriptures
+# (ofertes i esdeveniments caduquen pel pas del temps)
+CATALOGUE_CACHE_TTL = float(os.getenv('CATALOGUE_CACHE_TTL', '300'))
+# Respostes desades com a màxim (les menys usades recentment surten primer)
+CATALOGUE_CACHE_MAX_ENTRIES = int(os.getenv('CATALOGUE_CACHE_MAX_ENTRIES', '256'))
+# Límit màxim dels endpoints amb paràmetre limit (forma part de la clau de la cache)
+CATALOGUE_MAX_LIMIT = 100
+
+# Espais de noms del catàleg
+ESTABLISHMENTS = "establishments"
+OFFERS = "offers"
+EVENTS = "events"
+PROMOTIONS = "promotions"
+NEWS = "news"
+CLUB = "club"
+INFO = "info"
+
+
+def encode_json(data) -> bytes:
+    """Codificar igual que JSONResponse de FastAPI"""
+    return json.dumps(
+        jsonable_encoder(data),
+        ensure_ascii=False,
+        allow_nan=False,
+        indent=None,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.sha1(body).hexdigest() + '"'
+
+
+def clamp_limit(limit: int) -> int:
+    return max(1, min(limit, CATALOGUE_MAX_LIMIT))
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """Comprovar el header If-None-Match (accepta llistes i ETags febles)"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    candidates = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in candidates)
+
+
+class CatalogueCache:
+    """
+    Cache LRU per espai de noms + paràmetres.
+    Cada espai té una versió que s'incrementa en invalidar-lo; una càrrega
+    iniciada abans d'una invalidació no es desa.
+    """
+
+    def __init__(self, ttl: float = CATALOGUE_CACHE_TTL, max_entries: int = CATALOGUE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (namespace, params) -> (expires_at, version, body, etag)
+        self._versions = {}  # namespace -> int
+        self._locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def version(self, namespace: str) -> int:
+        return self._versions.get(namespace, 0)
+
+    async def get_or_load(self, namespace: str, params: tuple, loader: Callable[[], Awaitable]):
+        key = (namespace, params)
+        entry = self._valid_entry(key)
+        if entry:
+            self.hits += 1
+            return entry
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        try:
+            async with lock:
+                # Una altra petició pot haver-lo carregat mentre esperàvem
+                entry = self._valid_entry(key)
+                if entry:
+                    self.hits += 1
+                    return entry
+
+                self.misses += 1
+                version = self.version(namespace)
+                data = await loader()
+                body = encode_json(data)
+                etag = make_etag(body)
+                if version == self.version(namespace):
+                    self._store(key, (time.monotonic() + self.ttl, version, body, etag))
+                return body, etag
+        finally:
+            # Els locks només calen mentre es carrega (les peticions en espera ja el tenen)
+            if not lock.locked() and self._locks.get(key) is lock:
+                del self._locks[key]
+
+    def _store(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _valid_entry(self, key):
+        entry = self._entries.get(key)
+        if not entry:
+            return None
+        expires_at, version, body, etag = entry
+        if expires_at < time.monotonic() or version != self.version(key[0]):
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return body, etag
+
+    def invalidate(self, *namespaces: str):
+        for namespace in namespaces:
+            self._versions[namespace] = self.version(namespace) + 1
+            for key in [k for k in list(self._entries) if k[0] == namespace]:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        self.invalidate(*{k[0] for k in list(self._entries)})
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "not_modified": self.not_modified,
+            "versions": dict(self._versions),
+        }
+
+
+catalogue_cache = CatalogueCache()
+
+
+async def cached_json_response(
+    request: Request,
+    namespace: str,
+    loader: Callable[[], Awaitable],
+    params: tuple = (),
+) -> Response:
+    """Retornar la resposta des de la cache (o 304 si l'ETag coincideix)"""
+    body, etag = await catalogue_cache.get_or_load(namespace, params, loader)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        catalogue_cache.not_modified += 1
+        return Response(status_code=304, headers=headers)
+
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+_invalidation_listeners = {}  # namespace -> [callback]
+
+
+def add_invalidation_listener(namespace: str, callback: Callable[[], None]):
+    """
+    Registrar una funció (síncrona) que es crida quan s'invalida l'espai.
+    Serveix per recalcular dades derivades (p.ex. els clústers del mapa).
+    """
+    _invalidation_listeners.setdefault(namespace, []).append(callback)
+
+
+def invalidate_catalogue(*namespaces: str):
+    """Invalidar els espais del catàleg afectats per una escriptura"""
+    catalogue_cache.invalidate(*namespaces)
+    logger.debug(f"Cache del catàleg invalidada: {', '.join(namespaces)}")
+    for namespace in namespaces:
+        for callback in _invalidation_listeners.get(namespace, []):
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Error notificant la invalidació de {namespace}: {e}")
+
+
+def get_catalogue_cache_stats() -> dict:
+    return catalogue_cache.stats()
@@ -0,0 +1,244 @@
+"""
+Tasques programades amb un sol procés líder
+Cada worker d'uvicorn registra les mateixes tasques, però només el que té el
+lloguer (lease) del document scheduler_leases les executa; els altres esperen
+i el prenen si el líder deixa de renovar-lo (p. ex. si el procés cau).
+
+Les tasques es desen a scheduled_jobs amb la propera execució i el resultat
+de l'última; cada execució queda a scheduled_job_runs (durada, error, procés).
+La propera execució es reclama de forma atòmica (findOneAndUpdate), de manera
+que una tasca no s'executa dues vegades ni durant un canvi de líder.
+
+Si el servidor estava aturat a l'hora programada, la tasca s'executa una sola
+vegada en arrencar (no es recuperen totes les execucions perdudes).
+"""
+import os
+import socket
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Optional
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_TICK = float(os.getenv('SCHEDULER_TICK', '15'))
+# El líder ha de renovar el lloguer abans que caduqui
+SCHEDULER_LEASE_SECONDS = int(os.getenv('SCHEDULER_LEASE_SECONDS', '60'))
+LEASE_ID = "scheduler"
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_jobs: Dict[str, dict] = {}
+_running: Dict[str, asyncio.Task] = {}
+_loop_task: Optional[asyncio.Task] = None
+_is_leader = False
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def _next_fire(trigger, after: datetime) -> Optional[datetime]:
+    """Propera execució (UTC sense zona, com la resta de dates) d'un trigger d'APScheduler"""
+    now = after.replace(tzinfo=timezone.utc).astimezone(trigger.timezone)
+    fire_time = trigger.get_next_fire_time(None, now)
+    if fire_time is None:
+        return None
+    return fire_time.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def register_job(
+    job_id: str,
+    name: str,
+    func: Callable[[], Awaitable],
+    trigger,
+    first_run_delay: Optional[int] = None,
+):
+    """
+    Registrar una tasca (a tots els workers; només l'executa el líder)
+    trigger: CronTrigger o IntervalTrigger d'APScheduler
+    first_run_delay: segons fins a la primera execució quan la tasca és nova
+    """
+    _jobs[job_id] = {"id": job_id, "name": name, "func": func, "trigger": trigger,
+                     "first_run_delay": first_run_delay}
+
+
+async def _sync_jobs():
+    """Crear les tasques noves i recalcular la propera execució si ha canviat la programació"""
+    now = datetime.utcnow()
+    for job in _jobs.values():
+        schedule = str(job["trigger"])
+        existing = await db.scheduled_jobs.find_one({"_id": job["id"]}, {"schedule": 1})
+        update = {"name": job["name"], "schedule": schedule, "updated_at": now}
+        if existing is None:
+            delay = job["first_run_delay"]
+            update["next_run_at"] = now + timedelta(seconds=delay) if delay is not None else _next_fire(job["trigger"], now)
+        elif existing.get("schedule") != schedule:
+            update["next_run_at"] = _next_fire(job["trigger"], now)
+        await db.scheduled_jobs.update_one(
+            {"_id": job["id"]},
+            {"$set": update, "$setOnInsert": {"created_at": now, "runs": 0, "failures": 0}},
+            upsert=True,
+        )
+
+
+async def _acquire_lease() -> bool:
+    """Obtenir o renovar el lloguer; False si un altre procés el té vigent"""
+    now = datetime.utcnow()
+    try:
+        lease = await db.scheduler_leases.find_one_and_update(
+            {"_id": LEASE_ID, "$or": [{"holder": WORKER_ID}, {"expires_at": {"$lt": now}}]},
+            {
+                "$set": {"holder": WORKER_ID, "expires_at": now + timedelta(seconds=SCHEDULER_LEASE_SECONDS),
+                         "renewed_at": now},
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        # El document existeix i el té un altre procés: l'upsert no pot inserir-ne un altre
+        return False
+    return lease is not None and lease.get("holder") == WORKER_ID
+
+
+async def _release_lease():
+    await db.scheduler_leases.update_one(
+        {"_id": LEASE_ID, "holder": WORKER_ID},
+        {"$set": {"holder": None, "expires_at": datetime.utcnow()}},
+    )
+
+
+async def _run_job(job: dict, started_at: datetime):
+    status, error = "completed", None
+    start = asyncio.get_running_loop().time()
+    try:
+        await job["func"]()
+    except asyncio.CancelledError:
+        status, error = "cancelled", "Aturada del servidor"
+        raise
+    except Exception as e:
+        status, error = "failed", str(e)
+        logger.error(f"[SCHEDULER] Error a la tasca {job['id']}: {e}")
+    finally:
+        duration_ms = round((asyncio.get_running_loop().time() - start) * 1000)
+        finished_at = datetime.utcnow()
+        try:
+            await db.scheduled_job_runs.insert_one({
+                "job_id": job["id"],
+                "worker_id": WORKER_ID,
+                "status": status,
+                "error": error,
+                "started_at": started_at,
+                "finished_at": finished_at,
+                "duration_ms": duration_ms,
+            })
+            await db.scheduled_jobs.update_one(
+                {"_id": job["id"]},
+                {
+                    "$set": {"running_on": None, "last_status": status, "last_error": error,
+                             "last_duration_ms": duration_ms, "last_finished_at": finished_at},
+                    "$inc": {"runs": 1, "failures": 1 if status == "failed" else 0},
+                },
+            )
+        except Exception as e:
+            logger.error(f"[SCHEDULER] No s'ha pogut desar l'execució de {job['id']}: {e}")
+        logger.info(f"[SCHEDULER] {job['id']}: {status} en {duration_ms}ms")
+
+
+async def _run_due_jobs():
+    now = datetime.utcnow()
+    for job in _jobs.values():
+        task = _running.get(job["id"])
+        if task is not None and not task.done():
+            continue
+        # Reclamar l'execució i programar la següent en un sol pas
+        claimed = await db.scheduled_jobs.find_one_and_update(
+            {"_id": job["id"], "next_run_at": {"$lte": now}},
+            {"$set": {"next_run_at": _next_fire(job["trigger"], now), "last_run_at": now, "running_on": WORKER_ID}},
+        )
+        if claimed is None:
+            continue
+        logger.info(f"[SCHEDULER] Executant {job['id']} ({job['name']})")
+        _running[job["id"]] = asyncio.create_task(_run_job(job, now))
+
+
+async def _scheduler_loop():
+    global _is_leader
+    await _sync_jobs()
+    while True:
+        try:
+            leader = await _acquire_lease()
+            if leader != _is_leader:
+                logger.info(f"[SCHEDULER] {WORKER_ID} {'és el líder' if leader else 'ja no és el líder'}")
+            _is_leader = leader
+            if leader:
+                await _run_due_jobs()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[SCHEDULER] Error al planificador: {e}")
+        await asyncio.sleep(SCHEDULER_TICK)
+
+
+def start_scheduler():
+    """Iniciar el planificador en aquest worker (competeix pel lloguer amb els altres)"""
+    global _loop_task
+    if _loop_task is not None and not _loop_task.done():
+        return
+    _loop_task = asyncio.create_task(_scheduler_loop())
+    logger.info(f"[SCHEDULER] Planificador iniciat ({WORKER_ID}), {len(_jobs)} tasques registrades")
+
+
+async def stop_scheduler():
+    """
+    Aturar el planificador i alliberar el lloguer perquè un altre worker el prengui
+    sense esperar que caduqui. Les tasques en curs es cancel·len.
+    """
+    global _loop_task, _is_leader
+    if _loop_task is None:
+        return
+    _loop_task.cancel()
+    for task in _running.values():
+        task.cancel()
+    await asyncio.gather(_loop_task, *_running.values(), return_exceptions=True)
+    _loop_task = None
+    _running.clear()
+    if _is_leader:
+        try:
+            await _release_lease()
+        except Exception as e:
+            logger.error(f"[SCHEDULER] No s'ha pogut alliberar el lloguer: {e}")
+        _is_leader = False
+
+
+async def run_job_now(job_id: str) -> bool:
+    """Avançar la propera execució d'una tasca (la farà el líder al pròxim cicle)"""
+    result = await db.scheduled_jobs.update_one({"_id": job_id}, {"$set": {"next_run_at": datetime.utcnow()}})
+    return result.matched_count > 0
+
+
+async def get_scheduler_status(runs_limit: int = 50) -> dict:
+    lease = await db.scheduler_leases.find_one({"_id": LEASE_ID})
+    jobs = await db.scheduled_jobs.find({}).sort("_id", 1).to_list(100)
+    runs = await db.scheduled_job_runs.find({}).sort("started_at", -1).to_list(runs_limit)
+    for job in jobs:
+        job["id"] = job["_id"]
+        job["registered"] = job["_id"] in _jobs
+    for run in runs:
+        run["_id"] = str(run["_id"])
+        run["id"] = run["_id"]
+    return {
+        "worker_id": WORKER_ID,
+        "is_leader": _is_leader,
+        "leader": lease.get("holder") if lease else None,
+        "lease_expires_at": lease.get("expires_at") if lease else None,
+        "jobs": jobs,
+        "runs": runs,
+    }
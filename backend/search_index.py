@@ -0,0 +1,351 @@
+"""
+Cercador del catàleg (establiments, ofertes, esdeveniments i promocions)
+Índex invertit en memòria amb normalització sense accents ("Hostelería" =
+"hosteleria"), cerca per prefix, tolerància a un error tipogràfic i
+puntuació TF-IDF amb pes per camp.
+
+Cada tipus té el seu índex i es reconstrueix en segon pla quan s'invalida
+el seu espai del catàleg (response_cache), sense tocar els altres tipus.
+"""
+import math
+import time
+import bisect
+import asyncio
+import logging
+import unicodedata
+import re
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from geo import PUBLIC_ESTABLISHMENTS_QUERY
+from response_cache import (
+    add_invalidation_listener,
+    ESTABLISHMENTS, OFFERS, EVENTS, PROMOTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+REBUILD_DELAY = 1.0  # segons: agrupa invalidacions seguides
+MAX_RESULTS = 50
+MIN_PREFIX_LENGTH = 2
+MIN_FUZZY_LENGTH = 4
+
+# Qualitat de la coincidència d'un terme de la consulta
+EXACT, PREFIX, FUZZY = 1.0, 0.7, 0.5
+
+_TOKEN_RE = re.compile(r"[a-z0-9]+")
+# Paraules massa freqüents per aportar res al rànquing
+STOPWORDS = {
+    "a", "al", "als", "amb", "de", "del", "dels", "el", "els", "en", "i", "la", "les",
+    "per", "un", "una", "y", "los", "las", "con", "para", "por", "the", "and", "o",
+}
+
+
+def normalize(text: str) -> str:
+    """Minúscules i sense accents ni signes (ç -> c, l·l -> ll, ñ -> n)"""
+    if not text:
+        return ""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return "".join(c for c in text if not unicodedata.combining(c)).replace("·", "")
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in _TOKEN_RE.findall(normalize(text)) if t not in STOPWORDS]
+
+
+def _deletes(token: str) -> Set[str]:
+    """Variants amb una lletra menys (índex de distància 1, tipus SymSpell)"""
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+# Camps indexats per tipus amb el seu pes
+FIELD_WEIGHTS = {
+    "establishment": {"name": 4, "commercial_name": 4, "category": 2, "subcategory": 2,
+                      "altres_categories": 1.5, "address": 1, "description": 1},
+    "offer": {"title": 4, "tags": 2, "discount": 1.5, "description": 1},
+    "event": {"title": 4, "tags": 2, "description": 1},
+    "promotion": {"title": 4, "tag": 2, "description": 1},
+}
+
+# Camps retornats a cada resultat
+RESULT_FIELDS = {
+    "establishment": ("name", "commercial_name", "category", "address", "image_url", "logo_url"),
+    "offer": ("title", "discount", "image_url", "establishment_id", "valid_until"),
+    "event": ("title", "image_url", "valid_from", "valid_until"),
+    "promotion": ("title", "image_url", "establishment_id", "valid_until"),
+}
+
+SEARCH_TYPES = tuple(FIELD_WEIGHTS.keys())
+
+
+def _field_text(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return " ".join(str(v) for v in value if v)
+    return str(value) if value else ""
+
+
+class TypeIndex:
+    """Índex invertit d'un tipus de document"""
+
+    def __init__(self, doc_type: str, docs: Iterable[dict]):
+        self.doc_type = doc_type
+        self.built_at = datetime.utcnow()
+        self.results: Dict[str, dict] = {}
+        self.expires: Dict[str, Optional[datetime]] = {}
+        self.postings: Dict[str, Dict[str, float]] = {}
+        weights = FIELD_WEIGHTS[doc_type]
+
+        for doc in docs:
+            doc_id = str(doc["_id"])
+            term_weights: Dict[str, float] = {}
+            for field, weight in weights.items():
+                for token in tokenize(_field_text(doc.get(field))):
+                    term_weights[token] = term_weights.get(token, 0) + weight
+            if not term_weights:
+                continue
+
+            # Normalització per llargada: textos llargs no dominen el rànquing
+            length_norm = 1 / math.sqrt(len(term_weights))
+            for token, weight in term_weights.items():
+                self.postings.setdefault(token, {})[doc_id] = (1 + math.log(weight)) * length_norm
+
+            result = {"type": doc_type, "id": doc_id}
+            for field in RESULT_FIELDS[doc_type]:
+                value = doc.get(field)
+                result[field] = str(value) if field.endswith("_id") and value else value
+            self.results[doc_id] = result
+            self.expires[doc_id] = doc.get("valid_until") if isinstance(doc.get("valid_until"), datetime) else None
+
+        self.vocabulary = sorted(self.postings)
+        self.deletes: Dict[str, List[str]] = {}
+        for token in self.vocabulary:
+            if len(token) >= MIN_FUZZY_LENGTH:
+                for variant in _deletes(token):
+                    self.deletes.setdefault(variant, []).append(token)
+
+        total = max(len(self.results), 1)
+        self.idf = {token: math.log(1 + total / len(posting)) for token, posting in self.postings.items()}
+
+    def _expand(self, term: str, is_last: bool) -> List[Tuple[str, float]]:
+        """Termes del vocabulari que coincideixen amb el de la consulta"""
+        matches = {}
+        if term in self.postings:
+            matches[term] = EXACT
+
+        # Prefix (sempre per a l'últim terme: cerca mentre s'escriu)
+        if len(term) >= MIN_PREFIX_LENGTH and (is_last or not matches):
+            start = bisect.bisect_left(self.vocabulary, term)
+            for token in self.vocabulary[start:start + 50]:
+                if not token.startswith(term):
+                    break
+                matches.setdefault(token, PREFIX)
+
+        # Un error tipogràfic (inserció, omissió o substitució)
+        if not matches and len(term) >= MIN_FUZZY_LENGTH:
+            candidates = set(self.deletes.get(term, []))
+            for variant in _deletes(term):
+                if variant in self.postings:
+                    candidates.add(variant)
+                candidates.update(self.deletes.get(variant, []))
+            for token in candidates:
+                matches.setdefault(token, FUZZY)
+
+        return list(matches.items())
+
+    def search(self, terms: List[str], now: datetime) -> Dict[str, float]:
+        scores: Dict[str, float] = {}
+        matched_terms: Dict[str, int] = {}
+        for position, term in enumerate(terms):
+            seen = set()
+            for token, quality in self._expand(term, position == len(terms) - 1):
+                idf = self.idf[token]
+                for doc_id, weight in self.postings[token].items():
+                    scores[doc_id] = scores.get(doc_id, 0) + weight * idf * quality
+                    seen.add(doc_id)
+            for doc_id in seen:
+                matched_terms[doc_id] = matched_terms.get(doc_id, 0) + 1
+
+        results = {}
+        for doc_id, score in scores.items():
+            expires = self.expires.get(doc_id)
+            if expires is not None and expires < now:
+                continue
+            # Prioritzar els documents que contenen tots els termes
+            results[doc_id] = score * (matched_terms[doc_id] / len(terms)) ** 2
+        return results
+
+
+# Consultes de càrrega per tipus
+async def _load_establishments(db):
+    return await db.establishments.find(
+        PUBLIC_ESTABLISHMENTS_QUERY,
+        {**{f: 1 for f in FIELD_WEIGHTS["establishment"]}, **{f: 1 for f in RESULT_FIELDS["establishment"]}}
+    ).to_list(None)
+
+
+async def _load_offers(db):
+    return await db.offers.find({"valid_until": {"$gte": datetime.utcnow()}}).to_list(None)
+
+
+async def _load_events(db):
+    return await db.events.find({"valid_until": {"$exists": True, "$gte": datetime.utcnow()}}).to_list(None)
+
+
+async def _load_promotions(db):
+    now = datetime.utcnow()
+    return await db.promotions.find({
+        "status": "approved",
+        "$or": [
+            {"valid_until": {"$gte": now}},
+            {"valid_until": None},
+            {"valid_until": {"$exists": False}}
+        ]
+    }).to_list(None)
+
+
+LOADERS = {
+    "establishment": _load_establishments,
+    "offer": _load_offers,
+    "event": _load_events,
+    "promotion": _load_promotions,
+}
+
+NAMESPACE_TYPES = {
+    ESTABLISHMENTS: "establishment",
+    OFFERS: "offer",
+    EVENTS: "event",
+    PROMOTIONS: "promotion",
+}
+
+
+class SearchIndex:
+    """Índexs de tots els tipus, amb reconstrucció en segon pla"""
+
+    # Els documents caducats es filtren a la consulta; cal refer l'índex de
+    # tant en tant perquè no s'hi acumulin
+    MAX_AGE = 3600
+
+    def __init__(self):
+        self.db = None
+        self._indexes: Dict[str, TypeIndex] = {}
+        self._dirty: Set[str] = set()
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._rebuild_task: Optional[asyncio.Task] = None
+        self.builds = 0
+        self.queries = 0
+
+    async def _build(self, doc_type: str) -> TypeIndex:
+        async with self._locks.setdefault(doc_type, asyncio.Lock()):
+            if doc_type in self._indexes and doc_type not in self._dirty:
+                return self._indexes[doc_type]
+            self._dirty.discard(doc_type)
+            start = time.perf_counter()
+            docs = await LOADERS[doc_type](self.db)
+            index = await asyncio.to_thread(TypeIndex, doc_type, docs)
+            self._indexes[doc_type] = index
+            self.builds += 1
+            logger.info(f"[SEARCH] Índex '{doc_type}' reconstruït: {len(index.results)} documents, "
+                        f"{len(index.vocabulary)} termes en {(time.perf_counter() - start) * 1000:.0f}ms")
+            return index
+
+    async def get(self, doc_type: str) -> TypeIndex:
+        index = self._indexes.get(doc_type)
+        if index is None:
+            return await self._build(doc_type)
+        age = (datetime.utcnow() - index.built_at).total_seconds()
+        if doc_type in self._dirty or age > self.MAX_AGE:
+            self._dirty.add(doc_type)
+            lock = self._locks.get(doc_type)
+            if lock is not None and lock.locked():
+                # Ja s'està reconstruint: es fa servir l'índex anterior
+                return index
+            return await self._build(doc_type)
+        return index
+
+    async def warm(self):
+        for doc_type in SEARCH_TYPES:
+            await self.get(doc_type)
+
+    def mark_dirty(self, namespace: str):
+        doc_type = NAMESPACE_TYPES[namespace]
+        self._dirty.add(doc_type)
+        if self.db is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if self._rebuild_task and not self._rebuild_task.done():
+            return
+
+        async def rebuild():
+            await asyncio.sleep(REBUILD_DELAY)
+            for dirty_type in list(self._dirty):
+                try:
+                    await self._build(dirty_type)
+                except Exception as e:
+                    logger.error(f"[SEARCH] Error reconstruint l'índex '{dirty_type}': {e}")
+
+        self._rebuild_task = loop.create_task(rebuild())
+
+    async def search(self, query: str, types: Optional[List[str]] = None, limit: int = 20) -> dict:
+        self.queries += 1
+        start = time.perf_counter()
+        terms = tokenize(query)
+        types = [t for t in (types or SEARCH_TYPES) if t in SEARCH_TYPES]
+        limit = max(1, min(limit, MAX_RESULTS))
+
+        now = datetime.utcnow()
+        ranked = []
+        if terms:
+            for doc_type in types:
+                index = await self.get(doc_type)
+                for doc_id, score in index.search(terms, now).items():
+                    ranked.append((score, doc_id, index))
+
+        top = sorted(ranked, key=lambda item: item[0], reverse=True)[:limit]
+        results = []
+        for score, doc_id, index in top:
+            result = dict(index.results[doc_id])
+            result["score"] = round(score, 4)
+            results.append(result)
+
+        return {
+            "query": query,
+            "types": types,
+            "total": len(ranked),
+            "results": results,
+            "took_ms": round((time.perf_counter() - start) * 1000, 2),
+        }
+
+    def stats(self) -> dict:
+        return {
+            "indexes": {
+                doc_type: {
+                    "documents": len(index.results),
+                    "terms": len(index.vocabulary),
+                    "built_at": index.built_at,
+                    "dirty": doc_type in self._dirty,
+                }
+                for doc_type, index in self._indexes.items()
+            },
+            "builds": self.builds,
+            "queries": self.queries,
+        }
+
+
+search_index = SearchIndex()
+for _namespace in NAMESPACE_TYPES:
+    add_invalidation_listener(_namespace, lambda ns=_namespace: search_index.mark_dirty(ns))
+
+
+def set_database(database):
+    search_index.db = database
+
+
+async def search_catalogue(query: str, types: Optional[List[str]] = None, limit: int = 20) -> dict:
+    return await search_index.search(query, types, limit)
+
+
+def get_search_stats() -> dict:
+    return search_index.stats()
@@ -1,6 +1,5 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Header, Body, Request, UploadFile, File
+from fastapi import FastAPI, APIRouter, HTTPException, Header, Body, Request, UploadFile, File, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 from fastapi.responses import FileResponse
 from motor.motor_asyncio import AsyncIOMotorClient
 from dotenv import load_dotenv
@@ -13,11 +12,51 @@ from typing import Optional, List
 from pydantic import BaseModel, Field
 from bson import ObjectId
 import paypalrestsdk
-import random
 import uuid
 import shutil
-from push_notifications import send_push_notification, send_notification_to_user
-from web_push_service import get_vapid_public_key
+from push_notifications import (
+    send_push_notification,
+    send_notification_to_user,
+    set_database as set_push_db,
+    close_push_client,
+)
+from web_push_service import get_vapid_public_key, set_database as set_web_push_db, close_web_push
+from broadcast_jobs import set_database as set_broadcast_db, start_broadcast_worker, stop_broadcast_worker
+from blob_store import set_database as set_blob_db, blob_response
+from static_assets import (
+    asset_response, resolve_asset, CachedStaticFiles, REVALIDATE, schedule_warm as warm_static_assets,
+)
+from image_derivatives import (
+    UPLOAD_DIR, schedule_derivatives, pick_derivative, with_thumbnail, thumbnail_url, shutdown_image_pool,
+)
+from ticket_jobs import (
+    set_database as set_ticket_jobs_db,
+    enqueue_ticket,
+    get_ticket_job,
+    wait_for_ticket_job,
+    start_ticket_workers,
+    stop_ticket_workers
+)
+from geo import (
+    PUBLIC_ESTABLISHMENTS_QUERY,
+    with_location,
+    backfill_locations,
+    nearby_establishments,
+    establishments_in_bbox,
+    parse_bbox,
+)
+from map_clusters import (
+    set_database as set_map_clusters_db,
+    warm_clusters,
+    cluster_tile_response,
+    layer_summary,
+    ESTABLISHMENTS_LAYER,
+)
+from search_index import set_database as set_search_db, search_catalogue, search_index, SEARCH_TYPES
+from establishment_matcher import (
+    set_database as set_matcher_db,
+    establishment_matcher
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -29,7 +68,32 @@ logger = logging.getLogger(__name__)
 from admin_routes import admin_router, OfferCreate, OfferUpdate
 from consell_routes import consell_router
 from gimcana_routes import gimcana_router, set_database as set_gimcana_db
-from news_scheduler import start_news_scheduler
+from news_scheduler import register_news_jobs, run_news_ingestion, set_database as set_news_db
+from scheduler import set_database as set_scheduler_db, start_scheduler, stop_scheduler
+from audience_segments import set_database as set_segments_db, audience_segments
+from notification_inbox import (
+    set_database as set_inbox_db, get_inbox, get_inbox_changes, mark_read, mark_many_read, delete_for_user,
+    unread_count, parse_cursor, normalise_user_ids
+)
+from live_events import (
+    set_database as set_live_db, publish as publish_live, publish_to_user, sse_response, websocket_session,
+    start_live_events, stop_live_events
+)
+from stats_rollups import (
+    set_database as set_stats_db, register_stats_jobs, record_signups, record_news, record_promotion_status
+)
+from news_scraper import close_news_client
+from db_indexes import ensure_indexes
+from data_loader import DataLoaders
+from draw_engine import weighted_draw
+import gift_card_engine
+from auth_cache import resolve_user, invalidate_user, invalidate_token
+from response_cache import (
+    cached_json_response,
+    clamp_limit,
+    invalidate_catalogue,
+    ESTABLISHMENTS, OFFERS, EVENTS, PROMOTIONS, NEWS, CLUB, INFO
+)
 
 # MongoDB connection
 mongo_url = os.environ.get('MONGO_URL')
@@ -133,86 +197,83 @@ if _pwa_dist_path.exists():
     else:
         logger.warning(f"[PWA-INIT] icons dir NOT FOUND!")
 
+def _pwa_file(*names: str) -> Optional[Path]:
+    """Primer fitxer que existeixi a dist o, si no, a frontend/public"""
+    for name in names:
+        for base in (_pwa_dist_path, _pwa_public_path):
+            path = resolve_asset(base, name)
+            if path:
+                return path
+    return None
+
 @app.get("/manifest.json", tags=["PWA"])
-async def serve_manifest_early():
+async def serve_manifest_early(request: Request):
     """Servir el manifest PWA - ruta prioritària"""
-    logger.info(f"[PWA-EARLY] manifest.json request, dist exists: {_pwa_dist_path.exists()}")
-    manifest_file = _pwa_dist_path / "manifest.json"
-    logger.info(f"[PWA-EARLY] manifest file: {manifest_file}, exists: {manifest_file.exists()}")
-    if manifest_file.exists():
-        logger.info(f"[PWA-EARLY] Serving manifest from {manifest_file}")
-        return FileResponse(str(manifest_file), media_type="application/json")
-    public_manifest = _pwa_public_path / "manifest.json"
-    if public_manifest.exists():
-        logger.info(f"[PWA-EARLY] Serving manifest from public: {public_manifest}")
-        return FileResponse(str(public_manifest), media_type="application/json")
+    manifest_file = _pwa_file("manifest.json")
+    if manifest_file:
+        return await asset_response(request, manifest_file, media_type="application/json")
     logger.error(f"[PWA-EARLY] Manifest NOT FOUND in any location!")
     raise HTTPException(status_code=404, detail="Manifest not found")
 
 @app.get("/sw.js", tags=["PWA"])
-async def serve_sw_early():
+async def serve_sw_early(request: Request):
     """Servir el Service Worker - ruta prioritària"""
-    logger.info(f"[PWA-EARLY] sw.js request")
-    if (_pwa_dist_path / "sw.js").exists():
-        return FileResponse(_pwa_dist_path / "sw.js", media_type="application/javascript")
-    if (_pwa_public_path / "sw.js").exists():
-        return FileResponse(_pwa_public_path / "sw.js", media_type="application/javascript")
+    sw_file = _pwa_file("sw.js")
+    if sw_file:
+        return await asset_response(request, sw_file, media_type="application/javascript")
     raise HTTPException(status_code=404, detail="Service Worker not found")
 
 @app.get("/service-worker.js", tags=["PWA"])
-async def serve_sw_alt_early():
-    """Servir el Service Worker (ruta alternativa)"""
-    logger.info(f"[PWA-EARLY] service-worker.js request")
-    # Primer buscar service-worker.js
-    if (_pwa_dist_path / "service-worker.js").exists():
-        return FileResponse(str(_pwa_dist_path / "service-worker.js"), media_type="application/javascript")
-    # Fallback a sw.js
-    if (_pwa_dist_path / "sw.js").exists():
-        return FileResponse(str(_pwa_dist_path / "sw.js"), media_type="application/javascript")
-    if (_pwa_public_path / "sw.js").exists():
-        return FileResponse(str(_pwa_public_path / "sw.js"), media_type="application/javascript")
+async def serve_sw_alt_early(request: Request):
+    """Servir el Service Worker (ruta alternativa, amb sw.js com a alternativa)"""
+    sw_file = resolve_asset(_pwa_dist_path, "service-worker.js") or _pwa_file("sw.js")
+    if sw_file:
+        return await asset_response(request, sw_file, media_type="application/javascript")
     raise HTTPException(status_code=404, detail="Service Worker not found")
 
 # Ruta per favicon-32.png
 @app.get("/favicon-32.png", tags=["PWA"])
-async def serve_favicon_32():
+async def serve_favicon_32(request: Request):
     """Servir favicon 32x32"""
-    if (_pwa_dist_path / "favicon-32.png").exists():
-        return FileResponse(str(_pwa_dist_path / "favicon-32.png"), media_type="image/png")
+    path = resolve_asset(_pwa_dist_path, "favicon-32.png")
+    if path:
+        return await asset_response(request, path, media_type="image/png")
     raise HTTPException(status_code=404, detail="Favicon 32 not found")
 
 @app.get("/icons/{icon_name}", tags=["PWA"])
-async def serve_icon_early(icon_name: str):
+async def serve_icon_early(icon_name: str, request: Request):
     """Servir icones PWA - ruta prioritària"""
-    logger.info(f"[PWA-EARLY] icon request: {icon_name}")
-    if (_pwa_dist_path / "icons" / icon_name).exists():
-        return FileResponse(_pwa_dist_path / "icons" / icon_name, media_type="image/png")
-    if (_pwa_public_path / "icons" / icon_name).exists():
-        return FileResponse(_pwa_public_path / "icons" / icon_name, media_type="image/png")
+    path = _pwa_file(f"icons/{icon_name}")
+    if path:
+        return await asset_response(request, path, media_type="image/png")
     raise HTTPException(status_code=404, detail=f"Icon {icon_name} not found")
 
 # Favicon routes
 @app.get("/favicon.ico", tags=["PWA"])
-async def serve_favicon():
+async def serve_favicon(request: Request):
     """Servir favicon"""
-    if (_pwa_dist_path / "favicon.ico").exists():
-        return FileResponse(_pwa_dist_path / "favicon.ico", media_type="image/x-icon")
-    if (_pwa_dist_path / "favicon.png").exists():
-        return FileResponse(_pwa_dist_path / "favicon.png", media_type="image/png")
+    path = resolve_asset(_pwa_dist_path, "favicon.ico")
+    if path:
+        return await asset_response(request, path, media_type="image/x-icon")
+    path = resolve_asset(_pwa_dist_path, "favicon.png")
+    if path:
+        return await asset_response(request, path, media_type="image/png")
     raise HTTPException(status_code=404, detail="Favicon not found")
 
 @app.get("/favicon.png", tags=["PWA"])
-async def serve_favicon_png():
+async def serve_favicon_png(request: Request):
     """Servir favicon PNG"""
-    if (_pwa_dist_path / "favicon.png").exists():
-        return FileResponse(_pwa_dist_path / "favicon.png", media_type="image/png")
+    path = resolve_asset(_pwa_dist_path, "favicon.png")
+    if path:
+        return await asset_response(request, path, media_type="image/png")
     raise HTTPException(status_code=404, detail="Favicon not found")
 
 @app.get("/apple-touch-icon.png", tags=["PWA"])
-async def serve_apple_touch_icon():
+async def serve_apple_touch_icon(request: Request):
     """Servir Apple Touch Icon"""
-    if (_pwa_dist_path / "apple-touch-icon.png").exists():
-        return FileResponse(_pwa_dist_path / "apple-touch-icon.png", media_type="image/png")
+    path = resolve_asset(_pwa_dist_path, "apple-touch-icon.png")
+    if path:
+        return await asset_response(request, path, media_type="image/png")
     raise HTTPException(status_code=404, detail="Apple Touch Icon not found")
 
 logger.info(f"[PWA] Routes registered. dist_path={_pwa_dist_path}, exists={_pwa_dist_path.exists()}")
@@ -564,38 +625,15 @@ class WebPushSubscription(BaseModel):
     endpoint: str
     keys: dict  # p256dh i auth
 
+class MarkReadRequest(BaseModel):
+    """Marcar notificacions com a llegides: IDs concrets i/o totes fins al cursor up_to"""
+    ids: Optional[List[str]] = None
+    up_to: Optional[str] = None
+
 # Helper function for authentication
 async def get_user_from_token(authorization: str):
-    """Obtenir usuari des del token d'autorització"""
-    if not authorization:
-        print("[AUTH] No hi ha authorization header")
-        return None
-    
-    # Suportar diferents formats de token
-    token = authorization.replace("Bearer ", "").replace("token_", "")
-    print(f"[AUTH] Token rebut (primers 20 chars): {token[:20]}...")
-    
-    try:
-        # Primer intentar buscar per token directament (nou sistema)
-        user = await db.users.find_one({"token": token})
-        if user:
-            print(f"[AUTH] Usuari trobat pel camp 'token': {user.get('email')}")
-            return user
-        else:
-            print("[AUTH] Usuari NO trobat pel camp 'token'")
-        
-        # Si no es troba, intentar buscar per _id (sistema antic amb token_)
-        try:
-            user = await db.users.find_one({"_id": ObjectId(token)})
-            if user:
-                print(f"[AUTH] Usuari trobat per ObjectId: {user.get('email')}")
-            return user
-        except Exception as e:
-            print(f"[AUTH] Error buscant per ObjectId: {e}")
-            return None
-    except Exception as e:
-        print(f"[AUTH] Error general: {e}")
-        return None
+    """Obtenir usuari des del token d'autorització (amb cache en memòria)"""
+    return await resolve_user(db, authorization)
 
 # Authentication endpoints
 @api_router.post("/auth/register", response_model=User)
@@ -631,6 +669,8 @@ async def register(user_data: UserCreate):
     
     result = await db.users.insert_one(user_dict)
     user_id = str(result.inserted_id)
+    invalidate_token(user_dict['token'])
+    await record_signups()
     
     # Guardar historial de consentiment
     consent_history = {
@@ -664,6 +704,7 @@ async def update_push_token(
         {"_id": user['_id']},
         {"$set": {"push_token": token_data.push_token}}
     )
+    invalidate_user(user['_id'])
     
     logger.info(f"Push token actualitzat per usuari {user.get('email')}: {token_data.push_token[:30]}...")
     
@@ -707,6 +748,7 @@ async def subscribe_web_push(
         {"_id": user['_id']},
         {"$set": {"web_push_subscription": subscription_obj}}
     )
+    invalidate_user(user['_id'])
     
     logger.info(f"✅ Web Push subscrit per usuari {user.get('email')}")
     
@@ -727,6 +769,7 @@ async def unsubscribe_web_push(
         {"_id": user['_id']},
         {"$unset": {"web_push_subscription": ""}}
     )
+    invalidate_user(user['_id'])
     
     logger.info(f"❌ Web Push dessubscrit per usuari {user.get('email')}")
     
@@ -764,6 +807,7 @@ async def update_user_language(
         {"_id": user['_id']},
         {"$set": {"language": language}}
     )
+    invalidate_user(user['_id'])
     
     return {"success": True, "language": language}
 
@@ -800,6 +844,8 @@ async def login(email: str, password: str):
             {"_id": user['_id']},
             {"$set": {"token": token}}
         )
+    invalidate_token(token)
+    invalidate_user(user['_id'])
     
     user['_id'] = str(user['_id'])
     user['token'] = token
@@ -1013,13 +1059,16 @@ async def create_my_establishment(
         random_code = secrets.token_hex(3).upper()
         establishment_dict['establishment_code'] = f"ESTAB-{date_str}-{random_code}"
     
+    with_location(establishment_dict)
     result = await db.establishments.insert_one(establishment_dict)
+    invalidate_catalogue(ESTABLISHMENTS)
     
     # Actualitzar user amb establishment_id
     await db.users.update_one(
         {"_id": ObjectId(user['_id'])},
         {"$set": {"establishment_id": str(result.inserted_id)}}
     )
+    invalidate_user(user['_id'])
     
     return {"id": str(result.inserted_id), "message": "Establishment created successfully"}
 
@@ -1046,16 +1095,18 @@ async def update_my_establishment(
     
     # Actualitzar
     update_data = {k: v for k, v in establishment.dict().items() if v is not None}
+    with_location(update_data, existing)
     
     await db.establishments.update_one(
         {"_id": existing['_id']},
         {"$set": update_data}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     return {"message": "Establishment updated successfully"}
 
-@api_router.get("/establishments")
-async def get_establishments():
+async def _load_public_establishments():
+    """Establiments públics (socis actius i visibles)"""
     try:
         # NEUROMOBILE DESACTIVAT - Utilitzant només dades locals de MongoDB
         if True:  # not NEUROMOBILE_TOKEN:
@@ -1128,7 +1179,7 @@ async def get_establishments():
                     est['id'] = est['_id']
                     if est.get('owner_id'):
                         est['owner_id'] = str(est['owner_id'])
-                    commerces.append(est)
+                    commerces.append(with_thumbnail(est))
                 
                 logger.info(f"Added {len(local_establishments)} local establishments")
                 return commerces
@@ -1139,19 +1190,7 @@ async def get_establishments():
         logger.error(f"Error fetching from Neuromobile: {str(e)}")
     
     # Fallback to MongoDB - només establiments visibles públicament i socis actius
-    establishments = await db.establishments.find({
-        "$and": [
-            # Només socis actius
-            {"status": "A Soci"},
-            # I visibles públicament
-            {
-                "$or": [
-                    {"visible_in_public_list": True},
-                    {"visible_in_public_list": {"$exists": False}}  # Per compatibilitat amb establiments antics
-                ]
-            }
-        ]
-    }).to_list(1000)
+    establishments = await db.establishments.find(PUBLIC_ESTABLISHMENTS_QUERY).to_list(1000)
     
     logger.info(f"Returning {len(establishments)} establishments from MongoDB fallback")
     
@@ -1161,8 +1200,71 @@ async def get_establishments():
         # Convertir owner_id a string si existeix
         if est.get('owner_id'):
             est['owner_id'] = str(est['owner_id'])
+        with_thumbnail(est)
     return establishments
 
+@api_router.get("/establishments")
+async def get_establishments(request: Request):
+    return await cached_json_response(request, ESTABLISHMENTS, _load_public_establishments)
+
+def _public_establishments_query(category: Optional[str] = None) -> dict:
+    if not category:
+        return PUBLIC_ESTABLISHMENTS_QUERY
+    return {"$and": [PUBLIC_ESTABLISHMENTS_QUERY, {"category": category}]}
+
+@api_router.get("/establishments/nearby")
+async def get_nearby_establishments(
+    lat: float,
+    lon: float,
+    radius: float = 1000,
+    category: Optional[str] = None,
+    limit: int = 20,
+    offset: int = 0
+):
+    """Establiments públics propers (radi en metres), ordenats per distància"""
+    return await nearby_establishments(
+        db, lat, lon, radius, _public_establishments_query(category), limit=limit, offset=offset
+    )
+
+@api_router.get("/establishments/bbox")
+async def get_establishments_in_bbox(bbox: str, category: Optional[str] = None):
+    """Marcadors dels establiments públics dins del mapa visible (bbox=oest,sud,est,nord)"""
+    return await establishments_in_bbox(db, parse_bbox(bbox), _public_establishments_query(category))
+
+@api_router.get("/search")
+async def search_catalogue_endpoint(q: str = "", types: Optional[str] = None, limit: int = 20):
+    """
+    Cerca al catàleg sense accents, per prefix i amb tolerància a errors.
+    types: llista separada per comes (establishment, offer, event, promotion)
+    """
+    selected = None
+    if types:
+        # S'accepten també en plural ("establishments")
+        selected = [t.strip().lower().rstrip("s") for t in types.split(",") if t.strip()]
+        unknown = [t for t in selected if t not in SEARCH_TYPES]
+        if unknown:
+            raise HTTPException(status_code=400, detail=f"Tipus de cerca desconegut: {', '.join(unknown)}")
+    return await search_catalogue(q, selected, limit)
+
+@api_router.get("/map/clusters/{zoom}/{x}/{y}")
+async def get_map_cluster_tile(
+    zoom: int,
+    x: int,
+    y: int,
+    request: Request,
+    layer: str = ESTABLISHMENTS_LAYER
+):
+    """
+    Marcadors agrupats d'una tessel·la del mapa (z/x/y com OpenStreetMap).
+    layer: "establishments" o "event:{id}" (establiments participants)
+    """
+    return await cluster_tile_response(request, layer, zoom, x, y)
+
+@api_router.get("/map/summary")
+async def get_map_summary(layer: str = ESTABLISHMENTS_LAYER):
+    """Nombre de marcadors i límits (oest,sud,est,nord) d'una capa del mapa"""
+    return await layer_summary(layer)
+
 @api_router.get("/establishments/{establishment_id}")
 async def get_establishment(establishment_id: str):
     est = await db.establishments.find_one({"_id": ObjectId(establishment_id)})
@@ -1196,18 +1298,18 @@ async def update_establishment(
     # Actualitzar establiment
     establishment_dict = establishment.dict(exclude_unset=True)
     establishment_dict['updated_at'] = datetime.utcnow()
+    with_location(establishment_dict, existing)
     
     await db.establishments.update_one(
         {"_id": ObjectId(establishment_id)},
         {"$set": establishment_dict}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     return {"success": True, "message": "Establishment updated successfully"}
 
 # Offers endpoints
-@api_router.get("/offers")
-async def get_offers():
-    """Obtenir ofertes actives (no caducades) per al directori públic"""
+async def _load_public_offers():
     from datetime import datetime
     
     # Filtrar només ofertes no caducades (valid_until > ara)
@@ -1219,8 +1321,14 @@ async def get_offers():
     for offer in offers:
         offer['_id'] = str(offer['_id'])
         offer['id'] = str(offer['_id'])
+        with_thumbnail(offer)
     return offers
 
+@api_router.get("/offers")
+async def get_offers(request: Request):
+    """Obtenir ofertes actives (no caducades) per al directori públic"""
+    return await cached_json_response(request, OFFERS, _load_public_offers)
+
 @api_router.get("/offers/{offer_id}")
 async def get_offer(offer_id: str):
     offer = await db.offers.find_one({"_id": ObjectId(offer_id)})
@@ -1270,6 +1378,7 @@ async def update_establishment_gallery(
         {"_id": ObjectId(establishment_id)},
         {"$set": {"gallery": gallery, "updated_at": datetime.utcnow()}}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="No s'ha pogut actualitzar l'establiment")
@@ -1283,8 +1392,7 @@ async def get_my_offers(authorization: str = Header(None)):
     if not authorization:
         raise HTTPException(status_code=401, detail="Token no proporcionat")
     
-    token = authorization.replace('Bearer ', '')
-    user = await db.users.find_one({"token": token})
+    user = await get_user_from_token(authorization)
     
     if not user:
         raise HTTPException(status_code=401, detail="Usuari no trobat")
@@ -1314,8 +1422,7 @@ async def create_my_offer(
     if not authorization:
         raise HTTPException(status_code=401, detail="Token no proporcionat")
     
-    token = authorization.replace('Bearer ', '')
-    user = await db.users.find_one({"token": token})
+    user = await get_user_from_token(authorization)
     
     if not user:
         raise HTTPException(status_code=401, detail="Usuari no trobat")
@@ -1337,6 +1444,7 @@ async def create_my_offer(
     offer_dict['created_by'] = str(user['_id'])
     
     result = await db.offers.insert_one(offer_dict)
+    invalidate_catalogue(OFFERS)
     offer_dict['_id'] = str(result.inserted_id)
     
     return offer_dict
@@ -1351,8 +1459,7 @@ async def update_my_offer(
     if not authorization:
         raise HTTPException(status_code=401, detail="Token no proporcionat")
     
-    token = authorization.replace('Bearer ', '')
-    user = await db.users.find_one({"token": token})
+    user = await get_user_from_token(authorization)
     
     if not user:
         raise HTTPException(status_code=401, detail="Usuari no trobat")
@@ -1382,6 +1489,7 @@ async def update_my_offer(
         {"_id": ObjectId(offer_id)},
         {"$set": update_data}
     )
+    invalidate_catalogue(OFFERS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Oferta no trobada")
@@ -1400,8 +1508,7 @@ async def delete_my_offer(
     if not authorization:
         raise HTTPException(status_code=401, detail="Token no proporcionat")
     
-    token = authorization.replace('Bearer ', '')
-    user = await db.users.find_one({"token": token})
+    user = await get_user_from_token(authorization)
     
     if not user:
         raise HTTPException(status_code=401, detail="Usuari no trobat")
@@ -1425,6 +1532,7 @@ async def delete_my_offer(
         raise HTTPException(status_code=403, detail="No pots eliminar ofertes d'altres establiments")
     
     result = await db.offers.delete_one({"_id": ObjectId(offer_id)})
+    invalidate_catalogue(OFFERS)
     
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Oferta no trobada")
@@ -1433,9 +1541,7 @@ async def delete_my_offer(
 
 
 # Events endpoints
-@api_router.get("/events")
-async def get_events():
-    """Obtenir esdeveniments públics (només amb l'estructura nova)"""
+async def _load_public_events():
     current_time = datetime.utcnow()
     events = await db.events.find({
         "valid_from": {"$exists": True},
@@ -1447,9 +1553,15 @@ async def get_events():
         event['id'] = str(event['_id'])
         if event.get('establishment_id'):
             event['establishment_id'] = str(event['establishment_id'])
+        with_thumbnail(event)
     
     return events
 
+@api_router.get("/events")
+async def get_events(request: Request):
+    """Obtenir esdeveniments públics (només amb l'estructura nova)"""
+    return await cached_json_response(request, EVENTS, _load_public_events)
+
 @api_router.get("/events/{event_id}")
 async def get_event(event_id: str):
     """Obtenir un esdeveniment per ID"""
@@ -1513,12 +1625,7 @@ async def get_promotions(authorization: str = Header(None)):
     return promotions
 
 
-@api_router.get("/promotions/featured")
-async def get_featured_promotions():
-    """
-    Obtenir promocions destacades per a la pàgina principal.
-    Retorna les promocions aprovades, vigents i marcades com destacades.
-    """
+async def _load_featured_promotions():
     from datetime import datetime
     now = datetime.utcnow()
     
@@ -1551,6 +1658,15 @@ async def get_featured_promotions():
     return promotions
 
 
+@api_router.get("/promotions/featured")
+async def get_featured_promotions(request: Request):
+    """
+    Obtenir promocions destacades per a la pàgina principal.
+    Retorna les promocions aprovades, vigents i marcades com destacades.
+    """
+    return await cached_json_response(request, PROMOTIONS, _load_featured_promotions)
+
+
 @api_router.get("/promotions/{promotion_id}")
 async def get_promotion(promotion_id: str):
     """Obtenir una promoció específica"""
@@ -1569,9 +1685,7 @@ async def get_promotion(promotion_id: str):
 # NOTÍCIES "REUS I EL TERRITORI"
 # ============================================================================
 
-@api_router.get("/news")
-async def get_news(limit: int = 20):
-    """Obtenir notícies de Reus i el Territori (només notícies vàlides i no expirades)"""
+async def _load_public_news(limit: int):
     try:
         now = datetime.utcnow()
         # Filtrar notícies que no han expirat o que no tenen data de caducitat
@@ -1589,6 +1703,12 @@ async def get_news(limit: int = 20):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/news")
+async def get_news(request: Request, limit: int = 20):
+    """Obtenir notícies de Reus i el Territori (només notícies vàlides i no expirades)"""
+    limit = clamp_limit(limit)
+    return await cached_json_response(request, NEWS, lambda: _load_public_news(limit), (limit,))
+
 @api_router.post("/news")
 async def create_news(news_data: NewsArticle, authorization: str = Header(None)):
     """Crear notícia manualment (només admin)"""
@@ -1600,6 +1720,8 @@ async def create_news(news_data: NewsArticle, authorization: str = Header(None))
         news_dict = news_data.dict()
         news_dict['is_automatic'] = False  # Marcar com manual
         result = await db.news.insert_one(news_dict)
+        invalidate_catalogue(NEWS)
+        await record_news()
         news_dict['_id'] = str(result.inserted_id)
         news_dict['id'] = str(result.inserted_id)
         return news_dict
@@ -1619,6 +1741,7 @@ async def update_news(news_id: str, news_data: NewsArticle, authorization: str =
             {"_id": ObjectId(news_id)},
             {"$set": news_dict}
         )
+        invalidate_catalogue(NEWS)
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="News not found")
         
@@ -1638,6 +1761,7 @@ async def delete_news(news_id: str, authorization: str = Header(None)):
     
     try:
         result = await db.news.delete_one({"_id": ObjectId(news_id)})
+        invalidate_catalogue(NEWS)
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="News not found")
         return {"message": "News deleted successfully"}
@@ -1652,33 +1776,13 @@ async def fetch_automatic_news(authorization: str = Header(None)):
         raise HTTPException(status_code=403, detail="Access denied")
     
     try:
-        from news_scraper import fetch_daily_news
-        
-        # Obtenir notícies
-        news_items = await fetch_daily_news(max_news=6)
-        
-        # Guardar a la base de dades
-        inserted_count = 0
-        for item in news_items:
-            # Evitar duplicats
-            existing = await db.news.find_one({"url": item['url']})
-            if not existing:
-                await db.news.insert_one({
-                    "title": item['title'],
-                    "url": item['url'],
-                    "source": item['source'],
-                    "created_at": datetime.utcnow(),
-                    "publish_date": datetime.utcnow(),
-                    "is_automatic": True,
-                    "category": "general"
-                })
-                inserted_count += 1
-        
+        summary = await run_news_ingestion()
         return {
             "success": True,
-            "fetched": len(news_items),
-            "inserted": inserted_count,
-            "skipped": len(news_items) - inserted_count
+            "fetched": summary["fetched"],
+            "inserted": summary["inserted"],
+            "skipped": summary["skipped"],
+            "sources": summary["sources"]
         }
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -1687,9 +1791,7 @@ async def fetch_automatic_news(authorization: str = Header(None)):
 # CLUB EL TOMB - CONTINGUTS
 # ============================================================================
 
-@api_router.get("/club/content")
-async def get_club_content(limit: int = 50):
-    """Obtenir continguts del Club El Tomb (inclou esdeveniments actius)"""
+async def _load_club_content(limit: int):
     try:
         # 1. Filtrar continguts del club no caducats
         club_content = await db.club_content.find({
@@ -1732,6 +1834,12 @@ async def get_club_content(limit: int = 50):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/club/content")
+async def get_club_content(request: Request, limit: int = 50):
+    """Obtenir continguts del Club El Tomb (inclou esdeveniments actius)"""
+    limit = clamp_limit(limit)
+    return await cached_json_response(request, CLUB, lambda: _load_club_content(limit), (limit,))
+
 @api_router.post("/club/content")
 async def create_club_content(content_data: ClubContent, authorization: str = Header(None)):
     """Crear contingut del Club (només admin)"""
@@ -1742,6 +1850,7 @@ async def create_club_content(content_data: ClubContent, authorization: str = He
     try:
         content_dict = content_data.dict()
         result = await db.club_content.insert_one(content_dict)
+        invalidate_catalogue(CLUB)
         content_dict['_id'] = str(result.inserted_id)
         content_dict['id'] = str(result.inserted_id)
         return content_dict
@@ -1761,6 +1870,7 @@ async def update_club_content(content_id: str, content_data: ClubContent, author
             {"_id": ObjectId(content_id)},
             {"$set": content_dict}
         )
+        invalidate_catalogue(CLUB)
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Content not found")
         
@@ -1780,6 +1890,7 @@ async def delete_club_content(content_id: str, authorization: str = Header(None)
     
     try:
         result = await db.club_content.delete_one({"_id": ObjectId(content_id)})
+        invalidate_catalogue(CLUB)
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Content not found")
         return {"message": "Content deleted successfully"}
@@ -1790,9 +1901,7 @@ async def delete_club_content(content_id: str, authorization: str = Header(None)
 # INFORMACIÓ - Continguts sobre El Tomb de Reus
 # ============================================================================
 
-@api_router.get("/info/content")
-async def get_info_content():
-    """Obtenir continguts d'informació (públic)"""
+async def _load_info_content():
     try:
         content = await db.info_content.find({"is_active": True}).sort("order", 1).to_list(50)
         for item in content:
@@ -1802,6 +1911,11 @@ async def get_info_content():
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/info/content")
+async def get_info_content(request: Request):
+    """Obtenir continguts d'informació (públic)"""
+    return await cached_json_response(request, INFO, _load_info_content)
+
 @api_router.post("/info/content")
 async def create_info_content(content_data: InfoContent, authorization: str = Header(None)):
     """Crear contingut d'informació (només admin)"""
@@ -1812,6 +1926,7 @@ async def create_info_content(content_data: InfoContent, authorization: str = He
     try:
         content_dict = content_data.dict()
         result = await db.info_content.insert_one(content_dict)
+        invalidate_catalogue(INFO)
         content_dict['_id'] = str(result.inserted_id)
         content_dict['id'] = str(result.inserted_id)
         return content_dict
@@ -1831,6 +1946,7 @@ async def update_info_content(content_id: str, content_data: InfoContent, author
             {"_id": ObjectId(content_id)},
             {"$set": content_dict}
         )
+        invalidate_catalogue(INFO)
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Content not found")
         
@@ -1850,6 +1966,7 @@ async def delete_info_content(content_id: str, authorization: str = Header(None)
     
     try:
         result = await db.info_content.delete_one({"_id": ObjectId(content_id)})
+        invalidate_catalogue(INFO)
         if result.deleted_count == 0:
             raise HTTPException(status_code=404, detail="Content not found")
         return {"message": "Content deleted successfully"}
@@ -1865,202 +1982,60 @@ class TicketProcessRequest(BaseModel):
 
 @api_router.post("/tickets/process")
 async def process_ticket(request: TicketProcessRequest, authorization: str = Header(None)):
-    """Processar tiquet amb OCR i generar participacions"""
+    """
+    Processar un tiquet amb OCR i generar participacions (espera el resultat).
+    Es manté per a les apps instal·lades; l'app nova fa servir POST /tickets/jobs.
+    """
     user = await get_user_from_token(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
-    
-    try:
-        from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
-        import os
-        from participation_tracker import track_participation
-        
-        # Processar imatge amb OCR utilitzant IA
-        api_key = os.getenv('EMERGENT_LLM_KEY')
-        
-        prompt = """Ets un expert en processar tiquets de compra. Analitza aquesta imatge de tiquet i extreu:
-
-1. Número de tiquet (busca: "Nº", "Ticket", "Factura", o número llarg)
-2. Nom de l'establiment (a la part superior)
-3. NIF o CIF de l'establiment (busca: "NIF:", "CIF:", "B-", "A-" seguit de números)
-4. Import total (busca: "TOTAL", "Total", "IMPORTE", "EUR")
-5. Data (format DD/MM/YYYY o similar)
-
-IMPORTANT: Retorna NOMÉS un JSON vàlid amb aquest format exacte:
-{
-  "ticket_number": "número del tiquet",
-  "establishment": "nom de l'establiment",
-  "nif": "NIF/CIF de l'establiment",
-  "amount": importe_numèric,
-  "date": "DD/MM/YYYY"
-}
-
-Si no pots extreure alguna dada, posa null."""
-
-        chat = LlmChat(
-            api_key=api_key,
-            session_id=f"ticket_{user['_id']}_{datetime.now().timestamp()}",
-            system_message="Ets un expert OCR que extreu dades de tiquets amb precisió."
-        ).with_model("openai", "gpt-4o-mini")
-        
-        # Preparar imatge (eliminar prefix si és necessari)
-        image_data = request.ticket_image
-        if image_data.startswith('data:image'):
-            # Extreure només la part base64
-            image_data = image_data.split(',')[1]
-        
-        # Crear contingut d'imatge
-        image_content = ImageContent(image_base64=image_data)
-        
-        # Enviar imatge i prompt
-        user_message = UserMessage(
-            text=prompt,
-            file_contents=[image_content]
-        )
-        
-        response = await chat.send_message(user_message)
-        
-        # Parsejar resposta JSON
-        import json
-        import re
-        
-        # Extreure JSON de la resposta (per si hi ha text extra)
-        json_match = re.search(r'\{.*\}', response, re.DOTALL)
-        if not json_match:
-            raise HTTPException(status_code=400, detail="No s'ha pogut processar el tiquet. Assegura't que la imatge és clara i llegible.")
-        
-        ticket_data = json.loads(json_match.group())
-        
-        # DEBUG: Log del que s'ha detectat
-        print(f"🔍 OCR DETECTAT: {json.dumps(ticket_data, indent=2, ensure_ascii=False)}")
-        
-        # Validar dades bàsiques
-        if not ticket_data.get("ticket_number") or not ticket_data.get("amount"):
-            raise HTTPException(status_code=400, detail="No s'ha pogut llegir el número de tiquet o l'import. Fes una foto més clara.")
-        
-        # Comprovar duplicats (mateix número de tiquet)
-        existing = await db.tickets.find_one({"ticket_number": ticket_data["ticket_number"]})
-        if existing:
-            raise HTTPException(status_code=400, detail="Aquest tiquet ja ha estat escanejat anteriorment.")
-        
-        # Comprovar si l'establiment està associat - PRIORITAT: NIF
-        establishment_name = ticket_data.get("establishment", "")
-        establishment_nif = ticket_data.get("nif", "")
-        
-        print(f"🔍 BUSCANT ESTABLIMENT:")
-        print(f"   Nom detectat: '{establishment_name}'")
-        print(f"   NIF detectat: '{establishment_nif}'")
-        
-        establishment = None
-        
-        # PRIORITAT 1: Buscar per NIF (més fiable que el nom comercial)
-        if establishment_nif:
-            print(f"   🔑 Cercant per NIF: '{establishment_nif}'")
-            establishment = await db.establishments.find_one({"nif": establishment_nif})
-            if establishment:
-                print(f"   ✅ Trobat per NIF! Nom a BD: '{establishment['name']}'")
-        
-        # PRIORITAT 2: Si no té NIF o no el troba, buscar per nom
-        if not establishment and establishment_name:
-            print(f"   📝 Cercant per nom: '{establishment_name}'")
-            query = {"name": {"$regex": establishment_name, "$options": "i"}}
-            establishment = await db.establishments.find_one(query)
-            if establishment:
-                print(f"   ✅ Trobat per nom! ID: {establishment['_id']}")
-        
-        if not establishment:
-            print(f"   ❌ NO TROBAT a la base de dades")
-            raise HTTPException(
-                status_code=400, 
-                detail=f"L'establiment '{establishment_name}' (NIF: {establishment_nif or 'no detectat'}) no està al directori de El Tomb. Només els establiments socis poden generar participacions."
-            )
-        
-        # Calcular participacions (1 per cada 10€)
-        amount = float(ticket_data["amount"])
-        participations = int(amount // 10)
-        
-        if participations == 0:
-            raise HTTPException(status_code=400, detail="L'import mínim per generar participacions és 10€. Aquest tiquet té un import inferior.")
-        
-        # Guardar tiquet
-        ticket_date = None
-        if ticket_data.get("date"):
-            try:
-                ticket_date = datetime.strptime(ticket_data["date"], "%d/%m/%Y")
-            except (ValueError, TypeError):
-                ticket_date = datetime.utcnow()
-        else:
-            ticket_date = datetime.utcnow()
-        
-        ticket_doc = {
-            "ticket_number": ticket_data["ticket_number"],
-            "establishment_name": establishment_name,
-            "establishment_id": str(establishment["_id"]),
-            "amount": amount,
-            "ticket_date": ticket_date,
-            "image": request.ticket_image,
-            "user_id": str(user["_id"]),
-            "participations_generated": participations,
-            "validated": True,  # Auto-validat si l'establiment està a la BD
-            "created_at": datetime.utcnow()
-        }
-        
-        await db.tickets.insert_one(ticket_doc)
-        
-        # Tracking de participació per marcador (si la campanya té tag)
-        active_campaign = await db.ticket_campaigns.find_one({"is_active": True})
-        if active_campaign and active_campaign.get("tag"):
-            await track_participation(
-                user_id=str(user["_id"]),
-                tag=active_campaign["tag"],
-                activity_type="ticket_scan",
-                activity_id=str(active_campaign.get("_id", "")),
-                activity_title=active_campaign.get("title", "Escaneja Tiquets"),
-                metadata={
-                    "establishment_name": establishment_name,
-                    "amount": amount,
-                    "participations": participations
-                }
-            )
-        
-        # Actualitzar participacions de l'usuari
-        user_participation = await db.draw_participations.find_one({"user_id": str(user["_id"])})
-        
-        if user_participation:
-            await db.draw_participations.update_one(
-                {"user_id": str(user["_id"])},
-                {
-                    "$inc": {
-                        "participations": participations,
-                        "tickets_count": 1
-                    },
-                    "$set": {
-                        "last_ticket_date": datetime.utcnow()
-                    }
-                }
-            )
-        else:
-            await db.draw_participations.insert_one({
-                "user_id": str(user["_id"]),
-                "participations": participations,
-                "tickets_count": 1,
-                "last_ticket_date": datetime.utcnow()
-            })
-        
-        return {
-            "success": True,
-            "ticket_number": ticket_data["ticket_number"],
-            "establishment": establishment_name,
-            "amount": amount,
-            "participations": participations,
-            "message": f"✅ Tiquet validat! Has generat {participations} participació{'ns' if participations > 1 else ''}"
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error processant tiquet: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processant tiquet: {str(e)}")
+
+    job = await enqueue_ticket(user, request.ticket_image)
+    job = await wait_for_ticket_job(job["id"], str(user["_id"]))
+    if job is None:
+        raise HTTPException(status_code=500, detail="Error processant tiquet")
+    if job["status"] == "completed":
+        return job["result"]
+    if job["status"] == "failed":
+        raise HTTPException(status_code=job.get("status_code") or 500, detail=job.get("error"))
+    # Continua en segon pla: les participacions se sumaran igualment
+    raise HTTPException(
+        status_code=504,
+        detail="El tiquet encara s'està processant. Consulta l'historial d'aquí a uns minuts."
+    )
+
+@api_router.post("/tickets/jobs", status_code=202)
+async def create_ticket_job(request: TicketProcessRequest, authorization: str = Header(None)):
+    """
+    Encuar un tiquet per processar amb OCR i generar participacions.
+    Retorna l'ID del treball; el resultat es consulta a /tickets/jobs/{job_id}.
+    """
+    user = await get_user_from_token(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    job = await enqueue_ticket(user, request.ticket_image)
+    return {"job_id": job["id"], "status": job["status"]}
+
+@api_router.get("/tickets/jobs/{job_id}")
+async def get_ticket_job_status(job_id: str, authorization: str = Header(None)):
+    """Estat del processament d'un tiquet (queued, running, completed, failed)"""
+    user = await get_user_from_token(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    job = await get_ticket_job(job_id, str(user["_id"]))
+    if not job:
+        raise HTTPException(status_code=404, detail="Treball no trobat")
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "result": job.get("result"),
+        "error": job.get("error"),
+        "status_code": job.get("status_code"),
+        "created_at": job.get("created_at"),
+        "finished_at": job.get("finished_at"),
+    }
 
 @api_router.get("/tickets/my-participations")
 async def get_my_participations(authorization: str = Header(None)):
@@ -2092,7 +2067,8 @@ async def get_my_tickets(authorization: str = Header(None)):
         raise HTTPException(status_code=401, detail="Unauthorized")
     
     try:
-        tickets = await db.tickets.find({"user_id": str(user["_id"])}).sort("created_at", -1).to_list(100)
+        # Sense la foto: els tiquets antics la guarden en base64 dins del document
+        tickets = await db.tickets.find({"user_id": str(user["_id"])}, {"image": 0}).sort("created_at", -1).to_list(100)
         for ticket in tickets:
             ticket['_id'] = str(ticket['_id'])
             ticket['id'] = str(ticket['_id'])
@@ -2200,9 +2176,10 @@ async def get_campaign_participants_count(
 async def conduct_draw(
     campaign_id: str,
     num_winners: int = 1,
+    seed: Optional[int] = None,
     authorization: str = Header(None)
 ):
-    """Realitzar sorteig i notificar guanyadors (admin)"""
+    """Realitzar sorteig i notificar guanyadors (admin). La llavor queda registrada."""
     user = await get_user_from_token(authorization)
     if not user or user.get("role") != "admin":
         raise HTTPException(status_code=403, detail="Access denied")
@@ -2213,38 +2190,35 @@ async def conduct_draw(
         if not campaign:
             raise HTTPException(status_code=404, detail="Campaign not found")
         
-        # Obtenir tots els participants amb participacions
-        participants = await db.draw_participations.find(
-            {"participations": {"$gt": 0}}
-        ).to_list(1000)
+        # Sorteig ponderat llegint els participants del cursor
+        # (cada participació = 1 bitllet, sense guanyadors repetits)
+        participants_cursor = db.draw_participations.find(
+            {"participations": {"$gt": 0}},
+            {"user_id": 1, "participations": 1}
+        ).sort("_id", 1)
+        draw = await weighted_draw(
+            participants_cursor,
+            num_winners,
+            seed=seed,
+            weight=lambda p: p.get("participations", 0)
+        )
         
-        if len(participants) == 0:
+        if draw.total_participants == 0:
             raise HTTPException(status_code=400, detail="No hi ha participants al sorteig")
         
-        # Crear pool de participacions (cada participació = 1 bitllet)
-        tickets_pool = []
-        for participant in participants:
-            user_id = participant["user_id"]
-            participations = participant["participations"]
-            # Afegir tants bitllets com participacions tingui
-            tickets_pool.extend([user_id] * participations)
+        # Obtenir info dels guanyadors (una sola consulta)
+        loaders = DataLoaders(db)
+        winner_users = await loaders.users.load_many(p["user_id"] for p in draw.winners)
         
-        # Seleccionar guanyadors aleatòriament
         winners = []
-        selected_ids = set()
-        
-        for _ in range(min(num_winners, len(set(tickets_pool)))):  # No més guanyadors que participants únics
-            winner_id = random.choice([uid for uid in tickets_pool if uid not in selected_ids])
-            selected_ids.add(winner_id)
-            
-            # Obtenir info del guanyador
-            winner_user = await db.users.find_one({"_id": ObjectId(winner_id)})
+        for participant in draw.winners:
+            winner_user = winner_users.get(str(participant["user_id"]))
             if winner_user:
                 winners.append({
-                    "user_id": winner_id,
+                    "user_id": participant["user_id"],
                     "name": winner_user.get("name", "Sense nom"),
                     "email": winner_user.get("email", ""),
-                    "participations": next(p["participations"] for p in participants if p["user_id"] == winner_id)
+                    "participations": participant["participations"]
                 })
         
         # Guardar sorteig a la BD
@@ -2253,30 +2227,40 @@ async def conduct_draw(
             "draw_date": datetime.utcnow(),
             "winners": winners,
             "prize_description": campaign.get("prize_description", ""),
-            "total_participants": len(set(p["user_id"] for p in participants)),
-            "total_participations": sum(p["participations"] for p in participants),
+            "total_participants": draw.total_participants,
+            "total_participations": draw.total_weight,
+            "draw_audit": draw.audit(),
             "status": "completed",
             "created_at": datetime.utcnow()
         }
         
         result = await db.draws.insert_one(draw_doc)
         
-        # Notificar guanyadors
-        for winner in winners:
-            # Obtenir user per push token
-            winner_user = await db.users.find_one({"_id": ObjectId(winner["user_id"])})
-            if winner_user and winner_user.get("push_token"):
-                await send_notification_to_user(
-                    winner_user["push_token"],
-                    "🎉 Has Guanyat!",
-                    f"Felicitats! Has guanyat al sorteig mensual de El Tomb. Premi: {campaign.get('prize_description', 'Premi sorpresa')}"
-                )
+        # Notificar guanyadors (un sol enviament per lots)
+        winner_users = await loaders.users.load_many(w["user_id"] for w in winners)
+        winner_tokens = [u["push_token"] for u in winner_users.values() if u.get("push_token")]
+        if winner_tokens:
+            await send_push_notification(
+                winner_tokens,
+                "🎉 Has Guanyat!",
+                f"Felicitats! Has guanyat al sorteig mensual de El Tomb. Premi: {campaign.get('prize_description', 'Premi sorpresa')}"
+            )
+        
+        for position, winner in enumerate(winners, start=1):
+            await publish_to_user(winner["user_id"], "raffle_result", {
+                "source": "tickets",
+                "draw_id": str(result.inserted_id),
+                "won": True,
+                "position": position,
+                "prize_description": campaign.get("prize_description", "")
+            })
         
         # Reset participacions de tots els usuaris
         await db.draw_participations.update_many(
             {},
             {"$set": {"participations": 0, "tickets_count": 0}}
         )
+        await publish_live(["all"], "participations", {"participations": 0, "tickets_count": 0, "reset": True})
         
         return {
             "success": True,
@@ -2284,6 +2268,7 @@ async def conduct_draw(
             "winners": winners,
             "total_participants": draw_doc["total_participants"],
             "total_participations": draw_doc["total_participations"],
+            "seed": draw_doc["draw_audit"]["seed"],
             "message": f"Sorteig realitzat amb èxit. {len(winners)} guanyador(s) notificat(s) i participacions resetejades."
         }
         
@@ -2320,10 +2305,12 @@ async def get_all_participants(authorization: str = Header(None)):
             {"participations": {"$gt": 0}}
         ).sort("participations", -1).to_list(1000)
         
-        # Enriquir amb info d'usuari
+        # Enriquir amb info d'usuari (una sola consulta)
+        users_by_id = await DataLoaders(db).users.load_many(p["user_id"] for p in participants)
+        
         enriched = []
         for p in participants:
-            user_data = await db.users.find_one({"_id": ObjectId(p["user_id"])})
+            user_data = users_by_id.get(str(p["user_id"]))
             if user_data:
                 enriched.append({
                     "user_id": p["user_id"],
@@ -2394,6 +2381,8 @@ async def create_promotion(
         promo_dict['status'] = 'pending'
     
     result = await db.promotions.insert_one(promo_dict)
+    invalidate_catalogue(PROMOTIONS)
+    await record_promotion_status(None, promo_dict['status'])
     promo_id = str(result.inserted_id)
     promo_dict['_id'] = promo_id
     
@@ -2425,29 +2414,18 @@ async def create_promotion(
                     push_tokens.append(admin['push_token'])
             
             if push_tokens:
-                import httpx
                 # Enviar notificació push via Expo Push Notifications
-                messages = []
-                for token in push_tokens:
-                    messages.append({
-                        "to": token,
-                        "sound": "default",
-                        "title": "Nova promoció pendent",
-                        "body": f"📢 {promotion.title} - Pendent d'aprovació",
-                        "data": {
-                            "type": "new_promotion",
-                            "promotion_id": str(result.inserted_id),
-                            "route": "/admin/offers"
-                        }
-                    })
-                
-                async with httpx.AsyncClient() as client:
-                    response = await client.post(
-                        "https://exp.host/--/api/v2/push/send",
-                        json=messages,
-                        headers={"Accept": "application/json", "Content-Type": "application/json"}
-                    )
-                    print(f"✅ Notificacions push enviades als administradors: {response.status_code}")
+                push_result = await send_push_notification(
+                    push_tokens,
+                    "Nova promoció pendent",
+                    f"📢 {promotion.title} - Pendent d'aprovació",
+                    {
+                        "type": "new_promotion",
+                        "promotion_id": str(result.inserted_id),
+                        "route": "/admin/offers"
+                    }
+                )
+                print(f"✅ Notificacions push enviades als administradors: {len(push_result.get('data', []))}")
         except Exception as e:
             print(f"❌ Error enviant notificacions push: {e}")
     
@@ -2494,6 +2472,9 @@ async def update_promotion(
         {"_id": ObjectId(promotion_id)},
         {"$set": update_data}
     )
+    invalidate_catalogue(PROMOTIONS)
+    if 'status' in update_data:
+        await record_promotion_status(existing.get('status'), update_data['status'])
     
     updated = await db.promotions.find_one({"_id": ObjectId(promotion_id)})
     updated['_id'] = str(updated['_id'])
@@ -2520,7 +2501,10 @@ async def delete_promotion(
     if str(existing['created_by']) != user_id and user.get('role') != 'admin':
         raise HTTPException(status_code=403, detail="No tens permís per eliminar aquesta promoció")
     
-    await db.promotions.delete_one({"_id": ObjectId(promotion_id)})
+    result = await db.promotions.delete_one({"_id": ObjectId(promotion_id)})
+    invalidate_catalogue(PROMOTIONS)
+    if result.deleted_count:
+        await record_promotion_status(existing.get('status'), None)
     
     return {"success": True, "message": "Promoció eliminada"}
 
@@ -2552,15 +2536,17 @@ async def approve_promotion(
             }
         }
     )
+    invalidate_catalogue(PROMOTIONS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Promoció no trobada")
+    await record_promotion_status(promotion.get('status'), "approved")
     
     # Enviar notificació push al creador
     try:
         creator = await db.users.find_one({"_id": ObjectId(promotion["created_by"])})
         if creator and creator.get("push_token"):
-            send_notification_to_user(
+            await send_notification_to_user(
                 creator["push_token"],
                 "✅ Promoció Aprovada",
                 f"La teva promoció '{promotion.get('title', '')}' ha estat aprovada i ja és visible per a tots els usuaris!"
@@ -2599,15 +2585,17 @@ async def reject_promotion(
             }
         }
     )
+    invalidate_catalogue(PROMOTIONS)
     
     if result.matched_count == 0:
         raise HTTPException(status_code=404, detail="Promoció no trobada")
+    await record_promotion_status(promotion.get('status'), "rejected")
     
     # Enviar notificació push al creador
     try:
         creator = await db.users.find_one({"_id": ObjectId(promotion["created_by"])})
         if creator and creator.get("push_token"):
-            send_notification_to_user(
+            await send_notification_to_user(
                 creator["push_token"],
                 "❌ Promoció Rebutjada",
                 f"La teva promoció '{promotion.get('title', '')}' ha estat rebutjada. Motiu: {reason}"
@@ -2637,6 +2625,7 @@ async def create_gift_card(gift_card_data: GiftCardCreate):
     }
     
     result = await db.gift_cards.insert_one(gift_card_dict)
+    await gift_card_engine.credit_user_balance(db, gift_card_dict['user_id'], gift_card_dict['balance'])
     gift_card_dict['_id'] = str(result.inserted_id)
     
     return gift_card_dict
@@ -2707,6 +2696,7 @@ async def update_local_associat_config(
         {"_id": establishment['_id']},
         {"$set": update_data}
     )
+    invalidate_catalogue(ESTABLISHMENTS)
     
     return {"success": True, "message": "Configuració actualitzada"}
 
@@ -2750,20 +2740,19 @@ async def get_user_gift_card_balance(user_id: str, authorization: str = Header(N
     if not target_user:
         raise HTTPException(status_code=404, detail="Usuari no trobat")
     
-    # Calcular saldo total de les targetes actives
-    gift_cards = await db.gift_cards.find({
+    # Saldo desnormalitzat (una lectura) i nombre de targetes actives
+    total_balance = await gift_card_engine.get_user_balance(db, user_id)
+    cards_count = await db.gift_cards.count_documents({
         "user_id": user_id,
         "status": "active"
-    }).to_list(100)
-    
-    total_balance = sum(gc.get('balance', 0) for gc in gift_cards)
+    })
     
     return {
         "user_id": user_id,
         "name": target_user.get('name', ''),
         "email": target_user.get('email', ''),
         "balance": total_balance,
-        "cards_count": len(gift_cards)
+        "cards_count": cards_count
     }
 
 @api_router.post("/gift-cards/charge")
@@ -2798,76 +2787,25 @@ async def charge_gift_card(
     if amount > 500:
         raise HTTPException(status_code=400, detail="Import màxim per transacció: 500€")
     
-    # Obtenir targetes actives del client
-    gift_cards = await db.gift_cards.find({
-        "user_id": customer_id,
-        "status": "active",
-        "balance": {"$gt": 0}
-    }).sort("created_at", 1).to_list(100)  # Ordenar per antiguitat (FIFO)
-    
-    total_balance = sum(gc.get('balance', 0) for gc in gift_cards)
+    if not customer_id:
+        raise HTTPException(status_code=400, detail="Falta l'usuari a cobrar")
     
-    if total_balance < amount:
+    # Cobrament atòmic (reserva de saldo + descompte FIFO de les targetes)
+    try:
+        result = await gift_card_engine.charge(db, customer_id, establishment, amount)
+    except gift_card_engine.InsufficientBalance as e:
         raise HTTPException(
             status_code=400, 
-            detail=f"Saldo insuficient. El client té {total_balance:.2f}€ disponibles."
-        )
-    
-    # Descomptar l'import de les targetes (FIFO)
-    remaining = amount
-    for gc in gift_cards:
-        if remaining <= 0:
-            break
-        
-        card_balance = gc.get('balance', 0)
-        to_deduct = min(card_balance, remaining)
-        new_balance = card_balance - to_deduct
-        
-        # Actualitzar targeta
-        update_data = {"balance": new_balance}
-        if new_balance <= 0:
-            update_data["status"] = "used"
-        
-        await db.gift_cards.update_one(
-            {"_id": gc['_id']},
-            {"$set": update_data}
+            detail=f"Saldo insuficient. El client té {e.available:.2f}€ disponibles."
         )
-        
-        remaining -= to_deduct
-    
-    # Afegir l'import al saldo del botiguer
-    current_shop_balance = establishment.get('gift_card_balance', 0)
-    new_shop_balance = current_shop_balance + amount
-    
-    await db.establishments.update_one(
-        {"_id": establishment['_id']},
-        {"$set": {"gift_card_balance": new_shop_balance}}
-    )
-    
-    # Registrar la transacció
-    transaction = {
-        "type": "gift_card_charge",
-        "customer_id": customer_id,
-        "shop_id": str(establishment['_id']),
-        "shop_name": establishment.get('name', ''),
-        "amount": amount,
-        "created_at": datetime.utcnow(),
-    }
-    await db.gift_card_transactions.insert_one(transaction)
-    
-    # Calcular nou saldo del client
-    updated_cards = await db.gift_cards.find({
-        "user_id": customer_id,
-        "status": "active"
-    }).to_list(100)
-    new_customer_balance = sum(gc.get('balance', 0) for gc in updated_cards)
+    invalidate_catalogue(ESTABLISHMENTS)
     
     return {
         "success": True,
-        "message": f"Cobrament de {amount:.2f}€ realitzat correctament",
-        "amount": amount,
-        "new_balance": new_customer_balance,
-        "shop_balance": new_shop_balance
+        "message": f"Cobrament de {result['amount']:.2f}€ realitzat correctament",
+        "amount": result["amount"],
+        "new_balance": result["new_balance"],
+        "shop_balance": result["shop_balance"]
     }
 
 @api_router.get("/gift-cards/user/{user_id}")
@@ -3116,6 +3054,7 @@ async def update_consent(
             }
         }
     )
+    invalidate_user(user_id)
     
     # Guardar en historial
     consent_history = {
@@ -3262,6 +3201,7 @@ async def update_user_tags(
             {"_id": ObjectId(user['_id'])},
             {"$set": {"tags": tags}}
         )
+        invalidate_user(user['_id'])
         
         if result.modified_count == 0:
             raise HTTPException(status_code=404, detail="User not found")
@@ -3277,36 +3217,60 @@ async def update_user_tags(
 # ============================================================================
 
 @api_router.get("/notifications")
-async def get_user_notifications(authorization: str = Header(None)):
+async def get_user_notifications(since: Optional[str] = None, authorization: str = Header(None)):
     """
-    Obtenir totes les notificacions de l'usuari
+    Obtenir les notificacions de l'usuari (directes i massives)
+    Amb ?since=<cursor> només retorna els canvis: {cursor, items, deleted, read_before, unread_count}
     """
     user = await get_user_from_token(authorization)
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
+    since_at = None
+    if since:
+        since_at = parse_cursor(since)
+        if since_at is None:
+            raise HTTPException(status_code=400, detail="Cursor invàlid")
+    
     try:
-        user_id = user["_id"]
-        # Buscar per user_id com ObjectId O com string (per compatibilitat)
-        notifications = await db.notifications.find({
-            "$or": [
-                {"user_id": user_id},
-                {"user_id": str(user_id)}
-            ]
-        }).sort("created_at", -1).to_list(100)
-        
-        for notification in notifications:
-            notification['_id'] = str(notification['_id'])
-            notification['id'] = str(notification['_id'])
-            # Convertir user_id a string també
-            if notification.get('user_id'):
-                notification['user_id'] = str(notification['user_id'])
-        
-        return notifications
+        if since_at is not None:
+            return await get_inbox_changes(user, since_at)
+        return await get_inbox(user)
     except Exception as e:
         print(f"Error getting notifications: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@api_router.get("/notifications/unread-count")
+async def get_unread_notifications_count(authorization: str = Header(None)):
+    """
+    Nombre de notificacions no llegides (per a la icona) sense descarregar la safata
+    """
+    user = await get_user_from_token(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    return {"unread_count": await unread_count(user)}
+
+@api_router.post("/notifications/mark-read")
+async def mark_notifications_as_read(request: MarkReadRequest, authorization: str = Header(None)):
+    """
+    Marcar com a llegides diverses notificacions: llista d'IDs i/o totes fins a un cursor (up_to)
+    """
+    user = await get_user_from_token(authorization)
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    if not request.ids and not request.up_to:
+        raise HTTPException(status_code=400, detail="Cal indicar ids o up_to")
+    up_to = None
+    if request.up_to:
+        up_to = parse_cursor(request.up_to)
+        if up_to is None:
+            raise HTTPException(status_code=400, detail="Cursor invàlid")
+    
+    marked = await mark_many_read(user, request.ids, up_to)
+    return {"marked": marked, "unread_count": await unread_count(user)}
+
 @api_router.put("/notifications/{notification_id}/read")
 async def mark_notification_as_read(
     notification_id: str,
@@ -3319,27 +3283,10 @@ async def mark_notification_as_read(
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    try:
-        user_id = user["_id"]
-        # Buscar per user_id com ObjectId O com string (per compatibilitat)
-        result = await db.notifications.update_one(
-            {
-                "_id": ObjectId(notification_id),
-                "$or": [
-                    {"user_id": user_id},
-                    {"user_id": str(user_id)}
-                ]
-            },
-            {"$set": {"read": True, "read_at": datetime.utcnow()}}
-        )
-        
-        if result.modified_count == 0:
-            raise HTTPException(status_code=404, detail="Notification not found")
-        
-        return {"message": "Notification marked as read"}
-    except Exception as e:
-        print(f"Error marking notification as read: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if not await mark_read(user, notification_id):
+        raise HTTPException(status_code=404, detail="Notification not found")
+    
+    return {"message": "Notification marked as read"}
 
 @api_router.delete("/notifications/{notification_id}")
 async def delete_notification(
@@ -3353,24 +3300,38 @@ async def delete_notification(
     if not user:
         raise HTTPException(status_code=401, detail="Unauthorized")
     
-    try:
-        user_id = user["_id"]
-        # Buscar per user_id com ObjectId O com string (per compatibilitat)
-        result = await db.notifications.delete_one({
-            "_id": ObjectId(notification_id),
-            "$or": [
-                {"user_id": user_id},
-                {"user_id": str(user_id)}
-            ]
-        })
-        
-        if result.deleted_count == 0:
-            raise HTTPException(status_code=404, detail="Notification not found")
-        
-        return {"message": "Notification deleted"}
-    except Exception as e:
-        print(f"Error deleting notification: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    if not await delete_for_user(user, notification_id):
+        raise HTTPException(status_code=404, detail="Notification not found")
+    
+    return {"message": "Notification deleted"}
+
+# ============================================================================
+# CANAL EN DIRECTE (notificacions, tiquets, gimcana i sortejos)
+# ============================================================================
+
+@api_router.get("/live/events")
+async def live_events_stream(request: Request, token: Optional[str] = None, authorization: str = Header(None)):
+    """
+    Esdeveniments de l'usuari en directe (Server-Sent Events)
+    EventSource no pot enviar capçaleres: el token també s'accepta com a ?token=
+    """
+    user = await get_user_from_token(authorization or token)
+    if not user:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+    
+    return sse_response(request, user)
+
+@api_router.websocket("/live/ws")
+async def live_events_websocket(websocket: WebSocket, token: Optional[str] = None):
+    """
+    Els mateixos esdeveniments per WebSocket (per als clients on SSE no funciona)
+    """
+    user = await get_user_from_token(token or websocket.headers.get("authorization"))
+    if not user:
+        await websocket.close(code=1008)
+        return
+    
+    await websocket_session(websocket, user)
 
 # Health check
 @api_router.get("/")
@@ -3388,6 +3349,24 @@ app.include_router(consell_router)
 set_gimcana_db(db)
 app.include_router(gimcana_router)
 
+# Notificacions push (esborrat de tokens i subscripcions invàlids)
+set_push_db(db)
+set_web_push_db(db)
+set_broadcast_db(db)
+
+# Clústers dels mapes i cercador
+set_map_clusters_db(db)
+set_search_db(db)
+set_matcher_db(db)
+set_ticket_jobs_db(db)
+set_blob_db(db)
+set_news_db(db)
+set_scheduler_db(db)
+set_segments_db(db)
+set_stats_db(db)
+set_inbox_db(db)
+set_live_db(db)
+
 # Routes included above
 
 app.add_middleware(
@@ -3403,82 +3382,79 @@ landing_path = Path(__file__).parent / "static"
 if landing_path.exists():
     # Serve static assets (CSS, JS, images)
     if (landing_path / "assets").exists():
-        app.mount("/landing/assets", StaticFiles(directory=str(landing_path / "assets")), name="landing-assets")
+        app.mount("/landing/assets", CachedStaticFiles(directory=str(landing_path / "assets")), name="landing-assets")
     
     # Serve main files
     @app.get("/landing/{file_name}")
-    async def serve_landing_file(file_name: str):
+    async def serve_landing_file(file_name: str, request: Request):
         """Servir fitxers de la landing page"""
-        file_path = landing_path / file_name
-        if file_path.exists() and file_path.is_file():
-            return FileResponse(file_path)
+        file_path = resolve_asset(landing_path, file_name)
+        if file_path:
+            return await asset_response(request, file_path)
         raise HTTPException(status_code=404, detail="File not found")
     
     # Serve landing page at root /landing
     @app.get("/landing")
-    async def serve_landing():
+    async def serve_landing(request: Request):
         """Servir la landing page principal"""
-        index_path = landing_path / "index.html"
-        if index_path.exists():
-            return FileResponse(index_path)
+        index_path = resolve_asset(landing_path, "index.html")
+        if index_path:
+            return await asset_response(request, index_path)
         raise HTTPException(status_code=404, detail="Landing page not found")
     
     # Serve tomb-pagines files
     @app.get("/landing/tomb-pagines/{file_name}")
-    async def serve_tomb_pagina(file_name: str):
+    async def serve_tomb_pagina(file_name: str, request: Request):
         """Servir fitxers de les pàgines individuals"""
-        file_path = landing_path / "tomb-pagines" / file_name
-        if file_path.exists() and file_path.is_file():
-            return FileResponse(file_path)
+        file_path = resolve_asset(landing_path / "tomb-pagines", file_name)
+        if file_path:
+            return await asset_response(request, file_path)
         raise HTTPException(status_code=404, detail="Page not found")
     
     # Serve tomb-pagines files under /api/ route for proxy compatibility
     @app.get("/api/landing/tomb-pagines/{file_name}")
-    async def serve_tomb_pagina_api(file_name: str):
-        """Servir fitxers de les pàgines individuals (via /api/)"""
-        file_path = landing_path / "tomb-pagines" / file_name
-        if file_path.exists() and file_path.is_file():
-            response = FileResponse(file_path)
-            response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate, max-age=0"
-            response.headers["Pragma"] = "no-cache"
-            response.headers["Expires"] = "0"
-            response.headers["X-Content-Type-Options"] = "nosniff"
-            response.headers["Last-Modified"] = datetime.now().strftime("%a, %d %b %Y %H:%M:%S GMT")
-            response.headers["ETag"] = f'"{datetime.now().timestamp()}"'
-            return response
+    async def serve_tomb_pagina_api(file_name: str, request: Request):
+        """
+        Servir fitxers de les pàgines individuals (via /api/)
+        Es revaliden sempre (no-cache): l'ETag canvia quan s'edita la pàgina i si no
+        ha canviat el navegador rep un 304 en lloc de tornar-la a descarregar
+        """
+        file_path = resolve_asset(landing_path / "tomb-pagines", file_name)
+        if file_path:
+            return await asset_response(request, file_path, cache_control=REVALIDATE,
+                                        headers={"X-Content-Type-Options": "nosniff"})
         raise HTTPException(status_code=404, detail="Page not found")
     
     # Serve assets under /api/ route for proxy compatibility
     @app.get("/api/landing/assets/{file_name}")
-    async def serve_landing_assets_api(file_name: str):
+    async def serve_landing_assets_api(file_name: str, request: Request):
         """Servir assets de la landing (logos, imatges, etc.)"""
-        file_path = landing_path / "assets" / file_name
-        if file_path.exists() and file_path.is_file():
-            return FileResponse(file_path)
+        file_path = resolve_asset(landing_path / "assets", file_name)
+        if file_path:
+            return await asset_response(request, file_path)
         raise HTTPException(status_code=404, detail="Asset not found")
 
 # Serve map HTML files from frontend/public
 frontend_public_path = Path(__file__).parent.parent / "frontend" / "public"
 if frontend_public_path.exists():
     @app.get("/map.html")
-    async def serve_map():
+    async def serve_map(request: Request):
         """Servir el mapa general"""
-        map_path = frontend_public_path / "map.html"
-        if map_path.exists():
-            return FileResponse(map_path)
+        map_path = resolve_asset(frontend_public_path, "map.html")
+        if map_path:
+            return await asset_response(request, map_path)
         raise HTTPException(status_code=404, detail="Map file not found")
     
     @app.get("/event-map.html")
-    async def serve_event_map():
+    async def serve_event_map(request: Request):
         """Servir el mapa d'esdeveniments"""
-        map_path = frontend_public_path / "event-map.html"
-        if map_path.exists():
-            return FileResponse(map_path)
+        map_path = resolve_asset(frontend_public_path, "event-map.html")
+        if map_path:
+            return await asset_response(request, map_path)
         raise HTTPException(status_code=404, detail="Event map file not found")
 
 # ============== UPLOAD DE FITXERS ==============
-# Crear directori per emmagatzemar fitxers pujats
-UPLOAD_DIR = ROOT_DIR / "uploads"
+# Crear directori per emmagatzemar fitxers pujats (els derivats van a uploads/derivatives)
 UPLOAD_DIR.mkdir(exist_ok=True)
 
 @app.post("/api/upload")
@@ -3507,6 +3483,9 @@ async def upload_file(file: UploadFile = File(...), authorization: str = Header(
         with open(file_path, "wb") as buffer:
             shutil.copyfileobj(file.file, buffer)
         
+        # Miniatures i mides responsive en segon pla (no allarguen la pujada)
+        schedule_derivatives(file_path)
+        
         # Retornar la URL pública
         # La URL serà accessible via /api/uploads/filename
         file_url = f"/api/uploads/{unique_filename}"
@@ -3516,6 +3495,7 @@ async def upload_file(file: UploadFile = File(...), authorization: str = Header(
         return {
             "success": True,
             "url": file_url,
+            "thumbnail_url": thumbnail_url(file_url),
             "filename": unique_filename,
             "content_type": file.content_type
         }
@@ -3524,13 +3504,27 @@ async def upload_file(file: UploadFile = File(...), authorization: str = Header(
         raise HTTPException(status_code=500, detail=f"Error pujant el fitxer: {str(e)}")
 
 
+@app.get("/api/blobs/{blob_id}")
+async def get_blob(blob_id: str, request: Request):
+    """Servir un fitxer del magatzem per contingut (imatges pujades)"""
+    return await blob_response(request, blob_id)
+
+
 @app.get("/api/uploads/{filename}")
-async def get_uploaded_file(filename: str):
-    """Servir un fitxer pujat"""
+async def get_uploaded_file(filename: str, request: Request, w: Optional[int] = None):
+    """
+    Servir un fitxer pujat
+    Amb ?w= es serveix el derivat més petit que cobreix l'amplada (WebP si el client l'accepta)
+    """
     file_path = UPLOAD_DIR / filename
-    if not file_path.exists():
+    if "/" in filename or "\\" in filename or not file_path.is_file():
         raise HTTPException(status_code=404, detail="Fitxer no trobat")
-    return FileResponse(file_path)
+    derivative = pick_derivative(filename, w, request.headers.get("accept")) if w and w > 0 else None
+    # Els noms són UUIDs i el contingut no canvia; si el derivat encara no existeix
+    # es serveix l'original amb una memòria cau curta perquè el client el torni a demanar
+    max_age = 300 if w and derivative is None else 86400
+    headers = {"Vary": "Accept", "Cache-Control": f"public, max-age={max_age}"}
+    return FileResponse(derivative or file_path, headers=headers)
 
 
 # Endpoint per netejar les descripcions dels establiments (eliminar HTML tags)
@@ -3568,6 +3562,9 @@ async def clean_establishment_descriptions():
                     )
                     updated_count += 1
         
+        if updated_count:
+            invalidate_catalogue(ESTABLISHMENTS)
+        
         return {"success": True, "updated": updated_count, "message": f"S'han netejat {updated_count} descripcions"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -3575,56 +3572,56 @@ async def clean_establishment_descriptions():
 # Rutes amigables per a les pàgines web estàtiques (amb prefix /api/ per passar pel proxy)
 @app.get("/api/que-es-el-tomb/")
 @app.get("/api/que-es-el-tomb")
-async def serve_sobre_nosaltres():
+async def serve_sobre_nosaltres(request: Request):
     """Servir la pàgina 'Què és El Tomb?'"""
-    file_path = landing_path / "tomb-pagines" / "tomb-sobre.html"
-    if file_path.exists():
-        return FileResponse(file_path, media_type="text/html")
+    file_path = resolve_asset(landing_path / "tomb-pagines", "tomb-sobre.html")
+    if file_path:
+        return await asset_response(request, file_path, media_type="text/html")
     raise HTTPException(status_code=404, detail="Page not found")
 
 @app.get("/api/mapa-web/")
 @app.get("/api/mapa-web")
-async def serve_mapa_page():
+async def serve_mapa_page(request: Request):
     """Servir la pàgina del mapa"""
-    file_path = landing_path / "tomb-pagines" / "tomb-mapa.html"
-    if file_path.exists():
-        return FileResponse(file_path, media_type="text/html")
+    file_path = resolve_asset(landing_path / "tomb-pagines", "tomb-mapa.html")
+    if file_path:
+        return await asset_response(request, file_path, media_type="text/html")
     raise HTTPException(status_code=404, detail="Page not found")
 
 @app.get("/api/establiments-web/")
 @app.get("/api/establiments-web")
-async def serve_establiments_page():
+async def serve_establiments_page(request: Request):
     """Servir la pàgina d'establiments"""
-    file_path = landing_path / "tomb-pagines" / "tomb-establiments.html"
-    if file_path.exists():
-        return FileResponse(file_path, media_type="text/html")
+    file_path = resolve_asset(landing_path / "tomb-pagines", "tomb-establiments.html")
+    if file_path:
+        return await asset_response(request, file_path, media_type="text/html")
     raise HTTPException(status_code=404, detail="Page not found")
 
 @app.get("/api/ofertes-web/")
 @app.get("/api/ofertes-web")
-async def serve_ofertes_page():
+async def serve_ofertes_page(request: Request):
     """Servir la pàgina d'ofertes"""
-    file_path = landing_path / "tomb-pagines" / "tomb-ofertes.html"
-    if file_path.exists():
-        return FileResponse(file_path, media_type="text/html")
+    file_path = resolve_asset(landing_path / "tomb-pagines", "tomb-ofertes.html")
+    if file_path:
+        return await asset_response(request, file_path, media_type="text/html")
     raise HTTPException(status_code=404, detail="Page not found")
 
 @app.get("/api/esdeveniments-web/")
 @app.get("/api/esdeveniments-web")
-async def serve_esdeveniments_page():
+async def serve_esdeveniments_page(request: Request):
     """Servir la pàgina d'esdeveniments"""
-    file_path = landing_path / "tomb-pagines" / "tomb-esdeveniments.html"
-    if file_path.exists():
-        return FileResponse(file_path, media_type="text/html")
+    file_path = resolve_asset(landing_path / "tomb-pagines", "tomb-esdeveniments.html")
+    if file_path:
+        return await asset_response(request, file_path, media_type="text/html")
     raise HTTPException(status_code=404, detail="Page not found")
 
 @app.get("/api/noticies-web/")
 @app.get("/api/noticies-web")
-async def serve_noticies_page():
+async def serve_noticies_page(request: Request):
     """Servir la pàgina de notícies"""
-    file_path = landing_path / "tomb-pagines" / "tomb-noticies.html"
-    if file_path.exists():
-        return FileResponse(file_path, media_type="text/html")
+    file_path = resolve_asset(landing_path / "tomb-pagines", "tomb-noticies.html")
+    if file_path:
+        return await asset_response(request, file_path, media_type="text/html")
     raise HTTPException(status_code=404, detail="Page not found")
 
 # Mount Expo web app (after all API routes)
@@ -3634,25 +3631,25 @@ if dist_path.exists():
     
     # Servir assets
     if (dist_path / "assets").exists():
-        app.mount("/assets", StaticFiles(directory=str(dist_path / "assets")), name="app-assets")
+        app.mount("/assets", CachedStaticFiles(directory=str(dist_path / "assets")), name="app-assets")
     
     if (dist_path / "_expo").exists():
-        app.mount("/_expo", StaticFiles(directory=str(dist_path / "_expo")), name="expo-assets")
+        app.mount("/_expo", CachedStaticFiles(directory=str(dist_path / "_expo")), name="expo-assets")
     
     # Ruta principal - servir index.html
     @app.get("/")
-    async def serve_frontend():
-        return FileResponse(dist_path / "index.html")
+    async def serve_frontend(request: Request):
+        return await asset_response(request, dist_path / "index.html")
     
     # Catch-all per SPA routing
     @app.get("/{path:path}")
-    async def serve_spa(path: str):
-        # Si és un fitxer que existeix, servir-lo
-        file_path = dist_path / path
-        if file_path.exists() and file_path.is_file():
-            return FileResponse(file_path)
+    async def serve_spa(path: str, request: Request):
+        # Si és un fitxer que existeix (dins de dist), servir-lo
+        file_path = resolve_asset(dist_path, path)
+        if file_path:
+            return await asset_response(request, file_path)
         # Sinó, servir index.html per SPA routing
-        return FileResponse(dist_path / "index.html")
+        return await asset_response(request, dist_path / "index.html")
 else:
     logger.warning(f"dist directory not found at {dist_path}")
     
@@ -3669,10 +3666,67 @@ logging.basicConfig(
 
 @app.on_event("startup")
 async def startup_event():
-    """Inicialitzar el scheduler de notícies automàtiques"""
-    logger.info("Iniciant scheduler de notícies...")
-    start_news_scheduler()
-    logger.info("Scheduler de notícies iniciat correctament")
+    """Inicialitzar el planificador (notícies automàtiques) i els índexs en memòria"""
+    # Tots els workers competeixen pel lloguer; només el líder executa les tasques
+    register_news_jobs()
+    register_stats_jobs()
+    start_scheduler()
+    
+    # Crear els índexs declarats que falten (idempotent)
+    try:
+        await ensure_indexes(db)
+    except Exception as e:
+        logger.error(f"Error creant índexs: {e}")
+    
+    # Notificacions antigues amb user_id com a string (només les que queden)
+    try:
+        normalised = await normalise_user_ids()
+        if normalised:
+            logger.info(f"{normalised} notificacions amb user_id normalitzat")
+    except Exception as e:
+        logger.error(f"Error normalitzant les notificacions: {e}")
+    
+    # Camp GeoJSON dels establiments antics (només els que no en tenen)
+    try:
+        await backfill_locations(db)
+    except Exception as e:
+        logger.error(f"Error omplint les ubicacions: {e}")
+    
+    # Precalcular els clústers del mapa d'establiments
+    try:
+        await warm_clusters()
+    except Exception as e:
+        logger.error(f"Error precalculant els clústers del mapa: {e}")
+    
+    # Construir els índexs del cercador
+    try:
+        await search_index.warm()
+    except Exception as e:
+        logger.error(f"Error construint l'índex de cerca: {e}")
+    
+    # Índex de NIF i noms per identificar l'establiment dels tiquets
+    try:
+        await establishment_matcher.refresh()
+    except Exception as e:
+        logger.error(f"Error construint l'índex d'establiments dels tiquets: {e}")
+
+    # Segments d'audiència per a les notificacions segmentades
+    try:
+        await audience_segments.rebuild()
+    except Exception as e:
+        logger.error(f"Error construint els segments d'audiència: {e}")
+    
+    # Hashes i variants gzip/brotli dels fitxers estàtics (en segon pla)
+    warm_static_assets([_pwa_dist_path, landing_path, frontend_public_path])
+    
+    # Treballador de notificacions massives (reprèn els treballs pendents)
+    start_broadcast_worker()
+    
+    # Treballadors d'OCR dels tiquets (reprenen els pendents)
+    start_ticket_workers()
+    
+    # Canal en directe (SSE / WebSocket)
+    start_live_events()
     
     # Afegir COTTONI si no existeix
     try:
@@ -3694,7 +3748,7 @@ async def startup_event():
                 "created_at": datetime.utcnow(),
                 "updated_at": datetime.utcnow()
             }
-            result = await db.establishments.insert_one(cottoni_data)
+            result = await db.establishments.insert_one(with_location(cottoni_data))
             print(f"✅ COTTONI Toni Cano afegit automàticament amb ID: {result.inserted_id}")
         else:
             print("✅ COTTONI Toni Cano ja existeix")
@@ -3708,6 +3762,8 @@ async def startup_event():
             ]
         })
         print("✅ Duplicats de COTTONI eliminats")
+        # Els índexs en memòria (mapa, cercador, tiquets) ja s'han construït
+        invalidate_catalogue(ESTABLISHMENTS)
         
     except Exception as e:
         print(f"⚠️ Error processant COTTONI: {e}")
@@ -3736,6 +3792,14 @@ async def download_hosteleria_pdf():
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await stop_scheduler()
+    await stop_broadcast_worker()
+    await stop_ticket_workers()
+    await stop_live_events()
+    shutdown_image_pool()
+    await close_push_client()
+    await close_news_client()
+    close_web_push()
     client.close()
 
 # Endpoint per descarregar el ZIP amb el codi actualitzat
@@ -0,0 +1,264 @@
+"""
+Fitxers estàtics (PWA, landing, web Expo) amb memòria cau HTTP
+- ETag pel hash del contingut i Last-Modified per la data del fitxer, calculats
+  un sol cop (en arrencar o la primera vegada que es demana el fitxer)
+- 304 amb If-None-Match / If-Modified-Since
+- Cache-Control segons el tipus: immutable per als fitxers amb hash al nom,
+  revalidació (no-cache) per a HTML, manifest i service worker
+- Variants gzip/brotli precomprimides en memòria triades per Accept-Encoding
+
+Cada petició només fa un stat del fitxer: si la mida o la data canvien
+(p. ex. una pàgina de tomb-pagines editada) es torna a calcular.
+"""
+import os
+import re
+import gzip
+import asyncio
+import hashlib
+import logging
+import mimetypes
+from pathlib import Path
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Iterable, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+from fastapi.staticfiles import StaticFiles
+
+try:
+    import brotli
+except ImportError:  # Opcional: sense brotli només es serveix gzip
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+DEFAULT_CACHE = "public, max-age=86400"
+
+# Fitxers que han de canviar tan bon punt es despleguen
+REVALIDATE_NAMES = {"sw.js", "service-worker.js", "manifest.json", "index.html"}
+# Noms amb hash de contingut (entry-3f2a9c1b.js, 5d41402abc4b2a76b9719d911017c592.png)
+_HASHED_NAME_RE = re.compile(r"(?:^|[.-])[0-9a-f]{8,}(?:\.|$)", re.IGNORECASE)
+
+COMPRESSIBLE_TYPES = {
+    "application/javascript", "application/json", "application/manifest+json",
+    "application/xml", "image/svg+xml", "image/x-icon", "font/ttf", "font/otf",
+}
+MIN_COMPRESS_SIZE = 1024
+MAX_COMPRESS_SIZE = 10 * 1024 * 1024
+HASH_CHUNK_SIZE = 1024 * 1024
+
+mimetypes.add_type("application/javascript", ".js")
+mimetypes.add_type("application/manifest+json", ".webmanifest")
+
+
+class StaticAsset:
+    __slots__ = ("path", "signature", "etag", "last_modified", "mtime", "media_type", "variants")
+
+    def __init__(self, path: Path, signature: tuple, etag: str, mtime: float, media_type: str, variants: dict):
+        self.path = path
+        self.signature = signature
+        self.etag = etag
+        self.mtime = mtime
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.media_type = media_type
+        self.variants = variants  # {"br": bytes, "gzip": bytes}
+
+
+_assets: Dict[str, StaticAsset] = {}
+_warm_task: Optional[asyncio.Task] = None
+
+
+def _signature(st: os.stat_result) -> tuple:
+    return st.st_mtime_ns, st.st_size
+
+
+def _is_compressible(media_type: str) -> bool:
+    return media_type.startswith("text/") or media_type in COMPRESSIBLE_TYPES
+
+
+def _build(path: Path, with_brotli: bool) -> StaticAsset:
+    """Hash i variants comprimides d'un fitxer (bloquejant: s'executa en un fil)"""
+    st = path.stat()
+    media_type = mimetypes.guess_type(path.name)[0] or "application/octet-stream"
+    variants = {}
+    if _is_compressible(media_type) and MIN_COMPRESS_SIZE <= st.st_size <= MAX_COMPRESS_SIZE:
+        data = path.read_bytes()
+        etag = hashlib.sha256(data).hexdigest()[:32]
+        # Només es guarden les variants que estalvien prou bytes
+        compressed = gzip.compress(data, compresslevel=9, mtime=0)
+        if len(compressed) < len(data) * 0.9:
+            variants["gzip"] = compressed
+        if with_brotli and brotli is not None:
+            compressed = brotli.compress(data, quality=11)
+            if len(compressed) < len(data) * 0.9:
+                variants["br"] = compressed
+    else:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+    return StaticAsset(path, _signature(st), etag, st.st_mtime, media_type, variants)
+
+
+def cache_policy(path: Path) -> str:
+    name = path.name
+    if name in REVALIDATE_NAMES or path.suffix in (".html", ".htm"):
+        return REVALIDATE
+    if _HASHED_NAME_RE.search(name) or "_expo" in path.parts:
+        return IMMUTABLE
+    return DEFAULT_CACHE
+
+
+def _accepted_encodings(header: Optional[str]) -> set:
+    """Codificacions acceptades (q>0) d'un Accept-Encoding"""
+    accepted = set()
+    for part in (header or "").split(","):
+        coding, _, params = part.strip().partition(";")
+        coding = coding.strip().lower()
+        q = 1.0
+        params = params.replace(" ", "")
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if coding and q > 0:
+            accepted.add(coding)
+    return accepted
+
+
+def _not_modified(request: Request, asset: StaticAsset) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == "*":
+            return True
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            # Qualsevol variant (identitat, gzip, br) té el mateix contingut
+            if tag.strip('"').split("-")[0] == asset.etag:
+                return True
+        return False
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return int(asset.mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
+
+async def _get_asset(path: Path) -> Optional[StaticAsset]:
+    try:
+        st = path.stat()
+    except OSError:
+        return None
+    key = str(path)
+    asset = _assets.get(key)
+    if asset is None or asset.signature != _signature(st):
+        # Primera petició o fitxer modificat: brotli (lent) només en escalfar
+        asset = await asyncio.to_thread(_build, path, False)
+        _assets[key] = asset
+    return asset
+
+
+async def asset_response(
+    request: Request,
+    path: Path,
+    media_type: Optional[str] = None,
+    cache_control: Optional[str] = None,
+    headers: Optional[dict] = None,
+) -> Response:
+    """Servir un fitxer estàtic amb ETag, 304 i la variant comprimida que accepti el client"""
+    asset = await _get_asset(path)
+    if asset is None:
+        return FileResponse(path, media_type=media_type, headers=headers)
+
+    response_headers = {
+        "Cache-Control": cache_control or cache_policy(path),
+        "Last-Modified": asset.last_modified,
+        **(headers or {}),
+    }
+    if asset.variants:
+        response_headers["Vary"] = "Accept-Encoding"
+
+    if _not_modified(request, asset):
+        response_headers["ETag"] = f'"{asset.etag}"'
+        return Response(status_code=304, headers=response_headers)
+
+    accepted = _accepted_encodings(request.headers.get("accept-encoding"))
+    for encoding in ("br", "gzip"):
+        if encoding in asset.variants and encoding in accepted:
+            response_headers["ETag"] = f'"{asset.etag}-{encoding}"'
+            response_headers["Content-Encoding"] = encoding
+            return Response(asset.variants[encoding], media_type=media_type or asset.media_type,
+                            headers=response_headers)
+
+    response_headers["ETag"] = f'"{asset.etag}"'
+    return FileResponse(path, media_type=media_type or asset.media_type, headers=response_headers)
+
+
+def resolve_asset(root: Path, relative: str) -> Optional[Path]:
+    """Fitxer dins de root (None si no existeix o surt del directori)"""
+    try:
+        path = (root / relative).resolve()
+        path.relative_to(root.resolve())
+    except (ValueError, OSError):
+        return None
+    return path if path.is_file() else None
+
+
+class CachedStaticFiles(StaticFiles):
+    """StaticFiles amb les capçaleres de memòria cau i la compressió d'asset_response"""
+
+    async def get_response(self, path: str, scope) -> Response:
+        full_path, stat_result = await asyncio.to_thread(self.lookup_path, path)
+        if stat_result is not None and os.path.isfile(full_path):
+            return await asset_response(Request(scope), Path(full_path))
+        return await super().get_response(path, scope)
+
+
+def _warm(roots: Iterable[Path]) -> int:
+    count = 0
+    for root in roots:
+        if not root.exists():
+            continue
+        for path in root.rglob("*"):
+            if not path.is_file() or path.name.startswith("."):
+                continue
+            try:
+                _assets[str(path.resolve())] = _assets[str(path)] = _build(path, True)
+            except OSError as e:
+                logger.warning(f"[STATIC] No s'ha pogut processar {path}: {e}")
+                continue
+            count += 1
+    return count
+
+
+async def warm(roots: Iterable[Path]):
+    """Calcular hashes i variants comprimides de tots els fitxers dels directoris"""
+    roots = list(roots)
+    count = await asyncio.to_thread(_warm, roots)
+    compressed = sum(1 for asset in _assets.values() if asset.variants)
+    logger.info(f"[STATIC] {count} fitxers estàtics preparats ({compressed} amb variants comprimides, "
+                f"brotli {'actiu' if brotli is not None else 'no disponible'})")
+
+
+def schedule_warm(roots: Iterable[Path]):
+    """Escalfar en segon pla: brotli és lent i no ha de retardar l'arrencada"""
+    global _warm_task
+    _warm_task = asyncio.get_running_loop().create_task(warm(roots))
+
+
+def get_static_stats() -> dict:
+    assets = {id(asset): asset for asset in _assets.values()}.values()
+    return {
+        "files": len(assets),
+        "compressed": sum(1 for asset in assets if asset.variants),
+        "variant_bytes": sum(len(v) for asset in assets for v in asset.variants.values()),
+        "brotli": brotli is not None,
+    }
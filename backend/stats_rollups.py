@@ -0,0 +1,308 @@
+"""
+Comptadors materialitzats per a les estadístiques del tauler d'administració
+En lloc de recomptar usuaris, participacions i notícies cada vegada que s'obre
+el tauler, es mantenen comptadors a stats_rollups:
+
+- "dashboard": totals de participacions per tipus, marcador i esdeveniment,
+  promocions per estat, usuaris actius i, per mes (months.AAAA-MM), altes,
+  participacions i notícies. El tauler llegeix només aquest document.
+- "day:AAAA-MM-DD": els mateixos comptadors del dia (altes, participacions per
+  tipus i marcador, notícies)
+
+Cada alta, participació, notícia o canvi d'estat d'una promoció incrementa els
+comptadors en el moment ($inc). Les eliminacions i el que s'escriu fora de
+l'API (scripts, importacions directes) es corregeixen amb la reconciliació
+nocturna, que ho recalcula tot des de les col·leccions. Els usuaris actius
+només s'actualitzen en la reconciliació.
+
+Dates en UTC, com la resta de l'aplicació.
+
+Ús manual:
+    python stats_rollups.py    # Reconciliar ara
+"""
+import os
+import time
+import asyncio
+import logging
+from datetime import datetime
+from typing import Dict, Optional
+
+from apscheduler.triggers.cron import CronTrigger
+from pymongo import UpdateOne, ReplaceOne
+
+from scheduler import register_job
+
+logger = logging.getLogger(__name__)
+
+DASHBOARD_ID = "dashboard"
+DAY_PREFIX = "day:"
+
+# Col·leccions de participacions: user_participations (track_participation)
+# i participations (dades antigues amb created_at)
+PARTICIPATION_SOURCES = [
+    ("user_participations", "$participated_at"),
+    ("participations", "$created_at"),
+]
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def _key(value) -> str:
+    """Clau segura com a nom de camp de MongoDB (sense '.' ni '$' inicial)"""
+    return str(value).replace("%", "%25").replace(".", "%2E").replace("$", "%24")
+
+
+def _unkey(key: str) -> str:
+    return key.replace("%24", "$").replace("%2E", ".").replace("%25", "%")
+
+
+def _unkey_counts(counts: Optional[dict]) -> Dict[str, int]:
+    return {_unkey(key): value for key, value in (counts or {}).items()}
+
+
+def month_key(at: datetime) -> str:
+    return at.strftime("%Y-%m")
+
+
+def day_id(at: datetime) -> str:
+    return DAY_PREFIX + at.strftime("%Y-%m-%d")
+
+
+# --- Increments en escriure ---
+
+async def _increment(counters: Dict[str, int], at: Optional[datetime] = None, daily: Optional[Dict[str, int]] = None):
+    """
+    Incrementar el document del tauler i el del dia
+    counters: camps del document del tauler; daily: camps del document del dia
+    Un error als comptadors no ha de fer fallar l'escriptura original
+    """
+    at = at or datetime.utcnow()
+    operations = []
+    if counters:
+        operations.append(UpdateOne({"_id": DASHBOARD_ID}, {"$inc": counters}, upsert=True))
+    if daily:
+        operations.append(UpdateOne(
+            {"_id": day_id(at)},
+            {"$inc": daily, "$setOnInsert": {"date": at.strftime("%Y-%m-%d")}},
+            upsert=True,
+        ))
+    try:
+        await db.stats_rollups.bulk_write(operations, ordered=False)
+    except Exception as e:
+        logger.warning(f"[STATS] No s'han pogut actualitzar els comptadors: {e}")
+
+
+async def record_signups(count: int = 1, at: Optional[datetime] = None):
+    """Alta d'usuaris"""
+    at = at or datetime.utcnow()
+    await _increment({f"months.{month_key(at)}.signups": count}, at, {"signups": count})
+
+
+async def record_news(count: int = 1, at: Optional[datetime] = None):
+    """Notícies noves"""
+    if count <= 0:
+        return
+    at = at or datetime.utcnow()
+    await _increment({f"months.{month_key(at)}.news": count}, at, {"news": count})
+
+
+async def record_participation(activity_type: Optional[str], tag: Optional[str] = None,
+                               activity_id: Optional[str] = None, at: Optional[datetime] = None):
+    """Participació en una activitat (tipus, marcador i, si és un esdeveniment, l'esdeveniment)"""
+    at = at or datetime.utcnow()
+    counters = {"participations": 1, f"months.{month_key(at)}.participations": 1}
+    daily = {"participations": 1}
+    if activity_type:
+        counters[f"participations_by_type.{_key(activity_type)}"] = 1
+        daily[f"participations_by_type.{_key(activity_type)}"] = 1
+    if tag:
+        counters[f"participations_by_tag.{_key(tag)}"] = 1
+        daily[f"participations_by_tag.{_key(tag)}"] = 1
+    if activity_type == "event" and activity_id:
+        counters[f"participations_by_event.{_key(activity_id)}"] = 1
+    await _increment(counters, at, daily)
+
+
+async def record_promotion_status(old_status: Optional[str], new_status: Optional[str]):
+    """Canvi d'estat d'una promoció (None: creada o eliminada)"""
+    if old_status == new_status:
+        return
+    counters = {}
+    if old_status:
+        counters[f"promotions_by_status.{_key(old_status)}"] = -1
+    if new_status:
+        counters[f"promotions_by_status.{_key(new_status)}"] = 1
+    await _increment(counters)
+
+
+# --- Lectura ---
+
+async def get_dashboard_rollup() -> Optional[dict]:
+    """Document del tauler amb les claus originals (None si encara no s'ha reconciliat)"""
+    doc = await db.stats_rollups.find_one({"_id": DASHBOARD_ID})
+    if doc is None or "reconciled_at" not in doc:
+        return None
+    for field in ("participations_by_type", "participations_by_tag", "participations_by_event",
+                  "promotions_by_status"):
+        doc[field] = _unkey_counts(doc.get(field))
+    doc.setdefault("months", {})
+    return doc
+
+
+async def get_daily_rollups(start: datetime, end: datetime) -> list:
+    """Comptadors diaris entre dues dates (incloses)"""
+    docs = await db.stats_rollups.find(
+        {"_id": {"$gte": day_id(start), "$lte": day_id(end)}}
+    ).sort("_id", 1).to_list(None)
+    for doc in docs:
+        doc.pop("_id")
+        doc["participations_by_type"] = _unkey_counts(doc.get("participations_by_type"))
+        doc["participations_by_tag"] = _unkey_counts(doc.get("participations_by_tag"))
+    return docs
+
+
+# --- Reconciliació ---
+
+def _day_expr(date_field: str) -> dict:
+    return {"$dateToString": {"format": "%Y-%m-%d", "date": date_field}}
+
+
+async def _count_by_day(collection: str, date_field: str = "created_at") -> Dict[str, int]:
+    pipeline = [
+        {"$match": {date_field: {"$type": "date"}}},
+        {"$group": {"_id": _day_expr(f"${date_field}"), "count": {"$sum": 1}}},
+    ]
+    return {row["_id"]: row["count"] async for row in db[collection].aggregate(pipeline)}
+
+
+async def _participations_by_day(collection: str, date_field: str) -> list:
+    """Participacions per (dia, tipus, marcador, esdeveniment)"""
+    pipeline = [
+        {"$project": {
+            "day": {"$cond": [{"$eq": [{"$type": date_field}, "date"]}, _day_expr(date_field), None]},
+            "type": "$activity_type",
+            "tag": "$tag",
+            "event": {"$cond": [{"$eq": ["$activity_type", "event"]}, "$activity_id", None]},
+        }},
+        {"$group": {"_id": {"day": "$day", "type": "$type", "tag": "$tag", "event": "$event"},
+                    "count": {"$sum": 1}}},
+    ]
+    return [row async for row in db[collection].aggregate(pipeline, allowDiskUse=True)]
+
+
+async def _participant_ids(collection: str) -> set:
+    pipeline = [{"$match": {"user_id": {"$ne": None}}}, {"$group": {"_id": "$user_id"}}]
+    return {str(row["_id"]) async for row in db[collection].aggregate(pipeline, allowDiskUse=True)}
+
+
+def _add(counts: dict, key, amount: int):
+    if key is None or key == "":
+        return
+    key = _key(key)
+    counts[key] = counts.get(key, 0) + amount
+
+
+async def reconcile_rollups() -> dict:
+    """Recalcular tots els comptadors des de les col·leccions"""
+    start = time.perf_counter()
+    signups, news, promotions, *participation_rows = await asyncio.gather(
+        _count_by_day("users"),
+        _count_by_day("news"),
+        db.promotions.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(None),
+        *(_participations_by_day(name, field) for name, field in PARTICIPATION_SOURCES),
+    )
+    participants = set()
+    for name, _ in PARTICIPATION_SOURCES:
+        participants |= await _participant_ids(name)
+
+    days: Dict[str, dict] = {}
+    months: Dict[str, dict] = {}
+
+    def bucket(table: dict, key: str) -> dict:
+        return table.setdefault(key, {})
+
+    for day, count in signups.items():
+        bucket(days, day)["signups"] = count
+        _add(bucket(months, day[:7]), "signups", count)
+    for day, count in news.items():
+        bucket(days, day)["news"] = count
+        _add(bucket(months, day[:7]), "news", count)
+
+    dashboard = {
+        "participations": 0,
+        "participations_by_type": {},
+        "participations_by_tag": {},
+        "participations_by_event": {},
+        "promotions_by_status": {},
+    }
+    for row in (row for rows in participation_rows for row in rows):
+        group, count = row["_id"], row["count"]
+        dashboard["participations"] += count
+        _add(dashboard["participations_by_type"], group.get("type"), count)
+        _add(dashboard["participations_by_tag"], group.get("tag"), count)
+        _add(dashboard["participations_by_event"], group.get("event"), count)
+        day = group.get("day")
+        if not day:
+            continue
+        daily = bucket(days, day)
+        _add(daily, "participations", count)
+        _add(bucket(daily, "participations_by_type"), group.get("type"), count)
+        _add(bucket(daily, "participations_by_tag"), group.get("tag"), count)
+        _add(bucket(months, day[:7]), "participations", count)
+    for row in promotions:
+        _add(dashboard["promotions_by_status"], row["_id"], row["count"])
+
+    now = datetime.utcnow()
+    dashboard.update({"months": months, "active_users": len(participants), "reconciled_at": now})
+
+    operations = [ReplaceOne({"_id": DASHBOARD_ID}, dashboard, upsert=True)]
+    operations += [ReplaceOne({"_id": DAY_PREFIX + day}, {"date": day, **counters}, upsert=True)
+                   for day, counters in days.items()]
+    await db.stats_rollups.bulk_write(operations, ordered=False)
+    # Dies que ja no tenen cap document (p. ex. tot eliminat)
+    await db.stats_rollups.delete_many({
+        "_id": {"$regex": f"^{DAY_PREFIX}", "$nin": [DAY_PREFIX + day for day in days]}
+    })
+
+    summary = {
+        "days": len(days),
+        "months": len(months),
+        "participations": dashboard["participations"],
+        "active_users": dashboard["active_users"],
+        "duration_ms": round((time.perf_counter() - start) * 1000),
+    }
+    logger.info(f"[STATS] Comptadors reconciliats: {summary}")
+    return summary
+
+
+def register_stats_jobs():
+    """Reconciliació nocturna (3:30 UTC); la primera vegada, 60 segons després d'arrencar"""
+    register_job(
+        "stats_rollups",
+        "Reconciliació dels comptadors d'estadístiques (3:30)",
+        reconcile_rollups,
+        CronTrigger(hour=3, minute=30, timezone="UTC"),
+        first_run_delay=60,
+    )
+
+
+# Per executar manualment
+if __name__ == "__main__":
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from dotenv import load_dotenv
+
+    load_dotenv()
+
+    async def main():
+        client = AsyncIOMotorClient(os.getenv('MONGO_URL', 'mongodb://localhost:27017'))
+        set_database(client[os.getenv('DB_NAME', 'tomb_reus_db')])
+        print(f"📊 {await reconcile_rollups()}")
+        client.close()
+
+    asyncio.run(main())
@@ -0,0 +1,505 @@
+"""
+Processament asíncron dels tiquets escanejats (OCR)
+Un grup de treballadors en segon pla fa la crida OCR (LLM), identifica
+l'establiment i genera les participacions.
+
+- POST /tickets/process (apps instal·lades i PWA antigues): espera el
+  resultat fins a TICKET_SYNC_TIMEOUT i retorna la resposta de sempre
+- POST /tickets/jobs: retorna l'ID del treball de seguida (202) i l'app
+  consulta l'estat amb GET /tickets/jobs/{id}
+
+- El resultat de l'OCR es desa per hash SHA-256 de la imatge: tornar a pujar
+  la mateixa foto no torna a pagar la crida OCR.
+- Una foto que ja ha generat un tiquet es rebutja abans d'encuar-la.
+- Els treballs "running" sense batec es reprenen, com a broadcast_jobs.
+- La foto es desa al magatzem de fitxers com a blob privat; el hash de la
+  imatge és també l'identificador del blob.
+"""
+import os
+import re
+import json
+import base64
+import socket
+import asyncio
+import hashlib
+import binascii
+import logging
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from bson import ObjectId
+from fastapi import HTTPException
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+from establishment_matcher import match_ticket_establishment
+from blob_store import put_blob, read_blob
+from audience_segments import audience_segments, CAMPAIGN
+from live_events import publish_to_user
+
+logger = logging.getLogger(__name__)
+
+TICKET_OCR_WORKERS = int(os.getenv('TICKET_OCR_WORKERS', '4'))
+TICKET_POLL_INTERVAL = float(os.getenv('TICKET_POLL_INTERVAL', '5'))
+TICKET_STALE_AFTER = timedelta(seconds=int(os.getenv('TICKET_STALE_AFTER', '180')))
+TICKET_MAX_ATTEMPTS = 3
+# Espera màxima de la petició síncrona (/tickets/process)
+TICKET_SYNC_TIMEOUT = float(os.getenv('TICKET_SYNC_TIMEOUT', '90'))
+TICKET_MAX_IMAGE_BYTES = int(os.getenv('TICKET_MAX_IMAGE_BYTES', str(10 * 1024 * 1024)))
+OCR_MODEL = ("openai", "gpt-4o-mini")
+
+OCR_PROMPT = """Ets un expert en processar tiquets de compra. Analitza aquesta imatge de tiquet i extreu:
+
+1. Número de tiquet (busca: "Nº", "Ticket", "Factura", o número llarg)
+2. Nom de l'establiment (a la part superior)
+3. NIF o CIF de l'establiment (busca: "NIF:", "CIF:", "B-", "A-" seguit de números)
+4. Import total (busca: "TOTAL", "Total", "IMPORTE", "EUR")
+5. Data (format DD/MM/YYYY o similar)
+
+IMPORTANT: Retorna NOMÉS un JSON vàlid amb aquest format exacte:
+{
+  "ticket_number": "número del tiquet",
+  "establishment": "nom de l'establiment",
+  "nif": "NIF/CIF de l'establiment",
+  "amount": importe_numèric,
+  "date": "DD/MM/YYYY"
+}
+
+Si no pots extreure alguna dada, posa null."""
+
+ALREADY_SCANNED = "Aquest tiquet ja ha estat escanejat anteriorment."
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+_worker_tasks = []
+_wakeup: Optional[asyncio.Event] = None
+# Peticions síncrones esperant un treball d'aquest procés (job_id -> Event)
+_waiters: Dict[str, asyncio.Event] = {}
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def decode_ticket_image(ticket_image: str):
+    """
+    Bytes de la imatge, el seu tipus i el seu hash SHA-256.
+    El hash es calcula sobre els bytes, no sobre el text base64.
+    """
+    image_data = ticket_image or ""
+    content_type = "image/jpeg"
+    if image_data.startswith('data:image'):
+        header, image_data = image_data.split(',', 1)
+        content_type = header[5:].split(';')[0] or content_type
+    try:
+        raw = base64.b64decode(image_data, validate=False)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="La imatge del tiquet no és vàlida")
+    if not raw:
+        raise HTTPException(status_code=400, detail="La imatge del tiquet no és vàlida")
+    if len(raw) > TICKET_MAX_IMAGE_BYTES:
+        raise HTTPException(status_code=413, detail="La imatge del tiquet és massa gran")
+    return raw, content_type, hashlib.sha256(raw).hexdigest()
+
+
+def _serialize_job(job: dict) -> dict:
+    job = dict(job)
+    job["_id"] = str(job["_id"])
+    job["id"] = job["_id"]
+    return job
+
+
+async def enqueue_ticket(user: dict, ticket_image: str) -> dict:
+    """Encuar un tiquet per processar; retorna el treball (o l'existent per a la mateixa foto)"""
+    raw, content_type, image_hash = decode_ticket_image(ticket_image)
+    user_id = str(user["_id"])
+
+    # La mateixa foto ja ha generat un tiquet: no cal ni encuar-la
+    if await db.tickets.find_one({"image_hash": image_hash}, {"_id": 1}):
+        raise HTTPException(status_code=400, detail=ALREADY_SCANNED)
+
+    # Doble enviament (p.ex. doble clic o reintent de xarxa): es retorna el mateix treball
+    pending = await db.ticket_jobs.find_one(
+        {"user_id": user_id, "image_hash": image_hash, "status": {"$in": ["queued", "running"]}}
+    )
+    if pending:
+        return _serialize_job(pending)
+
+    await put_blob(raw, content_type, private=True, uploaded_by=user_id)
+
+    now = datetime.utcnow()
+    job = {
+        "user_id": user_id,
+        "image_hash": image_hash,
+        "status": "queued",
+        "attempts": 0,
+        "result": None,
+        "error": None,
+        "status_code": None,
+        "ocr_cached": None,
+        "created_at": now,
+        "updated_at": now,
+        "started_at": None,
+        "finished_at": None,
+        "heartbeat_at": None,
+        "worker_id": None,
+    }
+    result = await db.ticket_jobs.insert_one(job)
+    job["_id"] = result.inserted_id
+
+    if _wakeup is not None:
+        _wakeup.set()
+    return _serialize_job(job)
+
+
+async def get_ticket_job(job_id: str, user_id: str) -> Optional[dict]:
+    if not ObjectId.is_valid(job_id):
+        return None
+    job = await db.ticket_jobs.find_one({"_id": ObjectId(job_id), "user_id": user_id})
+    return _serialize_job(job) if job else None
+
+
+async def wait_for_ticket_job(job_id: str, user_id: str, timeout: float = TICKET_SYNC_TIMEOUT) -> Optional[dict]:
+    """
+    Esperar que un treball acabi; retorna el treball (o l'últim estat si s'esgota el temps)
+    Si l'executa aquest procés es desperta de seguida; si no, es consulta cada segon
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    event = _waiters.setdefault(job_id, asyncio.Event())
+    try:
+        while True:
+            job = await get_ticket_job(job_id, user_id)
+            remaining = deadline - loop.time()
+            if job is None or job["status"] in ("completed", "failed") or remaining <= 0:
+                return job
+            try:
+                await asyncio.wait_for(event.wait(), timeout=min(1.0, remaining))
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        _waiters.pop(job_id, None)
+
+
+async def _claim_job() -> Optional[dict]:
+    now = datetime.utcnow()
+    return await db.ticket_jobs.find_one_and_update(
+        {"$or": [
+            {"status": "queued"},
+            {"status": "running", "heartbeat_at": {"$lt": now - TICKET_STALE_AFTER}},
+        ]},
+        [{"$set": {
+            "status": "running",
+            "worker_id": WORKER_ID,
+            "heartbeat_at": now,
+            "updated_at": now,
+            "attempts": {"$add": [{"$ifNull": ["$attempts", 0]}, 1]},
+            "started_at": {"$ifNull": ["$started_at", now]},
+        }}],
+        sort=[("created_at", 1)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+async def _ocr_ticket(job: dict) -> dict:
+    """Dades del tiquet: de la memòria cau per hash o amb la crida OCR"""
+    cached = await db.ticket_ocr_cache.find_one({"_id": job["image_hash"]})
+    if cached:
+        logger.info(f"[TICKETS] OCR en memòria cau per a la imatge {job['image_hash'][:12]}")
+        await db.ticket_jobs.update_one({"_id": job["_id"]}, {"$set": {"ocr_cached": True}})
+        return cached["ticket_data"]
+
+    from emergentintegrations.llm.chat import LlmChat, UserMessage, ImageContent
+
+    chat = LlmChat(
+        api_key=os.getenv('EMERGENT_LLM_KEY'),
+        session_id=f"ticket_{job['user_id']}_{datetime.now().timestamp()}",
+        system_message="Ets un expert OCR que extreu dades de tiquets amb precisió."
+    ).with_model(*OCR_MODEL)
+
+    user_message = UserMessage(
+        text=OCR_PROMPT,
+        file_contents=[ImageContent(image_base64=base64.b64encode(await read_blob(job["image_hash"])).decode('utf-8'))]
+    )
+    response = await chat.send_message(user_message)
+
+    # Extreure JSON de la resposta (per si hi ha text extra)
+    json_match = re.search(r'\{.*\}', response, re.DOTALL)
+    if not json_match:
+        raise HTTPException(status_code=400, detail="No s'ha pogut processar el tiquet. Assegura't que la imatge és clara i llegible.")
+    ticket_data = json.loads(json_match.group())
+
+    await db.ticket_jobs.update_one({"_id": job["_id"]}, {"$set": {"ocr_cached": False}})
+    await db.ticket_ocr_cache.update_one(
+        {"_id": job["image_hash"]},
+        {"$set": {"ticket_data": ticket_data, "created_at": datetime.utcnow()}},
+        upsert=True
+    )
+    return ticket_data
+
+
+async def process_ticket_job(job: dict) -> dict:
+    """Validar el tiquet, desar-lo i sumar les participacions de l'usuari"""
+    user_id = job["user_id"]
+
+    # Reintent d'un treball que ja havia desat el tiquet abans de caure
+    existing_ticket = await db.tickets.find_one({"ticket_job_id": str(job["_id"])})
+    if existing_ticket:
+        logger.warning(f"[TICKETS] Treball {job['_id']} reprès amb el tiquet ja desat")
+        # Només els tiquets desats amb la marca a False: els anteriors ja es van sumar
+        if existing_ticket.get("participations_applied") is False:
+            campaign = None
+            if existing_ticket.get("campaign_id"):
+                campaign = await db.ticket_campaigns.find_one({"_id": ObjectId(existing_ticket["campaign_id"])})
+            await _apply_participations(existing_ticket, campaign)
+        return _ticket_result(existing_ticket)
+
+    ticket_data = await _ocr_ticket(job)
+
+    # Validar dades bàsiques
+    if not ticket_data.get("ticket_number") or not ticket_data.get("amount"):
+        raise HTTPException(status_code=400, detail="No s'ha pogut llegir el número de tiquet o l'import. Fes una foto més clara.")
+
+    # Comprovar duplicats (mateix número de tiquet)
+    if await db.tickets.find_one({"ticket_number": ticket_data["ticket_number"]}, {"_id": 1}):
+        raise HTTPException(status_code=400, detail=ALREADY_SCANNED)
+
+    # Comprovar si l'establiment està associat - PRIORITAT: NIF
+    establishment_name = ticket_data.get("establishment", "")
+    establishment_nif = ticket_data.get("nif", "")
+
+    logger.debug(f"[TICKETS] Cercant establiment: nom '{establishment_name}', NIF '{establishment_nif}'")
+
+    establishment = None
+
+    # PRIORITAT 1: NIF normalitzat ("B-43688217" = "B43688217")
+    # PRIORITAT 2: nom aproximat (errors d'OCR, accents, forma jurídica)
+    match = await match_ticket_establishment(establishment_nif, establishment_name)
+    if match:
+        establishment = await db.establishments.find_one(
+            {"_id": ObjectId(match["establishment_id"])}, {"name": 1}
+        )
+        if establishment:
+            logger.info(f"[TICKETS] Establiment trobat per {match['method']} "
+                        f"(confiança {match['score']}): '{establishment.get('name')}'")
+
+    if not establishment:
+        logger.info(f"[TICKETS] Establiment no trobat: nom '{establishment_name}', NIF '{establishment_nif}'")
+        raise HTTPException(
+            status_code=400,
+            detail=f"L'establiment '{establishment_name}' (NIF: {establishment_nif or 'no detectat'}) no està al directori de El Tomb. Només els establiments socis poden generar participacions."
+        )
+
+    # Calcular participacions (1 per cada 10€)
+    try:
+        amount = float(ticket_data["amount"])
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="No s'ha pogut llegir el número de tiquet o l'import. Fes una foto més clara.")
+    participations = int(amount // 10)
+
+    if participations == 0:
+        raise HTTPException(status_code=400, detail="L'import mínim per generar participacions és 10€. Aquest tiquet té un import inferior.")
+
+    # Guardar tiquet
+    ticket_date = None
+    if ticket_data.get("date"):
+        try:
+            ticket_date = datetime.strptime(ticket_data["date"], "%d/%m/%Y")
+        except (ValueError, TypeError):
+            ticket_date = datetime.utcnow()
+    else:
+        ticket_date = datetime.utcnow()
+
+    # Campanya activa: el tiquet en queda marcat (segments de notificacions)
+    active_campaign = await db.ticket_campaigns.find_one({"is_active": True})
+
+    ticket_doc = {
+        "ticket_number": ticket_data["ticket_number"],
+        "campaign_id": str(active_campaign["_id"]) if active_campaign else None,
+        "establishment_name": establishment_name,
+        "establishment_id": str(establishment["_id"]),
+        "establishment_match": {"method": match["method"], "score": match["score"]},
+        "amount": amount,
+        "ticket_date": ticket_date,
+        "image_blob_id": job["image_hash"],
+        "image_hash": job["image_hash"],
+        "ticket_job_id": str(job["_id"]),
+        "user_id": user_id,
+        "participations_generated": participations,
+        "validated": True,  # Auto-validat si l'establiment està a la BD
+        # Es posa a True en sumar les participacions (reintents després d'una caiguda)
+        "participations_applied": False,
+        "created_at": datetime.utcnow()
+    }
+
+    try:
+        await db.tickets.insert_one(ticket_doc)
+    except DuplicateKeyError:
+        # Dos escanejos simultanis del mateix tiquet (índex únic)
+        raise HTTPException(status_code=400, detail=ALREADY_SCANNED)
+
+    await _apply_participations(ticket_doc, active_campaign)
+    return _ticket_result(ticket_doc)
+
+
+async def _apply_participations(ticket_doc: dict, active_campaign: Optional[dict]):
+    """
+    Sumar les participacions d'un tiquet desat (una sola vegada)
+    La marca es reclama abans de sumar: un reintent concurrent o després d'una
+    caiguda no les torna a sumar
+    """
+    from participation_tracker import track_participation
+
+    claimed = await db.tickets.find_one_and_update(
+        {"_id": ticket_doc["_id"], "participations_applied": False},
+        {"$set": {"participations_applied": True}},
+        projection={"_id": 1},
+    )
+    if claimed is None:
+        logger.warning(f"[TICKETS] Participacions del tiquet {ticket_doc['_id']} ja aplicades")
+        return
+
+    user_id = ticket_doc["user_id"]
+    participations = ticket_doc["participations_generated"]
+
+    audience_segments.add(CAMPAIGN, ticket_doc["campaign_id"], user_id)
+
+    # Tracking de participació per marcador (si la campanya té tag)
+    if active_campaign and active_campaign.get("tag"):
+        await track_participation(
+            user_id=user_id,
+            tag=active_campaign["tag"],
+            activity_type="ticket_scan",
+            activity_id=str(active_campaign.get("_id", "")),
+            activity_title=active_campaign.get("title", "Escaneja Tiquets"),
+            metadata={
+                "establishment_name": ticket_doc["establishment_name"],
+                "amount": ticket_doc["amount"],
+                "participations": participations
+            }
+        )
+
+    # Actualitzar participacions de l'usuari
+    draw = await db.draw_participations.find_one_and_update(
+        {"user_id": user_id},
+        {
+            "$inc": {
+                "participations": participations,
+                "tickets_count": 1
+            },
+            "$set": {
+                "last_ticket_date": datetime.utcnow()
+            }
+        },
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    await publish_to_user(user_id, "participations", {
+        "participations": draw.get("participations", 0),
+        "tickets_count": draw.get("tickets_count", 0),
+        "last_ticket_date": draw.get("last_ticket_date"),
+    })
+
+
+def _ticket_result(ticket: dict) -> dict:
+    participations = ticket["participations_generated"]
+    return {
+        "success": True,
+        "ticket_number": ticket["ticket_number"],
+        "establishment": ticket["establishment_name"],
+        "amount": ticket["amount"],
+        "participations": participations,
+        "message": f"✅ Tiquet validat! Has generat {participations} participació{'ns' if participations > 1 else ''}"
+    }
+
+
+async def _finish(job: dict, update: dict):
+    now = datetime.utcnow()
+    await db.ticket_jobs.update_one(
+        {"_id": job["_id"], "worker_id": WORKER_ID},
+        {"$set": {**update, "finished_at": now, "updated_at": now}},
+    )
+    waiter = _waiters.get(str(job["_id"]))
+    if waiter is not None:
+        waiter.set()
+    await publish_to_user(job["user_id"], "ticket_processed", {
+        "job_id": str(job["_id"]),
+        "status": update["status"],
+        "result": update.get("result"),
+        "error": update.get("error"),
+    })
+
+
+async def _heartbeat(job: dict):
+    while True:
+        await asyncio.sleep(TICKET_STALE_AFTER.total_seconds() / 3)
+        await db.ticket_jobs.update_one(
+            {"_id": job["_id"], "worker_id": WORKER_ID},
+            {"$set": {"heartbeat_at": datetime.utcnow()}},
+        )
+
+
+async def _run_job(job: dict):
+    if job.get("attempts", 1) > TICKET_MAX_ATTEMPTS:
+        await _finish(job, {"status": "failed", "status_code": 500,
+                            "error": "No s'ha pogut processar el tiquet. Torna-ho a provar més tard."})
+        return
+
+    heartbeat = asyncio.create_task(_heartbeat(job))
+    try:
+        result = await process_ticket_job(job)
+        await _finish(job, {"status": "completed", "result": result})
+    except HTTPException as e:
+        await _finish(job, {"status": "failed", "status_code": e.status_code, "error": e.detail})
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.exception(f"[TICKETS] Error processant el treball {job['_id']}: {e}")
+        await _finish(job, {"status": "failed", "status_code": 500, "error": f"Error processant tiquet: {str(e)}"})
+    finally:
+        heartbeat.cancel()
+
+
+async def _worker_loop():
+    while True:
+        try:
+            job = await _claim_job()
+            if job is None:
+                _wakeup.clear()
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=TICKET_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await _run_job(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"[TICKETS] Error al treballador: {e}")
+            await asyncio.sleep(TICKET_POLL_INTERVAL)
+
+
+def start_ticket_workers():
+    """Iniciar els treballadors d'OCR (TICKET_OCR_WORKERS crides simultànies)"""
+    global _wakeup
+    if any(not task.done() for task in _worker_tasks):
+        return
+    _wakeup = asyncio.Event()
+    _worker_tasks[:] = [asyncio.create_task(_worker_loop()) for _ in range(TICKET_OCR_WORKERS)]
+    logger.info(f"[TICKETS] {TICKET_OCR_WORKERS} treballadors d'OCR iniciats ({WORKER_ID})")
+
+
+async def stop_ticket_workers():
+    """Aturar els treballadors; els treballs en curs es reprenen quan el batec caduca"""
+    for task in _worker_tasks:
+        task.cancel()
+    for task in _worker_tasks:
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+    _worker_tasks.clear()
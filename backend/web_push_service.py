@@ -1,11 +1,26 @@
 """
 Servei de Web Push Notifications per El Tomb de Reus
 Permet enviar notificacions push als navegadors web
+
+Els enviaments massius es fan en un pool de fils limitat (pywebpush és síncron)
+perquè no bloquegin el bucle d'esdeveniments. Les capçaleres VAPID es signen
+una vegada per origen del servei push (FCM, Mozilla, Apple...) i es reutilitzen
+fins que caduquen. Les subscripcions que responen 404/410 s'esborren.
 """
 import os
 import json
+import time
+import asyncio
 import logging
-from pywebpush import webpush, WebPushException
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from py_vapid import Vapid
+from pywebpush import WebPusher, WebPushException
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -17,97 +32,232 @@ VAPID_PUBLIC_KEY = os.getenv('VAPID_PUBLIC_KEY', '')
 VAPID_PRIVATE_KEY = os.getenv('VAPID_PRIVATE_KEY', '')
 VAPID_CLAIMS_EMAIL = os.getenv('VAPID_CLAIMS_EMAIL', 'gestio@reusapp.com')
 
+WEB_PUSH_MAX_WORKERS = int(os.getenv('WEB_PUSH_MAX_WORKERS', '32'))
+WEB_PUSH_TIMEOUT = float(os.getenv('WEB_PUSH_TIMEOUT', '10'))
+WEB_PUSH_TTL = int(os.getenv('WEB_PUSH_TTL', '86400'))
+# Validesa del JWT VAPID (màxim 24h segons l'especificació)
+VAPID_EXPIRATION = 12 * 60 * 60
+
+EXPIRED_STATUS_CODES = (404, 410)
+
+_executor: Optional[ThreadPoolExecutor] = None
+_session: Optional[requests.Session] = None
+_vapid: Optional[Vapid] = None
+_vapid_headers: Dict[str, tuple] = {}  # origen -> (capçaleres, caducitat)
+_lock = threading.Lock()
+
+# Database reference (will be set from server.py)
+db = None
+
+
+def set_database(database):
+    global db
+    db = database
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=WEB_PUSH_MAX_WORKERS, thread_name_prefix="webpush")
+    return _executor
+
+
+def _get_session() -> requests.Session:
+    """Sessió HTTP compartida pels fils (pool de connexions per origen)"""
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=WEB_PUSH_MAX_WORKERS)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def close_web_push():
+    """Aturar el pool de fils i tancar la sessió HTTP"""
+    global _executor, _session
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+    if _session is not None:
+        _session.close()
+        _session = None
+
+
+def _origin(endpoint: str) -> str:
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def _get_vapid_headers(endpoint: str) -> dict:
+    """Capçaleres VAPID de l'origen de l'endpoint, signades una sola vegada"""
+    global _vapid
+    origin = _origin(endpoint)
+    now = int(time.time())
+
+    with _lock:
+        cached = _vapid_headers.get(origin)
+        # Marge d'una hora perquè no caduqui durant un enviament llarg
+        if cached and cached[1] - 3600 > now:
+            return cached[0]
+
+        if _vapid is None:
+            _vapid = Vapid.from_string(private_key=VAPID_PRIVATE_KEY)
+        expiration = now + VAPID_EXPIRATION
+        headers = _vapid.sign({
+            "sub": f"mailto:{VAPID_CLAIMS_EMAIL}",
+            "aud": origin,
+            "exp": expiration,
+        })
+        _vapid_headers[origin] = (headers, expiration)
+        return headers
+
+
+def _build_payload(title: str, body: str, data: dict = None, icon: str = None) -> str:
+    # Assegurar que data conté la URL de navegació
+    notification_data = data.copy() if data else {}
+    if 'url' not in notification_data:
+        notification_data['url'] = '/notifications'  # URL per defecte
+
+    return json.dumps({
+        "title": title,
+        "body": body,
+        "icon": icon or "/icons/icon-192x192.png",
+        "badge": "/icons/icon-72x72.png",
+        "data": notification_data,
+        "requireInteraction": False,
+        "tag": "el-tomb-de-reus"
+    })
+
+
+def _send_one(subscription_info: dict, payload: str) -> dict:
+    """
+    Xifrar i enviar una notificació. Retorna el resultat de l'endpoint:
+    {"endpoint", "status": sent|expired|failed, "status_code", "error"}
+    """
+    endpoint = (subscription_info or {}).get('endpoint', '')
+    outcome = {"endpoint": endpoint, "status": "failed", "status_code": None, "error": None}
+
+    try:
+        response = WebPusher(subscription_info, requests_session=_get_session()).send(
+            payload,
+            headers=dict(_get_vapid_headers(endpoint)),
+            ttl=WEB_PUSH_TTL,
+            timeout=WEB_PUSH_TIMEOUT,
+        )
+        outcome["status_code"] = response.status_code
+        if response.status_code in EXPIRED_STATUS_CODES:
+            outcome["status"] = "expired"
+        elif response.status_code < 300:
+            outcome["status"] = "sent"
+        else:
+            outcome["error"] = (response.text or "")[:200]
+    except WebPushException as e:
+        outcome["error"] = str(e)
+        if e.response is not None and e.response.status_code in EXPIRED_STATUS_CODES:
+            outcome["status"] = "expired"
+            outcome["status_code"] = e.response.status_code
+    except Exception as e:
+        outcome["error"] = str(e)
+
+    return outcome
+
 
 def send_web_push(subscription_info: dict, title: str, body: str, data: dict = None, icon: str = None) -> bool:
     """
     Envia una notificació web push a un navegador subscrit.
-    
+
     Args:
         subscription_info: Objecte de subscripció del navegador
         title: Títol de la notificació
         body: Cos de la notificació
         data: Dades addicionals (opcional)
         icon: URL de la icona (opcional)
-    
+
     Returns:
         True si s'ha enviat correctament, False en cas contrari
     """
     if not VAPID_PUBLIC_KEY or not VAPID_PRIVATE_KEY:
         logger.warning("Web Push no configurat: falten claus VAPID")
         return False
-    
-    try:
-        # Preparar payload
-        # Assegurar que data conté la URL de navegació
-        notification_data = data.copy() if data else {}
-        if 'url' not in notification_data:
-            notification_data['url'] = '/notifications'  # URL per defecte
-        
-        payload = {
-            "title": title,
-            "body": body,
-            "icon": icon or "/icons/icon-192x192.png",
-            "badge": "/icons/icon-72x72.png",
-            "data": notification_data,
-            "requireInteraction": False,
-            "tag": "el-tomb-de-reus"
-        }
-        
-        # Enviar notificació
-        webpush(
-            subscription_info=subscription_info,
-            data=json.dumps(payload),
-            vapid_private_key=VAPID_PRIVATE_KEY,
-            vapid_claims={"sub": f"mailto:{VAPID_CLAIMS_EMAIL}"}
-        )
-        
+
+    outcome = _send_one(subscription_info, _build_payload(title, body, data, icon))
+    if outcome["status"] == "sent":
         logger.info(f"✅ Web Push enviat correctament")
         return True
-        
-    except WebPushException as e:
-        logger.error(f"❌ Error enviant Web Push: {e}")
-        # Si la subscripció ha expirat o és invàlida, retornem False
-        if e.response and e.response.status_code in [404, 410]:
-            logger.warning("Subscripció expirada o invàlida")
-        return False
+
+    logger.error(f"❌ Error enviant Web Push: {outcome['error'] or outcome['status_code']}")
+    if outcome["status"] == "expired":
+        logger.warning("Subscripció expirada o invàlida")
+    return False
+
+
+async def prune_expired_subscriptions(endpoints: List[str]) -> int:
+    """Esborrar de cop les subscripcions que el servei push ha donat per expirades"""
+    endpoints = list(set(e for e in endpoints if e))
+    if not endpoints or db is None:
+        return 0
+    try:
+        result = await db.users.update_many(
+            {"web_push_subscription.endpoint": {"$in": endpoints}},
+            {"$unset": {"web_push_subscription": ""}}
+        )
+        if result.modified_count:
+            logger.info(f"[WEB PUSH] {result.modified_count} subscripcions expirades esborrades")
+        return result.modified_count
     except Exception as e:
-        logger.error(f"❌ Error inesperat enviant Web Push: {e}")
-        return False
+        logger.error(f"[WEB PUSH] Error esborrant subscripcions: {e}")
+        return 0
 
 
-def send_web_push_to_many(subscriptions: list, title: str, body: str, data: dict = None) -> dict:
+async def send_web_push_to_many(subscriptions: list, title: str, body: str, data: dict = None,
+                                icon: str = None, prune: bool = True) -> dict:
     """
-    Envia una notificació web push a múltiples subscriptors.
-    
+    Envia una notificació web push a múltiples subscriptors en paral·lel.
+
     Args:
         subscriptions: Llista de subscripcions
         title: Títol de la notificació
         body: Cos de la notificació
         data: Dades addicionals (opcional)
-    
+        icon: URL de la icona (opcional)
+        prune: Esborrar dels usuaris les subscripcions expirades (404/410)
+
     Returns:
-        Dict amb sent_count i failed_count
+        Dict amb sent_count, failed_count, expired_endpoints, pruned_count
+        i results (resultat per endpoint)
     """
-    sent = 0
-    failed = 0
-    expired_subscriptions = []
-    
-    for sub in subscriptions:
-        try:
-            success = send_web_push(sub, title, body, data)
-            if success:
-                sent += 1
-            else:
-                failed += 1
-                expired_subscriptions.append(sub.get('endpoint'))
-        except Exception as e:
-            failed += 1
-            logger.error(f"Error: {e}")
-    
+    subscriptions = [s for s in subscriptions if isinstance(s, dict) and s.get('endpoint')]
+    if not VAPID_PUBLIC_KEY or not VAPID_PRIVATE_KEY:
+        logger.warning("Web Push no configurat: falten claus VAPID")
+        return {"sent_count": 0, "failed_count": len(subscriptions), "expired_endpoints": [],
+                "pruned_count": 0, "results": []}
+
+    payload = _build_payload(title, body, data, icon)
+    loop = asyncio.get_running_loop()
+    executor = _get_executor()
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*[
+        loop.run_in_executor(executor, _send_one, sub, payload) for sub in subscriptions
+    ])
+    elapsed = time.perf_counter() - start
+
+    sent = sum(1 for r in results if r["status"] == "sent")
+    expired = [r["endpoint"] for r in results if r["status"] == "expired"]
+    failed = len(results) - sent
+
+    pruned = await prune_expired_subscriptions(expired) if prune else 0
+    logger.info(f"[WEB PUSH] {sent}/{len(results)} enviats en {elapsed:.2f}s, "
+                f"{len(expired)} expirats, {pruned} esborrats")
+
     return {
         "sent_count": sent,
         "failed_count": failed,
-        "expired_endpoints": expired_subscriptions
+        "expired_endpoints": expired,
+        "pruned_count": pruned,
+        "results": results,
     }
 
 
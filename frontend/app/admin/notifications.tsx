@@ -235,10 +235,9 @@ export default function AdminNotificationsScreen() {
           headers: { Authorization: token }
         });
         
-        const webSent = response.data?.web_sent || 0;
         Alert.alert(
           'Notificació enviada',
-          `S'han enviat ${webSent} notificacions web push.`
+          response.data?.message || 'La notificació s\'està enviant.'
         );
         
         setBroadcastTitle('');
@@ -211,18 +211,38 @@ export default function ScanTicketScreen() {
     }
   };
 
+  const waitForTicketJob = async (jobId: string) => {
+    for (let attempt = 0; attempt < 60; attempt++) {
+      await new Promise((resolve) => setTimeout(resolve, attempt < 5 ? 1000 : 2000));
+      const { data } = await api.get(`/tickets/jobs/${jobId}`, {
+        headers: { Authorization: token! },
+      });
+      if (data.status === 'completed') {
+        return data.result;
+      }
+      if (data.status === 'failed') {
+        // Mateix format d'error que la resposta HTTP perquè el catch el mostri
+        throw { response: { data: { detail: data.error } } };
+      }
+    }
+    throw { response: { data: { detail: 'El tiquet encara s\'està processant. Consulta l\'historial d\'aquí a uns minuts.' } } };
+  };
+
   const processTicket = async (imageBase64: string) => {
     try {
       setProcessing(true);
       
       const response = await api.post(
-        '/tickets/process',
+        '/tickets/jobs',
         { ticket_image: imageBase64 },
         { headers: { Authorization: token! } }
       );
 
-      if (response.data.success) {
-        const msg = `${response.data.message}\n\nEstabliment: ${response.data.establishment}\nImport: ${response.data.amount}€\n\nTotal participacions: ${participations + response.data.participations}`;
+      // El tiquet es processa en segon pla: consultar l'estat fins que acabi
+      const result = await waitForTicketJob(response.data.job_id);
+
+      if (result.success) {
+        const msg = `${result.message}\n\nEstabliment: ${result.establishment}\nImport: ${result.amount}€\n\nTotal participacions: ${participations + result.participations}`;
         if (Platform.OS === 'web') {
           window.alert(`🎉 Tiquet Validat!\n${msg}`);
         } else {
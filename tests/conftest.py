@@ -0,0 +1,10 @@
+"""
+Configuració comuna de les proves: els mòduls del backend s'importen pel nom
+(com fa server.py), sense connexió a MongoDB ni a serveis externs
+"""
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+if str(BACKEND_DIR) not in sys.path:
+    sys.path.insert(0, str(BACKEND_DIR))
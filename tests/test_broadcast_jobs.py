@@ -0,0 +1,101 @@
+"""
+Reintents dels treballs de notificacions massives (mongomock)
+Un error transitori torna el treball a la cua amb espera exponencial; només
+queda "failed" després de BROADCAST_MAX_ATTEMPTS intents o amb un error que
+no es pot reintentar.
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+from bson import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+from pymongo.errors import AutoReconnect
+
+import broadcast_jobs
+from broadcast_jobs import BROADCAST_MAX_ATTEMPTS, BROADCAST_RETRY_DELAY
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(broadcast_jobs, "db", database)
+    return database
+
+
+def _enqueue(db) -> ObjectId:
+    job_id = ObjectId()
+    now = datetime.utcnow()
+    asyncio.run(db.broadcast_jobs.insert_one({
+        "_id": job_id, "status": "queued", "attempts": 0, "retry_at": None,
+        "last_user_id": None, "created_at": now, "started_at": None,
+    }))
+    return job_id
+
+
+def fail_once(db, error: Exception) -> dict:
+    """Reclamar el treball, fer-lo fallar i retornar-lo tal com queda"""
+    async def main():
+        job = await broadcast_jobs._claim_job()
+        assert job is not None
+        await broadcast_jobs._job_failed(job, error)
+        return await db.broadcast_jobs.find_one({"_id": job["_id"]})
+
+    return asyncio.run(main())
+
+
+def _make_due(db, job_id: ObjectId):
+    asyncio.run(db.broadcast_jobs.update_one({"_id": job_id}, {"$set": {"retry_at": datetime.utcnow()}}))
+
+
+def test_transient_error_requeues_with_backoff(db):
+    job_id = _enqueue(db)
+
+    job = fail_once(db, AutoReconnect("connection reset"))
+
+    assert job["status"] == "queued"
+    assert job["attempts"] == 1
+    assert job["error"] == "connection reset"
+    assert job["worker_id"] is None
+    delay = job["retry_at"] - job["updated_at"]
+    assert delay == BROADCAST_RETRY_DELAY
+    # No es torna a reclamar fins que passa l'espera
+    assert asyncio.run(broadcast_jobs._claim_job()) is None
+
+    _make_due(db, job_id)
+    job = fail_once(db, AutoReconnect("connection reset"))
+
+    assert job["attempts"] == 2
+    assert job["retry_at"] - job["updated_at"] == BROADCAST_RETRY_DELAY * 2
+
+
+def test_fails_after_max_attempts(db):
+    job_id = _enqueue(db)
+
+    for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+        job = fail_once(db, TimeoutError("Expo no respon"))
+        assert job["attempts"] == attempt
+        _make_due(db, job_id)
+
+    assert job["status"] == "failed"
+    assert job["finished_at"] is not None
+    assert asyncio.run(broadcast_jobs._claim_job()) is None
+
+
+def test_non_retryable_error_fails_at_once(db):
+    _enqueue(db)
+
+    job = fail_once(db, ValueError("consulta no vàlida"))
+
+    assert job["status"] == "failed"
+    assert job["attempts"] == 1
+
+
+def test_jobs_without_retry_fields_are_still_claimed(db):
+    job_id = _enqueue(db)
+    asyncio.run(db.broadcast_jobs.update_one({"_id": job_id}, {"$unset": {"attempts": "", "retry_at": ""}}))
+
+    job = asyncio.run(broadcast_jobs._claim_job())
+
+    assert job["_id"] == job_id
+    assert job["status"] == "running"
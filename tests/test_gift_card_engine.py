@@ -0,0 +1,229 @@
+"""
+Cobraments de targetes regal amb una base de dades en memòria
+Cobraments simultanis, saldo insuficient, desfer el descompte quan el saldo
+desnormalitzat no quadra i recàlcul del saldo amb un cobrament a mig fer.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import gift_card_engine
+from gift_card_engine import InsufficientBalance, charge, get_user_balance, rebuild_user_balance
+
+CUSTOMER = "customer-1"
+SHOP = {"_id": "shop-1", "name": "Botiga"}
+
+
+# --- Base de dades en memòria (només les operacions que fa gift_card_engine) ---
+# Cada operació cedeix el control abans d'executar-se, com una consulta real
+
+def _matches(doc: dict, query: dict) -> bool:
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$gte" in condition and not (value is not None and value >= condition["$gte"]):
+                return False
+            if "$gt" in condition and not (value is not None and value > condition["$gt"]):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+def _inc(doc: dict, update: dict):
+    for field, amount in update.get("$inc", {}).items():
+        doc[field] = doc.get(field, 0) + amount
+    doc.update(update.get("$set", {}))
+
+
+class FakeBalances:
+    def __init__(self):
+        self.docs = {}
+
+    async def find_one(self, query, projection=None):
+        await asyncio.sleep(0)
+        doc = self.docs.get(query["_id"])
+        return dict(doc) if doc else None
+
+    async def insert_one(self, doc):
+        await asyncio.sleep(0)
+        if doc["_id"] in self.docs:
+            raise DuplicateKeyError("E11000")
+        self.docs[doc["_id"]] = dict(doc)
+
+    async def update_one(self, query, update):
+        await asyncio.sleep(0)
+        doc = self.docs.get(query["_id"])
+        if doc is None or not _matches(doc, query):
+            return SimpleNamespace(matched_count=0)
+        _inc(doc, update)
+        return SimpleNamespace(matched_count=1)
+
+    async def find_one_and_update(self, query, update, return_document=None):
+        await asyncio.sleep(0)
+        doc = self.docs.get(query["_id"])
+        if doc is None or not _matches(doc, query):
+            return None
+        _inc(doc, update)
+        return dict(doc)
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, length):
+        return self.docs[:length]
+
+
+class FakeCards:
+    def __init__(self, *balances):
+        self.docs = [
+            {"_id": f"card-{i}", "user_id": CUSTOMER, "status": "active", "balance": balance, "created_at": i}
+            for i, balance in enumerate(balances)
+        ]
+
+    def aggregate(self, pipeline):
+        active = [doc for doc in self.docs if _matches(doc, pipeline[0]["$match"])]
+        return FakeCursor([{"_id": None, "balance": sum(doc["balance"] for doc in active)}] if active else [])
+
+    async def find_one_and_update(self, query, pipeline, sort, projection, return_document):
+        """Descompte de la targeta més antiga (el pipeline de _take_from_oldest_card)"""
+        await asyncio.sleep(0)
+        candidates = sorted((doc for doc in self.docs if _matches(doc, query)), key=lambda doc: doc["created_at"])
+        if not candidates:
+            return None
+        card = candidates[0]
+        remaining = pipeline[0]["$set"]["balance"]["$round"][0]["$subtract"][1]["$min"][1]
+        before = dict(card)
+        card["balance"] = round(card["balance"] - min(card["balance"], remaining), 2)
+        if card["balance"] <= 0:
+            card["status"] = "used"
+        return before
+
+    async def update_one(self, query, update):
+        await asyncio.sleep(0)
+        card = next(doc for doc in self.docs if doc["_id"] == query["_id"])
+        _inc(card, update)
+
+    def total(self) -> float:
+        return round(sum(doc["balance"] for doc in self.docs if doc["status"] == "active"), 2)
+
+
+class FakeEstablishments:
+    def __init__(self):
+        self.balance = 0.0
+
+    async def find_one_and_update(self, query, update, projection=None, return_document=None):
+        await asyncio.sleep(0)
+        self.balance = round(self.balance + update["$inc"]["gift_card_balance"], 2)
+        return {"_id": query["_id"], "gift_card_balance": self.balance}
+
+
+class FakeTransactions:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_one(self, doc):
+        self.docs.append(doc)
+
+
+def make_db(*cards: float) -> SimpleNamespace:
+    return SimpleNamespace(
+        gift_cards=FakeCards(*cards),
+        gift_card_balances=FakeBalances(),
+        establishments=FakeEstablishments(),
+        gift_card_transactions=FakeTransactions(),
+    )
+
+
+@pytest.fixture(autouse=True)
+def fast_retries(monkeypatch):
+    monkeypatch.setattr(gift_card_engine, "REBUILD_RETRY_DELAY", 0.001)
+
+
+def test_charge_takes_from_the_oldest_cards():
+    db = make_db(10, 10)
+
+    result = asyncio.run(charge(db, CUSTOMER, SHOP, 15))
+
+    assert result == {"amount": 15.0, "new_balance": 5.0, "shop_balance": 15.0}
+    assert [(card["balance"], card["status"]) for card in db.gift_cards.docs] == [(0, "used"), (5, "active")]
+    assert db.gift_card_balances.docs[CUSTOMER]["balance"] == 5.0
+    assert db.gift_card_balances.docs[CUSTOMER]["pending"] == 0
+    assert [card["amount"] for card in db.gift_card_transactions.docs[0]["cards"]] == [10.0, 5.0]
+
+
+def test_insufficient_balance_changes_nothing():
+    db = make_db(10)
+
+    with pytest.raises(InsufficientBalance) as error:
+        asyncio.run(charge(db, CUSTOMER, SHOP, 15))
+
+    assert error.value.available == 10.0
+    assert db.gift_cards.total() == 10.0
+    assert db.gift_card_balances.docs[CUSTOMER]["balance"] == 10.0
+    assert db.establishments.balance == 0
+    assert db.gift_card_transactions.docs == []
+
+
+def test_concurrent_charges_never_overdraw():
+    db = make_db(10, 10)
+
+    async def main():
+        await rebuild_user_balance(db, CUSTOMER)
+        return await asyncio.gather(*(charge(db, CUSTOMER, SHOP, 8) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert sum(isinstance(result, InsufficientBalance) for result in results) == 1
+    assert db.gift_cards.total() == 4.0
+    assert db.gift_card_balances.docs[CUSTOMER]["balance"] == 4.0
+    assert db.establishments.balance == 16.0
+    assert len(db.gift_card_transactions.docs) == 2
+
+
+def test_rebuild_during_a_charge_does_not_inflate_the_balance():
+    db = make_db(10, 10)
+
+    async def main():
+        await rebuild_user_balance(db, CUSTOMER)
+        # El recàlcul arriba amb la reserva feta i les targetes encara sense descomptar
+        charged, rebuilt = await asyncio.gather(
+            charge(db, CUSTOMER, SHOP, 15),
+            rebuild_user_balance(db, CUSTOMER),
+        )
+        return charged, rebuilt, await get_user_balance(db, CUSTOMER)
+
+    charged, rebuilt, balance = asyncio.run(main())
+
+    assert charged["new_balance"] == rebuilt == balance == 5.0
+    assert db.gift_cards.total() == 5.0
+
+
+def test_out_of_sync_balance_rolls_back_and_rebuilds():
+    db = make_db(5)
+    # Saldo desnormalitzat més alt que les targetes
+    db.gift_card_balances.docs[CUSTOMER] = {"_id": CUSTOMER, "balance": 20.0, "pending": 0.0, "version": 3}
+
+    with pytest.raises(InsufficientBalance) as error:
+        asyncio.run(charge(db, CUSTOMER, SHOP, 15))
+
+    assert error.value.available == 5.0
+    assert db.gift_cards.docs[0]["balance"] == 5 and db.gift_cards.docs[0]["status"] == "active"
+    balance = db.gift_card_balances.docs[CUSTOMER]
+    assert balance["balance"] == 5.0 and balance["pending"] == 0
+    assert db.establishments.balance == 0
+    assert db.gift_card_transactions.docs == []
+
+
+def test_missing_balance_document_is_rebuilt_concurrently():
+    db = make_db(10)
+
+    async def main():
+        return await asyncio.gather(*(get_user_balance(db, CUSTOMER) for _ in range(3)))
+
+    assert asyncio.run(main()) == [10.0, 10.0, 10.0]
+    assert db.gift_card_balances.docs[CUSTOMER]["balance"] == 10.0
@@ -0,0 +1,264 @@
+"""
+Ingesta de notícies amb feeds locals (httpx.MockTransport, sense xarxa)
+Peticions condicionals (304), deduplicació per URL amb el bulk upsert i
+estadístiques de news_sources.
+"""
+import asyncio
+import hashlib
+from email.utils import formatdate
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+import news_scheduler
+import news_scraper
+from news_scraper import RSS_FEEDS, fetch_all_sources
+
+
+def fixture_feed(key: str, name: str, items: int, revision: int = 0) -> bytes:
+    entries = "".join(
+        f"<item><title>Reus: notícia {i} de {name} (revisió {revision})</title>"
+        f"<link>https://example.com/{key}/{revision}/{i}</link></item>"
+        for i in range(items)
+    )
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+            f"<title>{name}</title>{entries}</channel></rss>").encode("utf-8")
+
+
+class FixtureFeeds:
+    """Un feed RSS local per font de RSS_FEEDS, amb ETag i 304"""
+
+    def __init__(self, items: int = 3):
+        self.items = items
+        self.sources = {info["url"]: (key, info["name"]) for key, info in RSS_FEEDS.items()}
+        self.revisions = {url: 0 for url in self.sources}
+        self.requests = []
+
+    def bump(self, key: str):
+        self.revisions[RSS_FEEDS[key]["url"]] += 1
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        self.requests.append((url, request.headers.get("if-none-match")))
+        if url not in self.sources:
+            return httpx.Response(404)
+        key, name = self.sources[url]
+        body = fixture_feed(key, name, self.items, self.revisions[url])
+        etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304, headers={"ETag": etag})
+        return httpx.Response(200, content=body, headers={
+            "ETag": etag,
+            "Last-Modified": formatdate(usegmt=True),
+            "Content-Type": "application/rss+xml",
+        })
+
+
+# --- Base de dades en memòria (només les operacions que fa la ingesta) ---
+
+def _set_path(doc: dict, path: str, value):
+    *parents, field = path.split(".")
+    for parent in parents:
+        doc = doc.setdefault(parent, {})
+    doc[field] = value
+
+
+def _get_path(doc: dict, path: str):
+    for field in path.split("."):
+        doc = doc.get(field, {})
+    return doc or 0
+
+
+class FakeNews:
+    """news amb índex únic per URL"""
+
+    def __init__(self):
+        self.docs = {}
+        self.bulk_writes = []
+        # URLs que "una altra execució" insereix alhora (error 11000)
+        self.concurrent_urls = set()
+        # Codi d'error per a la propera escriptura (p. ex. 121, validació)
+        self.fail_with = None
+
+    async def distinct(self, field, query):
+        return [url for url in query[field]["$in"] if url in self.docs]
+
+    async def bulk_write(self, operations, ordered=True):
+        self.bulk_writes.append(operations)
+        if self.fail_with is not None:
+            code, self.fail_with = self.fail_with, None
+            raise BulkWriteError({"writeErrors": [{"index": 0, "code": code}], "upserted": []})
+        upserted, errors = {}, []
+        for index, operation in enumerate(operations):
+            url = operation._filter["url"]
+            if url in self.concurrent_urls:
+                errors.append({"index": index, "code": 11000})
+            elif url not in self.docs:
+                self.docs[url] = {"_id": ObjectId(), **operation._doc["$setOnInsert"]}
+                upserted[index] = self.docs[url]["_id"]
+        if errors:
+            raise BulkWriteError({
+                "writeErrors": errors,
+                "upserted": [{"index": index, "_id": _id} for index, _id in upserted.items()],
+            })
+        return SimpleNamespace(upserted_ids=upserted)
+
+
+class FakeNewsSources:
+    def __init__(self):
+        self.docs = {}
+
+    async def _find(self):
+        for doc in list(self.docs.values()):
+            yield doc
+
+    def find(self, query, projection=None):
+        return self._find()
+
+    async def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            doc = self.docs.setdefault(operation._filter["_id"], {"_id": operation._filter["_id"]})
+            for path, value in operation._doc.get("$set", {}).items():
+                _set_path(doc, path, value)
+            for path, amount in operation._doc.get("$inc", {}).items():
+                _set_path(doc, path, _get_path(doc, path) + amount)
+
+
+@pytest.fixture
+def feeds():
+    return FixtureFeeds()
+
+
+@pytest.fixture
+def db(monkeypatch, feeds):
+    database = SimpleNamespace(news=FakeNews(), news_sources=FakeNewsSources())
+    monkeypatch.setattr(news_scheduler, "db", database)
+    recorded = []
+
+    async def record_news(count):
+        recorded.append(count)
+
+    monkeypatch.setattr(news_scheduler, "record_news", record_news)
+    database.recorded_news = recorded
+
+    # Sense IA: es trien les primeres
+    async def select_news(items, max_news):
+        return items[:max_news]
+
+    monkeypatch.setattr(news_scraper, "select_news", select_news)
+    return database
+
+
+def ingest(monkeypatch, feeds: FixtureFeeds, max_news: int = 50) -> dict:
+    """Una execució de run_news_ingestion contra els feeds locals"""
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(feeds.handler)) as client:
+            monkeypatch.setattr(news_scraper, "get_client", lambda: client)
+            return await news_scheduler.run_news_ingestion(max_news)
+
+    return asyncio.run(main())
+
+
+def test_conditional_requests_skip_unchanged_feeds(feeds):
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(feeds.handler)) as client:
+            first = await fetch_all_sources(client=client)
+            state = {r["key"]: {"etag": r["etag"], "last_modified": r["last_modified"]} for r in first}
+            second = await fetch_all_sources(state, client=client)
+            feeds.bump("canal_reus")
+            third = await fetch_all_sources(state, client=client)
+            return first, second, third
+
+    first, second, third = asyncio.run(main())
+
+    assert all(r["status"] == "ok" and len(r["items"]) == 3 for r in first)
+    assert all(r["status"] == "not_modified" and r["items"] == [] for r in second)
+    assert [r["key"] for r in third if r["status"] == "ok"] == ["canal_reus"]
+    # Les consultes següents envien l'ETag desat
+    assert all(etag for _, etag in feeds.requests[len(RSS_FEEDS):])
+
+
+def test_second_run_gets_304_and_stores_nothing(monkeypatch, feeds, db):
+    first = ingest(monkeypatch, feeds)
+    second = ingest(monkeypatch, feeds)
+
+    assert first["fetched"] == first["inserted"] == 3 * len(RSS_FEEDS)
+    assert {source["status"] for source in second["sources"]} == {"not_modified"}
+    assert second["fetched"] == second["inserted"] == 0
+    # La segona execució no arriba a escriure a news
+    assert len(db.news.bulk_writes) == 1
+    assert db.recorded_news == [3 * len(RSS_FEEDS)]
+
+
+def test_known_urls_are_skipped_before_selection(monkeypatch, feeds, db):
+    ingest(monkeypatch, feeds)
+    # Les fonts tornen a respondre 200 amb les mateixes URLs (sense validadors desats)
+    for doc in db.news_sources.docs.values():
+        doc.pop("etag")
+
+    summary = ingest(monkeypatch, feeds)
+
+    assert summary["fetched"] == summary["known"] == 3 * len(RSS_FEEDS)
+    assert summary["inserted"] == 0
+    assert len(db.news.bulk_writes) == 1
+
+
+def test_repeated_urls_are_upserted_once(db):
+    item = {"title": "Reus: notícia", "url": "https://example.com/a", "source": "Canal Reus"}
+    other = {**item, "url": "https://example.com/b"}
+
+    inserted, skipped = asyncio.run(news_scheduler.store_news_items([item, item, other]))
+
+    assert (inserted, skipped) == (2, 1)
+    assert len(db.news.bulk_writes) == 1
+    assert len(db.news.bulk_writes[0]) == 2
+    assert set(db.news.docs) == {item["url"], other["url"]}
+
+
+def test_concurrent_insert_is_rejected_by_the_unique_index(db):
+    items = [{"title": f"Reus: {i}", "url": f"https://example.com/{i}", "source": "Canal Reus"}
+             for i in range(3)]
+    db.news.concurrent_urls = {items[1]["url"]}
+
+    inserted, skipped = asyncio.run(news_scheduler.store_news_items(items))
+
+    assert (inserted, skipped) == (2, 1)
+    assert db.recorded_news == [2]
+
+
+def test_failed_store_keeps_previous_validators(monkeypatch, feeds, db):
+    db.news.fail_with = 121
+    with pytest.raises(BulkWriteError):
+        ingest(monkeypatch, feeds)
+
+    # Estat registrat però sense ETag: la propera execució torna a descarregar
+    assert all(doc["last_status"] == "ok" and "etag" not in doc for doc in db.news_sources.docs.values())
+
+    summary = ingest(monkeypatch, feeds)
+
+    assert {source["status"] for source in summary["sources"]} == {"ok"}
+    assert summary["inserted"] == 3 * len(RSS_FEEDS)
+
+
+def test_news_sources_stats(monkeypatch, feeds, db):
+    ingest(monkeypatch, feeds)
+    feeds.bump("canal_reus")
+    ingest(monkeypatch, feeds)
+
+    sources = db.news_sources.docs
+    assert set(sources) == set(RSS_FEEDS)
+    canal = sources["canal_reus"]
+    assert canal["runs"] == {"ok": 2}
+    assert canal["total_items"] == 6
+    assert canal["items"] == 3
+    assert canal["etag"]
+    other = sources["diari_mes_reus"]
+    assert other["runs"] == {"ok": 1, "not_modified": 1}
+    assert other["last_status"] == "not_modified"
+    assert other["total_items"] == 3
+    assert other["items"] == 0
+    assert other["name"] == RSS_FEEDS["diari_mes_reus"]["name"]
+    assert isinstance(other["latency_ms"], float)
@@ -0,0 +1,99 @@
+"""
+Safata de notificacions amb una base de dades en memòria (mongomock)
+Compartides eliminades: les que no caben a notification_states passen a
+notification_deletions i les anteriors que no s'han eliminat continuen visibles.
+"""
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from mongomock_motor import AsyncMongoMockClient
+
+import notification_inbox
+from notification_inbox import STATE_LIMIT
+
+
+@pytest.fixture
+def db(monkeypatch):
+    database = AsyncMongoMockClient()["test"]
+    monkeypatch.setattr(notification_inbox, "db", database)
+    return database
+
+
+def _user() -> dict:
+    return {"_id": ObjectId(), "role": "user", "created_at": datetime(2024, 1, 1)}
+
+
+async def _broadcasts(count: int, start: datetime) -> list:
+    """Compartides per a tothom, una per minut a partir de start (ids en el mateix ordre)"""
+    ids = []
+    for i in range(count):
+        created_at = start + timedelta(minutes=i)
+        job_id = ObjectId.from_datetime(created_at)
+        await notification_inbox.create_broadcast(job_id, f"Avís {i}", "Text", None, ["all"], created_at)
+        ids.append(job_id)
+    return ids
+
+
+async def _visible_shared(user: dict) -> list:
+    """Les compartides que veu l'usuari (el mateix filtre que la safata)"""
+    state = await notification_inbox._get_state(user["_id"])
+    pipeline = [
+        {"$match": notification_inbox._shared_match(user, state)},
+        *notification_inbox._without_old_deletions(user["_id"], state),
+    ]
+    return [doc["_id"] async for doc in notification_inbox.db.notification_broadcasts.aggregate(pipeline)]
+
+
+def test_deleting_more_than_state_limit_keeps_older_undeleted_visible(db):
+    user = _user()
+
+    async def main():
+        [kept] = await _broadcasts(1, datetime(2024, 2, 1))
+        deleted = await _broadcasts(STATE_LIMIT + 20, datetime(2024, 3, 1))
+        for notification_id in deleted:
+            assert await notification_inbox.delete_for_user(user, str(notification_id))
+        state = await notification_inbox._get_state(user["_id"])
+        return kept, deleted, state, await _visible_shared(user), await notification_inbox.unread_count(user)
+
+    kept, deleted, state, visible, unread = asyncio.run(main())
+
+    assert visible == [kept]
+    assert unread == 1
+    # Les més recents a la llista; la resta, a notification_deletions
+    assert state["deleted"] == deleted[-STATE_LIMIT:]
+    assert state["deleted_overflow"] is True
+    assert "deleted_before" not in state
+    stored = db.notification_deletions.find({"user_id": user["_id"]}, {"notification_id": 1})
+    assert sorted([doc["notification_id"] for doc in asyncio.run(stored.to_list(None))]) == deleted[:20]
+
+
+def test_deleting_again_is_idempotent(db):
+    user = _user()
+
+    async def main():
+        deleted = await _broadcasts(STATE_LIMIT + 1, datetime(2024, 3, 1))
+        for notification_id in deleted + deleted[:3]:
+            await notification_inbox.delete_for_user(user, str(notification_id))
+        return await _visible_shared(user), await db.notification_deletions.count_documents({})
+
+    visible, stored = asyncio.run(main())
+
+    assert visible == []
+    assert stored == 1
+
+
+def test_other_users_are_not_affected(db):
+    user, other = _user(), _user()
+
+    async def main():
+        ids = await _broadcasts(STATE_LIMIT + 5, datetime(2024, 3, 1))
+        for notification_id in ids:
+            await notification_inbox.delete_for_user(user, str(notification_id))
+        return ids, await _visible_shared(other), await notification_inbox.unread_count(other)
+
+    ids, visible, unread = asyncio.run(main())
+
+    assert sorted(visible) == ids
+    assert unread == len(ids)
@@ -0,0 +1,146 @@
+"""
+Enviament push contra el stub local d'Expo (expo_push_stub.py)
+Lots de 100, un tiquet per missatge (errors inclosos) i esborrat dels tokens
+DeviceNotRegistered, tant dels tiquets com dels rebuts.
+"""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from aiohttp.test_utils import TestServer
+
+import expo_push_stub
+import push_notifications
+
+
+class FakeUsers:
+    """Col·lecció users mínima: registra els tokens esborrats"""
+
+    def __init__(self):
+        self.pruned = []
+
+    async def update_many(self, query, update):
+        tokens = query["push_token"]["$in"]
+        self.pruned.extend(tokens)
+        return SimpleNamespace(modified_count=len(tokens))
+
+
+def _tokens(count: int, prefix: str = "ok") -> list:
+    return [f"ExponentPushToken[{prefix}-{i}]" for i in range(count)]
+
+
+@pytest.fixture
+def users(monkeypatch):
+    expo_push_stub.receipts.clear()
+    for key in expo_push_stub.stats:
+        expo_push_stub.stats[key] = 0
+    fake = FakeUsers()
+    monkeypatch.setattr(push_notifications, "db", SimpleNamespace(users=fake))
+    monkeypatch.setattr(push_notifications, "EXPO_RECEIPT_DELAY", 0)
+    return fake
+
+
+def run_with_stub(monkeypatch, scenario):
+    """Executar scenario(server) amb el stub escoltant i push_notifications apuntant-hi"""
+    async def main():
+        server = TestServer(expo_push_stub.create_app(latency=0))
+        await server.start_server()
+        monkeypatch.setattr(push_notifications, "EXPO_PUSH_URL", str(server.make_url("/--/api/v2/push/send")))
+        monkeypatch.setattr(push_notifications, "EXPO_RECEIPTS_URL",
+                            str(server.make_url("/--/api/v2/push/getReceipts")))
+        try:
+            return await scenario(server)
+        finally:
+            await push_notifications.close_push_client()
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_batches_of_100(monkeypatch, users):
+    tokens = _tokens(250)
+
+    async def scenario(server):
+        return await push_notifications.send_push_notification(tokens, "Títol", "Text")
+
+    result = run_with_stub(monkeypatch, scenario)
+
+    assert len(result["data"]) == 250
+    assert all(ticket["status"] == "ok" for ticket in result["data"])
+    assert expo_push_stub.stats["requests"] == 3
+    assert expo_push_stub.stats["max_batch"] == 100
+    assert expo_push_stub.stats["messages"] == 250
+
+
+def test_invalid_and_duplicate_tokens_are_not_sent(monkeypatch, users):
+    tokens = _tokens(2) + _tokens(2) + ["", "not-an-expo-token"]
+
+    async def scenario(server):
+        return await push_notifications.send_push_notification(tokens, "Títol", "Text")
+
+    result = run_with_stub(monkeypatch, scenario)
+
+    assert len(result["data"]) == 2
+    assert expo_push_stub.stats["messages"] == 2
+
+
+def test_ticket_errors_are_returned_per_message_and_pruned(monkeypatch, users):
+    invalid = _tokens(2, prefix="INVALID_TICKET")
+    tokens = _tokens(3) + invalid
+
+    async def scenario(server):
+        return await push_notifications.send_push_notification(tokens, "Títol", "Text")
+
+    result = run_with_stub(monkeypatch, scenario)
+
+    statuses = [ticket["status"] for ticket in result["data"]]
+    assert statuses == ["ok", "ok", "ok", "error", "error"]
+    assert result["data"][3]["details"]["error"] == "DeviceNotRegistered"
+    assert sorted(users.pruned) == sorted(invalid)
+
+
+def test_failed_batch_returns_an_error_ticket_per_message(monkeypatch, users):
+    async def scenario(server):
+        monkeypatch.setattr(push_notifications, "EXPO_PUSH_URL", str(server.make_url("/no-such-endpoint")))
+        return await push_notifications.send_push_notification(_tokens(3), "Títol", "Text")
+
+    result = run_with_stub(monkeypatch, scenario)
+
+    assert len(result["data"]) == 3
+    assert all(ticket["status"] == "error" for ticket in result["data"])
+    assert users.pruned == []
+
+
+def test_receipt_check_prunes_unregistered_devices(monkeypatch, users):
+    # Tiquet correcte però rebut DeviceNotRegistered
+    unregistered = _tokens(2, prefix="INVALID")
+    tokens = _tokens(3) + unregistered
+
+    async def scenario(server):
+        result = await push_notifications.send_push_notification(tokens, "Títol", "Text")
+        # EXPO_RECEIPT_DELAY = 0: la consulta de rebuts programada s'executa de seguida
+        await asyncio.gather(*push_notifications._pending_tasks)
+        return result
+
+    result = run_with_stub(monkeypatch, scenario)
+
+    assert all(ticket["status"] == "ok" for ticket in result["data"])
+    assert expo_push_stub.stats["receipt_requests"] == 1
+    assert sorted(users.pruned) == sorted(unregistered)
+    assert expo_push_stub.receipts == {}
+
+
+def test_check_receipts_summary(monkeypatch, users):
+    tokens = _tokens(2) + _tokens(1, prefix="INVALID")
+
+    async def scenario(server):
+        monkeypatch.setattr(push_notifications, "db", None)  # Sense rebuts programats
+        result = await push_notifications.send_push_notification(tokens, "Títol", "Text")
+        monkeypatch.setattr(push_notifications, "db", SimpleNamespace(users=users))
+        receipt_tokens = {ticket["id"]: token for ticket, token in zip(result["data"], tokens)}
+        return await push_notifications.check_receipts(receipt_tokens)
+
+    summary = run_with_stub(monkeypatch, scenario)
+
+    assert summary == {"ok": 2, "errors": 1, "pruned": 1}
+    assert users.pruned == tokens[2:]